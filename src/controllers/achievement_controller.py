@@ -1,126 +1,256 @@
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required  # To enforce user authentication
-from init import db  # Import the database instance
-from models.achievement import Achievement, achievement_schema, achievements_schema  # Import Achievement model and schemas
-
-# Create a Blueprint for achievement-related routes
-achievement_controller = Blueprint("achievement_controller", __name__)
-
-@achievement_controller.route("/achievements", methods=["POST"])
-@jwt_required()  # Ensure the user is authenticated to create an achievement
-def create_achievement():
-    
-    # Create a new achievement.
-
-    # Expects:
-    #     - JSON payload with 'name', 'description', 'user_id', and 'game_id'.
-    
-    # Returns:
-    #     - JSON representation of the newly created achievement.
-    
-    body = request.json  # Get JSON payload from the request
-
-    # Create a new achievement instance
-    new_achievement = Achievement(
-        name=body.get("name"),  # Name of the achievement
-        description=body.get("description"),  # Description of what the achievement represents
-        user_id=body.get("user_id"),  # User who achieved this
-        game_id=body.get("game_id")  # Game where this achievement can be earned
-    )
-
-    # Add the new achievement to the database and commit the changes
-    db.session.add(new_achievement)
-    db.session.commit()
-
-    return achievement_schema.jsonify(new_achievement), 201  # Return the created achievement with a 201 status
-
-
-@achievement_controller.route("/achievements", methods=["GET"])
-def get_achievements():
-   
-    # Retrieve all achievements.
-
-    # Returns:
-    #     - JSON list of all achievements in the database.
-    
-    achievements = Achievement.query.all()  # Retrieve all achievements from the database
-    return achievements_schema.jsonify(achievements)  # Return the list of achievements
-
-
-@achievement_controller.route("/achievements/<int:id>", methods=["GET"])
-def get_achievement(id):
-    
-    # Retrieve a specific achievement by ID.
-
-    # Arguments:
-    #     - id: The ID of the achievement to retrieve.
-
-    # Returns:
-    #     - JSON representation of the achievement if found.
-    #     - Error message if the achievement is not found.
-   
-    achievement = Achievement.query.get(id)  # Retrieve achievement by ID
-
-    if not achievement:
-        return {"message": "Achievement not found"}, 404  # Return error if not found
-
-    return achievement_schema.jsonify(achievement)  # Return the found achievement
-
-
-@achievement_controller.route("/achievements/<int:id>", methods=["PUT", "PATCH"])
-@jwt_required()  # Ensure the user is authenticated to update an achievement
-def update_achievement(id):
-    
-    # Update an existing achievement's information.
-
-    # Arguments:
-    #     - id: The ID of the achievement to update.
-
-    # Expects:
-    #     - JSON payload with fields to update, such as 'name' or 'description'.
-
-    # Returns:
-    #     - JSON representation of the updated achievement if successful.
-    #     - Error message if the achievement is not found.
-    
-    achievement = Achievement.query.get(id)  # Retrieve the achievement by ID
-
-    if not achievement:
-        return {"message": "Achievement not found"}, 404  # Return error if not found
-
-    body = request.json  # Get JSON payload for updates
-
-    # Update fields as necessary
-    if "name" in body:
-        achievement.name = body["name"]
-    if "description" in body:
-        achievement.description = body["description"]
-
-    # Commit changes to the database
-    db.session.commit()
-
-    return achievement_schema.jsonify(achievement)  # Return the updated achievement
-
-
-@achievement_controller.route("/achievements/<int:id>", methods=["DELETE"])
-@jwt_required()  # Ensure the user is authenticated to delete an achievement
-def delete_achievement(id):
-    
-    # Delete an achievement by its ID.
-
-    # Arguments:
-    #     - id: The ID of the achievement to delete.
-
-    # Returns:
-    #     - Success message if deleted, or error message if not found.
-   
-    achievement = Achievement.query.get(id)  # Retrieve the achievement by ID
-
-    if not achievement:
-        return {"message": "Achievement not found"}, 404  # Return error if not found
-
-    # Delete the achievement from the database
-    db.session.delete(achievement)
-    db.session.commit()
-
-    return {"message": "Achievement deleted successfully"}, 200  # Return success message
\ No newline at end of file
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required, get_jwt_identity  # To enforce user authentication
+from init import db  # Import the database instance
+from sqlalchemy.exc import IntegrityError
+from models.achievement import Achievement, achievement_schema, achievements_schema, achievement_detail_options  # Import Achievement model, schemas and loader options
+from models.achievement_definition import (  # Import AchievementDefinition model and schemas
+    AchievementDefinition,
+    achievement_definition_schema,
+    achievement_definitions_schema,
+)
+from models.game import Game  # Import Game model to validate game ID
+from models.user import User  # Import User model to validate user ID
+from services import outbox  # Domain events, which also refresh every worker's caches
+from services.idempotency import idempotent, remember  # Safe retries with an Idempotency-Key header
+from services import jobs  # Background job queue
+from services.concurrency import with_etag  # Optimistic concurrency
+from services.writes import insert_returning, update_returning, violation, missing, UNIQUE, FOREIGN_KEY, NOT_NULL  # Single-statement writes
+from services.multi_get import requested_ids, get_many  # ?ids= multi-get
+from services import repository  # Data access in SQLAlchemy 2.0 style
+
+# Create a Blueprint for achievement-related routes
+achievement_controller = Blueprint("achievement_controller", __name__)
+
+@achievement_controller.route("/achievements", methods=["POST"])
+@jwt_required()  # Ensure the user is authenticated to create an achievement
+@idempotent  # Retries with the same Idempotency-Key replay the original response
+def create_achievement():
+    
+    # Create a new achievement.
+
+    # Expects:
+    #     - JSON payload with 'name', 'description', 'user_id', and 'game_id'.
+    
+    # Returns:
+    #     - JSON representation of the newly created achievement.
+    #     - Error message if the user or game does not exist, or the user already has it.
+    
+    body = request.json  # Get JSON payload from the request
+
+    # Insert the new achievement in one statement, which returns the stored row. The user
+    # and game foreign keys, and the unique name per user and game, are checked by the database
+    values = {
+        "name": body.get("name"),  # Name of the achievement
+        "description": body.get("description"),  # Description of what the achievement represents
+        "user_id": body.get("user_id"),  # User who achieved this
+        "game_id": body.get("game_id"),  # Game where this achievement can be earned
+    }
+    try:
+        new_achievement = insert_returning(Achievement, **values)
+    except IntegrityError as error:
+        kind = violation(error)
+        model = missing((User, values["user_id"]), (Game, values["game_id"])) if kind in (FOREIGN_KEY, NOT_NULL) else None
+        if model is not None:
+            return {"message": f"{model.__name__} not found"}, 404
+        if kind == UNIQUE:
+            return {"message": "Achievement already exists"}, 400
+        raise
+
+    # Serialise before committing, so the response does not re-read the row and is
+    # committed with it for retries
+    response = remember(with_etag(achievement_schema.jsonify(new_achievement), new_achievement, 201))
+    outbox.record("achievement.created", new_achievement.id, user_id=new_achievement.user_id, game_id=new_achievement.game_id)
+    db.session.commit()
+
+    return response  # Return the created achievement with a 201 status
+
+
+@achievement_controller.route("/achievements", methods=["GET"])
+def get_achievements():
+   
+    # Retrieve all achievements, or several achievements by ID.
+
+    # Query parameters:
+    #     - ids: Optional comma separated achievement IDs (at most 100), fetched in one query.
+
+    # Returns:
+    #     - JSON list of all achievements in the database, or of the requested achievements that exist.
+    
+    ids = requested_ids()
+    if ids is not None:
+        achievements = get_many(Achievement, ids, options=achievement_detail_options())  # Retrieve the requested achievements in one IN query
+    else:
+        achievements = repository.list_all(Achievement, *achievement_detail_options())  # Retrieve all achievements from the database
+    return achievements_schema.jsonify(achievements)  # Return the list of achievements
+
+
+@achievement_controller.route("/achievements/<int:id>", methods=["GET"])
+def get_achievement(id):
+    
+    # Retrieve a specific achievement by ID.
+
+    # Arguments:
+    #     - id: The ID of the achievement to retrieve.
+
+    # Returns:
+    #     - JSON representation of the achievement if found.
+    #     - Error message if the achievement is not found.
+   
+    achievement = repository.get(Achievement, id)  # Retrieve achievement by ID
+
+    if not achievement:
+        return {"message": "Achievement not found"}, 404  # Return error if not found
+
+    return with_etag(achievement_schema.jsonify(achievement), achievement)  # Return the found achievement with its ETag
+
+
+@achievement_controller.route("/achievements/<int:id>", methods=["PUT", "PATCH"])
+@jwt_required()  # Ensure the user is authenticated to update an achievement
+def update_achievement(id):
+    
+    # Update an existing achievement's information.
+
+    # Arguments:
+    #     - id: The ID of the achievement to update.
+
+    # Expects:
+    #     - JSON payload with fields to update, such as 'name' or 'description'.
+    #     - If-Match header with the ETag from the last read.
+
+    # Returns:
+    #     - JSON representation of the updated achievement if successful.
+    #     - Error message if the achievement is not found.
+    #     - 428 if If-Match is missing, 412 if the achievement was changed since it was read.
+    
+    body = request.json  # Get JSON payload for updates
+
+    # Update the fields provided, in one statement that only matches the version the
+    # client last read (its If-Match ETag) and returns the updated row
+    values = {field: body[field] for field in ("name", "description") if field in body}
+    try:
+        achievement, error = update_returning(Achievement, id, **values)
+    except IntegrityError as error:
+        if violation(error) == UNIQUE:
+            return {"message": "Achievement already exists"}, 400
+        raise
+    if error:
+        return error
+    if not achievement:
+        return {"message": "Achievement not found"}, 404  # Return error if not found
+
+    # Serialise before committing, so the response does not re-read the row
+    response = with_etag(achievement_schema.jsonify(achievement), achievement)
+    outbox.record("achievement.updated", id, user_id=achievement.user_id, game_id=achievement.game_id)
+    db.session.commit()
+
+    return response  # Return the updated achievement
+
+
+@achievement_controller.route("/achievements/<int:id>", methods=["DELETE"])
+@jwt_required()  # Ensure the user is authenticated to delete an achievement
+def delete_achievement(id):
+    
+    # Delete an achievement by its ID.
+
+    # Arguments:
+    #     - id: The ID of the achievement to delete.
+
+    # Returns:
+    #     - Success message if deleted, or error message if not found.
+   
+    achievement = repository.get(Achievement, id)  # Retrieve the achievement by ID
+
+    if not achievement:
+        return {"message": "Achievement not found"}, 404  # Return error if not found
+
+    # Delete the achievement from the database
+    db.session.delete(achievement)
+    outbox.record("achievement.deleted", id, user_id=achievement.user_id, game_id=achievement.game_id)
+    db.session.commit()
+
+    return {"message": "Achievement deleted successfully"}, 200  # Return success message
+
+
+@achievement_controller.route("/games/<int:game_id>/achievement-definitions", methods=["POST"])
+@jwt_required()  # Ensure the user is authenticated to define an achievement
+def create_achievement_definition(game_id):
+
+    # Define an achievement that players unlock automatically.
+
+    # Arguments:
+    #     - game_id: The ID of the game the achievement belongs to.
+
+    # Expects:
+    #     - JSON payload with 'name', 'description', 'rule' and 'threshold'.
+    #       'rule' is one of 'score_threshold', 'session_count' or 'play_time' (seconds).
+
+    # Returns:
+    #     - JSON representation of the newly created definition. Players who already meet
+    #       it are awarded it shortly after, by a background job.
+    #     - Error message if the game does not exist or the name is already used.
+
+    body = achievement_definition_schema.load(request.json)  # Validate the definition
+
+    # Insert the definition in one statement, which returns the stored row; the game
+    # foreign key and the unique name per game are checked by the database
+    try:
+        new_definition = insert_returning(AchievementDefinition, game_id=game_id, **body)
+    except IntegrityError as error:
+        kind = violation(error)
+        if kind == FOREIGN_KEY:
+            return {"message": "Game not found"}, 404
+        if kind == UNIQUE:
+            return {"message": "Achievement definition already exists"}, 400
+        raise
+
+    # Queue a job to award it to players who already meet it, which can touch many rows,
+    # in the same transaction, and serialise before committing so the row is not re-read
+    jobs.enqueue("award_achievement", requested_by=get_jwt_identity(), definition_id=new_definition.id)
+    outbox.record("achievement_definition.created", new_definition.id, game_id=game_id)  # Every worker picks up the new rule
+    response = achievement_definition_schema.jsonify(new_definition)
+    db.session.commit()
+
+    return response, 201
+
+
+@achievement_controller.route("/games/<int:game_id>/achievement-definitions", methods=["GET"])
+def get_achievement_definitions(game_id):
+
+    # Retrieve the achievements that can be unlocked in a game.
+
+    # Arguments:
+    #     - game_id: The ID of the game.
+
+    # Returns:
+    #     - JSON list of the game's achievement definitions.
+
+    definitions = repository.list_by(AchievementDefinition.game_id, game_id)
+    return achievement_definitions_schema.jsonify(definitions)
+
+
+@achievement_controller.route("/achievement-definitions/<int:id>", methods=["DELETE"])
+@jwt_required()  # Ensure the user is authenticated to delete a definition
+def delete_achievement_definition(id):
+
+    # Delete an achievement definition by its ID.
+    # Achievements already unlocked from it are kept.
+
+    # Arguments:
+    #     - id: The ID of the definition to delete.
+
+    # Returns:
+    #     - Success message if deleted, or error message if not found.
+
+    definition = repository.get(AchievementDefinition, id)  # Retrieve the definition by ID
+
+    if not definition:
+        return {"message": "Achievement definition not found"}, 404
+
+    game_id = definition.game_id
+
+    # Delete the definition; the database detaches unlocked achievements (ON DELETE SET NULL)
+    db.session.delete(definition)
+    outbox.record("achievement_definition.deleted", id, game_id=game_id)  # Every worker stops evaluating the rule
+    db.session.commit()
+
+    return {"message": "Achievement definition deleted successfully"}, 200
@@ -0,0 +1,78 @@
+from flask import Blueprint, request, current_app
+from werkzeug.test import EnvironBuilder
+from init import db  # Import the database instance
+
+# Create a Blueprint for the batch route
+batch_controller = Blueprint("batch_controller", __name__)
+
+# Most sub-requests one batch can contain
+MAX_BATCH_REQUESTS = 20
+
+# Request headers passed on to every sub-request, and response headers passed back
+FORWARDED_HEADERS = ("Authorization",)
+RETURNED_HEADERS = ("ETag", "Location", "Retry-After", "Idempotent-Replayed", "X-Request-ID")
+
+
+def _run(sub_request):
+
+    # Run one sub-request through the app and return its result.
+    # The sub-request gets its own request context, so it goes through the same routing,
+    # JWT checks, admission control and error handlers as a normal request, but it shares
+    # the batch's app context, so every sub-request uses the same database session.
+
+    headers = {name: request.headers[name] for name in FORWARDED_HEADERS if name in request.headers}
+    headers.update(sub_request.get("headers") or {})
+    builder = EnvironBuilder(
+        path=sub_request["path"],
+        method=sub_request.get("method", "GET").upper(),
+        json=sub_request.get("body"),
+        headers=headers,
+        environ_base={"REMOTE_ADDR": request.remote_addr},
+    )
+    with current_app.request_context(builder.get_environ()):
+        try:
+            response = current_app.full_dispatch_request()
+        except Exception:
+            # An unhandled error fails only its own sub-request; its half-done work is
+            # rolled back so the next sub-request starts from a clean session
+            db.session.rollback()
+            current_app.logger.exception("Batch sub-request %s %s failed", builder.method, builder.path)
+            return {"status": 500, "body": {"message": "Internal server error"}}
+
+    result = {"status": response.status_code, "body": response.get_json(silent=True)}
+    if result["body"] is None and response.data:
+        result["body"] = response.get_data(as_text=True)
+    returned = {name: response.headers[name] for name in RETURNED_HEADERS if name in response.headers}
+    if returned:
+        result["headers"] = returned
+    return result
+
+
+@batch_controller.route("/batch", methods=["POST"])
+def batch():
+
+    # Run several API requests in one round trip, e.g. everything a page needs on load.
+
+    # Expects:
+    #     - JSON payload with 'requests': a list (at most 20) of objects with
+    #       'path' (including any query string), and optional 'method' (default GET),
+    #       'body' (JSON) and 'headers'. The batch's Authorization header is used for
+    #       every sub-request.
+
+    # Returns:
+    #     - JSON with 'responses': one object per sub-request, in order, with its
+    #       'status', 'body' and any ETag, Location, Retry-After or Idempotent-Replayed
+    #       'headers'. Sub-requests run one after the other, so later ones see earlier
+    #       writes, and a failed sub-request does not stop the rest.
+    #     - Error message if the batch itself is invalid.
+
+    sub_requests = (request.get_json(silent=True) or {}).get("requests")
+    if not isinstance(sub_requests, list) or not 1 <= len(sub_requests) <= MAX_BATCH_REQUESTS:
+        return {"message": f"requests must be a list of 1 to {MAX_BATCH_REQUESTS} requests"}, 400
+    for sub_request in sub_requests:
+        if not isinstance(sub_request, dict) or not str(sub_request.get("path", "")).startswith("/"):
+            return {"message": "Every request needs a path starting with /"}, 400
+        if sub_request["path"].split("?")[0].rstrip("/") == "/batch":
+            return {"message": "Batches cannot contain batches"}, 400
+
+    return {"responses": [_run(sub_request) for sub_request in sub_requests]}
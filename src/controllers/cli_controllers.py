@@ -1,112 +1,409 @@
-from flask import Blueprint  # Import Blueprint for grouping related functions
-from init import db, bcrypt  # Import the database instance for SQLAlchemy and Bcrypt for password hashing
-
-from models.user import User  # Import User model for creating demo users
-from models.game import Game  # Import Game model for demo data
-from models.genre import Genre  # Import Genre model for demo data
-from models.developer import Developer  # Import Developer model for demo data
-
-# Create a Blueprint for the database commands
-db_commands = Blueprint("db_commands", __name__)
-
-@db_commands.cli.command("create")
-def create_db():
-    
-    # Create a new database. This involves creating all the tables that are
-    # defined in the models. This is a one-time operation and should be run
-    # only once, ideally when the application is first set up.
-    
-    db.create_all()  # This creates all tables defined by your SQLAlchemy models
-    print("Database created")
-
-@db_commands.cli.command("drop")
-def drop_db():
-    
-    # Drop all tables in the database.
-
-    # This command is used to delete all of the tables in the database.
-    # This is the opposite of the 'create' command, which creates the tables
-    # in the first place.
-    
-    # This command is useful for starting over from scratch or for clearing
-    # out old data that is no longer needed.
-    
-    db.drop_all()  # Call the `drop_all` method on the database
-    print("Database dropped")  # Print a message letting the user know what happened
-
-@db_commands.cli.command("seed")
-def seed_db():
-    
-    # Populate the database with initial data. This is useful for setting up the database
-    # for the first time or for filling it with some sample data for testing purposes.
-    
-    
-    # Create initial genres for the game database
-    genres = [
-        Genre(name="Action"),
-        Genre(name="Adventure"),
-        Genre(name="RPG"),
-        Genre(name="Strategy")
-    ]
-    
-    # Add genres to the session and commit
-    db.session.add_all(genres)
-    db.session.commit()  # Commit to save the genres
-    print("Genres added to the database")
-
-    # Create initial developers
-    developers = [
-        Developer(name="Epic Games"),
-        Developer(name="Blizzard Entertainment"),
-        Developer(name="Ubisoft")
-    ]
-    
-    # Add developers to the session and commit
-    db.session.add_all(developers)
-    db.session.commit()  # Commit to save the developers
-    print("Developers added to the database")
-
-    # Create some demo games associated with the created developers and genres
-    games = [
-        Game(
-            title="Fortnite",
-            genre_id=genres[0].id,  # Associate with Action genre
-            developer_id=developers[0].id  # Associate with Epic Games
-        ),
-        Game(
-            title="Overwatch",
-            genre_id=genres[1].id,  # Associate with Adventure genre
-            developer_id=developers[1].id  # Associate with Blizzard Entertainment
-        ),
-        Game(
-            title="Assassin's Creed",
-            genre_id=genres[2].id,  # Associate with RPG genre
-            developer_id=developers[2].id  # Associate with Ubisoft
-        )
-    ]
-
-    # Add games to the session and commit
-    db.session.add_all(games)
-    db.session.commit()  # Commit to save the games
-    print("Games added to the database")
-
-    # Create initial users, demonstrating the use of hashing
-    users = [
-        User(
-            name="Admin User",
-            email="admin@example.com",
-            password=bcrypt.generate_password_hash("admin123").decode("utf-8")  # Hash the password
-        ),
-        User(
-            name="Player One",
-            email="player1@example.com",
-            password=bcrypt.generate_password_hash("player123").decode("utf-8")  # Hash the password
-        )
-    ]
-
-    # Add users to the session and commit
-    db.session.add_all(users)
-    db.session.commit()  # Commit to save the users
-    print("Users added to the database")
-
-    print("Database seeding completed")  # Print a message indicating seeding was successful
\ No newline at end of file
+import os
+import click
+from flask import Blueprint, current_app  # Import Blueprint for grouping related functions
+from init import db, bcrypt  # Import the database instance for SQLAlchemy and Bcrypt for password hashing
+
+from models.user import User  # Import User model for creating demo users
+from models.game import Game  # Import Game model for demo data
+from models.genre import Genre  # Import Genre model for demo data
+from models.developer import Developer  # Import Developer model for demo data
+from services.catalogue_import import import_catalogue, read_rows, CatalogueImportError, DEFAULT_CHUNK_SIZE
+from services.idempotency import purge_expired
+from services import playtime
+from services.sharding import shards
+from services import jobs
+from services import outbox
+from services import ratings
+from services import active_players
+from services import concurrency_series
+from services import recommendations
+from services import anomalies
+from services import query_budget
+from services import snapshot
+from services import serving
+from services import sync
+from services.repository import query_stats, cache_hit_rate
+
+# Create a Blueprint for the database commands
+db_commands = Blueprint("db_commands", __name__)
+
+# Create a Blueprint for top-level commands, such as `flask worker`
+worker_commands = Blueprint("worker_commands", __name__, cli_group=None)
+
+@db_commands.cli.command("create")
+def create_db():
+    
+    # Create a new database. This involves creating all the tables that are
+    # defined in the models. This is a one-time operation and should be run
+    # only once, ideally when the application is first set up.
+    
+    db.create_all()  # This creates all tables defined by your SQLAlchemy models
+    shards.create_all()  # And the score and session tables on each shard, if sharding is configured
+    print("Database created")
+
+@db_commands.cli.command("drop")
+def drop_db():
+    
+    # Drop all tables in the database.
+
+    # This command is used to delete all of the tables in the database.
+    # This is the opposite of the 'create' command, which creates the tables
+    # in the first place.
+    
+    # This command is useful for starting over from scratch or for clearing
+    # out old data that is no longer needed.
+    
+    db.drop_all()  # Call the `drop_all` method on the database
+    shards.drop_all()  # Drop the score and session tables on each shard too
+    print("Database dropped")  # Print a message letting the user know what happened
+
+@db_commands.cli.command("seed")
+def seed_db():
+    
+    # Populate the database with initial data. This is useful for setting up the database
+    # for the first time or for filling it with some sample data for testing purposes.
+    
+    
+    # Create initial genres for the game database
+    genres = [
+        Genre(name="Action"),
+        Genre(name="Adventure"),
+        Genre(name="RPG"),
+        Genre(name="Strategy")
+    ]
+    
+    # Add genres to the session and commit
+    db.session.add_all(genres)
+    db.session.commit()  # Commit to save the genres
+    print("Genres added to the database")
+
+    # Create initial developers
+    developers = [
+        Developer(name="Epic Games"),
+        Developer(name="Blizzard Entertainment"),
+        Developer(name="Ubisoft")
+    ]
+    
+    # Add developers to the session and commit
+    db.session.add_all(developers)
+    db.session.commit()  # Commit to save the developers
+    print("Developers added to the database")
+
+    # Create some demo games associated with the created developers and genres
+    games = [
+        Game(
+            title="Fortnite",
+            genre_id=genres[0].id,  # Associate with Action genre
+            developer_id=developers[0].id  # Associate with Epic Games
+        ),
+        Game(
+            title="Overwatch",
+            genre_id=genres[1].id,  # Associate with Adventure genre
+            developer_id=developers[1].id  # Associate with Blizzard Entertainment
+        ),
+        Game(
+            title="Assassin's Creed",
+            genre_id=genres[2].id,  # Associate with RPG genre
+            developer_id=developers[2].id  # Associate with Ubisoft
+        )
+    ]
+
+    # Add games to the session and commit
+    db.session.add_all(games)
+    db.session.commit()  # Commit to save the games
+    print("Games added to the database")
+
+    # Create initial users, demonstrating the use of hashing
+    users = [
+        User(
+            name="Admin User",
+            email="admin@example.com",
+            password=bcrypt.generate_password_hash("admin123").decode("utf-8")  # Hash the password
+        ),
+        User(
+            name="Player One",
+            email="player1@example.com",
+            password=bcrypt.generate_password_hash("player123").decode("utf-8")  # Hash the password
+        )
+    ]
+
+    # Add users to the session and commit
+    db.session.add_all(users)
+    db.session.commit()  # Commit to save the users
+    print("Users added to the database")
+
+    print("Database seeding completed")  # Print a message indicating seeding was successful
+
+@db_commands.cli.command("import-games")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "json"]), help="File format, taken from the extension by default")
+@click.option("--chunk-size", default=DEFAULT_CHUNK_SIZE, show_default=True, help="Games written per batch")
+def import_games(path, fmt, chunk_size):
+
+    # Bulk import a catalogue of games from a CSV or JSON file.
+    # Each row needs a 'title', 'genre' and 'developer' (names, not IDs). Missing genres
+    # and developers are created, and games are upserted by title, so the same file
+    # can be imported again safely.
+
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    with open(path, encoding="utf-8") as file:
+        try:
+            rows = read_rows(file.read(), fmt)
+            summary = import_catalogue(rows, chunk_size)
+        except CatalogueImportError as error:
+            raise click.ClickException(str(error))
+
+    print(f"Imported {summary['games']} games from {summary['rows']} rows")
+    print(f"Created {summary['genres_created']} genres and {summary['developers_created']} developers")
+    for error in summary["errors"]:
+        print(f"Row {error['row']}: {error['message']}")
+    if summary["error_count"] > len(summary["errors"]):
+        print(f"... and {summary['error_count'] - len(summary['errors'])} more rejected rows")
+
+@db_commands.cli.command("purge-idempotency-keys")
+def purge_idempotency_keys():
+
+    # Delete expired Idempotency-Key records from the shared table.
+    # Expired records are ignored anyway, so this only reclaims space; run it periodically.
+
+    removed = purge_expired()
+    print(f"Removed {removed} expired idempotency records")
+
+@db_commands.cli.command("rebuild-playtime")
+@click.option("--user-id", type=int, help="Only rebuild this user's rollups")
+def rebuild_playtime(user_id):
+
+    # Recompute the daily playtime rollups from the sessions table.
+    # Rollups are kept up to date as sessions end; this backfills sessions recorded
+    # before rollups existed, or repairs them after sessions were changed by hand.
+
+    count = playtime.rebuild(user_id)
+    print(f"Rebuilt playtime rollups from {count} sessions")
+
+@db_commands.cli.command("rebuild-ratings")
+@click.option("--game-id", type=int, help="Only rebuild this game's ratings")
+@click.option("--batch-size", default=ratings.DEFAULT_BATCH_SIZE, show_default=True, help="Scores read at a time")
+def rebuild_ratings(game_id, batch_size):
+
+    # Recompute skill ratings from the full score history, e.g. after a backfill or a change
+    # to the rating formula. Best run while scores are not being submitted.
+
+    count = ratings.rebuild(game_id, batch_size)
+    print(f"Rebuilt ratings from {count} scores")
+
+@db_commands.cli.command("rebuild-score-baselines")
+@click.option("--batch-size", default=anomalies.DEFAULT_BATCH_SIZE, show_default=True, help="Scores read at a time")
+def rebuild_score_baselines(batch_size):
+
+    # Recompute the statistics the score anomaly detector checks against from the accepted
+    # scores, e.g. when turning the detector on for an existing database. Every worker
+    # reloads them once the rebuild is committed.
+
+    count = anomalies.rebuild(batch_size)
+    print(f"Rebuilt score baselines from {count} scores")
+
+@db_commands.cli.command("rebuild-active-players")
+@click.option("--game-id", type=int, help="Only rebuild this game's sketches")
+def rebuild_active_players(game_id):
+
+    # Recompute the daily active player sketches from the sessions table.
+    # Sketches are kept up to date as sessions are created; this backfills sessions
+    # recorded before sketches existed.
+
+    count = active_players.rebuild(game_id)
+    print(f"Rebuilt active player sketches from {count} sessions")
+
+@db_commands.cli.command("rebuild-concurrency")
+@click.option("--game-id", type=int, help="Only rebuild this game's series")
+def rebuild_concurrency(game_id):
+
+    # Recompute the players online time series from the sessions table, e.g. to backfill
+    # sessions recorded before the series existed. Best run while sessions are quiet.
+
+    count = concurrency_series.rebuild(game_id)
+    print(f"Rebuilt players online series from {count} sessions")
+
+@db_commands.cli.command("rollup-concurrency")
+def rollup_concurrency():
+
+    # Fold recent session changes into the minute data, downsample minute data past its
+    # retention into hourly and daily data, and remove hourly data past its retention.
+    # Run it every few minutes, e.g. from cron, so queries have few changes to add up.
+
+    rolled, removed = concurrency_series.rollup()
+    print(f"Rolled up {rolled} days of minute data and removed {removed} old hour blocks")
+
+@db_commands.cli.command("refresh-similar-games")
+@click.option("--full", is_flag=True, help="Recompute every game, not only games played since the last refresh")
+@click.option("--background", is_flag=True, help="Queue the refresh for a worker instead of running it here")
+def refresh_similar_games(full, background):
+
+    # Recompute the "players also played" lists from the sessions table. Run it regularly,
+    # e.g. hourly from cron; an occasional --full refresh also refills lists that lost
+    # entries between full refreshes.
+
+    if background:
+        job = jobs.enqueue("similar_games", full=full)
+        db.session.commit()
+        print(f"Queued similar games refresh as job {job.id}")
+        return
+    count = recommendations.refresh(full)
+    print(f"Refreshed similar games for {count} games")
+
+@db_commands.cli.command("check-query-plans")
+@click.option("--baseline", "baseline_path", default=query_budget.DEFAULT_BASELINE_PATH, show_default=True, help="Budgets file")
+@click.option("--update", is_flag=True, help="Write the measurements as the new budgets instead of checking them")
+@click.option("--seed/--no-seed", default=True, show_default=True, help="Seed the empty database first")
+@click.option("--scale", type=float, help="Size of the seeded data, the baseline's scale by default")
+def check_query_plans(baseline_path, update, seed, scale):
+
+    # Call every GET route against a seeded database, EXPLAIN each statement it runs, and
+    # compare with the per-endpoint budgets in query_budgets.json: the number of statements,
+    # the most times one statement repeats (N+1 queries), sequential scans of scores and
+    # sessions, and the planner cost (PostgreSQL only). Exits with an error when an
+    # endpoint is over budget, so it can run in CI against a fresh database:
+    #     flask db_commands create && flask db_commands check-query-plans
+
+    baseline = query_budget.load_baseline(baseline_path)
+    scale = scale if scale is not None else baseline.get("scale", 1.0)
+    if seed:
+        try:
+            sizes = query_budget.seed(scale)
+        except RuntimeError as error:
+            raise click.ClickException(str(error))
+        print("Seeded " + ", ".join(f"{count} {name}" for name, count in sizes.items()))
+
+    query_stats.reset()
+    results = query_budget.measure(current_app._get_current_object())
+    for endpoint, result in sorted(results.items()):
+        if result["path"] is None:
+            print(f"skip  {endpoint}: {result['skipped']}")
+            continue
+        cost = f"{result['cost']:.0f}" if result["cost"] is not None else "-"
+        print(
+            f"{result['status']}   {endpoint} {result['path']}: {result['statements']} statements, "
+            f"{result['max_repeats']} max repeats, cost {cost}, seq scans {', '.join(result['seq_scans']) or 'none'}, "
+            f"cache misses {result['cache_misses']}"
+        )
+
+    # Compiled-statement cache over both calls of every route, per repository query
+    figures = query_stats.snapshot()
+    print("Repository queries (calls, mean ms, cache hits/misses):")
+    for name, entry in sorted(figures.items()):
+        mean = f"{entry['total_ms'] / entry['calls']:.3f}" if entry["calls"] else "-"
+        print(f"  {name}: {entry['calls']} calls, {mean} ms, {entry['cache_hits']}/{entry['cache_misses']}")
+    overall = cache_hit_rate(figures)
+    if overall is not None:
+        warm_hits = sum(result.get("cache_hits", 0) for result in results.values())
+        warm_misses = sum(result.get("cache_misses", 0) for result in results.values())
+        warm = warm_hits / (warm_hits + warm_misses) if warm_hits + warm_misses else 1.0
+        print(f"Statement cache hit rate: {overall:.1%} overall, {warm:.1%} on warm routes ({warm_misses} misses)")
+
+    if update:
+        query_budget.update_baseline(results, baseline, scale, baseline_path)
+        print(f"Wrote budgets to {baseline_path}")
+        return
+    problems = query_budget.check(results, baseline)
+    for endpoint, problem in problems:
+        print(f"FAIL  {endpoint} {problem}")
+    if problems:
+        raise click.ClickException(f"{len(problems)} query budget problems")
+    print("All endpoints within their query budgets")
+
+@db_commands.cli.group("snapshot")
+def snapshot_commands():
+
+    # Export the dataset to Parquet files, or import such a snapshot into an empty database:
+    #     flask db_commands snapshot export /backups/2026-10-19
+    #     flask db_commands create && flask db_commands snapshot import /backups/2026-10-19
+
+    pass
+
+@snapshot_commands.command("export")
+@click.argument("directory")
+@click.option("--workers", default=snapshot.DEFAULT_WORKERS, show_default=True, help="Files written at once")
+@click.option("--chunk-rows", default=snapshot.DEFAULT_CHUNK_ROWS, show_default=True, help="IDs per file")
+@click.option("--compression", type=click.Choice(snapshot.COMPRESSIONS), default="zstd", show_default=True)
+def export_snapshot(directory, workers, chunk_rows, compression):
+
+    # Write users, games, genres, developers, scores, sessions, achievements and achievement
+    # definitions and progress to Parquet files in a new or empty directory, several
+    # ranges of IDs at a time.
+
+    try:
+        counts = snapshot.export(directory, workers, chunk_rows, compression)
+    except snapshot.SnapshotError as error:
+        raise click.ClickException(str(error))
+    print("Exported " + ", ".join(f"{rows} {table}" for table, rows in counts.items()))
+
+@snapshot_commands.command("import")
+@click.argument("directory")
+@click.option("--workers", default=snapshot.DEFAULT_WORKERS, show_default=True, help="Files loaded at once")
+def import_snapshot(directory, workers):
+
+    # Load a snapshot into an empty database with COPY, rebuild the indexes once the rows
+    # are in, and rebuild the derived tables (ratings, rollups, similar games...) from them.
+
+    try:
+        counts = snapshot.import_(directory, workers)
+    except snapshot.SnapshotError as error:
+        raise click.ClickException(str(error))
+    print("Imported " + ", ".join(f"{rows} {table}" for table, rows in counts.items()))
+
+@db_commands.cli.command("purge-jobs")
+@click.option("--days", default=7, show_default=True, help="Keep finished and failed jobs this many days")
+def purge_jobs(days):
+
+    # Delete old finished and failed background jobs. Queued and running jobs are kept.
+
+    removed = jobs.purge_finished(days)
+    print(f"Removed {removed} old jobs")
+
+@db_commands.cli.command("purge-outbox")
+@click.option("--hours", default=outbox.DEFAULT_RETENTION_HOURS, show_default=True, help="Keep events this many hours")
+def purge_outbox(hours):
+
+    # Delete old outbox events. Workers only need events from after they started, so this
+    # only has to keep more than the longest time a worker may fall behind.
+
+    removed = outbox.purge_old(hours)
+    print(f"Removed {removed} old outbox events")
+
+@db_commands.cli.command("purge-tombstones")
+@click.option("--days", type=int, default=None, help="Keep tombstones this many days  [default: SYNC_TOMBSTONE_DAYS, or 90]")
+def purge_tombstones(days):
+
+    # Delete old tombstones of deleted rows. /sync refuses tokens older than
+    # SYNC_TOMBSTONE_DAYS, so clients never sync from before what is kept.
+
+    removed = sync.purge_old(days)
+    print(f"Removed {removed} old tombstones")
+
+@worker_commands.cli.command("worker")
+@click.option("--concurrency", "-c", default=1, show_default=True, help="Jobs run at the same time")
+@click.option("--poll-interval", default=jobs.DEFAULT_POLL_INTERVAL, show_default=True, help="Seconds between checks when idle")
+@click.option("--burst", is_flag=True, help="Exit once there are no jobs due")
+def worker(concurrency, poll_interval, burst):
+
+    # Run background jobs (deletes, achievement backfills, ...) queued by the API.
+    # Several workers can run at once, on one or more machines; each job is claimed by
+    # exactly one of them. Stop with Ctrl+C, which lets the running jobs finish.
+
+    print(f"Worker started with {concurrency} threads")
+    jobs.run_worker(current_app._get_current_object(), concurrency, poll_interval, burst)
+    print("Worker stopped")
+
+@worker_commands.cli.command("serve")
+@click.option("--bind", "-b", default=lambda: f"0.0.0.0:{os.environ.get('PORT', 8080)}", show_default="0.0.0.0:$PORT or 8080", help="Address to listen on")
+@click.option("--workers", "-w", type=int, default=lambda: int(os.environ.get("WEB_CONCURRENCY", 0)) or serving.default_workers(), show_default="$WEB_CONCURRENCY or one per CPU", help="Worker processes")
+@click.option("--threads", "-t", type=int, default=serving.DEFAULT_THREADS, show_default=True, help="Threads per worker")
+@click.option("--timeout", type=int, default=30, show_default=True, help="Seconds before a stuck worker is restarted")
+def serve(bind, workers, threads, timeout):
+
+    # Run the API in production, under gunicorn (`flask run` is for development only).
+    # The app is loaded and its caches filled once, in the master process, before the
+    # workers are forked; each worker then reports ready on /readyz once it has connected
+    # to the database. Stop with Ctrl+C or SIGTERM, which lets running requests finish.
+
+    print(f"Serving on {bind} with {workers} workers of {threads} threads")
+    serving.serve(current_app._get_current_object(), bind, workers, threads, timeout)
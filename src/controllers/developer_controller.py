@@ -1,121 +1,158 @@
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required  # To enforce user authentication
-from init import db  # Import the database instance
-from models.developer import Developer, developer_schema, developers_schema  # Import Developer model and schemas
-
-# Create a Blueprint for developer-related routes
-developer_controller = Blueprint("developer_controller", __name__)
-
-@developer_controller.route("/developers", methods=["POST"])
-@jwt_required()  # Ensure the user is authenticated to create a developer
-def create_developer():
-    
-    # Create a new developer.
-
-    # Expects:
-    #     - JSON payload with 'name'.
-
-    # Returns:
-    #     - JSON representation of the newly created developer.
-    
-    body = request.json  # Get JSON payload from the request
-
-    # Create a new developer instance
-    new_developer = Developer(
-        name=body.get("name")  # The name of the developer
-    )
-
-    # Add the new developer to the database and commit the changes
-    db.session.add(new_developer)
-    db.session.commit()
-
-    return developer_schema.jsonify(new_developer), 201  # Return the created developer with a 201 status
-
-
-@developer_controller.route("/developers", methods=["GET"])
-def get_developers():
-    
-    # Retrieve all developers.
-
-    # Returns:
-    #     - JSON list of all developers in the database.
-    
-    developers = Developer.query.all()  # Retrieve all developers from the database
-    return developers_schema.jsonify(developers)  # Return the list of developers
-
-
-@developer_controller.route("/developers/<int:id>", methods=["GET"])
-def get_developer(id):
-   
-    # Retrieve a specific developer by ID.
-
-    # Arguments:
-    #     - id: The ID of the developer to retrieve.
-
-    # Returns:
-    #     - JSON representation of the developer if found.
-    #     - Error message if the developer is not found.
-    
-    developer = Developer.query.get(id)  # Retrieve developer by ID
-
-    if not developer:
-        return {"message": "Developer not found"}, 404  # Return error if not found
-
-    return developer_schema.jsonify(developer)  # Return the found developer
-
-
-@developer_controller.route("/developers/<int:id>", methods=["PUT", "PATCH"])
-@jwt_required()  # Ensure the user is authenticated to update a developer
-def update_developer(id):
-    
-    # Update an existing developer's information.
-
-    # Arguments:
-    #     - id: The ID of the developer to update.
-
-    # Expects:
-    #     - JSON payload with 'name' to update.
-
-    # Returns:
-    #     - JSON representation of the updated developer if successful.
-    #     - Error message if the developer is not found.
-    
-    developer = Developer.query.get(id)  # Retrieve the developer by ID
-
-    if not developer:
-        return {"message": "Developer not found"}, 404  # Return error if not found
-
-    body = request.json  # Get JSON payload for updates
-
-    # Update the name of the developer if provided
-    if "name" in body:
-        developer.name = body["name"]
-
-    # Commit changes to the database
-    db.session.commit()
-
-    return developer_schema.jsonify(developer)  # Return the updated developer
-
-
-@developer_controller.route("/developers/<int:id>", methods=["DELETE"])
-@jwt_required()  # Ensure the user is authenticated to delete a developer
-def delete_developer(id):
-    
-    # Delete a developer by their ID.
-
-    # Arguments:
-    #     - id: The ID of the developer to delete.
-
-    # Returns:
-    #     - Success message if deleted, or error message if not found.
-    
-    developer = Developer.query.get(id)  # Retrieve the developer by ID
-
-    if not developer:
-        return {"message": "Developer not found"}, 404  # Return error if not found
-
-    # Delete the developer from the database
-    db.session.delete(developer)
-    db.session.commit()
-
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required  # To enforce user authentication
+from init import db  # Import the database instance
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import subqueryload
+from models.developer import Developer, developer_schema, developers_schema  # Import Developer model and schemas
+from models.game import game_detail_options  # Everything a game's response nests
+from services import outbox  # Domain events, which also refresh every worker's caches
+from services.concurrency import with_etag  # Optimistic concurrency
+from services.writes import insert_returning, update_returning, violation, UNIQUE  # Single-statement writes
+from services.multi_get import requested_ids, get_many  # ?ids= multi-get
+from services import repository  # Data access in SQLAlchemy 2.0 style
+
+# Create a Blueprint for developer-related routes
+developer_controller = Blueprint("developer_controller", __name__)
+
+@developer_controller.route("/developers", methods=["POST"])
+@jwt_required()  # Ensure the user is authenticated to create a developer
+def create_developer():
+    
+    # Create a new developer.
+
+    # Expects:
+    #     - JSON payload with 'name'.
+
+    # Returns:
+    #     - JSON representation of the newly created developer.
+    #     - Error message if the name is already used.
+    
+    body = request.json  # Get JSON payload from the request
+
+    # Insert the new developer in one statement, which returns the stored row; the unique
+    # name is checked by the database rather than looked up first
+    try:
+        new_developer = insert_returning(Developer, name=body.get("name"))
+    except IntegrityError as error:
+        if violation(error) == UNIQUE:
+            return {"message": "Developer already exists"}, 400
+        raise
+
+    # Serialise before committing, so the response does not re-read the row
+    response = with_etag(developer_schema.jsonify(new_developer), new_developer, 201)
+    outbox.record("developer.created", new_developer.id)
+    db.session.commit()
+
+    return response  # Return the created developer with a 201 status
+
+
+@developer_controller.route("/developers", methods=["GET"])
+def get_developers():
+    
+    # Retrieve all developers, or several developers by ID.
+
+    # Query parameters:
+    #     - ids: Optional comma separated developer IDs (at most 100), fetched in one query.
+
+    # Returns:
+    #     - JSON list of all developers in the database, or of the requested developers that exist.
+    
+    ids = requested_ids()
+    if ids is not None:
+        developers = get_many(Developer, ids, options=(subqueryload(Developer.game_list).options(*game_detail_options()),))  # Retrieve the requested developers in one IN query
+    else:
+        developers = repository.list_all(Developer, subqueryload(Developer.game_list).options(*game_detail_options()))  # Retrieve all developers from the database
+    return developers_schema.jsonify(developers)  # Return the list of developers
+
+
+@developer_controller.route("/developers/<int:id>", methods=["GET"])
+def get_developer(id):
+   
+    # Retrieve a specific developer by ID.
+
+    # Arguments:
+    #     - id: The ID of the developer to retrieve.
+
+    # Returns:
+    #     - JSON representation of the developer if found.
+    #     - Error message if the developer is not found.
+    
+    developer = repository.get(Developer, id, subqueryload(Developer.game_list).options(*game_detail_options()))  # Retrieve developer by ID
+
+    if not developer:
+        return {"message": "Developer not found"}, 404  # Return error if not found
+
+    return with_etag(developer_schema.jsonify(developer), developer)  # Return the found developer with its ETag
+
+
+@developer_controller.route("/developers/<int:id>", methods=["PUT", "PATCH"])
+@jwt_required()  # Ensure the user is authenticated to update a developer
+def update_developer(id):
+    
+    # Update an existing developer's information.
+
+    # Arguments:
+    #     - id: The ID of the developer to update.
+
+    # Expects:
+    #     - JSON payload with 'name' to update.
+    #     - If-Match header with the ETag from the last read.
+
+    # Returns:
+    #     - JSON representation of the updated developer if successful.
+    #     - Error message if the developer is not found.
+    #     - Error message if the new name is already used.
+    #     - 428 if If-Match is missing, 412 if the developer was changed since it was read.
+    
+    body = request.json  # Get JSON payload for updates
+
+    # Update the name if provided, in one statement that only matches the version the
+    # client last read (its If-Match ETag) and returns the updated row
+    values = {"name": body["name"]} if "name" in body else {}
+    try:
+        developer, error = update_returning(Developer, id, **values)
+    except IntegrityError as error:
+        if violation(error) == UNIQUE:
+            return {"message": "Developer already exists"}, 400
+        raise
+    if error:
+        return error
+    if not developer:
+        return {"message": "Developer not found"}, 404  # Return error if not found
+
+    # Serialise before committing, so the response does not re-read the row
+    response = with_etag(developer_schema.jsonify(developer), developer)
+    outbox.record("developer.updated", id)
+    db.session.commit()
+
+    return response  # Return the updated developer
+
+
+@developer_controller.route("/developers/<int:id>", methods=["DELETE"])
+@jwt_required()  # Ensure the user is authenticated to delete a developer
+def delete_developer(id):
+    
+    # Delete a developer by their ID.
+
+    # Arguments:
+    #     - id: The ID of the developer to delete.
+
+    # Returns:
+    #     - Success message if deleted, or error message if not found.
+    
+    developer = repository.get(Developer, id)  # Retrieve the developer by ID
+
+    if not developer:
+        return {"message": "Developer not found"}, 404  # Return error if not found
+
+    # Delete the developer from the database
+    # The database refuses (ON DELETE RESTRICT) while games still reference it
+    db.session.delete(developer)
+    outbox.record("developer.deleted", id)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return {"message": "Developer still has games"}, 409
+
     return {"message": "Developer deleted successfully"}, 200  # Return success message
\ No newline at end of file
@@ -1,144 +1,361 @@
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required  # To enforce user authentication
-from init import db  # Import the database instance
-from models.game import Game, game_schema, games_schema  # Import Game model and schemas
-from models.genre import Genre  # Import Genre model to validate genre ID
-from models.developer import Developer  # Import Developer model to validate developer ID
-
-# Create a Blueprint for game-related routes
-game_controller = Blueprint("game_controller", __name__)
-
-@game_controller.route("/games", methods=["POST"])
-@jwt_required()  # Ensure the user is authenticated to create a game
-def create_game():
-    
-    # Create a new game.
-
-    # Expects:
-    #     - JSON payload with 'title', 'genre_id', and 'developer_id'.
-    
-    # Returns:
-    #     - JSON representation of the newly created game.
-    #     - Error message if genre or developer does not exist.
-   
-    body = request.json  # Get JSON payload from the request
-
-    # Validate existence of genre and developer
-    genre_id = body.get("genre_id")
-    developer_id = body.get("developer_id")
-
-    # Check if the provided genre_id exists
-    genre = Genre.query.get(genre_id)
-    if not genre:
-        return {"message": "Genre not found"}, 404
-
-    # Check if the provided developer_id exists
-    developer = Developer.query.get(developer_id)
-    if not developer:
-        return {"message": "Developer not found"}, 404
-
-    # Create a new game instance
-    new_game = Game(
-        title=body.get("title"),  # The title of the game
-        genre_id=genre_id,  # Associate with the verified genre
-        developer_id=developer_id  # Associate with the verified developer
-    )
-
-    # Add the new game to the database and commit the changes
-    db.session.add(new_game)
-    db.session.commit()
-
-    return game_schema.jsonify(new_game), 201  # Return the created game with a 201 status
-
-
-@game_controller.route("/games", methods=["GET"])
-def get_games():
-    
-    # Retrieve all games.
-
-    # Returns:
-    #     - JSON list of all games in the database.
-    
-    games = Game.query.all()  # Retrieve all games from the database
-    return games_schema.jsonify(games)  # Return the list of games
-
-
-@game_controller.route("/games/<int:id>", methods=["GET"])
-def get_game(id):
-    
-    # Retrieve a specific game by ID.
-
-    # Arguments:
-    #     - id: The ID of the game to retrieve.
-
-    # Returns:
-    #     - JSON representation of the game if found.
-    #     - Error message if the game is not found.
-    
-    game = Game.query.get(id)  # Retrieve game by ID
-
-    if not game:
-        return {"message": "Game not found"}, 404  # Return error if not found
-
-    return game_schema.jsonify(game)  # Return the found game
-
-
-@game_controller.route("/games/<int:id>", methods=["PUT", "PATCH"])
-@jwt_required()  # Ensure the user is authenticated to update a game
-def update_game(id):
-    
-    # Update an existing game's information.
-
-    # Arguments:
-    #     - id: The ID of the game to update.
-
-    # Expects:
-    #     - JSON payload with fields to update such as 'title', 'genre_id', or 'developer_id'.
-
-    # Returns:
-    #     - JSON representation of the updated game if successful.
-    #     - Error message if game is not found.
-    
-    game = Game.query.get(id)  # Retrieve the game by ID
-
-    if not game:
-        return {"message": "Game not found"}, 404  # Return error if the game does not exist
-
-    body = request.json  # Get JSON payload for updates
-
-    # Update fields based on the provided data in the request body
-    if "title" in body:
-        game.title = body["title"]  # Update the title of the game
-    if "genre_id" in body:
-        game.genre_id = body["genre_id"]  # Update the genre ID
-    if "developer_id" in body:
-        game.developer_id = body["developer_id"]  # Update the developer ID
-
-    # Commit changes to the database
-    db.session.commit()
-
-    return game_schema.jsonify(game)  # Return the updated game
-
-
-@game_controller.route("/games/<int:id>", methods=["DELETE"])
-@jwt_required()  # Ensure the user is authenticated to delete a game
-def delete_game(id):
-    
-    # Delete a game by its ID.
-
-    # Arguments:
-    #     - id: The ID of the game to delete.
-
-    # Returns:
-    #     - Success message if deleted, or error message if not found.
-    
-    game = Game.query.get(id)  # Retrieve the game by ID
-
-    if not game:
-        return {"message": "Game not found"}, 404  # Return error if the game does not exist
-
-    # Delete the game from the database
-    db.session.delete(game)
-    db.session.commit()
-
+import re
+from flask import Blueprint, request, url_for
+from flask_jwt_extended import jwt_required, get_jwt_identity  # To enforce user authentication
+from init import db  # Import the database instance
+from models.game import Game, game_schema, games_schema, game_detail_options  # Import Game model, schemas and loader options
+from models.genre import Genre  # Import Genre model to validate genre ID
+from models.developer import Developer  # Import Developer model to validate developer ID
+from services import outbox  # Domain events, which also refresh every worker's caches
+from services.purge import start_purge  # Background chunked deletes
+from models.job import job_schema  # Background job progress
+from services.sharding import shards  # Scores and sessions on shard databases
+from services.catalogue_import import import_catalogue, read_rows, CatalogueImportError  # Bulk import
+from services.concurrency import with_etag  # Optimistic concurrency
+from services.writes import insert_returning, update_returning, violation, missing, UNIQUE, FOREIGN_KEY, NOT_NULL  # Single-statement writes
+from sqlalchemy.exc import IntegrityError
+from services import active_players  # Daily active player sketches
+from services import concurrency_series  # Players online over time
+from services import recommendations  # Players also played
+from services.multi_get import requested_ids, get_many  # ?ids= multi-get
+from services import repository  # Data access in SQLAlchemy 2.0 style
+from services.reference_data import reference_data  # Genres and developers held in memory
+from datetime import datetime, timedelta
+from marshmallow import fields
+
+# Create a Blueprint for game-related routes
+game_controller = Blueprint("game_controller", __name__)
+
+# Active player windows are a number of days, e.g. '30d'
+WINDOW = re.compile(r"^(\d+)d$")
+
+
+def _unknown_reference(values):
+    # 404 for whichever of the genre and developer given for a game does not exist, or None,
+    # checked against the in-process reference data so a valid write needs no extra query
+    for field, kind in (("genre_id", "genre"), ("developer_id", "developer")):
+        if field in values and not reference_data.exists(kind, values[field]):
+            return {"message": f"{kind.capitalize()} not found"}, 404
+    return None
+
+
+def _missing_reference(values):
+    # 404 for whichever of the genre and developer given for a game does not exist, or None.
+    # Only called once a write has failed, to say which foreign key it broke; the database
+    # has the final say when a genre or developer was deleted since the reference data was read
+    references = [(model, values[field]) for field, model in (("genre_id", Genre), ("developer_id", Developer)) if field in values]
+    model = missing(*references)
+    if model is not None:
+        return {"message": f"{model.__name__} not found"}, 404
+    return None
+
+
+@game_controller.route("/games", methods=["POST"])
+@jwt_required()  # Ensure the user is authenticated to create a game
+def create_game():
+    
+    # Create a new game.
+
+    # Expects:
+    #     - JSON payload with 'title', 'genre_id', and 'developer_id'.
+    
+    # Returns:
+    #     - JSON representation of the newly created game.
+    #     - Error message if genre or developer does not exist, or the title is already used.
+   
+    body = request.json  # Get JSON payload from the request
+
+    # Insert the new game in one statement, which returns the stored row. The genre and
+    # developer are checked against the reference data first; the database still enforces
+    # the foreign keys (and the unique title) in case either was deleted in the meantime
+    values = {"title": body.get("title"), "genre_id": body.get("genre_id"), "developer_id": body.get("developer_id")}
+    unknown_reference = _unknown_reference(values)
+    if unknown_reference:
+        return unknown_reference
+    try:
+        new_game = insert_returning(Game, **values)
+    except IntegrityError as error:
+        kind = violation(error)
+        missing_reference = _missing_reference(values) if kind in (FOREIGN_KEY, NOT_NULL) else None
+        if missing_reference:
+            return missing_reference
+        if kind == UNIQUE:
+            return {"message": "Game already exists"}, 400
+        raise
+
+    # Serialise before committing, so the response does not re-read the row
+    response = with_etag(game_schema.jsonify(new_game), new_game, 201)
+    outbox.record("game.created", new_game.id)
+    db.session.commit()
+
+    return response  # Return the created game with a 201 status
+
+
+@game_controller.route("/games/import", methods=["POST"])
+@jwt_required()  # Ensure the user is authenticated to import games
+def import_games():
+
+    # Bulk import games by genre and developer name.
+
+    # Expects:
+    #     - A JSON list of objects with 'title', 'genre' and 'developer', or
+    #     - A CSV body (Content-Type: text/csv) with the same columns as a header row.
+
+    # Returns:
+    #     - Summary of the import, including rejected rows.
+    #     - Error message if the body cannot be read.
+
+    fmt = "csv" if request.mimetype == "text/csv" else "json"
+
+    try:
+        rows = read_rows(request.get_data(as_text=True), fmt)
+        summary = import_catalogue(rows)
+    except CatalogueImportError as error:
+        return {"message": str(error)}, 400
+
+    return summary, 200
+
+
+@game_controller.route("/games", methods=["GET"])
+def get_games():
+    
+    # Retrieve all games, or several games by ID.
+
+    # Query parameters:
+    #     - ids: Optional comma separated game IDs (at most 100), fetched in one query.
+
+    # Returns:
+    #     - JSON list of all games in the database, or of the requested games that exist.
+    
+    ids = requested_ids()
+    if ids is not None:
+        games = get_many(Game, ids, options=game_detail_options())  # Retrieve the requested games in one IN query
+    else:
+        games = repository.list_all(Game, *game_detail_options())  # Retrieve all games from the database
+    return games_schema.jsonify(games)  # Return the list of games
+
+
+@game_controller.route("/games/<int:id>", methods=["GET"])
+def get_game(id):
+    
+    # Retrieve a specific game by ID.
+
+    # Arguments:
+    #     - id: The ID of the game to retrieve.
+
+    # Returns:
+    #     - JSON representation of the game if found.
+    #     - Error message if the game is not found.
+    
+    game = repository.get(Game, id, *game_detail_options())  # Retrieve game by ID, with what it nests
+
+    if not game:
+        return {"message": "Game not found"}, 404  # Return error if not found
+
+    return with_etag(game_schema.jsonify(game), game)  # Return the found game with its ETag
+
+
+@game_controller.route("/games/<int:id>/active-players", methods=["GET"])
+def get_active_players(id):
+
+    # Estimate how many distinct players started a session in a game over a window of days,
+    # e.g. daily (window=1d) or monthly (window=30d) active players.
+
+    # Arguments:
+    #     - id: The ID of the game.
+
+    # Query parameters:
+    #     - window: Number of days ending on 'to', as '<days>d' (default '30d', at most '366d').
+    #     - to: Optional last day (YYYY-MM-DD) of the window, today by default.
+
+    # Returns:
+    #     - The estimated number of active players, accurate to about 1-2%.
+    #     - Error message if the game is not found or a parameter is invalid.
+
+    if not repository.exists(Game, id):
+        return {"message": "Game not found"}, 404
+
+    window = request.args.get("window", "30d")
+    match = WINDOW.match(window)
+    if not match or not 1 <= int(match.group(1)) <= active_players.MAX_WINDOW_DAYS:
+        return {"message": f"window must be between 1d and {active_players.MAX_WINDOW_DAYS}d"}, 400
+
+    # Invalid dates raise a ValidationError, which is returned as a 400
+    end = fields.Date().deserialize(request.args["to"]) if "to" in request.args else None
+    start, end = active_players.window_bounds(int(match.group(1)), end)
+
+    estimate, days = active_players.count(id, start, end)
+    return {
+        "game_id": id,
+        "window": window,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "active_players": estimate,
+        "days_with_sessions": days,
+    }
+
+
+@game_controller.route("/games/<int:id>/concurrency", methods=["GET"])
+def get_concurrency(id):
+
+    # Retrieve the number of players online in a game over time, for graphs.
+
+    # Arguments:
+    #     - id: The ID of the game.
+
+    # Query parameters:
+    #     - from / to: Optional ISO 8601 date-times; the last 24 hours by default.
+    #     - step: 'minute', 'hour' or 'day'; by default minutes up to 2 days, hours up to
+    #       60 days and days beyond. Minutes are kept for 14 days and hours for 400 days.
+
+    # Returns:
+    #     - One point per step with the peak and average number of players online.
+    #     - Error message if the game is not found or a parameter is invalid.
+
+    if not repository.exists(Game, id):
+        return {"message": "Game not found"}, 404
+
+    # Invalid date-times raise a ValidationError, which is returned as a 400
+    now = datetime.now()
+    end = fields.DateTime().deserialize(request.args["to"]) if "to" in request.args else now
+    start = fields.DateTime().deserialize(request.args["from"]) if "from" in request.args else end - timedelta(days=1)
+    if start.tzinfo or end.tzinfo:
+        return {"message": "from and to must not include a time zone"}, 400
+    if start >= end:
+        return {"message": "from must be before to"}, 400
+
+    step = request.args.get("step")
+    if step is None:
+        span = end - start
+        step = "minute" if span <= timedelta(days=2) else "hour" if span <= timedelta(days=60) else "day"
+    if step not in concurrency_series.RESOLUTIONS:
+        return {"message": f"step must be one of {', '.join(concurrency_series.RESOLUTIONS)}"}, 400
+
+    # Finer steps are only kept for recent history
+    retention = {
+        "minute": concurrency_series.MINUTE_RETENTION_DAYS,
+        "hour": concurrency_series.HOUR_RETENTION_DAYS,
+    }.get(step)
+    if retention is not None and start < now - timedelta(days=retention):
+        return {"message": f"{step} steps are only kept for {retention} days"}, 400
+    if concurrency_series.points(start, end, step) > concurrency_series.MAX_POINTS:
+        return {"message": "Range too long for this step"}, 400
+
+    return {
+        "game_id": id,
+        "step": step,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "points": concurrency_series.series(id, start, end, step, now),
+    }
+
+
+@game_controller.route("/games/<int:id>/similar", methods=["GET"])
+def get_similar_games(id):
+
+    # Retrieve the games most often played by the players of a game ("players also played").
+
+    # Arguments:
+    #     - id: The ID of the game.
+
+    # Query parameters:
+    #     - limit: Number of games to return (default 10, at most 20).
+
+    # Returns:
+    #     - Similar games, most similar first, with a score from 0 to 1 and the number of
+    #       players they share. Lists are refreshed in the background, not on every session.
+    #     - Error message if the game is not found or the limit is invalid.
+
+    if not repository.exists(Game, id):
+        return {"message": "Game not found"}, 404
+
+    limit = request.args.get("limit", 10, type=int)
+    if not 1 <= limit <= recommendations.TOP_K:
+        return {"message": f"limit must be between 1 and {recommendations.TOP_K}"}, 400
+
+    return {"game_id": id, "similar": list(recommendations.similar_cache.get(id)[:limit])}
+
+
+@game_controller.route("/games/<int:id>", methods=["PUT", "PATCH"])
+@jwt_required()  # Ensure the user is authenticated to update a game
+def update_game(id):
+    
+    # Update an existing game's information.
+
+    # Arguments:
+    #     - id: The ID of the game to update.
+
+    # Expects:
+    #     - JSON payload with fields to update such as 'title', 'genre_id', or 'developer_id'.
+    #     - If-Match header with the ETag from the last read.
+
+    # Returns:
+    #     - JSON representation of the updated game if successful.
+    #     - Error message if game is not found.
+    #     - 428 if If-Match is missing, 412 if the game was changed since it was read.
+    
+    body = request.json  # Get JSON payload for updates
+
+    # Update the fields provided in the request body, in one statement that only matches
+    # the version the client last read (its If-Match ETag) and returns the updated row
+    values = {field: body[field] for field in ("title", "genre_id", "developer_id") if field in body}
+    unknown_reference = _unknown_reference(values)
+    if unknown_reference:
+        return unknown_reference
+    try:
+        game, error = update_returning(Game, id, **values)
+    except IntegrityError as error:
+        kind = violation(error)
+        missing_reference = _missing_reference(values) if kind in (FOREIGN_KEY, NOT_NULL) else None
+        if missing_reference:
+            return missing_reference
+        if kind == UNIQUE:
+            return {"message": "Game already exists"}, 400
+        raise
+    if error:
+        return error
+    if not game:
+        return {"message": "Game not found"}, 404  # Return error if the game does not exist
+
+    # Serialise before committing, so the response does not re-read the row
+    response = with_etag(game_schema.jsonify(game), game)
+    outbox.record("game.updated", id)
+    db.session.commit()
+
+    return response  # Return the updated game
+
+
+@game_controller.route("/games/<int:id>", methods=["DELETE"])
+@jwt_required()  # Ensure the user is authenticated to delete a game
+def delete_game(id):
+    
+    # Delete a game by its ID.
+    # Its scores, sessions and achievements are removed by the database (ON DELETE CASCADE).
+
+    # Arguments:
+    #     - id: The ID of the game to delete.
+
+    # Query parameters:
+    #     - async: 'true' to delete in the background in small batches, for games with
+    #       a lot of history. Progress can be followed at the returned Location.
+
+    # Returns:
+    #     - Success message if deleted, or error message if not found.
+    #     - 202 with the background job if 'async' was requested.
+    
+    game = repository.get(Game, id)  # Retrieve the game by ID
+
+    if not game:
+        return {"message": "Game not found"}, 404  # Return error if the game does not exist
+
+    if request.args.get("async", "").lower() in ("1", "true"):
+        job = start_purge("game", id, get_jwt_identity())
+        location = url_for("purge_controller.get_purge_job", job_id=job.id)
+        return {"message": "Game deletion started", "job": job_schema.dump(job)}, 202, {"Location": location}
+
+    # Delete the game's scores and sessions from its shard (if any), then the game itself
+    shards.delete_all("game_id", id)
+    db.session.delete(game)
+    outbox.record("game.deleted", id)
+    db.session.commit()
+
     return {"message": "Game deleted successfully"}, 200  # Return success message
\ No newline at end of file
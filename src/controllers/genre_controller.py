@@ -1,121 +1,158 @@
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required
-from init import db  # Import the database instance
-from models.genre import Genre, genre_schema, genres_schema  # Import Genre model and schemas
-
-# Create a Blueprint for genre-related routes
-genre_controller = Blueprint("genre_controller", __name__)
-
-@genre_controller.route("/genres", methods=["POST"])
-@jwt_required()  # Ensure the user is authenticated to create a genre
-def create_genre():
-    
-    # Create a new genre.
-
-    # Expects:
-    # - JSON payload with 'name'.
-    
-    # Returns:
-    # - JSON representation of the newly created genre.
-    
-    body = request.json  # Get JSON payload from the request
-
-    # Create a new genre instance
-    new_genre = Genre(
-        name=body.get("name")  # The name of the genre
-    )
-
-    # Add the new genre to the database and commit the changes
-    db.session.add(new_genre)
-    db.session.commit()
-
-    return genre_schema.jsonify(new_genre), 201  # Return the created genre with a 201 status
-
-
-@genre_controller.route("/genres", methods=["GET"])
-def get_genres():
-    
-    # Retrieve all genres.
-
-    # Returns:
-    # - JSON list of all genres in the database.
-    
-    genres = Genre.query.all()  # Retrieve all genres
-    return genres_schema.jsonify(genres)  # Return the list of genres
-
-
-@genre_controller.route("/genres/<int:id>", methods=["GET"])
-def get_genre(id):
-    
-    # Retrieve a specific genre by ID.
-
-    # Arguments:
-    # - id: The ID of the genre to retrieve.
-
-    # Returns:
-    # - JSON representation of the genre if found.
-    # - Error message if the genre is not found.
-    
-    genre = Genre.query.get(id)  # Retrieve genre by ID
-    
-    if not genre:
-        return {"message": "Genre not found"}, 404  # Return error if not found
-
-    return genre_schema.jsonify(genre)  # Return the found genre
-
-
-@genre_controller.route("/genres/<int:id>", methods=["PUT", "PATCH"])
-@jwt_required()  # Ensure the user is authenticated to update a genre
-def update_genre(id):
-   
-    # Update an existing genre by ID.
-
-    # Arguments:
-    # - id: The ID of the genre to update.
-
-    # Expects:
-    # - JSON payload with 'name' to update.
-
-    # Returns:
-    # - JSON representation of the updated genre if successful.
-    # - Error message if genre not found.
-    
-    genre = Genre.query.get(id)  # Retrieve the genre by ID
-
-    if not genre:
-        return {"message": "Genre not found"}, 404  # Return error if not found
-
-    body = request.json  # Get JSON payload for updates
-
-    # Update the name of the genre if provided
-    if "name" in body:
-        genre.name = body["name"]
-
-    # Commit changes to the database
-    db.session.commit()
-
-    return genre_schema.jsonify(genre)  # Return updated genre
-
-
-@genre_controller.route("/genres/<int:id>", methods=["DELETE"])
-@jwt_required()  # Ensure the user is authenticated to delete a genre
-def delete_genre(id):
-    
-    # Delete a genre by its ID.
-
-    # Arguments:
-    # - id: The ID of the genre to delete.
-
-    # Returns:
-    # - Success message if deleted, or error message if not found.
-    
-    genre = Genre.query.get(id)  # Retrieve the genre by ID
-
-    if not genre:
-        return {"message": "Genre not found"}, 404  # Return error if not found
-
-    # Delete the genre from the database
-    db.session.delete(genre)
-    db.session.commit()
-
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required
+from init import db  # Import the database instance
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import subqueryload
+from models.genre import Genre, genre_schema, genres_schema  # Import Genre model and schemas
+from models.game import game_detail_options  # Everything a game's response nests
+from services import outbox  # Domain events, which also refresh every worker's caches
+from services.concurrency import with_etag  # Optimistic concurrency
+from services.writes import insert_returning, update_returning, violation, UNIQUE  # Single-statement writes
+from services.multi_get import requested_ids, get_many  # ?ids= multi-get
+from services import repository  # Data access in SQLAlchemy 2.0 style
+
+# Create a Blueprint for genre-related routes
+genre_controller = Blueprint("genre_controller", __name__)
+
+@genre_controller.route("/genres", methods=["POST"])
+@jwt_required()  # Ensure the user is authenticated to create a genre
+def create_genre():
+    
+    # Create a new genre.
+
+    # Expects:
+    # - JSON payload with 'name'.
+    
+    # Returns:
+    # - JSON representation of the newly created genre.
+    # - Error message if the name is already used.
+    
+    body = request.json  # Get JSON payload from the request
+
+    # Insert the new genre in one statement, which returns the stored row; the unique
+    # name is checked by the database rather than looked up first
+    try:
+        new_genre = insert_returning(Genre, name=body.get("name"))
+    except IntegrityError as error:
+        if violation(error) == UNIQUE:
+            return {"message": "Genre already exists"}, 400
+        raise
+
+    # Serialise before committing, so the response does not re-read the row
+    response = with_etag(genre_schema.jsonify(new_genre), new_genre, 201)
+    outbox.record("genre.created", new_genre.id)
+    db.session.commit()
+
+    return response  # Return the created genre with a 201 status
+
+
+@genre_controller.route("/genres", methods=["GET"])
+def get_genres():
+    
+    # Retrieve all genres, or several genres by ID.
+
+    # Query parameters:
+    # - ids: Optional comma separated genre IDs (at most 100), fetched in one query.
+
+    # Returns:
+    # - JSON list of all genres in the database, or of the requested genres that exist.
+    
+    ids = requested_ids()
+    if ids is not None:
+        genres = get_many(Genre, ids, options=(subqueryload(Genre.game_list).options(*game_detail_options()),))  # Retrieve the requested genres in one IN query
+    else:
+        genres = repository.list_all(Genre, subqueryload(Genre.game_list).options(*game_detail_options()))  # Retrieve all genres
+    return genres_schema.jsonify(genres)  # Return the list of genres
+
+
+@genre_controller.route("/genres/<int:id>", methods=["GET"])
+def get_genre(id):
+    
+    # Retrieve a specific genre by ID.
+
+    # Arguments:
+    # - id: The ID of the genre to retrieve.
+
+    # Returns:
+    # - JSON representation of the genre if found.
+    # - Error message if the genre is not found.
+    
+    genre = repository.get(Genre, id, subqueryload(Genre.game_list).options(*game_detail_options()))  # Retrieve genre by ID
+    
+    if not genre:
+        return {"message": "Genre not found"}, 404  # Return error if not found
+
+    return with_etag(genre_schema.jsonify(genre), genre)  # Return the found genre with its ETag
+
+
+@genre_controller.route("/genres/<int:id>", methods=["PUT", "PATCH"])
+@jwt_required()  # Ensure the user is authenticated to update a genre
+def update_genre(id):
+   
+    # Update an existing genre by ID.
+
+    # Arguments:
+    # - id: The ID of the genre to update.
+
+    # Expects:
+    # - JSON payload with 'name' to update.
+    # - If-Match header with the ETag from the last read.
+
+    # Returns:
+    # - JSON representation of the updated genre if successful.
+    # - Error message if genre not found.
+    # - Error message if the new name is already used.
+    # - 428 if If-Match is missing, 412 if the genre was changed since it was read.
+    
+    body = request.json  # Get JSON payload for updates
+
+    # Update the name if provided, in one statement that only matches the version the
+    # client last read (its If-Match ETag) and returns the updated row
+    values = {"name": body["name"]} if "name" in body else {}
+    try:
+        genre, error = update_returning(Genre, id, **values)
+    except IntegrityError as error:
+        if violation(error) == UNIQUE:
+            return {"message": "Genre already exists"}, 400
+        raise
+    if error:
+        return error
+    if not genre:
+        return {"message": "Genre not found"}, 404  # Return error if not found
+
+    # Serialise before committing, so the response does not re-read the row
+    response = with_etag(genre_schema.jsonify(genre), genre)
+    outbox.record("genre.updated", id)
+    db.session.commit()
+
+    return response  # Return updated genre
+
+
+@genre_controller.route("/genres/<int:id>", methods=["DELETE"])
+@jwt_required()  # Ensure the user is authenticated to delete a genre
+def delete_genre(id):
+    
+    # Delete a genre by its ID.
+
+    # Arguments:
+    # - id: The ID of the genre to delete.
+
+    # Returns:
+    # - Success message if deleted, or error message if not found.
+    
+    genre = repository.get(Genre, id)  # Retrieve the genre by ID
+
+    if not genre:
+        return {"message": "Genre not found"}, 404  # Return error if not found
+
+    # Delete the genre from the database
+    # The database refuses (ON DELETE RESTRICT) while games still reference it
+    db.session.delete(genre)
+    outbox.record("genre.deleted", id)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return {"message": "Genre still has games"}, 409
+
     return {"message": "Genre deleted successfully"}, 200  # Return success message
\ No newline at end of file
@@ -0,0 +1,32 @@
+from flask import Blueprint
+from services.serving import check_ready  # Warm-up and database checks
+
+# Create a Blueprint for the load balancer's and orchestrator's probes
+health_controller = Blueprint("health_controller", __name__)
+
+@health_controller.route("/healthz", methods=["GET"])
+def healthz():
+
+    # Liveness probe: the process is up and answering requests. Checks nothing else, so a
+    # database outage does not get every worker restarted.
+
+    # Returns:
+    # - 200 with {"status": "ok"}.
+
+    return {"status": "ok"}, 200
+
+
+@health_controller.route("/readyz", methods=["GET"])
+def readyz():
+
+    # Readiness probe: the worker has warmed up and can reach the database (and every shard),
+    # so it can be sent traffic.
+
+    # Returns:
+    # - 200 with {"status": "ready"}.
+    # - 503 with the reason while the worker is warming up or the database is unreachable.
+
+    problem = check_ready()
+    if problem:
+        return {"status": problem}, 503
+    return {"status": "ready"}, 200
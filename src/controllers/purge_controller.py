@@ -0,0 +1,31 @@
+from flask import Blueprint
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from models.job import Job, job_schema  # Background delete jobs run by `flask worker`
+from services import repository  # Data access in SQLAlchemy 2.0 style
+
+# Create a Blueprint for background delete progress routes
+purge_controller = Blueprint("purge_controller", __name__)
+
+@purge_controller.route("/purge-jobs/<int:job_id>", methods=["GET"])
+@jwt_required()  # Ensure the user is authenticated to check a delete job
+def get_purge_job(job_id):
+
+    # Retrieve the progress of a background delete started with '?async=true'.
+
+    # Arguments:
+    # - job_id: The ID returned when the delete was started.
+
+    # Returns:
+    # - JSON representation of the job, including rows deleted so far per table.
+    # - Error message if the job is not found or belongs to another user.
+
+    job = repository.get(Job, job_id)  # Retrieve the job by ID
+
+    if not job or job.name != "purge":
+        return {"message": "Purge job not found"}, 404
+
+    # Only the user who started the delete can follow it
+    if job.requested_by != get_jwt_identity():
+        return {"message": "Unauthorised"}, 401
+
+    return job_schema.dump(job)
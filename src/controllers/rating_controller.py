@@ -0,0 +1,49 @@
+from flask import Blueprint, request
+from models.game import Game  # Import Game model to validate game ID
+from models.rating import ratings_schema  # Rating schema
+from services import ratings  # Skill ratings kept up to date as scores arrive
+from services import repository  # Data access in SQLAlchemy 2.0 style
+
+# Create a Blueprint for rating routes
+rating_controller = Blueprint("rating_controller", __name__)
+
+# Pagination limits
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 200
+
+
+@rating_controller.route("/games/<int:id>/ratings", methods=["GET"])
+def get_ratings(id):
+
+    # Retrieve a game's skill ratings, highest first, for leaderboards and matchmaking.
+
+    # Arguments:
+    # - id: The ID of the game.
+
+    # Query parameters:
+    # - page / per_page: Pagination, 50 players per page by default.
+
+    # Returns:
+    # - JSON object with the ratings for the requested page. Players with few scores are
+    #   marked as provisional.
+    # - Error message if the game is not found or a parameter is invalid.
+
+    if not repository.exists(Game, id):
+        return {"message": "Game not found"}, 404
+
+    page = request.args.get("page", 1, type=int)
+    per_page = request.args.get("per_page", DEFAULT_PER_PAGE, type=int)
+    if page < 1 or per_page < 1:
+        return {"message": "page and per_page must be positive"}, 400
+    per_page = min(per_page, MAX_PER_PAGE)
+
+    # Fetch one extra row to know whether another page exists without counting
+    rows = ratings.leaderboard(id, (page - 1) * per_page, per_page + 1)
+
+    return {
+        "game_id": id,
+        "page": page,
+        "per_page": per_page,
+        "has_more": len(rows) > per_page,
+        "ratings": ratings_schema.dump(rows[:per_page]),
+    }
@@ -1,107 +1,249 @@
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from init import db  # Import the database instance
-from models.score import Score, score_schema, scores_schema  # Import Score model and schemas
-
-# Create a Blueprint for score-related routes
-score_controller = Blueprint("score_controller", __name__)
-
-@score_controller.route("/scores", methods=["POST"])
-@jwt_required()  # Ensure the user is authenticated to create a score
-def create_score():
-    
-    # Create a new score for a specific game.
-
-    # Expects:
-    # - JSON payload with 'value' and 'game_id'.
-    
-    # Returns:
-    # - JSON representation of the newly created score on success.
-    
-    body = request.json  # Get JSON payload from the request
-
-    # Get the current user's ID from the JWT
-    user_id = get_jwt_identity()
-
-    # Create a new score instance
-    new_score = Score(
-        value=body.get("value"),  # The score value
-        user_id=user_id,
-        game_id=body.get("game_id")  # The game with which this score is associated
-    )
-
-    # Add the new score to the database session and commit
-    db.session.add(new_score)
-    db.session.commit()
-
-    return score_schema.jsonify(new_score), 201  # Return the created score with a 201 status
-
-
-@score_controller.route("/scores", methods=["GET"])
-@jwt_required()  # Ensure the user is authenticated to retrieve scores
-def get_scores():
-    
-    # Retrieve all scores for the authenticated user.
-
-    # Returns:
-    # - JSON list of scores tied to the current user.
-    
-    user_id = get_jwt_identity()  # Get the current user's ID from the JWT
-
-    # Query all scores associated with the current user
-    scores = Score.query.filter_by(user_id=user_id).all()
-
-    return scores_schema.jsonify(scores)  # Return the list of user scores
-
-
-@score_controller.route("/scores/<int:id>", methods=["GET"])
-@jwt_required()  # Ensure the user is authenticated to access this route
-def get_score(id):
-    
-    # Retrieve a specific score by ID.
-
-    # Arguments:
-    # - id: The ID of the score to retrieve.
-
-    # Returns:
-    # - JSON representation of the score if found.
-    # - Error message if the score is not found or unauthorized.
-    
-    score = Score.query.get(id)  # Retrieve score by ID
-
-    if not score:
-        return {"message": "Score not found"}, 404  # Return error if not found
-
-    # Ensure that the authenticated user owns the score
-    if score.user_id != get_jwt_identity():
-        return {"message": "Unauthorized"}, 401
-
-    return score_schema.jsonify(score)  # Return the found score
-
-
-@score_controller.route("/scores/<int:id>", methods=["DELETE"])
-@jwt_required()  # Ensure the user is authenticated to delete a score
-def delete_score(id):
-    
-    # Delete a score by its ID.
-
-    # Arguments:
-    # - id: The ID of the score to delete.
-
-    # Returns:
-    # - Success message if deleted, or error message if not found/unauthorized.
-    
-    score = Score.query.get(id)  # Retrieve the score by ID
-
-    if not score:
-        return {"message": "Score not found"}, 404  # Return error if not found
-
-    # Ensure that the authenticated user owns the score before deletion
-    if score.user_id != get_jwt_identity():
-        return {"message": "Unauthorized"}, 401
-
-    # Delete the score from the database
-    db.session.delete(score)
-    db.session.commit()
-
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from init import db  # Import the database instance
+from models.score import Score, score_schema, scores_schema  # Import Score model and schemas
+from models.score import review_score_schema, review_scores_schema, REVIEW_STATUSES, STATUS_ACCEPTED, STATUS_REJECTED, STATUS_QUARANTINED, COUNTED_STATUSES
+from models.game import Game  # Import Game model to validate game ID
+from models.user import User  # Import User model to check admin rights
+from services import achievements  # Achievement rules evaluated as scores arrive
+from services import ratings  # Skill ratings updated as scores arrive
+from services.anomalies import detector  # Inline check for cheated scores
+from services.idempotency import idempotent, remember, row_key  # Safe retries with an Idempotency-Key header
+from services import outbox  # Domain events, which also refresh every worker's caches
+from services.sharding import shards  # Scores are stored on their game's shard, if sharding is configured
+from services.multi_get import requested_ids, get_many  # ?ids= multi-get
+from services import repository  # Data access in SQLAlchemy 2.0 style
+from datetime import datetime
+
+# Create a Blueprint for score-related routes
+score_controller = Blueprint("score_controller", __name__)
+
+@score_controller.route("/scores", methods=["POST"])
+@jwt_required()  # Ensure the user is authenticated to create a score
+@idempotent  # Retries with the same Idempotency-Key replay the original response
+def create_score():
+    
+    # Create a new score for a specific game.
+
+    # Expects:
+    # - JSON payload with 'value' and 'game_id'.
+    
+    # Returns:
+    # - JSON representation of the newly created score on success.
+    # - Error message if the game does not exist.
+    
+    body = request.json  # Get JSON payload from the request
+
+    # Get the current user's ID from the JWT
+    user_id = get_jwt_identity()
+
+    # The game ID also picks the score's shard, so it has to be an integer
+    game_id = body.get("game_id")
+    if not isinstance(game_id, int) or isinstance(game_id, bool):
+        return {"message": "game_id must be an integer"}, 400
+
+    # Check that the game exists (shards cannot enforce the foreign key themselves)
+    if not repository.exists(Game, game_id):
+        return {"message": "Game not found"}, 404
+
+    value = body.get("value")
+    if not isinstance(value, int) or isinstance(value, bool):
+        return {"message": "value must be an integer"}, 400
+
+    # Check the score against the game's and player's previous scores; outliers are
+    # flagged for review, or quarantined so they do not count until accepted
+    status, flag_reason = detector.check(user_id, game_id, value)
+
+    # Create a new score instance
+    new_score = Score(
+        value=value,  # The score value
+        date_achieved=datetime.now(),  # The score is recorded as achieved now
+        user_id=user_id,
+        game_id=game_id,  # The game with which this score is associated
+        status=status,
+        flag_reason=flag_reason,
+        idempotency_key=row_key(),  # Lets a retry find the score on its shard
+    )
+
+    # Store the new score, evaluate the game's achievement rules, update the player's
+    # rating, and commit. A retry gets back the score an earlier attempt left on its
+    # shard, if that attempt failed before committing the rest (see ShardRouter.add).
+    new_score = shards.add(new_score)
+    if new_score.status in COUNTED_STATUSES:
+        achievements.record_score(new_score)
+        ratings.record_score(new_score)
+    outbox.record("score.created", new_score.id, user_id=user_id, game_id=new_score.game_id)
+    # Serialise before committing, so the response is committed with the score for retries
+    response = remember((score_schema.jsonify(new_score), 201))  # The created score with a 201 status
+    db.session.commit()
+
+    # Only a committed score joins the baselines future scores are checked against
+    if new_score.status == STATUS_ACCEPTED:
+        detector.observe(user_id, game_id, new_score.value)
+
+    return response
+
+
+@score_controller.route("/scores", methods=["GET"])
+@jwt_required()  # Ensure the user is authenticated to retrieve scores
+def get_scores():
+    
+    # Retrieve all scores for the authenticated user.
+
+    # Query parameters:
+    # - ids: Optional comma separated score IDs (at most 100); only those scores are returned.
+
+    # Returns:
+    # - JSON list of scores tied to the current user.
+    
+    user_id = get_jwt_identity()  # Get the current user's ID from the JWT
+
+    # Query all scores associated with the current user, from every shard in parallel
+    ids = requested_ids()
+    if ids is not None:
+        scores = get_many(Score, ids, Score.user_id == user_id)
+    else:
+        scores = shards.select(Score, Score.user_id == user_id)
+        if not shards.enabled:
+            shards.attach(scores)  # Their users and games in one query each (already attached when sharded)
+
+    return scores_schema.jsonify(scores)  # Return the list of user scores
+
+
+@score_controller.route("/scores/flagged", methods=["GET"])
+@jwt_required()  # Ensure the user is authenticated to review scores
+def get_flagged_scores():
+
+    # Retrieve scores flagged by the anomaly detector, oldest first. Admins only.
+
+    # Query parameters:
+    #     - status: 'flagged', 'quarantined' or 'rejected'; flagged and quarantined by default.
+    #     - game_id: Only this game's scores.
+    #     - after: Only scores with a higher ID, for the next page.
+    #     - limit: Number of scores to return (default 50, at most 500).
+
+    # Returns:
+    #     - JSON list of scores with the reason each was flagged.
+    #     - Error message if the user is not an admin or a parameter is invalid.
+
+    user = repository.get(User, get_jwt_identity())
+    if not user or not user.is_admin:
+        return {"message": "Unauthorized"}, 401
+
+    statuses = REVIEW_STATUSES
+    if "status" in request.args:
+        if request.args["status"] not in REVIEW_STATUSES + (STATUS_REJECTED,):
+            return {"message": "status must be flagged, quarantined or rejected"}, 400
+        statuses = (request.args["status"],)
+    limit = request.args.get("limit", 50, type=int)
+    if not 1 <= limit <= 500:
+        return {"message": "limit must be between 1 and 500"}, 400
+
+    # Only flagged scores are in the status index, so this never scans accepted scores
+    criteria = [Score.status.in_(statuses), Score.id > request.args.get("after", 0, type=int)]
+    game_id = request.args.get("game_id", type=int)
+    if game_id is not None:
+        criteria.append(Score.game_id == game_id)
+    scores = shards.select(Score, *criteria, order_by=Score.id, game_id=game_id, limit=limit)
+
+    return review_scores_schema.jsonify(scores)
+
+
+@score_controller.route("/scores/<int:id>/review", methods=["POST"])
+@jwt_required()  # Ensure the user is authenticated to review scores
+def review_score(id):
+
+    # Accept or reject a flagged or quarantined score. Admins only.
+
+    # Arguments:
+    #     - id: The ID of the score to review.
+
+    # Expects:
+    #     - JSON payload with 'status': 'accepted' or 'rejected'.
+
+    # Returns:
+    #     - JSON representation of the reviewed score.
+    #     - Error message if the score is not found, not waiting for review, or the user is not an admin.
+
+    user = repository.get(User, get_jwt_identity())
+    if not user or not user.is_admin:
+        return {"message": "Unauthorized"}, 401
+
+    status = (request.json or {}).get("status")
+    if status not in (STATUS_ACCEPTED, STATUS_REJECTED):
+        return {"message": "status must be accepted or rejected"}, 400
+
+    score = shards.get(Score, id)
+    if not score:
+        return {"message": "Score not found"}, 404
+    if score.status not in REVIEW_STATUSES:
+        return {"message": "Score is not waiting for review"}, 409
+
+    # An accepted score joins the baselines once committed, and a quarantined one now
+    # counts like any other. A rejected score that was only flagged stays in its player's
+    # rating until the next `rebuild-ratings`, which leaves it out.
+    if status == STATUS_ACCEPTED and score.status == STATUS_QUARANTINED:
+        achievements.record_score(score)
+        ratings.record_score(score)
+    observed = (score.user_id, score.game_id, score.value)
+    shards.update(score, status=status)
+    outbox.record("score.reviewed", id, user_id=score.user_id, game_id=score.game_id, status=status)
+    db.session.commit()
+    if status == STATUS_ACCEPTED:
+        detector.observe(*observed)
+
+    return review_score_schema.jsonify(score)
+
+
+@score_controller.route("/scores/<int:id>", methods=["GET"])
+@jwt_required()  # Ensure the user is authenticated to access this route
+def get_score(id):
+    
+    # Retrieve a specific score by ID.
+
+    # Arguments:
+    # - id: The ID of the score to retrieve.
+
+    # Returns:
+    # - JSON representation of the score if found.
+    # - Error message if the score is not found or unauthorized.
+    
+    score = shards.get(Score, id)  # Retrieve score by ID
+
+    if not score:
+        return {"message": "Score not found"}, 404  # Return error if not found
+
+    # Ensure that the authenticated user owns the score
+    if score.user_id != get_jwt_identity():
+        return {"message": "Unauthorized"}, 401
+
+    return score_schema.jsonify(score)  # Return the found score
+
+
+@score_controller.route("/scores/<int:id>", methods=["DELETE"])
+@jwt_required()  # Ensure the user is authenticated to delete a score
+def delete_score(id):
+    
+    # Delete a score by its ID.
+
+    # Arguments:
+    # - id: The ID of the score to delete.
+
+    # Returns:
+    # - Success message if deleted, or error message if not found/unauthorized.
+    
+    score = shards.get(Score, id)  # Retrieve the score by ID
+
+    if not score:
+        return {"message": "Score not found"}, 404  # Return error if not found
+
+    # Ensure that the authenticated user owns the score before deletion
+    if score.user_id != get_jwt_identity():
+        return {"message": "Unauthorized"}, 401
+
+    # Delete the score from the database
+    shards.delete(score)
+    outbox.record("score.deleted", id, user_id=score.user_id, game_id=score.game_id)
+    db.session.commit()
+
     return {"message": "Score deleted successfully"}, 200  # Return success message
\ No newline at end of file
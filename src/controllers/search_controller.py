@@ -0,0 +1,92 @@
+from flask import Blueprint, request
+from services.search import SEARCH_TARGETS, search, autocomplete  # Search backends (PostgreSQL or in-process trie)
+
+# Create a Blueprint for catalogue search routes
+search_controller = Blueprint("search_controller", __name__)
+
+# Pagination and suggestion limits
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 25
+
+
+def _parse_types():
+    # Read the optional comma-separated 'type' filter, defaulting to every searchable type
+    raw = request.args.get("type")
+    if not raw:
+        return set(SEARCH_TARGETS), None
+    types = {t.strip() for t in raw.split(",") if t.strip()}
+    unknown = types - set(SEARCH_TARGETS)
+    if unknown:
+        return None, {"message": f"Unknown search type: {', '.join(sorted(unknown))}"}
+    return types, None
+
+
+@search_controller.route("/search", methods=["GET"])
+def search_catalogue():
+
+    # Search games, developers and genres by name.
+
+    # Query parameters:
+    # - q: The search text (required).
+    # - type: Optional comma-separated filter of 'game', 'developer' and 'genre'.
+    # - page / per_page: Pagination, 20 results per page by default.
+
+    # Returns:
+    # - JSON object with the ranked results for the requested page.
+    # - Error message if the query is missing or a parameter is invalid.
+
+    q = request.args.get("q", "").strip()
+    if not q:
+        return {"message": "Missing search query"}, 400
+
+    types, error = _parse_types()
+    if error:
+        return error, 400
+
+    page = request.args.get("page", 1, type=int)
+    per_page = request.args.get("per_page", DEFAULT_PER_PAGE, type=int)
+    if page < 1 or per_page < 1:
+        return {"message": "page and per_page must be positive"}, 400
+    per_page = min(per_page, MAX_PER_PAGE)
+
+    # Fetch one extra row to know whether another page exists without counting
+    results = search(q, types, (page - 1) * per_page, per_page + 1)
+
+    return {
+        "query": q,
+        "page": page,
+        "per_page": per_page,
+        "has_more": len(results) > per_page,
+        "results": results[:per_page],
+    }
+
+
+@search_controller.route("/search/autocomplete", methods=["GET"])
+def autocomplete_catalogue():
+
+    # Suggest names starting with the given prefix.
+
+    # Query parameters:
+    # - q: The prefix typed so far (required).
+    # - type: Optional comma-separated filter of 'game', 'developer' and 'genre'.
+    # - limit: Maximum number of suggestions, 10 by default.
+
+    # Returns:
+    # - JSON object with the suggestions in alphabetical order.
+
+    q = request.args.get("q", "").strip()
+    if not q:
+        return {"message": "Missing search query"}, 400
+
+    types, error = _parse_types()
+    if error:
+        return error, 400
+
+    limit = request.args.get("limit", DEFAULT_SUGGESTIONS, type=int)
+    if limit < 1:
+        return {"message": "limit must be positive"}, 400
+    limit = min(limit, MAX_SUGGESTIONS)
+
+    return {"query": q, "suggestions": autocomplete(q, types, limit)}
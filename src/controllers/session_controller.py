@@ -1,108 +1,232 @@
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from init import db  # Import the database instance
-from models.session import Session, session_schema, sessions_schema  # Import Session model and schemas
-
-# Create a Blueprint for session-related routes
-session_controller = Blueprint("session_controller", __name__)
-
-@session_controller.route("/sessions", methods=["POST"])
-@jwt_required()  # Ensure the user is authenticated to create a session
-def create_session():
-    
-    # Create a new gaming session.
-
-    # Expects:
-    # - JSON payload with 'start_time', 'game_id', and optionally 'end_time'.
-
-    # Returns:
-    # - JSON representation of the newly created session.
-    
-    body = request.json  # Get JSON payload from the request
-
-    # Get the current user's ID from the JWT
-    user_id = get_jwt_identity()
-
-    # Create a new session instance with the provided data
-    new_session = Session(
-        start_time=body.get("start_time", None),
-        user_id=user_id,
-        game_id=body.get("game_id", None),
-        end_time=body.get("end_time", None)  # end_time can be optional while creating the session
-    )
-
-    # Add the new session to the database session and commit
-    db.session.add(new_session)
-    db.session.commit()
-
-    return session_schema.jsonify(new_session), 201  # Return the created session with a 201 status
-
-
-@session_controller.route("/sessions", methods=["GET"])
-@jwt_required()  # Ensure the user is authenticated to retrieve sessions
-def get_sessions():
-    
-    # Retrieve all gaming sessions for the authenticated user.
-
-    # Returns:
-    # - JSON list of sessions tied to the current user.
-    
-    user_id = get_jwt_identity()  # Get the current user's ID from the JWT
-
-    # Query all sessions associated with the current user
-    sessions = Session.query.filter_by(user_id=user_id).all()
-
-    return sessions_schema.jsonify(sessions)  # Return the list of sessions
-
-
-@session_controller.route("/sessions/<int:id>", methods=["GET"])
-@jwt_required()  # Ensure the user is authenticated to access this route
-def get_session(id):
-    
-    # Retrieve a specific gaming session by ID.
-
-    # Arguments:
-    # - id: The ID of the session to retrieve.
-
-    # Returns:
-    # - JSON representation of the session if found.
-    # - Error message if the session is not found or unauthorised.
-    
-    session = Session.query.get(id)  # Retrieve session by ID
-
-    if not session:
-        return {"message": "Session not found"}, 404  # Return error if not found
-
-    # Ensure that the authenticated user owns the session
-    if session.user_id != get_jwt_identity():
-        return {"message": "Unauthorised"}, 401
-
-    return session_schema.jsonify(session)  # Return the found session
-
-
-@session_controller.route("/sessions/<int:id>", methods=["DELETE"])
-@jwt_required()  # Ensure the user is authenticated to delete a session
-def delete_session(id):
-    #
-    # Delete a gaming session by its ID.
-
-    # Arguments:
-    # - id: The ID of the session to delete.
-
-    # Returns:
-    # - Success message if deleted, or error message if not found/unauthorized.
-    
-    session = Session.query.get(id)  # Retrieve the session by ID
-
-    if not session:
-        return {"message": "Session not found"}, 404  # Return error if not found
-
-    # Ensure that the authenticated user owns the session before deletion
-    if session.user_id != get_jwt_identity():
-        return {"message": "Unauthorised"}, 401
-
-    # Delete the session from the database
-    db.session.delete(session)
-    db.session.commit()
-
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from init import db  # Import the database instance
+from models.session import Session, session_schema, sessions_schema  # Import Session model and schemas
+from services import achievements  # Achievement rules evaluated as sessions arrive
+from services import playtime  # Daily play time rollups
+from services import active_players  # Daily active player sketches
+from services import concurrency_series  # Players online over time
+from services.sharding import shards  # Sessions are stored on their game's shard, if sharding is configured
+from models.game import Game  # Import Game model to validate game ID
+from services.idempotency import idempotent, remember, row_key  # Safe retries with an Idempotency-Key header
+from services import outbox  # Domain events, which also refresh every worker's caches
+from services.multi_get import requested_ids, get_many  # ?ids= multi-get
+from services import repository  # Data access in SQLAlchemy 2.0 style
+from marshmallow import fields
+from datetime import datetime
+
+# Create a Blueprint for session-related routes
+session_controller = Blueprint("session_controller", __name__)
+
+
+def _parse_time(value):
+    # Parse an ISO 8601 timestamp from the request body into a naive local datetime,
+    # matching how session times are stored. Invalid values raise a ValidationError,
+    # which is returned as a 400.
+    parsed = fields.DateTime().deserialize(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+@session_controller.route("/sessions", methods=["POST"])
+@jwt_required()  # Ensure the user is authenticated to create a session
+@idempotent  # Retries with the same Idempotency-Key replay the original response
+def create_session():
+    
+    # Create a new gaming session.
+
+    # Expects:
+    # - JSON payload with 'start_time', 'game_id', and optionally 'end_time'.
+
+    # Returns:
+    # - JSON representation of the newly created session.
+    # - Error message if the game does not exist.
+    
+    body = request.json  # Get JSON payload from the request
+
+    # Get the current user's ID from the JWT
+    user_id = get_jwt_identity()
+
+    # The game ID also picks the session's shard, so it has to be an integer
+    game_id = body.get("game_id")
+    if not isinstance(game_id, int) or isinstance(game_id, bool):
+        return {"message": "game_id must be an integer"}, 400
+
+    # Check that the game exists (shards cannot enforce the foreign key themselves)
+    if not repository.exists(Game, game_id):
+        return {"message": "Game not found"}, 404
+
+    # Parse the timestamps so play time can be worked out from them
+    start_time = body.get("start_time", None)
+    end_time = body.get("end_time", None)
+    if start_time is not None:
+        start_time = _parse_time(start_time)
+    if end_time is not None:
+        end_time = _parse_time(end_time)
+        # Same check as ending a session; a missing start_time defaults to now
+        if end_time <= (start_time or datetime.now()):
+            return {"message": "end_time must be after start_time"}, 400
+
+    # Create a new session instance with the provided data
+    new_session = Session(
+        start_time=start_time,
+        user_id=user_id,
+        game_id=game_id,
+        end_time=end_time,  # end_time can be optional while creating the session
+        idempotency_key=row_key(),  # Lets a retry find the session on its shard
+    )
+
+    # Store the new session (which applies the start_time default), evaluate the game's
+    # achievement rules, count the player as active and online, and commit. A retry gets
+    # back the session an earlier attempt left on its shard, if that attempt failed before
+    # committing the rest (see ShardRouter.add).
+    new_session = shards.add(new_session)
+    achievements.record_session(new_session)
+    playtime.record_session_end(new_session)  # Only counted once the session has ended
+    active_players.record_session(new_session)
+    concurrency_series.record_session(new_session)
+    outbox.record("session.created", new_session.id, user_id=user_id, game_id=new_session.game_id)
+    # Serialise before committing, so the response is committed with the session for retries
+    response = remember((session_schema.jsonify(new_session), 201))  # The created session with a 201 status
+    db.session.commit()
+
+    return response
+
+
+@session_controller.route("/sessions", methods=["GET"])
+@jwt_required()  # Ensure the user is authenticated to retrieve sessions
+def get_sessions():
+    
+    # Retrieve gaming sessions for the authenticated user, oldest first.
+
+    # Query parameters:
+    # - from: Optional ISO 8601 timestamp; only sessions starting at or after it.
+    # - to: Optional ISO 8601 timestamp; only sessions starting before it.
+    # - ids: Optional comma separated session IDs (at most 100); only those sessions are
+    #   returned, in the order given.
+
+    # Returns:
+    # - JSON list of sessions tied to the current user.
+    
+    user_id = get_jwt_identity()  # Get the current user's ID from the JWT
+
+    # Query the current user's sessions in the requested range; served by the
+    # (user_id, start_time) index, so the cost depends on the range, not the history.
+    # With sharding every shard is queried in parallel and the results are merged by start time
+    criteria = [Session.user_id == user_id]
+    if "from" in request.args:
+        criteria.append(Session.start_time >= _parse_time(request.args["from"]))
+    if "to" in request.args:
+        criteria.append(Session.start_time < _parse_time(request.args["to"]))
+    ids = requested_ids()
+    if ids is not None:
+        sessions = get_many(Session, ids, *criteria)
+    else:
+        sessions = shards.select(Session, *criteria, order_by=Session.start_time)
+        if not shards.enabled:
+            shards.attach(sessions)  # Their users and games in one query each (already attached when sharded)
+
+    return sessions_schema.jsonify(sessions)  # Return the list of sessions
+
+
+@session_controller.route("/sessions/<int:id>", methods=["GET"])
+@jwt_required()  # Ensure the user is authenticated to access this route
+def get_session(id):
+    
+    # Retrieve a specific gaming session by ID.
+
+    # Arguments:
+    # - id: The ID of the session to retrieve.
+
+    # Returns:
+    # - JSON representation of the session if found.
+    # - Error message if the session is not found or unauthorised.
+    
+    session = shards.get(Session, id)  # Retrieve session by ID
+
+    if not session:
+        return {"message": "Session not found"}, 404  # Return error if not found
+
+    # Ensure that the authenticated user owns the session
+    if session.user_id != get_jwt_identity():
+        return {"message": "Unauthorised"}, 401
+
+    return session_schema.jsonify(session)  # Return the found session
+
+
+@session_controller.route("/sessions/<int:id>", methods=["PUT", "PATCH"])
+@jwt_required()  # Ensure the user is authenticated to end a session
+def end_session(id):
+
+    # End an ongoing gaming session.
+
+    # Arguments:
+    # - id: The ID of the session to end.
+
+    # Expects:
+    # - Optional JSON payload with 'end_time'; defaults to now.
+
+    # Returns:
+    # - JSON representation of the ended session.
+    # - Error message if the session is not found, unauthorised or already ended.
+
+    session = shards.get(Session, id)  # Retrieve the session by ID
+
+    if not session:
+        return {"message": "Session not found"}, 404  # Return error if not found
+
+    # Ensure that the authenticated user owns the session
+    if session.user_id != get_jwt_identity():
+        return {"message": "Unauthorised"}, 401
+
+    if session.end_time is not None:
+        return {"message": "Session has already ended"}, 409
+
+    body = request.get_json(silent=True) or {}
+    end_time = _parse_time(body["end_time"]) if body.get("end_time") else datetime.now()
+    if end_time <= session.start_time:
+        return {"message": "end_time must be after start_time"}, 400
+
+    # End the session, then add its play time to the rollups, the players online series
+    # and achievement progress
+    shards.update(session, end_time=end_time)
+    playtime.record_session_end(session)
+    concurrency_series.record_session_end(session)
+    achievements.record_session_end(session)
+    outbox.record("session.ended", id, user_id=session.user_id, game_id=session.game_id)
+    db.session.commit()
+
+    return session_schema.jsonify(session)  # Return the ended session
+
+
+@session_controller.route("/sessions/<int:id>", methods=["DELETE"])
+@jwt_required()  # Ensure the user is authenticated to delete a session
+def delete_session(id):
+    #
+    # Delete a gaming session by its ID.
+
+    # Arguments:
+    # - id: The ID of the session to delete.
+
+    # Returns:
+    # - Success message if deleted, or error message if not found/unauthorized.
+    
+    session = shards.get(Session, id)  # Retrieve the session by ID
+
+    if not session:
+        return {"message": "Session not found"}, 404  # Return error if not found
+
+    # Ensure that the authenticated user owns the session before deletion
+    if session.user_id != get_jwt_identity():
+        return {"message": "Unauthorised"}, 401
+
+    # Delete the session from the database, taking it out of the play time rollups and
+    # the players online series
+    playtime.remove_session(session)
+    concurrency_series.remove_session(session)
+    shards.delete(session)
+    outbox.record("session.deleted", id, user_id=session.user_id, game_id=session.game_id)
+    db.session.commit()
+
     return {"message": "Session deleted successfully"}, 200  # Return success message
\ No newline at end of file
@@ -0,0 +1,41 @@
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from services import sync  # Changes since a sync token, with tombstones for deletes
+
+# Create a Blueprint for the delta sync route
+sync_controller = Blueprint("sync_controller", __name__)
+
+@sync_controller.route("/sync", methods=["GET"])
+@jwt_required()  # Ensure the user is authenticated, since their own history is synced
+def get_changes():
+
+    # Retrieve what changed since the client last synced: genres, developers and games, and
+    # the user's own achievements, scores and sessions, created, updated or deleted.
+
+    # Query parameters:
+    # - since: The token returned as "next" by the previous call. Without it, everything
+    #   is returned (a first sync).
+    # - limit: Rows per page (default 500, at most 2000).
+
+    # Returns:
+    # - JSON object with the changed rows by resource ("changes"), the IDs deleted by
+    #   resource ("deleted"), the token for the next call ("next"), and whether more pages
+    #   follow straight away ("has_more"). A deleted game takes its scores, sessions and
+    #   achievements with it.
+    # - 400 if a parameter is invalid, or 410 if the token is too old to sync from, in which
+    #   case the client syncs again without one.
+
+    # Parsed here rather than with type=int, which would quietly fall back to the default
+    try:
+        limit = int(request.args.get("limit", sync.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        limit = None
+    if limit is None or not 1 <= limit <= sync.MAX_PAGE_SIZE:
+        return {"message": f"limit must be an integer between 1 and {sync.MAX_PAGE_SIZE}"}, 400
+
+    try:
+        return sync.changes(get_jwt_identity(), request.args.get("since"), limit)
+    except sync.SyncTokenExpired:
+        return {"message": "Sync token has expired; sync again without since"}, 410
+    except sync.SyncTokenError:
+        return {"message": "Invalid sync token"}, 400
@@ -1,117 +1,196 @@
-from flask import Blueprint, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from init import db  # Import the database instance
-from models.user import User, user_schema, users_schema  # Import User model and schemas
-
-# Create a Blueprint for user-related routes
-user_controller = Blueprint("user_controller", __name__)
-
-@user_controller.route("/users/<int:id>", methods=["GET"])
-@jwt_required()  # Ensure the user is authenticated to access this route
-def get_user(id):
-    
-    # Retrieve details of a specific user by their ID.
-    # - id: The ID of the user to retrieve.
-
-    # Returns:
-    # - JSON representation of the user if found.
-    # - Error message if the user does not exist.
-    
-    # Fetch the user from the database by ID
-    user = User.query.get(id)
-    
-    # If user not found, return error message
-    if not user:
-        return {"message": "User not found"}, 404
-
-    # Return user data
-    return user_schema.jsonify(user)
-
-
-@user_controller.route("/users", methods=["GET"])
-@jwt_required()  # Ensure the user is authenticated to access this route
-def get_all_users():
-    
-    # Retrieve a list of all users.
-
-    # Returns:
-    # - JSON list of all users in the database.
-
-    
-    users = User.query.all()  # Retrieve all users
-    return users_schema.jsonify(users)  # Return user data
-
-
-@user_controller.route("/users/<int:id>", methods=["PUT", "PATCH"])
-@jwt_required()  # Ensure the user is authenticated to access this route
-def update_user(id):
-    
-    # Update an existing user's information.
-
-    # Arguments:
-    # - id: The ID of the user to update.
-
-    # Expects a JSON payload with fields to update (name or email).
-
-    # Returns:
-    # - Updated user data if successful.
-    # - Error message if user not found or if unauthorised.
-    
-    # Fetch the user from the database
-    user = User.query.get(id)
-
-    # If user not found, return an error message
-    if not user:
-        return {"message": "User not found"}, 404
-
-    # Ensure that the authenticated user can only update their own information
-    if user.id != get_jwt_identity():
-        return {"message": "Unauthorised"}, 401
-
-    # Get the data from the request, allowing optional updates
-    body = request.json
-
-    # Update user fields if present in the request
-    if "name" in body:
-        user.name = body["name"]
-    if "email" in body:
-        user.email = body["email"]
-    if "password" in body:
-        user.password = bcrypt.generate_password_hash(body["password"]).decode("utf-8")
-
-    # Commit changes to the database
-    db.session.commit()
-
-    # Return the updated user data
-    return user_schema.jsonify(user)
-
-
-@user_controller.route("/users/<int:id>", methods=["DELETE"])
-@jwt_required()  # Ensure the user is authenticated to access this route
-def delete_user(id):
-    
-    # Delete a user by their ID.
-
-    # Arguments:
-    # - id: The ID of the user to delete.
-
-    # Returns:
-    # - Success message on deletion or an error message if user not found.
-    
-    # Fetch the user from the database
-    user = User.query.get(id)
-
-    # If user not found, return an error message
-    if not user:
-        return {"message": "User not found"}, 404
-
-    # Ensure the authenticated user can only delete their own account
-    if user.id != get_jwt_identity():
-        return {"message": "Unauthorised"}, 401
-
-    # Remove the user from the session and commit the deletion
-    db.session.delete(user)
-    db.session.commit()
-
-    # Return a success message
+from flask import Blueprint, request, url_for
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from init import db, bcrypt  # Import the database instance and password hasher
+from models.user import User, user_schema, users_schema, user_detail_options  # Import User model, schemas and loader options
+from services.purge import start_purge  # Background chunked deletes
+from models.job import job_schema  # Background job progress
+from services.concurrency import with_etag  # Optimistic concurrency
+from services.writes import update_returning, violation, UNIQUE  # Single-statement writes
+from services import playtime  # Daily play time rollups
+from services.sharding import shards  # Scores and sessions on shard databases
+from services import outbox  # Domain events, which also refresh every worker's caches
+from services import anomalies  # Score baselines of the anomaly detector
+from services.multi_get import requested_ids, get_many  # ?ids= multi-get
+from services import repository  # Data access in SQLAlchemy 2.0 style
+from marshmallow import fields
+from sqlalchemy.exc import IntegrityError
+
+# Create a Blueprint for user-related routes
+user_controller = Blueprint("user_controller", __name__)
+
+@user_controller.route("/users/<int:id>", methods=["GET"])
+@jwt_required()  # Ensure the user is authenticated to access this route
+def get_user(id):
+    
+    # Retrieve details of a specific user by their ID.
+    # - id: The ID of the user to retrieve.
+
+    # Returns:
+    # - JSON representation of the user if found.
+    # - Error message if the user does not exist.
+    
+    # Fetch the user from the database by ID, with what the response nests
+    user = repository.get(User, id, *user_detail_options())
+    
+    # If user not found, return error message
+    if not user:
+        return {"message": "User not found"}, 404
+
+    # Return user data with its ETag
+    return with_etag(user_schema.jsonify(user), user)
+
+
+@user_controller.route("/users", methods=["GET"])
+@jwt_required()  # Ensure the user is authenticated to access this route
+def get_all_users():
+    
+    # Retrieve a list of all users, or several users by ID.
+
+    # Query parameters:
+    # - ids: Optional comma separated user IDs (at most 100), fetched in one query.
+
+    # Returns:
+    # - JSON list of all users in the database, or of the requested users that exist.
+
+    ids = requested_ids()
+    if ids is not None:
+        users = get_many(User, ids, options=user_detail_options())  # Retrieve the requested users in one IN query
+    else:
+        users = repository.list_all(User, *user_detail_options())  # Retrieve all users
+    return users_schema.jsonify(users)  # Return user data
+
+
+@user_controller.route("/users/<int:id>", methods=["PUT", "PATCH"])
+@jwt_required()  # Ensure the user is authenticated to access this route
+def update_user(id):
+    
+    # Update an existing user's information.
+
+    # Arguments:
+    # - id: The ID of the user to update.
+
+    # Expects a JSON payload with fields to update (name or email), and an If-Match
+    # header with the ETag from the last read.
+
+    # Returns:
+    # - Updated user data if successful.
+    # - Error message if user not found, if unauthorised, or if the email is already used.
+    # - 428 if If-Match is missing, 412 if the user was changed since it was read.
+    
+    # Ensure that the authenticated user can only update their own information
+    if id != get_jwt_identity():
+        return {"message": "Unauthorised"}, 401
+
+    # Get the data from the request, allowing optional updates
+    body = request.json
+
+    # Update the user fields present in the request, in one statement that only matches the
+    # version the client last read (its If-Match ETag) and returns the updated row
+    values = {field: body[field] for field in ("name", "email") if field in body}
+    if "password" in body:
+        values["password"] = bcrypt.generate_password_hash(body["password"]).decode("utf-8")
+    try:
+        user, error = update_returning(User, id, **values)
+    except IntegrityError as error:
+        if violation(error) == UNIQUE:
+            return {"message": "User already exists"}, 400
+        raise
+    if error:
+        return error
+
+    # If user not found, return an error message
+    if not user:
+        return {"message": "User not found"}, 404
+
+    # Serialise before committing, so the response does not re-read the row
+    response = with_etag(user_schema.jsonify(user), user)
+    outbox.record("user.updated", id)
+    db.session.commit()
+
+    # Return the updated user data
+    return response
+
+
+@user_controller.route("/users/<int:id>/playtime", methods=["GET"])
+@jwt_required()  # Ensure the user is authenticated to access this route
+def get_playtime(id):
+
+    # Retrieve a user's play time per day or per week, from the daily rollups.
+
+    # Arguments:
+    # - id: The ID of the user.
+
+    # Query parameters:
+    # - bucket: 'day' (default) or 'week' (weeks start on Monday).
+    # - from: Optional date (YYYY-MM-DD), included.
+    # - to: Optional date (YYYY-MM-DD), excluded.
+
+    # Returns:
+    # - Total seconds played in the range and one entry per bucket with play time.
+    # - Error message if unauthorised or the bucket is not supported.
+
+    # Play history is private to the user, like their sessions
+    if id != get_jwt_identity():
+        return {"message": "Unauthorised"}, 401
+
+    bucket = request.args.get("bucket", playtime.BUCKET_DAY)
+    if bucket not in playtime.BUCKETS:
+        return {"message": f"bucket must be one of {', '.join(playtime.BUCKETS)}"}, 400
+
+    # Invalid dates raise a ValidationError, which is returned as a 400
+    start = fields.Date().deserialize(request.args["from"]) if "from" in request.args else None
+    end = fields.Date().deserialize(request.args["to"]) if "to" in request.args else None
+
+    buckets = playtime.report(id, bucket, start, end)
+    return {
+        "user_id": id,
+        "bucket": bucket,
+        "total_seconds": sum(entry["seconds"] for entry in buckets),
+        "buckets": buckets,
+    }
+
+
+@user_controller.route("/users/<int:id>", methods=["DELETE"])
+@jwt_required()  # Ensure the user is authenticated to access this route
+def delete_user(id):
+    
+    # Delete a user by their ID.
+    # Their scores, sessions and achievements are removed by the database (ON DELETE CASCADE).
+
+    # Arguments:
+    # - id: The ID of the user to delete.
+
+    # Query parameters:
+    # - async: 'true' to delete in the background in small batches, for users with
+    #   a lot of history. Progress can be followed at the returned Location.
+
+    # Returns:
+    # - Success message on deletion or an error message if user not found.
+    # - 202 with the background job if 'async' was requested.
+    
+    # Fetch the user from the database
+    user = repository.get(User, id)
+
+    # If user not found, return an error message
+    if not user:
+        return {"message": "User not found"}, 404
+
+    # Ensure the authenticated user can only delete their own account
+    if user.id != get_jwt_identity():
+        return {"message": "Unauthorised"}, 401
+
+    if request.args.get("async", "").lower() in ("1", "true"):
+        job = start_purge("user", id, get_jwt_identity())
+        location = url_for("purge_controller.get_purge_job", job_id=job.id)
+        return {"message": "User deletion started", "job": job_schema.dump(job)}, 202, {"Location": location}
+
+    # Remove the user's scores and sessions from the shards (if any) and their score
+    # baselines, then remove the user from the session and commit the deletion
+    shards.delete_all("user_id", id)
+    anomalies.delete_player(id)
+    db.session.delete(user)
+    outbox.record("user.deleted", id)
+    db.session.commit()
+
+    # Return a success message
     return {"message": "User deleted successfully"}, 200
\ No newline at end of file
@@ -1,21 +1,40 @@
-# Import required extensions from Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_marshmallow import Marshmallow
-from flask_bcrypt import Bcrypt
-from flask_jwt_extended import JWTManager
-
-# SQLAlchemy instance for database management
-# It provides ORM capabilities to map classes to database tables
-db = SQLAlchemy()
-
-# Marshmallow instance for data serialisation and validation
-# Used to facilitate conversion between complex data types and Python data types
-ma = Marshmallow()
-
-# Bcrypt instance for password hashing
-# Ensures that passwords are stored securely using salted hashes
-bcrypt = Bcrypt()
-
-# JWTManager instance for token management
-# Handles the creation and verification of JSON Web Tokens for authentication
+# Import required extensions from Flask
+from flask_sqlalchemy import SQLAlchemy
+from flask_marshmallow import Marshmallow
+from flask_bcrypt import Bcrypt
+from flask_jwt_extended import JWTManager
+from sqlalchemy import event, DDL
+from sqlalchemy.engine import Engine
+import sqlite3
+
+# SQLAlchemy instance for database management
+# It provides ORM capabilities to map classes to database tables
+db = SQLAlchemy()
+
+# Enable the pg_trgm extension on PostgreSQL before any tables are created,
+# so the trigram search indexes declared on the models can be built
+event.listen(
+    db.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+
+# SQLite only enforces foreign keys (and their ON DELETE rules) when asked to on each connection
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+# Marshmallow instance for data serialisation and validation
+# Used to facilitate conversion between complex data types and Python data types
+ma = Marshmallow()
+
+# Bcrypt instance for password hashing
+# Ensures that passwords are stored securely using salted hashes
+bcrypt = Bcrypt()
+
+# JWTManager instance for token management
+# Handles the creation and verification of JSON Web Tokens for authentication
 jwt = JWTManager()
\ No newline at end of file
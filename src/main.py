@@ -1,79 +1,174 @@
-import os
-from flask import Flask
-from marshmallow.exceptions import ValidationError
-
-# Import initialised instances of database, Marshmallow, Bcrypt, and JWT
-from init import db, ma, bcrypt, jwt
-
-# Import controllers 
-from controllers.cli_controllers import db_commands
-from controllers.auth_controller import auth
-from controllers.user_controller import user_controller
-from controllers.game_controller import game_controller
-from controllers.genre_controller import genre_controller
-from controllers.developer_controller import developer_controller
-from controllers.session_controller import session_controller
-from controllers.score_controller import score_controller
-from controllers.achievement_controller import achievement_controller
-
-def create_app():
-    # creates the Flask application
-    app = Flask(__name__)
-
-    # Configure the app's secret key from environment variables
-    app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY")
-
-    # Set the SQLAlchemy database URI, read from environment variables
-    # This defines the database connection string used by SQLAlchemy
-    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-    
-    # Initialise SQLAlchemy with the Flask app instance
-    # This sets up the database connection and prepares models
-    db.init_app(app)
-    
-    # Initialise Marshmallow for object serialization/deserialization
-    ma.init_app(app)
-    
-    # Initialise Bcrypt for secure password hashing
-    # Used for hashing passwords and authenticating users
-    bcrypt.init_app(app)
-    
-    # Initialise JWTManager for handling JSON Web Tokens
-    jwt.init_app(app)
-
-    # Define an error handler for Marshmallow's ValidationError
-    # Converts validation errors into JSON responses with status code 400
-    @app.errorhandler(ValidationError)
-    def handle_validation_error(error):
-        return {"validation_error": error.messages}, 400
-    
-    # Register CLI-related commands with the app
-    # These commands help with database operations via command line
-    app.register_blueprint(db_commands)
-    
-    # Register authentication routes and logic
-    app.register_blueprint(auth)
-
-    # Register user management routes
-    app.register_blueprint(user_controller)
-
-    # Register game management routes
-    app.register_blueprint(game_controller)
-
-    # Register genre management routes
-    app.register_blueprint(genre_controller)
-
-    # Register developer data routes
-    app.register_blueprint(developer_controller)
-
-    # Register session management routes for multiplayer games
-    app.register_blueprint(session_controller)
-
-    # Register score tracking routes
-    app.register_blueprint(score_controller)
-
-    # Register achievement management routes
-    app.register_blueprint(achievement_controller)
-    
-    # Return the configured Flask app 
-    return app
+import os
+import json
+from flask import Flask
+from marshmallow.exceptions import ValidationError
+
+# Import initialised instances of database, Marshmallow, Bcrypt, and JWT
+from init import db, ma, bcrypt, jwt
+from services.admission import admission
+from services.sharding import shards
+from services.outbox import relay
+from services.anomalies import detector
+from services.logs import logs
+from services.audit import audit
+from services.repository import query_stats
+from services.reference_data import reference_data
+
+# Import controllers 
+from controllers.cli_controllers import db_commands, worker_commands
+from controllers.auth_controller import auth
+from controllers.user_controller import user_controller
+from controllers.game_controller import game_controller
+from controllers.genre_controller import genre_controller
+from controllers.developer_controller import developer_controller
+from controllers.session_controller import session_controller
+from controllers.score_controller import score_controller
+from controllers.achievement_controller import achievement_controller
+from controllers.search_controller import search_controller
+from controllers.purge_controller import purge_controller
+from controllers.rating_controller import rating_controller
+from controllers.batch_controller import batch_controller
+from controllers.health_controller import health_controller
+from controllers.sync_controller import sync_controller
+
+def create_app():
+    # creates the Flask application
+    app = Flask(__name__)
+
+    # Configure the app's secret key from environment variables
+    app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY")
+
+    # Set the SQLAlchemy database URI, read from environment variables
+    # This defines the database connection string used by SQLAlchemy
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+
+    # Optional shard databases for scores and sessions, as comma separated name=url pairs
+    # (e.g. "shard0=postgresql://...,shard1=postgresql://..."), and an optional JSON map
+    # pinning games to shards (e.g. '{"1": "shard0"}')
+    if os.environ.get("SHARD_DATABASE_URLS"):
+        app.config["SHARD_DATABASE_URIS"] = dict(
+            pair.strip().split("=", 1) for pair in os.environ["SHARD_DATABASE_URLS"].split(",")
+        )
+    if os.environ.get("SHARD_MAP"):
+        app.config["SHARD_MAP"] = json.loads(os.environ["SHARD_MAP"])
+    
+    # Initialise SQLAlchemy with the Flask app instance
+    # This sets up the database connection and prepares models
+    db.init_app(app)
+
+    # Initialise the shard router, which stores each game's scores and sessions on one of
+    # the shard databases when they are configured, and on the main database otherwise
+    shards.init_app(app)
+    
+    # Initialise Marshmallow for object serialization/deserialization
+    ma.init_app(app)
+    
+    # Initialise Bcrypt for secure password hashing
+    # Used for hashing passwords and authenticating users
+    bcrypt.init_app(app)
+    
+    # Initialise JWTManager for handling JSON Web Tokens
+    jwt.init_app(app)
+
+    # Initialise structured logging: JSON log lines (LOG_LEVEL, and LOG_FILE instead of
+    # stdout) and an access log line per request (ACCESS_LOG=false turns it off), written in
+    # batches by a background thread. Set up before admission control, so shed requests are
+    # logged too
+    if os.environ.get("LOG_LEVEL"):
+        app.config["LOG_LEVEL"] = os.environ["LOG_LEVEL"].upper()
+    if os.environ.get("LOG_FILE"):
+        app.config["LOG_FILE"] = os.environ["LOG_FILE"]
+    if os.environ.get("ACCESS_LOG"):
+        app.config["ACCESS_LOG"] = os.environ["ACCESS_LOG"].lower() not in ("0", "false", "no")
+    logs.init_app(app)
+
+    # Initialise query timing for the repository layer; calls slower than SLOW_QUERY_MS
+    # milliseconds are logged
+    if os.environ.get("SLOW_QUERY_MS"):
+        app.config["SLOW_QUERY_MS"] = float(os.environ["SLOW_QUERY_MS"])
+    query_stats.init_app(app)
+
+    # Initialise the audit trail, which records who made every committed change, written
+    # to the audit_log table in batches by a background thread
+    audit.init_app(app)
+
+    # Initialise admission control, which limits concurrent requests per endpoint class
+    # (ingest, auth, catalogue reads, bulk export) and sheds low-priority work with a 503
+    # when the worker is overloaded
+    admission.init_app(app)
+
+    # Initialise the outbox relay, which delivers events committed by other workers and
+    # hosts to this worker so it can drop stale cache entries
+    # (OUTBOX_POLL_INTERVAL bounds how stale they can get when a notification is missed)
+    if os.environ.get("OUTBOX_POLL_INTERVAL"):
+        app.config["OUTBOX_POLL_INTERVAL"] = float(os.environ["OUTBOX_POLL_INTERVAL"])
+    relay.init_app(app)
+
+    # Initialise the score anomaly detector, which checks each new score against running
+    # statistics of its game and player (SCORE_ANOMALY_ACTION: 'flag', 'quarantine' or 'off')
+    if os.environ.get("SCORE_ANOMALY_ACTION"):
+        app.config["SCORE_ANOMALY_ACTION"] = os.environ["SCORE_ANOMALY_ACTION"]
+    detector.init_app(app)
+
+    # Read the genres and developers into memory now, rather than on the first request that
+    # shows a game (skipped until the tables exist). The relay is told to deliver every
+    # event from this point, so nothing changed before the first request is missed
+    with app.app_context():
+        relay.start_from_now()
+        reference_data.preload()
+
+    # Define an error handler for Marshmallow's ValidationError
+    # Converts validation errors into JSON responses with status code 400
+    @app.errorhandler(ValidationError)
+    def handle_validation_error(error):
+        return {"validation_error": error.messages}, 400
+    
+    # Register CLI-related commands with the app
+    # These commands help with database operations via command line
+    app.register_blueprint(db_commands)
+    app.register_blueprint(worker_commands)  # `flask worker`, which runs background jobs
+    
+    # Register authentication routes and logic
+    app.register_blueprint(auth)
+
+    # Register user management routes
+    app.register_blueprint(user_controller)
+
+    # Register game management routes
+    app.register_blueprint(game_controller)
+
+    # Register genre management routes
+    app.register_blueprint(genre_controller)
+
+    # Register developer data routes
+    app.register_blueprint(developer_controller)
+
+    # Register session management routes for multiplayer games
+    app.register_blueprint(session_controller)
+
+    # Register score tracking routes
+    app.register_blueprint(score_controller)
+
+    # Register achievement management routes
+    app.register_blueprint(achievement_controller)
+
+    # Register catalogue search routes
+    app.register_blueprint(search_controller)
+
+    # Register background delete progress routes
+    app.register_blueprint(purge_controller)
+
+    # Register skill rating routes
+    app.register_blueprint(rating_controller)
+
+    # Register the batch route, which runs several requests in one round trip
+    app.register_blueprint(batch_controller)
+
+    # Register the delta sync route
+    app.register_blueprint(sync_controller)
+
+    # Register the liveness and readiness probes
+    app.register_blueprint(health_controller)
+    
+    # Return the configured Flask app 
+    return app
@@ -1,44 +1,78 @@
-from init import db, ma
-from marshmallow import fields
-
-class Achievement(db.Model):
-    
-    # This class represents the Achievement model in the database.
-    # - id: The primary key of the achievement.
-    # - name: The name of the achievement, which should be unique and not null.
-    # - description: A brief description of the achievement.
-    # - user_id: Foreign key linking to the User who earned the achievement.
-    # - game_id: Foreign key linking to the Game where the achievement can be earned.
-    
-    __tablename__ = "achievements"  # Specifies the table name in the database
-
-    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each achievement
-    name = db.Column(db.String(150), nullable=False, unique=True)  # Achievement name, unique and non-null
-    description = db.Column(db.String(255), nullable=False)  # Description of what the achievement represents
-
-    # Establishing foreign key relationships
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)  # Foreign key to User
-    game_id = db.Column(db.Integer, db.ForeignKey('games.id'), nullable=False)  # Foreign key to Game
-
-    # Defining relationships
-    user = db.relationship("User", back_populates="achievements")  # Relationship with User model
-    game = db.relationship("Game", back_populates="achievements")  # Relationship with Game model
-
-
-class AchievementSchema(ma.Schema):
-
-    # Schema for serialising achievement records
-    id = fields.Integer(dump_only=True)  # Only for output serialisation
-    name = fields.String(required=True)  # Name of the achievement (required)
-    description = fields.String(required=True)  # Description of the achievement (required)
-    # Nested fields to include related user and game, avoiding recursive serialisation
-    user = fields.Nested("UserSchema", exclude=["achievements", "password"])
-    game = fields.Nested("GameSchema", exclude=["achievements"])
-
-    class Meta:
-        
-        fields = ("id", "name", "description", "user", "game")  # Fields to include in serialisation
-
-# Instances of AchievementSchema for serialising single and multiple achievement records
-achievement_schema = AchievementSchema()  # Single achievement instance
-achievements_schema = AchievementSchema(many=True)  # Multiple achievements instance
\ No newline at end of file
+from init import db, ma
+from marshmallow import fields
+from datetime import datetime
+from sqlalchemy.orm import joinedload
+
+class Achievement(db.Model):
+    
+    # This class represents an achievement unlocked by a user in the database.
+    # - id: The primary key of the achievement.
+    # - name: The name of the achievement, unique per user and game.
+    # - description: A brief description of the achievement.
+    # - unlocked_at: The date and time when the achievement was unlocked.
+    # - updated_at: When the achievement was unlocked or last changed.
+    # - user_id: Foreign key linking to the User who earned the achievement.
+    # - game_id: Foreign key linking to the Game where the achievement can be earned.
+    # - definition_id: Foreign key linking to the AchievementDefinition that awarded it,
+    #   null for achievements created by hand.
+    # - version: Row version, bumped on every update and used as the ETag.
+    
+    __tablename__ = "achievements"  # Specifies the table name in the database
+
+    # The same achievement can be held by many players, but only once by each player
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "game_id", "name", name="uq_achievements_user_game_name"),
+        db.Index("ix_achievements_user_id_updated_at", "user_id", "updated_at"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each achievement
+    name = db.Column(db.String(150), nullable=False)  # Achievement name, non-null
+    description = db.Column(db.String(255), nullable=False)  # Description of what the achievement represents
+    unlocked_at = db.Column(db.DateTime, nullable=False, default=datetime.now)  # When the achievement was unlocked
+
+    # When the row was created or last changed, for /sync (see services/sync.py); indexed
+    # with user_id in __table_args__, since players sync their own rows
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+    # Establishing foreign key relationships
+    # Achievements are removed by the database together with their user or game
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), nullable=False)  # Foreign key to User
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), nullable=False, index=True)  # Foreign key to Game
+    definition_id = db.Column(db.Integer, db.ForeignKey('achievement_definitions.id', ondelete="SET NULL"))  # Foreign key to AchievementDefinition
+
+    # Row version for optimistic concurrency: every UPDATE checks and bumps it, so a write
+    # based on a stale read fails instead of overwriting (see services/concurrency.py)
+    version = db.Column(db.Integer, nullable=False, server_default="1")  # Returned as the ETag
+    __mapper_args__ = {"version_id_col": version}
+
+    # Defining relationships
+    user = db.relationship("User", back_populates="achievements")  # Relationship with User model
+    game = db.relationship("Game", back_populates="achievements")  # Relationship with Game model
+    definition = db.relationship("AchievementDefinition", back_populates="unlocks")  # Rule that awarded it
+
+
+class AchievementSchema(ma.Schema):
+
+    # Schema for serialising achievement records
+    id = fields.Integer(dump_only=True)  # Only for output serialisation
+    name = fields.String(required=True)  # Name of the achievement (required)
+    description = fields.String(required=True)  # Description of the achievement (required)
+    unlocked_at = fields.DateTime(dump_only=True)  # Set when the achievement is unlocked
+    # Nested fields to include related user and game, avoiding recursive serialisation
+    # Only the user's and game's own fields are included, because their collections lead
+    # back to other records (user -> achievements -> game -> ...) and would never end
+    user = fields.Nested("UserSchema", only=["id", "name", "email"])
+    game = fields.Nested("GameSchema", only=["id", "title", "genre", "developer"])
+
+    class Meta:
+        
+        fields = ("id", "name", "description", "unlocked_at", "user", "game")  # Fields to include in serialisation
+
+# Instances of AchievementSchema for serialising single and multiple achievement records
+achievement_schema = AchievementSchema()  # Single achievement instance
+achievements_schema = AchievementSchema(many=True)  # Multiple achievements instance
+
+def achievement_detail_options():
+    # Loader options for the user and game each achievement nests, joined into the query
+    # that reads the achievements (built on use, like game_detail_options)
+    return joinedload(Achievement.user), joinedload(Achievement.game)
\ No newline at end of file
@@ -0,0 +1,73 @@
+from init import db, ma
+from marshmallow import fields, validate
+
+# Kinds of rule an achievement definition can declare, and the progress counter each one watches
+RULE_SCORE_THRESHOLD = "score_threshold"  # Unlocks when a single score reaches the threshold
+RULE_SESSION_COUNT = "session_count"  # Unlocks after the threshold number of sessions
+RULE_PLAY_TIME = "play_time"  # Unlocks after the threshold seconds of finished sessions
+RULES = (RULE_SCORE_THRESHOLD, RULE_SESSION_COUNT, RULE_PLAY_TIME)
+
+class AchievementDefinition(db.Model):
+
+    # This class represents an achievement that can be unlocked in a game.
+    # - id: The primary key of the definition.
+    # - name: The name given to unlocked achievements, unique per game.
+    # - description: A brief description of what has to be done.
+    # - rule: Which progress counter the definition watches (see RULES).
+    # - threshold: The counter value at which the achievement unlocks.
+    # - game_id: Foreign key linking to the Game the achievement belongs to.
+
+    __tablename__ = "achievement_definitions"  # Specifies the table name in the database
+
+    # Names only need to be unique within a game
+    __table_args__ = (db.UniqueConstraint("game_id", "name", name="uq_achievement_definitions_game_name"),)
+
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each definition
+    name = db.Column(db.String(150), nullable=False)  # Achievement name, non-null
+    description = db.Column(db.String(255), nullable=False)  # Description of the goal
+    rule = db.Column(db.String(30), nullable=False)  # Rule kind, one of RULES
+    threshold = db.Column(db.Integer, nullable=False)  # Value the counter has to reach
+
+    # Foreign key to the game, indexed because rules are always loaded per game
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), nullable=False, index=True)
+
+    # Establishing relationships with the Game and Achievement models
+    game = db.relationship("Game")  # Game this definition belongs to
+    # Unlocked achievements are detached by the database (SET NULL) when the definition is deleted
+    unlocks = db.relationship("Achievement", back_populates="definition", lazy='dynamic', passive_deletes=True)  # Achievements awarded by it
+
+
+class AchievementProgress(db.Model):
+
+    # This class keeps running counters per user and game, so rules can be checked
+    # on each new score or session without re-reading the user's history.
+    # - best_score: The highest score submitted.
+    # - session_count: The number of sessions started.
+    # - play_seconds: The total length of finished sessions, in seconds.
+
+    __tablename__ = "achievement_progress"  # Specifies the table name in the database
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), primary_key=True)  # Foreign key to User
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), primary_key=True, index=True)  # Foreign key to Game
+    best_score = db.Column(db.Integer, nullable=False, default=0)
+    session_count = db.Column(db.Integer, nullable=False, default=0)
+    play_seconds = db.Column(db.Integer, nullable=False, default=0)
+
+
+class AchievementDefinitionSchema(ma.Schema):
+
+    # Schema for serialising and validating achievement definitions
+    id = fields.Integer(dump_only=True)
+    name = fields.String(required=True, validate=[validate.Length(min=1, max=150)])
+    description = fields.String(required=True, validate=[validate.Length(max=255)])
+    rule = fields.String(required=True, validate=[validate.OneOf(RULES)])
+    threshold = fields.Integer(required=True, validate=[validate.Range(min=1)])
+    game_id = fields.Integer(dump_only=True)
+
+    class Meta:
+
+        fields = ("id", "name", "description", "rule", "threshold", "game_id")  # Fields to include in serialisation
+
+# Instances of AchievementDefinitionSchema for serialising single and multiple definitions
+achievement_definition_schema = AchievementDefinitionSchema()  # Single definition instance
+achievement_definitions_schema = AchievementDefinitionSchema(many=True)  # Multiple definitions instance
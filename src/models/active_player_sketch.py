@@ -0,0 +1,17 @@
+from init import db
+
+class ActivePlayerSketch(db.Model):
+
+    # This class stores a HyperLogLog sketch of the players who started a session in a game
+    # on one day (see services/hll.py). Sketches for a range of days merge into an estimate
+    # of the distinct players over that range, without scanning the sessions table.
+    # - game_id: Foreign key linking to the Game.
+    # - day: The calendar day the sessions started on.
+    # - registers: The serialised sketch, a few bytes for quiet days and at most 8 KB.
+
+    __tablename__ = "active_player_sketches"  # Specifies the table name in the database
+
+    # One row per game per day; the primary key doubles as the (game_id, day) range index
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    registers = db.Column(db.LargeBinary, nullable=False)
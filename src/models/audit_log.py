@@ -0,0 +1,25 @@
+from init import db
+
+class AuditLog(db.Model):
+
+    # This class represents one write in the audit trail: who changed what, and when.
+    # Entries are made from the domain events each transaction commits (see services/audit.py)
+    # and written in batches by a background thread, so a request never waits for them.
+    # - id: The primary key.
+    # - occurred_at: When the change was committed.
+    # - actor_id: The user who made the change, or null for registrations, CLI commands and jobs.
+    #   Not a foreign key, so the trail outlives deleted users.
+    # - action: The event topic, e.g. "game.updated" or "user.deleted".
+    # - entity_id: The ID of the record that changed.
+    # - request_id: The request that made the change, as in the access log and X-Request-ID.
+    # - details: The event's payload, e.g. the game a score belongs to.
+
+    __tablename__ = "audit_log"  # Specifies the table name in the database
+
+    id = db.Column(db.Integer, primary_key=True)
+    occurred_at = db.Column(db.DateTime, nullable=False, index=True)  # Indexed for time ranges and pruning
+    actor_id = db.Column(db.Integer, index=True)  # Indexed to list everything one user changed
+    action = db.Column(db.String(80), nullable=False)
+    entity_id = db.Column(db.Integer)
+    request_id = db.Column(db.String(64))
+    details = db.Column(db.JSON, nullable=False, default=dict)
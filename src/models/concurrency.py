@@ -0,0 +1,58 @@
+from init import db
+
+# Resolutions of the concurrent player time series, finest first
+RESOLUTION_MINUTE = "minute"
+RESOLUTION_HOUR = "hour"
+RESOLUTION_DAY = "day"
+
+class ConcurrencyBlock(db.Model):
+
+    # This class stores a block of a game's concurrent player time series as a packed array
+    # (see services/concurrency_series.py), so a year of history is a few dozen rows.
+    # - game_id: Foreign key linking to the Game.
+    # - resolution: 'minute', 'hour' or 'day'.
+    # - start: First day covered. Minute blocks cover one day (1440 counts); hour blocks
+    #   30 days and day blocks 360 days, each slot holding the peak and average.
+    # - data: The packed values.
+
+    __tablename__ = "concurrency_blocks"  # Specifies the table name in the database
+
+    # The primary key doubles as the (game_id, resolution, start) range index
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), primary_key=True)
+    resolution = db.Column(db.String(10), primary_key=True)
+    start = db.Column(db.Date, primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+
+class ConcurrencyChange(db.Model):
+
+    # This class records changes in a game's players online, per minute, that have not been
+    # folded into its minute blocks yet (see services/concurrency_series.py). A session adds
+    # +1 at the minute it starts and -1 at the minute it ends, so the count at any minute is
+    # the sum of the changes up to it.
+    # - game_id: Foreign key linking to the Game.
+    # - minute: Minutes since 1970-01-01.
+    # - delta: Net change in players online at that minute.
+
+    __tablename__ = "concurrency_changes"  # Specifies the table name in the database
+
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), primary_key=True)
+    minute = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    delta = db.Column(db.Integer, nullable=False)
+
+
+class OpenSession(db.Model):
+
+    # This class tracks sessions that have not ended yet. They are added to the time series
+    # once they end; until then they are counted as online from their start to now.
+    # - session_id: The ID of the session (sessions may be on a shard, so there is no foreign key).
+    # - user_id: Foreign key linking to the User, so deleting the user removes the row.
+    # - game_id: Foreign key linking to the Game.
+    # - start_time: When the session started.
+
+    __tablename__ = "open_sessions"  # Specifies the table name in the database
+
+    session_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), nullable=False, index=True)
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), nullable=False, index=True)
+    start_time = db.Column(db.DateTime, nullable=False)
@@ -1,32 +1,58 @@
-from init import db, ma
-from marshmallow import fields
-
-class Developer(db.Model):
-    
-    # This class represents the Developer model in the database.
-    # - id: The primary key of the developer.
-    # - name: The name of the developer, which should be unique and not null.
-    
-    __tablename__ = "developers"  # Specifies the table name in the database
-
-    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each developer
-    name = db.Column(db.String(150), nullable=False, unique=True)  # Developer name, unique and non-null
-
-    # Relationship to associate games with this developer
-    games = db.relationship("Game", back_populates="developer", lazy='dynamic')  # Games developed by this developer
-
-
-class DeveloperSchema(ma.Schema):
-    # Fields to include in serialisation
-    id = fields.Integer(dump_only=True)
-    name = fields.String(required=True)
-    # Nested fields for related games, avoiding recursive serialisation
-    games = fields.List(fields.Nested("GameSchema", exclude=["developer"]))
-
-    class Meta:
-        # Fields to include in serialisation
-        fields = ("id", "name", "games") 
-
-# Instances of DeveloperSchema for serialising single and multiple developer records
-developer_schema = DeveloperSchema()  # Single developer instance
+from init import db, ma
+from marshmallow import fields
+from datetime import datetime
+from sqlalchemy import event, DDL
+
+class Developer(db.Model):
+    
+    # This class represents the Developer model in the database.
+    # - id: The primary key of the developer.
+    # - name: The name of the developer, which should be unique and not null.
+    # - updated_at: When the developer was created or last changed.
+    # - version: Row version, bumped on every update and used as the ETag.
+    
+    __tablename__ = "developers"  # Specifies the table name in the database
+
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each developer
+    name = db.Column(db.String(150), nullable=False, unique=True)  # Developer name, unique and non-null
+
+    # When the row was created or last changed, for /sync (see services/sync.py)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now, index=True)
+
+    # Row version for optimistic concurrency: every UPDATE checks and bumps it, so a write
+    # based on a stale read fails instead of overwriting (see services/concurrency.py)
+    version = db.Column(db.Integer, nullable=False, server_default="1")  # Returned as the ETag
+    __mapper_args__ = {"version_id_col": version}
+
+    # Relationship to associate games with this developer
+    # passive_deletes="all" leaves the games untouched so the database RESTRICT rule applies
+    games = db.relationship("Game", back_populates="developer", lazy='dynamic', passive_deletes="all")  # Games developed by this developer
+    # Read-only copy of games, which DeveloperSchema serialises, so it can be eager-loaded
+    game_list = db.relationship("Game", viewonly=True)
+
+
+# PostgreSQL search indexes on the name (used by services/search.py):
+# trigram and full-text GIN indexes for ranked search, and a lower(name)
+# text_pattern_ops B-tree index for prefix autocomplete
+for ddl in (
+    "CREATE INDEX IF NOT EXISTS ix_developers_name_trgm ON developers USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_developers_name_fts ON developers USING gin (to_tsvector('simple', name))",
+    "CREATE INDEX IF NOT EXISTS ix_developers_name_prefix ON developers (lower(name) text_pattern_ops)",
+):
+    event.listen(Developer.__table__, "after_create", DDL(ddl).execute_if(dialect="postgresql"))
+
+
+class DeveloperSchema(ma.Schema):
+    # Fields to include in serialisation
+    id = fields.Integer(dump_only=True)
+    name = fields.String(required=True)
+    # Nested fields for related games, avoiding recursive serialisation
+    games = fields.List(fields.Nested("GameSchema", exclude=["developer"]), attribute="game_list")
+
+    class Meta:
+        # Fields to include in serialisation
+        fields = ("id", "name", "games") 
+
+# Instances of DeveloperSchema for serialising single and multiple developer records
+developer_schema = DeveloperSchema()  # Single developer instance
 developers_schema = DeveloperSchema(many=True)  # Multiple developers instance
\ No newline at end of file
@@ -1,46 +1,97 @@
-from init import db, ma
-from marshmallow import fields
-
-class Game(db.Model):
-
-    # This class represents the Game model in the database.
-    # - id: The primary key of the game.
-    # - title: The title of the game, which should be unique and not null.
-    # - genre_id: Foreign key linking to the Genre of the game.
-    # - developer_id: Foreign key linking to the Developer of the game.
-
-    __tablename__ = "games"  # Specifies the table name in the database
-
-    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each game
-    title = db.Column(db.String(150), nullable=False, unique=True)  # Game title, unique and non-null
-    genre_id = db.Column(db.Integer, db.ForeignKey('genres.id'), nullable=False)  # Foreign key to Genre
-    developer_id = db.Column(db.Integer, db.ForeignKey('developers.id'), nullable=False)  # Foreign key to Developer
-    
-    # Establishing relationships with related models
-    genre = db.relationship("Genre", back_populates="games")  # Relationship with the Genre model
-    developer = db.relationship("Developer", back_populates="games")  # Relationship with the Developer model
-    scores = db.relationship("Score", back_populates="game", lazy='dynamic')  # Scores achieved in this game
-    sessions = db.relationship("Session", back_populates="game", lazy='dynamic')  # Sessions related to this game
-    achievements = db.relationship("Achievement", back_populates="game", lazy='dynamic')  # Achievements linked to the game
-
-
-class GameSchema(ma.Schema):
-
-    # Fields for serialising and deserialising Game objects
-    id = fields.Integer(dump_only=True)
-    title = fields.String(required=True)
-    # Nested fields for related genre, developer, scores, and sessions, while avoiding recursive data exposure
-    genre = fields.Nested("GenreSchema", exclude=["games"])
-    developer = fields.Nested("DeveloperSchema", exclude=["games"])
-    scores = fields.List(fields.Nested("ScoreSchema", exclude=["game"]))
-    sessions = fields.List(fields.Nested("SessionSchema", exclude=["game"]))
-    achievements = fields.List(fields.Nested("AchievementSchema", exclude=["game"]))  # Serialize related achievements
-
-    # Meta class specifies the fields in serialisation
-    class Meta:
-    
-        fields = ("id", "title", "genre", "developer", "scores", "sessions", "achievements")
-
-# Instances of GameSchema for serialising single and multiple game entries
-game_schema = GameSchema()  # Single game instance
-games_schema = GameSchema(many=True)  # Multiple games instance
\ No newline at end of file
+from init import db, ma
+from marshmallow import fields
+from datetime import datetime
+from sqlalchemy import event, DDL
+from sqlalchemy.orm import subqueryload, joinedload
+from services.reference_data import ReferenceField
+from models.score import Score
+from models.session import Session
+from models.achievement import Achievement
+
+class Game(db.Model):
+
+    # This class represents the Game model in the database.
+    # - id: The primary key of the game.
+    # - title: The title of the game, which should be unique and not null.
+    # - genre_id: Foreign key linking to the Genre of the game.
+    # - developer_id: Foreign key linking to the Developer of the game.
+    # - updated_at: When the game was created or last changed.
+    # - version: Row version, bumped on every update and used as the ETag.
+
+    __tablename__ = "games"  # Specifies the table name in the database
+
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each game
+    title = db.Column(db.String(150), nullable=False, unique=True)  # Game title, unique and non-null
+    # A genre or developer cannot be deleted while games still reference it
+    genre_id = db.Column(db.Integer, db.ForeignKey('genres.id', ondelete="RESTRICT"), nullable=False, index=True)  # Foreign key to Genre
+    developer_id = db.Column(db.Integer, db.ForeignKey('developers.id', ondelete="RESTRICT"), nullable=False, index=True)  # Foreign key to Developer
+
+    # When the row was created or last changed, for /sync (see services/sync.py)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now, index=True)
+
+    # Row version for optimistic concurrency: every UPDATE checks and bumps it, so a write
+    # based on a stale read fails instead of overwriting (see services/concurrency.py)
+    version = db.Column(db.Integer, nullable=False, server_default="1")  # Returned as the ETag
+    __mapper_args__ = {"version_id_col": version}
+    
+    # Establishing relationships with related models
+    # Child rows are deleted by the database's ON DELETE CASCADE, so passive_deletes stops
+    # the ORM from loading them one by one when a game is deleted
+    genre = db.relationship("Genre", back_populates="games")  # Relationship with the Genre model
+    developer = db.relationship("Developer", back_populates="games")  # Relationship with the Developer model
+    scores = db.relationship("Score", back_populates="game", lazy='dynamic', passive_deletes=True)  # Scores achieved in this game
+    sessions = db.relationship("Session", back_populates="game", lazy='dynamic', passive_deletes=True)  # Sessions related to this game
+    achievements = db.relationship("Achievement", back_populates="game", lazy='dynamic', passive_deletes=True)  # Achievements linked to the game
+
+    # Read-only copies of the collections above, which GameSchema serialises. Dynamic
+    # relationships cannot be eager-loaded, so these are, with game_detail_options()
+    score_list = db.relationship("Score", viewonly=True)
+    session_list = db.relationship("Session", viewonly=True)
+    achievement_list = db.relationship("Achievement", viewonly=True)
+
+
+# PostgreSQL search indexes on the title (used by services/search.py):
+# trigram and full-text GIN indexes for ranked search, and a lower(title)
+# text_pattern_ops B-tree index for prefix autocomplete
+for ddl in (
+    "CREATE INDEX IF NOT EXISTS ix_games_title_trgm ON games USING gin (title gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_games_title_fts ON games USING gin (to_tsvector('simple', title))",
+    "CREATE INDEX IF NOT EXISTS ix_games_title_prefix ON games (lower(title) text_pattern_ops)",
+):
+    event.listen(Game.__table__, "after_create", DDL(ddl).execute_if(dialect="postgresql"))
+
+
+class GameSchema(ma.Schema):
+
+    # Fields for serialising and deserialising Game objects
+    id = fields.Integer(dump_only=True)
+    title = fields.String(required=True)
+    # Genre and developer as {"id", "name"}, from the in-process reference data rather than
+    # a query per game (see services/reference_data.py)
+    genre = ReferenceField("genre")
+    developer = ReferenceField("developer")
+    # Nested fields for related scores and sessions, while avoiding recursive data exposure
+    scores = fields.List(fields.Nested("ScoreSchema", exclude=["game"]), attribute="score_list")
+    sessions = fields.List(fields.Nested("SessionSchema", exclude=["game"]), attribute="session_list")
+    achievements = fields.List(fields.Nested("AchievementSchema", exclude=["game"]), attribute="achievement_list")  # Serialize related achievements
+
+    # Meta class specifies the fields in serialisation
+    class Meta:
+    
+        fields = ("id", "title", "genre", "developer", "scores", "sessions", "achievements")
+
+# Instances of GameSchema for serialising single and multiple game entries
+game_schema = GameSchema()  # Single game instance
+games_schema = GameSchema(many=True)  # Multiple games instance
+
+def game_detail_options():
+    # Loader options for what game_schema nests: each collection is read in one query,
+    # joined to the user of each row, rather than lazily game by game and row by row.
+    # subqueryload repeats the games' query as a subquery, so the whole catalogue is still
+    # one query, where selectinload would send its IDs 500 at a time.
+    # Built on use, since building them needs every model mapped.
+    return (
+        subqueryload(Game.score_list).joinedload(Score.user),
+        subqueryload(Game.session_list).joinedload(Session.user),
+        subqueryload(Game.achievement_list).joinedload(Achievement.user),
+    )
\ No newline at end of file
@@ -1,28 +1,52 @@
-from init import db, ma
-from marshmallow import fields
-
-class Genre(db.Model):
-    
-    __tablename__ = "genres"  # Specifies the table name in the database
-
-    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each genre
-    name = db.Column(db.String(80), nullable=False, unique=True)  # Genre name, unique and non-null
-
-    # Relationship to associate games with this genre
-    games = db.relationship("Game", back_populates="genre", lazy='dynamic')  # Games that belong to this genre
-
-
-class GenreSchema(ma.Schema):
-   
-    id = fields.Integer(dump_only=True)
-    name = fields.String(required=True)
-    # Excludes certain sensitive fields in nested representations to prevent recursive data exposure
-    games = fields.List(fields.Nested("GameSchema", exclude=["genre"]))
-
-    class Meta:
-        
-        fields = ("id", "name", "games")  # Fields to include in serialisation
-
-# Instances of GenreSchema for serialising single and multiple genre records
-genre_schema = GenreSchema()  # Single genre instance
+from init import db, ma
+from marshmallow import fields
+from datetime import datetime
+from sqlalchemy import event, DDL
+
+class Genre(db.Model):
+    
+    __tablename__ = "genres"  # Specifies the table name in the database
+
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each genre
+    name = db.Column(db.String(80), nullable=False, unique=True)  # Genre name, unique and non-null
+
+    # When the row was created or last changed, for /sync (see services/sync.py)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now, index=True)
+
+    # Row version for optimistic concurrency: every UPDATE checks and bumps it, so a write
+    # based on a stale read fails instead of overwriting (see services/concurrency.py)
+    version = db.Column(db.Integer, nullable=False, server_default="1")  # Returned as the ETag
+    __mapper_args__ = {"version_id_col": version}
+
+    # Relationship to associate games with this genre
+    # passive_deletes="all" leaves the games untouched so the database RESTRICT rule applies
+    games = db.relationship("Game", back_populates="genre", lazy='dynamic', passive_deletes="all")  # Games that belong to this genre
+    # Read-only copy of games, which GenreSchema serialises, so it can be eager-loaded
+    game_list = db.relationship("Game", viewonly=True)
+
+
+# PostgreSQL search indexes on the name (used by services/search.py):
+# trigram and full-text GIN indexes for ranked search, and a lower(name)
+# text_pattern_ops B-tree index for prefix autocomplete
+for ddl in (
+    "CREATE INDEX IF NOT EXISTS ix_genres_name_trgm ON genres USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_genres_name_fts ON genres USING gin (to_tsvector('simple', name))",
+    "CREATE INDEX IF NOT EXISTS ix_genres_name_prefix ON genres (lower(name) text_pattern_ops)",
+):
+    event.listen(Genre.__table__, "after_create", DDL(ddl).execute_if(dialect="postgresql"))
+
+
+class GenreSchema(ma.Schema):
+   
+    id = fields.Integer(dump_only=True)
+    name = fields.String(required=True)
+    # Excludes certain sensitive fields in nested representations to prevent recursive data exposure
+    games = fields.List(fields.Nested("GameSchema", exclude=["genre"]), attribute="game_list")
+
+    class Meta:
+        
+        fields = ("id", "name", "games")  # Fields to include in serialisation
+
+# Instances of GenreSchema for serialising single and multiple genre records
+genre_schema = GenreSchema()  # Single genre instance
 genres_schema = GenreSchema(many=True)  # Multiple genres instance
\ No newline at end of file
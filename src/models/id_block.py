@@ -0,0 +1,14 @@
+from init import db
+
+class IdBlock(db.Model):
+
+    # This class represents the next free ID of a table whose rows are spread over shards.
+    # Shard databases cannot share an autoincrement counter, so IDs are handed out from
+    # here in blocks (see services/sharding.py) and stay unique across every shard.
+    # - name: The table the IDs are for.
+    # - next_id: The first ID not yet handed out.
+
+    __tablename__ = "id_blocks"  # Specifies the table name in the database
+
+    name = db.Column(db.String(80), primary_key=True)  # Table name
+    next_id = db.Column(db.BigInteger, nullable=False)  # First unallocated ID
@@ -0,0 +1,20 @@
+from init import db
+
+class IdempotencyRecord(db.Model):
+
+    # This class represents a stored response for an Idempotency-Key, shared by all workers.
+    # - key: The client's key, scoped by user and endpoint.
+    # - request_hash: Hash of the request body, to detect a key reused for another request.
+    # - status_code: The response status, null while the first request is still running.
+    # - response_body: The response body to replay to retries.
+    # - mimetype: The response content type.
+    # - expires_at: When the record can be discarded.
+
+    __tablename__ = "idempotency_records"  # Specifies the table name in the database
+
+    key = db.Column(db.String(255), primary_key=True)  # Scoped idempotency key
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)  # Null while in progress
+    response_body = db.Column(db.Text)
+    mimetype = db.Column(db.String(100))
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # Indexed for purging expired records
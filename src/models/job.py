@@ -0,0 +1,69 @@
+from init import db, ma
+from marshmallow import fields
+from datetime import datetime
+
+# Job statuses
+STATUS_QUEUED = "queued"  # Waiting for run_at, or for a free worker
+STATUS_RUNNING = "running"  # Claimed by a worker
+STATUS_FINISHED = "finished"
+STATUS_FAILED = "failed"  # Gave up after max_attempts
+
+class Job(db.Model):
+
+    # This class represents a unit of background work, run by `flask worker` (see services/jobs.py).
+    # - id: The primary key of the job.
+    # - name: The registered task to run.
+    # - payload: Keyword arguments for the task.
+    # - status: One of queued, running, finished or failed.
+    # - attempts: Number of times a worker has started the job.
+    # - max_attempts: Attempts allowed before the job is marked as failed.
+    # - run_at: Earliest time the job may run; pushed back after each failure.
+    # - locked_at: When the running worker last reported in, to detect crashed workers.
+    # - locked_by: Name of the worker running the job.
+    # - last_error: Error from the latest failed attempt.
+    # - result: Progress or result reported by the task.
+    # - requested_by: The ID of the user who started the job, if any. Not a foreign key, so
+    #   it is kept when that user is deleted and they can still follow their own purge.
+    # - created_at, finished_at: When the job was enqueued and when it finished or failed.
+
+    __tablename__ = "jobs"  # Specifies the table name in the database
+
+    # Workers look for queued jobs that are due, oldest first
+    __table_args__ = (db.Index("ix_jobs_status_run_at", "status", "run_at"),)
+
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each job
+    name = db.Column(db.String(80), nullable=False)  # Task name
+    payload = db.Column(db.JSON, nullable=False, default=dict)  # Task arguments
+    status = db.Column(db.String(20), nullable=False, default=STATUS_QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    locked_at = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(120))
+    last_error = db.Column(db.Text)
+    result = db.Column(db.JSON)
+    requested_by = db.Column(db.Integer)  # ID of the User who started the job
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    finished_at = db.Column(db.DateTime)
+
+
+class JobSchema(ma.Schema):
+
+    # Fields for serialising Job objects; jobs are only created through services/jobs.py
+    id = fields.Integer(dump_only=True)
+    name = fields.String(dump_only=True)
+    payload = fields.Dict(dump_only=True)
+    status = fields.String(dump_only=True)
+    attempts = fields.Integer(dump_only=True)
+    run_at = fields.DateTime(dump_only=True)
+    last_error = fields.String(dump_only=True)
+    result = fields.Raw(dump_only=True)
+    created_at = fields.DateTime(dump_only=True)
+    finished_at = fields.DateTime(dump_only=True)
+
+    class Meta:
+
+        fields = ("id", "name", "payload", "status", "attempts", "run_at", "last_error", "result", "created_at", "finished_at")
+
+# Instance of JobSchema for serialising a single job
+job_schema = JobSchema()
@@ -0,0 +1,20 @@
+from init import db
+from datetime import datetime
+
+class OutboxEvent(db.Model):
+
+    # This class represents a domain event (e.g. "game.updated"), written in the same
+    # transaction as the change it describes and relayed to every worker (see services/outbox.py).
+    # - id: The primary key, which also orders the events.
+    # - topic: What happened, as "<entity>.<action>".
+    # - entity_id: The ID of the record that changed.
+    # - payload: Extra details for subscribers.
+    # - created_at: When the event was recorded, used to prune old events.
+
+    __tablename__ = "outbox_events"  # Specifies the table name in the database
+
+    id = db.Column(db.Integer, primary_key=True)  # Unique, increasing identifier for each event
+    topic = db.Column(db.String(80), nullable=False)
+    entity_id = db.Column(db.Integer)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)  # Indexed for pruning
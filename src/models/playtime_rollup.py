@@ -0,0 +1,18 @@
+from init import db
+
+class PlaytimeRollup(db.Model):
+
+    # This class represents one user's total play time for one day, kept up to date as
+    # sessions end so playtime reports never have to scan the sessions table.
+    # - user_id: Foreign key linking to the User.
+    # - day: The calendar day (sessions crossing midnight are split between days).
+    # - seconds: Seconds played on that day by ended sessions.
+    # - sessions: Number of ended sessions that started on that day.
+
+    __tablename__ = "playtime_rollups"  # Specifies the table name in the database
+
+    # One row per user per day; the primary key doubles as the (user_id, day) range index
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    seconds = db.Column(db.Integer, nullable=False, default=0)
+    sessions = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,72 @@
+from init import db, ma
+from marshmallow import fields
+
+# Rating every player starts from, and the average of the field they are rated against
+INITIAL_RATING = 1500.0
+
+# Players with fewer rated scores than this are shown as provisional
+PROVISIONAL_GAMES = 10
+
+class ScoreStats(db.Model):
+
+    # This class keeps running statistics of each game's scores (Welford's method), so a new
+    # score can be placed against the rest of the field without reading the scores table.
+    # - game_id: Foreign key linking to the Game.
+    # - count: Number of scores seen.
+    # - mean: Mean score.
+    # - m2: Sum of squared differences from the mean; the variance is m2 / count.
+
+    __tablename__ = "score_stats"  # Specifies the table name in the database
+
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    mean = db.Column(db.Float, nullable=False, default=0.0)
+    m2 = db.Column(db.Float, nullable=False, default=0.0)
+
+
+class Rating(db.Model):
+
+    # This class represents a player's skill rating in one game, updated as their scores arrive
+    # (see services/ratings.py).
+    # - user_id: Foreign key linking to the User.
+    # - game_id: Foreign key linking to the Game.
+    # - rating: Elo-style rating, starting at INITIAL_RATING.
+    # - games: Number of scores the rating is based on.
+    # - updated_at: When the latest of those scores was achieved.
+
+    __tablename__ = "ratings"  # Specifies the table name in the database
+
+    # Leaderboards read a game's ratings from the highest down
+    __table_args__ = (db.Index("ix_ratings_game_id_rating", "game_id", "rating"),)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), primary_key=True)  # Foreign key to User
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), primary_key=True)  # Foreign key to Game
+    rating = db.Column(db.Float, nullable=False, default=INITIAL_RATING)
+    games = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+    user = db.relationship("User")  # The rated player
+
+
+class RatingSchema(ma.Schema):
+
+    # Fields for serialising ratings; ratings are only written by services/ratings.py
+    user = fields.Nested("UserSchema", only=["id", "name"])
+    game_id = fields.Integer(dump_only=True)
+    rating = fields.Method("get_rating")
+    games = fields.Integer(dump_only=True)
+    provisional = fields.Method("get_provisional")
+    updated_at = fields.DateTime(dump_only=True)
+
+    def get_rating(self, obj):
+        return round(obj.rating, 1)
+
+    def get_provisional(self, obj):
+        return obj.games < PROVISIONAL_GAMES
+
+    class Meta:
+
+        fields = ("user", "game_id", "rating", "games", "provisional", "updated_at")
+
+# Instance of RatingSchema for serialising lists of ratings
+ratings_schema = RatingSchema(many=True)
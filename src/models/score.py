@@ -1,46 +1,90 @@
-from init import db, ma
-from marshmallow import fields
-
-class Score(db.Model):
-
-    # This class represents the Score model in the database.
-    # - id: The primary key of the score entry.
-    # - value: The score value achieved by the user.
-    # - date_achieved: The date and time when the score was achieved.
-    # - user_id: Foreign key linking to the User who achieved the score.
-    # - game_id: Foreign key linking to the Game for which the score is recorded.
-    
-    __tablename__ = "scores"  # Specifies the table name in the database
-
-    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each score entry
-    value = db.Column(db.Integer, nullable=False)  # The score value, must be non-null
-    date_achieved = db.Column(db.DateTime, nullable=False)  # Date and time when the score was achieved
-
-    # Foreign key to associate with a specific user
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-
-    # Foreign key to associate with a specific game
-    game_id = db.Column(db.Integer, db.ForeignKey('games.id'), nullable=False)
-
-    # Establishing relationships with the User and Game models
-    user = db.relationship("User", back_populates="scores")  # Relationship with User model
-    game = db.relationship("Game", back_populates="scores")  # Relationship with Game model
-
-
-class ScoreSchema(ma.Schema):
-    
-    id = fields.Integer(dump_only=True)
-    value = fields.Integer(required=True)
-    date_achieved = fields.DateTime(dump_only=True)  # Automatically set; not intended for input
-    # Nested fields for related user and game, avoiding recursive serialisation issues
-    user = fields.Nested("UserSchema", exclude=["scores", "password"])
-    game = fields.Nested("GameSchema", exclude=["scores"])
-
-    class Meta:
-
-        # Meta class defining which fields are included in serialisation
-        fields = ("id", "value", "date_achieved", "user", "game")  # Fields included in serialisation
-
-# Instances of ScoreSchema for serialising single and multiple score records
-score_schema = ScoreSchema()  # Single score instance
-scores_schema = ScoreSchema(many=True)  # Multiple scores instance
\ No newline at end of file
+from init import db, ma
+from marshmallow import fields
+from datetime import datetime
+
+# Review status of a score, set by the anomaly detector as it is submitted
+STATUS_ACCEPTED = "accepted"  # Normal score
+STATUS_FLAGGED = "flagged"  # Looked like an outlier; counted, waiting for review
+STATUS_QUARANTINED = "quarantined"  # Looked like an outlier; not counted until accepted
+STATUS_REJECTED = "rejected"  # Reviewed and found to be cheated; kept but never counted
+
+# Scores that count towards achievements and ratings
+COUNTED_STATUSES = (STATUS_ACCEPTED, STATUS_FLAGGED)
+
+# Scores waiting for review
+REVIEW_STATUSES = (STATUS_FLAGGED, STATUS_QUARANTINED)
+
+class Score(db.Model):
+
+    # This class represents the Score model in the database.
+    # - id: The primary key of the score entry.
+    # - value: The score value achieved by the user.
+    # - date_achieved: The date and time when the score was achieved.
+    # - user_id: Foreign key linking to the User who achieved the score.
+    # - game_id: Foreign key linking to the Game for which the score is recorded.
+    # - status: Review status, one of the STATUS_* values above.
+    # - flag_reason: Why the anomaly detector flagged the score, if it did.
+    # - updated_at: When the score was submitted or last reviewed.
+    # - idempotency_key: Identifies the request that created the score, for safe retries.
+    
+    __tablename__ = "scores"  # Specifies the table name in the database
+
+    # Only the few scores that are not accepted are indexed, for the review queue
+    __table_args__ = (
+        db.Index(
+            "ix_scores_status_review", "status",
+            postgresql_where=db.text("status <> 'accepted'"),
+            sqlite_where=db.text("status <> 'accepted'"),
+        ),
+        db.Index("ix_scores_user_id_updated_at", "user_id", "updated_at"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each score entry
+    value = db.Column(db.Integer, nullable=False)  # The score value, must be non-null
+    date_achieved = db.Column(db.DateTime, nullable=False)  # Date and time when the score was achieved
+    status = db.Column(db.String(20), nullable=False, default=STATUS_ACCEPTED, server_default=STATUS_ACCEPTED)
+    flag_reason = db.Column(db.String(40))  # Set only for flagged and quarantined scores
+
+    # Digest of the Idempotency-Key and body of the request that created the row, if it
+    # had a key, so a retry finds the row rather than inserting another (see ShardRouter.add)
+    idempotency_key = db.Column(db.String(64), unique=True, index=True)
+
+    # When the row was created or last changed, for /sync (see services/sync.py); indexed
+    # with user_id in __table_args__, since players sync their own rows
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+    # Foreign key to associate with a specific user, deleted together with the user
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), nullable=False, index=True)
+
+    # Foreign key to associate with a specific game, deleted together with the game
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), nullable=False, index=True)
+
+    # Establishing relationships with the User and Game models
+    user = db.relationship("User", back_populates="scores")  # Relationship with User model
+    game = db.relationship("Game", back_populates="scores")  # Relationship with Game model
+
+
+class ScoreSchema(ma.Schema):
+    
+    id = fields.Integer(dump_only=True)
+    value = fields.Integer(required=True)
+    date_achieved = fields.DateTime(dump_only=True)  # Automatically set; not intended for input
+    status = fields.String(dump_only=True)  # Set by the anomaly detector and by reviews
+    flag_reason = fields.String(dump_only=True)
+    # Nested fields for related user and game, avoiding recursive serialisation issues
+    # Only the user's and game's own fields are included, because their collections lead
+    # back to other records (user -> achievements -> game -> ...) and would never end
+    user = fields.Nested("UserSchema", only=["id", "name", "email"])
+    game = fields.Nested("GameSchema", only=["id", "title", "genre", "developer"])
+
+    class Meta:
+
+        # Meta class defining which fields are included in serialisation
+        fields = ("id", "value", "date_achieved", "status", "flag_reason", "user", "game")  # Fields included in serialisation
+
+# Instances of ScoreSchema for serialising single and multiple score records
+# Players are not told why a score was flagged, which would show them the limits
+score_schema = ScoreSchema(exclude=["flag_reason"])  # Single score instance
+scores_schema = ScoreSchema(many=True, exclude=["flag_reason"])  # Multiple scores instance
+review_score_schema = ScoreSchema()  # Single score for reviewers, with the flag reason
+review_scores_schema = ScoreSchema(many=True)  # Review queue
\ No newline at end of file
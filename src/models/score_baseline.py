@@ -0,0 +1,26 @@
+from init import db
+
+# user_id of a game's baseline over every player
+ALL_PLAYERS = 0
+
+class ScoreBaseline(db.Model):
+
+    # This class stores the running statistics the score anomaly detector compares new
+    # scores against (see services/anomalies.py), so every worker starts warm.
+    # - game_id: Foreign key linking to the Game.
+    # - user_id: The player, or ALL_PLAYERS for the game as a whole. Not a foreign key,
+    #   since the game-wide rows have no player; rows are deleted with the user instead
+    #   (anomalies.delete_player, and the purge).
+    # - count, mean, m2: Welford statistics of the accepted scores; the variance is m2 / count.
+    # - quantiles: P-squared markers of the median and 99th percentile (game-wide rows only).
+    # - updated_at: When the row was last synced from a worker.
+
+    __tablename__ = "score_baselines"  # Specifies the table name in the database
+
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True, index=True)
+    count = db.Column(db.Integer, nullable=False)
+    mean = db.Column(db.Float, nullable=False)
+    m2 = db.Column(db.Float, nullable=False)
+    quantiles = db.Column(db.LargeBinary)
+    updated_at = db.Column(db.DateTime, nullable=False)
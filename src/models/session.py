@@ -1,53 +1,82 @@
-from init import db, ma
-from marshmallow import fields
-from datetime import datetime
-
-class Session(db.Model):
-    
-    # This class represents the Session model in the database.
-    # - id: The primary key of the session.
-    # - start_time: The timestamp indicating when the session started.
-    # - end_time: The timestamp indicating when the session ended. This can be null if the session is ongoing.
-    # - user_id: Foreign key linking to the User who is participating in the session.
-    # - game_id: Foreign key linking to the Game that the session is associated with.
-    
-    __tablename__ = "sessions"  # Specifies the table name in the database
-
-    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each session
-
-    # Start time of the session, cannot be null
-    start_time = db.Column(db.DateTime, default=datetime.now(), nullable=False)
-
-    # End time of the session, can be null if the session is ongoing
-    end_time = db.Column(db.DateTime)
-
-    # Foreign key to link the session with a specific user
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-
-    # Foreign key to link the session with a specific game
-    game_id = db.Column(db.Integer, db.ForeignKey('games.id'), nullable=False)
-
-    # Establishing relationships with the User and Game models
-    user = db.relationship("User", back_populates="sessions")  # User model relationship
-    game = db.relationship("Game", back_populates="sessions")  # Game model relationship
-
-class SessionSchema(ma.Schema):
-
-    # Schema for serialising and deserialising Session objects.
-
-    # Fields to include in serialisation
-    id = fields.Integer(dump_only=True)
-    start_time = fields.DateTime(required=True)
-    end_time = fields.DateTime()
-
-    # Nested fields for associated user and game, avoiding unnecessary circular references
-    user = fields.Nested("UserSchema", exclude=["sessions", "password"])
-    game = fields.Nested("GameSchema", exclude=["sessions"])
-
-    class Meta:
-        
-        fields = ("id", "start_time", "end_time", "user", "game")  # Fields to include in serialisation
-
-# Instances of SessionSchema for serialising single and multiple session data
-session_schema = SessionSchema()  # Single session instance
+from init import db, ma
+from marshmallow import fields
+from datetime import datetime
+from sqlalchemy import event, DDL
+
+class Session(db.Model):
+    
+    # This class represents the Session model in the database.
+    # - id: The primary key of the session.
+    # - start_time: The timestamp indicating when the session started.
+    # - end_time: The timestamp indicating when the session ended. This can be null if the session is ongoing.
+    # - user_id: Foreign key linking to the User who is participating in the session.
+    # - game_id: Foreign key linking to the Game that the session is associated with.
+    # - updated_at: When the session was started or last changed (e.g. ended).
+    # - idempotency_key: Identifies the request that created the session, for safe retries.
+    
+    __tablename__ = "sessions"  # Specifies the table name in the database
+
+    # A player's history is read by time range, so sessions are indexed by (user_id, start_time);
+    # the index also serves lookups by user_id alone
+    __table_args__ = (
+        db.Index("ix_sessions_user_id_start_time", "user_id", "start_time"),
+        db.Index("ix_sessions_user_id_updated_at", "user_id", "updated_at"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)  # Unique identifier for each session
+
+    # Start time of the session, cannot be null
+    start_time = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+    # End time of the session, can be null if the session is ongoing
+    end_time = db.Column(db.DateTime)
+
+    # Digest of the Idempotency-Key and body of the request that created the row, if it
+    # had a key, so a retry finds the row rather than inserting another (see ShardRouter.add)
+    idempotency_key = db.Column(db.String(64), unique=True, index=True)
+
+    # When the row was created or last changed, for /sync (see services/sync.py); indexed
+    # with user_id in __table_args__, since players sync their own rows
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+    # Foreign key to link the session with a specific user, deleted together with the user
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
+
+    # Foreign key to link the session with a specific game, deleted together with the game
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), nullable=False, index=True)
+
+    # Establishing relationships with the User and Game models
+    user = db.relationship("User", back_populates="sessions")  # User model relationship
+    game = db.relationship("Game", back_populates="sessions")  # Game model relationship
+
+
+# Sessions are inserted in roughly start_time order, so on PostgreSQL a small BRIN index
+# covers time-range scans across all players (e.g. everything played last week)
+start_time_brin_index = DDL(
+    "CREATE INDEX IF NOT EXISTS ix_sessions_start_time_brin ON sessions USING brin (start_time)"
+).execute_if(dialect="postgresql")
+event.listen(Session.__table__, "after_create", start_time_brin_index)
+
+
+class SessionSchema(ma.Schema):
+
+    # Schema for serialising and deserialising Session objects.
+
+    # Fields to include in serialisation
+    id = fields.Integer(dump_only=True)
+    start_time = fields.DateTime(required=True)
+    end_time = fields.DateTime()
+
+    # Nested fields for associated user and game, avoiding unnecessary circular references
+    # Only the user's and game's own fields are included, because their collections lead
+    # back to other records (user -> achievements -> game -> ...) and would never end
+    user = fields.Nested("UserSchema", only=["id", "name", "email"])
+    game = fields.Nested("GameSchema", only=["id", "title", "genre", "developer"])
+
+    class Meta:
+        
+        fields = ("id", "start_time", "end_time", "user", "game")  # Fields to include in serialisation
+
+# Instances of SessionSchema for serialising single and multiple session data
+session_schema = SessionSchema()  # Single session instance
 sessions_schema = SessionSchema(many=True)  # Multiple sessions instance
\ No newline at end of file
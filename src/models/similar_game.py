@@ -0,0 +1,42 @@
+from init import db
+from datetime import datetime
+
+class SimilarGame(db.Model):
+
+    # This class stores one entry of a game's "players also played" list, precomputed from
+    # co-play in the sessions table (see services/recommendations.py).
+    # - game_id: Foreign key linking to the Game the list is for.
+    # - similar_game_id: Foreign key linking to the recommended Game.
+    # - score: Cosine similarity of the two games' sets of players (0 to 1).
+    # - players_in_common: Number of players who played both games.
+
+    __tablename__ = "similar_games"  # Specifies the table name in the database
+
+    # A game's list is read best first
+    __table_args__ = (db.Index("ix_similar_games_game_id_score", "game_id", "score"),)
+
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), primary_key=True)
+    similar_game_id = db.Column(db.Integer, db.ForeignKey('games.id', ondelete="CASCADE"), primary_key=True, index=True)
+    score = db.Column(db.Float, nullable=False)
+    players_in_common = db.Column(db.Integer, nullable=False)
+
+    similar_game = db.relationship("Game", foreign_keys=[similar_game_id])  # The recommended game
+
+
+class SimilarityRun(db.Model):
+
+    # This class records each refresh of the similar games lists, so the next incremental
+    # refresh knows which sessions are new.
+    # - id: The primary key of the run.
+    # - full: Whether every game was recomputed.
+    # - until: Sessions started before this time were included.
+    # - games: Number of games whose lists were recomputed.
+    # - finished_at: When the run finished.
+
+    __tablename__ = "similarity_runs"  # Specifies the table name in the database
+
+    id = db.Column(db.Integer, primary_key=True)
+    full = db.Column(db.Boolean, nullable=False)
+    until = db.Column(db.DateTime, nullable=False)
+    games = db.Column(db.Integer, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
@@ -0,0 +1,25 @@
+from init import db
+from datetime import datetime
+
+class Tombstone(db.Model):
+
+    # This class represents a deleted row, kept so that clients syncing through /sync learn
+    # to drop their copy of it (see services/sync.py).
+    # - id: The primary key, which orders tombstones with the same deleted_at.
+    # - resource: The resource the row belonged to, as /sync names it (e.g. "games").
+    # - entity_id: The ID the deleted row had.
+    # - user_id: The player the row belonged to, for resources players only sync their own
+    #   rows of (scores, sessions, achievements); null for the catalogue. Not a foreign key,
+    #   since the tombstone outlives the row and may outlive the player.
+    # - deleted_at: When the row was deleted.
+
+    __tablename__ = "tombstones"  # Specifies the table name in the database
+
+    # /sync reads one resource's tombstones for one player (or for the catalogue) by time
+    __table_args__ = (db.Index("ix_tombstones_resource_user_id_deleted_at", "resource", "user_id", "deleted_at", "id"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String(40), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)  # Indexed for pruning
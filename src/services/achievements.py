@@ -0,0 +1,203 @@
+import threading
+from collections import namedtuple
+
+from sqlalchemy import select, insert, literal, exists
+from sqlalchemy.dialects import postgresql, sqlite
+
+from init import db
+from services import outbox
+from services.jobs import task
+from models.achievement import Achievement
+from models.achievement_definition import (
+    AchievementDefinition,
+    AchievementProgress,
+    RULE_SCORE_THRESHOLD,
+    RULE_SESSION_COUNT,
+    RULE_PLAY_TIME,
+)
+
+# Immutable copy of an achievement definition, safe to share between requests
+Rule = namedtuple("Rule", "id name description rule threshold")
+
+# Progress counter watched by each rule kind
+RULE_COUNTERS = {
+    RULE_SCORE_THRESHOLD: "best_score",
+    RULE_SESSION_COUNT: "session_count",
+    RULE_PLAY_TIME: "play_seconds",
+}
+
+
+class RuleCache:
+
+    # Per-game cache of achievement definitions.
+    # Rules are loaded the first time a game sees an event and kept until invalidated,
+    # so evaluating an event never queries the definitions table.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rules = {}
+
+    def rules_for(self, game_id):
+        rules = self._rules.get(game_id)
+        if rules is None:
+            definitions = db.session.scalars(
+                select(AchievementDefinition).where(AchievementDefinition.game_id == game_id)
+            )
+            rules = tuple(
+                Rule(d.id, d.name, d.description, d.rule, d.threshold) for d in definitions
+            )
+            with self._lock:
+                self._rules[game_id] = rules
+        return rules
+
+    def invalidate(self, game_id=None):
+        # Forget the rules of one game, or of every game when no ID is given
+        with self._lock:
+            if game_id is None:
+                self._rules.clear()
+            else:
+                self._rules.pop(game_id, None)
+
+
+# Shared rule cache for this process
+rule_cache = RuleCache()
+
+# Drop a game's rules whenever any worker adds or removes one of its definitions, or deletes it
+outbox.subscribe("achievement_definition.", lambda event: rule_cache.invalidate(event.payload.get("game_id")))
+outbox.subscribe("game.deleted", lambda event: rule_cache.invalidate(event.entity_id))
+
+
+def _insert_for_dialect():
+    name = db.engine.dialect.name
+    if name == "postgresql":
+        return postgresql.insert
+    if name == "sqlite":
+        return sqlite.insert
+    raise RuntimeError(f"Achievement progress is not supported on {name}")
+
+
+def _progress(user_id, game_id):
+    # Fetch (and lock) the progress row for this user and game, creating it on first use.
+    # The row is created with INSERT ... ON CONFLICT DO NOTHING, so two first events for
+    # the same player and game cannot both try to insert it
+    db.session.execute(
+        _insert_for_dialect()(AchievementProgress.__table__)
+        .values(user_id=user_id, game_id=game_id, best_score=0, session_count=0, play_seconds=0)
+        .on_conflict_do_nothing(index_elements=["user_id", "game_id"])
+    )
+    return db.session.get(
+        AchievementProgress, (user_id, game_id), with_for_update=True, populate_existing=True
+    )
+
+
+def _advance(progress, rule_kind, after):
+
+    # Move one counter forward and unlock every rule of that kind whose threshold was crossed.
+    # Only rules of the event's game are checked, so the cost is O(rules for that game).
+
+    counter = RULE_COUNTERS[rule_kind]
+    before = getattr(progress, counter)
+    if after <= before:
+        return []
+    setattr(progress, counter, after)
+
+    # A player who already holds an achievement with the rule's name (e.g. one created by
+    # hand) keeps it; ON CONFLICT skips the unlock instead of breaking the unique constraint
+    unlocked = []
+    for rule in rule_cache.rules_for(progress.game_id):
+        if rule.rule == rule_kind and before < rule.threshold <= after:
+            achievement = db.session.scalars(
+                _insert_for_dialect()(Achievement)
+                .values(
+                    name=rule.name,
+                    description=rule.description,
+                    user_id=progress.user_id,
+                    game_id=progress.game_id,
+                    definition_id=rule.id,
+                )
+                .on_conflict_do_nothing(index_elements=["user_id", "game_id", "name"])
+                .returning(Achievement)
+            ).one_or_none()
+            if achievement is not None:
+                unlocked.append(achievement)
+    return unlocked
+
+
+def record_score(score):
+
+    # Update progress for a newly created score.
+    # Runs in the caller's transaction; returns the achievements unlocked by the score.
+
+    progress = _progress(score.user_id, score.game_id)
+    return _advance(progress, RULE_SCORE_THRESHOLD, score.value)
+
+
+def record_session(session):
+
+    # Update progress for a newly created session, including its play time when it has ended.
+    # Runs in the caller's transaction; returns the achievements unlocked by the session.
+
+    progress = _progress(session.user_id, session.game_id)
+    unlocked = _advance(progress, RULE_SESSION_COUNT, progress.session_count + 1)
+    if session.end_time is not None:
+        unlocked += _add_play_time(progress, session)
+    return unlocked
+
+
+def record_session_end(session):
+
+    # Update progress for a session that has just been ended, adding its play time.
+    # Runs in the caller's transaction; returns the achievements unlocked by the session.
+
+    return _add_play_time(_progress(session.user_id, session.game_id), session)
+
+
+def _add_play_time(progress, session):
+    seconds = int((session.end_time - session.start_time).total_seconds())
+    if seconds <= 0:
+        return []
+    return _advance(progress, RULE_PLAY_TIME, progress.play_seconds + seconds)
+
+
+def award_existing(definition):
+
+    # Unlock a newly created definition for every player whose progress already meets it.
+    # Done with a single INSERT ... SELECT over the progress table, skipping players who
+    # already hold an achievement with the same name. Returns the number of unlocks.
+
+    counter = getattr(AchievementProgress, RULE_COUNTERS[definition.rule])
+    already_held = exists().where(
+        Achievement.user_id == AchievementProgress.user_id,
+        Achievement.game_id == AchievementProgress.game_id,
+        Achievement.name == definition.name,
+    )
+    eligible = select(
+        literal(definition.name),
+        literal(definition.description),
+        AchievementProgress.user_id,
+        AchievementProgress.game_id,
+        literal(definition.id),
+    ).where(
+        AchievementProgress.game_id == definition.game_id,
+        counter >= definition.threshold,
+        ~already_held,
+    )
+
+    result = db.session.execute(
+        insert(Achievement).from_select(
+            ["name", "description", "user_id", "game_id", "definition_id"], eligible
+        )
+    )
+    return result.rowcount
+
+
+@task("award_achievement")
+def award_existing_task(job, definition_id):
+    # Background part of creating a definition: award it to players who already meet it.
+    # Safe to retry, since players who already hold the achievement are skipped.
+    definition = db.session.get(AchievementDefinition, definition_id)
+    if definition is None:
+        return {"awarded": 0}  # Deleted before the job ran
+    awarded = award_existing(definition)
+    db.session.commit()
+    return {"awarded": awarded}
@@ -0,0 +1,127 @@
+from collections import defaultdict
+from datetime import date, timedelta
+
+import numpy as np
+from sqlalchemy import select, delete, insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+from init import db
+from models.session import Session
+from models.active_player_sketch import ActivePlayerSketch
+from services.sharding import shards
+from services.hll import HyperLogLog, position, positions
+
+# Longest window a report can cover, in days
+MAX_WINDOW_DAYS = 366
+
+# Sessions read from the database at a time during a rebuild
+DEFAULT_BATCH_SIZE = 100000
+
+
+def _insert_for_dialect():
+    name = db.engine.dialect.name
+    if name == "postgresql":
+        return postgresql.insert
+    if name == "sqlite":
+        return sqlite.insert
+    raise RuntimeError(f"Active player sketches are not supported on {name}")
+
+
+def record_session(session):
+
+    # Count the session's player as active in its game on the day it started.
+    # Most sessions leave the sketch unchanged (the player was already counted, or their
+    # register is already higher), so the row is first read without a lock and only
+    # locked and rewritten when a register goes up.
+
+    day = session.start_time.date()
+    index, rank = position(session.user_id)
+
+    row = db.session.get(ActivePlayerSketch, (session.game_id, day))
+    if row is not None and HyperLogLog.from_bytes(row.registers).registers[index] >= rank:
+        return
+
+    if row is None:
+        db.session.execute(
+            _insert_for_dialect()(ActivePlayerSketch.__table__)
+            .values(game_id=session.game_id, day=day, registers=HyperLogLog().to_bytes())
+            .on_conflict_do_nothing(index_elements=["game_id", "day"])
+        )
+    row = db.session.get(
+        ActivePlayerSketch, (session.game_id, day), with_for_update=True, populate_existing=True
+    )
+    sketch = HyperLogLog.from_bytes(row.registers)
+    if sketch.add(session.user_id):
+        row.registers = sketch.to_bytes()
+
+
+def count(game_id, start, end):
+
+    # Estimate the distinct players of a game from start to end (dates, both included),
+    # by merging one sketch per day: the cost depends on the number of days only.
+    # Returns the estimate and the number of days that had any sessions.
+
+    sketch = HyperLogLog()
+    days = 0
+    for registers in db.session.scalars(
+        select(ActivePlayerSketch.registers).where(
+            ActivePlayerSketch.game_id == game_id,
+            ActivePlayerSketch.day >= start,
+            ActivePlayerSketch.day <= end,
+        )
+    ):
+        sketch.update(HyperLogLog.from_bytes(registers))
+        days += 1
+    return sketch.count(), days
+
+
+def window_bounds(days, end=None):
+    # First and last day of a window of the given number of days ending on end (today by default)
+    end = end or date.today()
+    return end - timedelta(days=days - 1), end
+
+
+def rebuild(game_id=None, batch_size=DEFAULT_BATCH_SIZE):
+
+    # Recompute the sketches from the sessions table (all shards), for one game or all of
+    # them. Sketches are kept up to date as sessions are created; this backfills sessions
+    # recorded before sketches existed. Returns the number of sessions read.
+
+    stmt = select(Session.game_id, Session.start_time, Session.user_id)
+    if game_id is not None:
+        stmt = stmt.where(Session.game_id == game_id)
+
+    sketches = defaultdict(HyperLogLog)
+    total = 0
+    for rows in shards.stream(stmt, game_id, batch_size):
+        game_ids, start_times, user_ids = zip(*rows)
+        total += len(rows)
+        indexes, ranks = positions(np.array(user_ids, dtype=np.int64))
+
+        # Group the batch by (game, day) and apply each group with one vectorised maximum
+        keys = np.stack([
+            np.array(game_ids, dtype=np.int64),
+            np.array(start_times, dtype="datetime64[D]").astype(np.int64),
+        ], axis=1)
+        unique, groups = np.unique(keys, axis=0, return_inverse=True)
+        order = np.argsort(groups.reshape(-1), kind="stable")
+        ends = np.cumsum(np.bincount(groups.reshape(-1), minlength=len(unique)))
+        for (game, day), start, end in zip(unique, np.append(0, ends[:-1]), ends):
+            sketch = sketches[(int(game), np.datetime64(int(day), "D").astype(date))]
+            rows_in_group = order[start:end]
+            np.maximum.at(sketch.registers, indexes[rows_in_group], ranks[rows_in_group])
+
+    rows = delete(ActivePlayerSketch)
+    if game_id is not None:
+        rows = rows.where(ActivePlayerSketch.game_id == game_id)
+    db.session.execute(rows)
+    if sketches:
+        db.session.execute(
+            insert(ActivePlayerSketch),
+            [
+                {"game_id": game, "day": day, "registers": sketch.to_bytes()}
+                for (game, day), sketch in sketches.items()
+            ],
+        )
+    db.session.commit()
+    return total
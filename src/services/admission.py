@@ -0,0 +1,131 @@
+import threading
+
+from flask import request
+
+# Endpoint classes, from most to least important
+CLASS_INGEST = "ingest"  # Score and session writes from game servers
+CLASS_AUTH = "auth"  # Login and registration (bcrypt is CPU heavy)
+CLASS_DEFAULT = "default"  # Everything else that changes data
+CLASS_CATALOGUE = "catalogue"  # Read-only listings and lookups
+CLASS_EXPORT = "export"  # Bulk imports and exports
+
+# Per-class limits: (maximum concurrent requests, seconds a request may queue for a slot,
+# seconds clients are told to wait in Retry-After when shed)
+DEFAULT_LIMITS = {
+    CLASS_INGEST: (64, 2.0, 1),
+    CLASS_AUTH: (8, 0.5, 2),
+    CLASS_DEFAULT: (32, 1.0, 1),
+    CLASS_CATALOGUE: (16, 0.1, 2),
+    CLASS_EXPORT: (2, 0.0, 30),
+}
+
+# Classes that are shed straight away, without queueing, while the worker is under pressure
+LOW_PRIORITY = (CLASS_CATALOGUE, CLASS_EXPORT)
+
+# Share of all slots in use above which the worker counts as under pressure
+DEFAULT_SHED_THRESHOLD = 0.8
+
+# Endpoints with a fixed class; other GET endpoints are catalogue reads, the rest default
+DEFAULT_ENDPOINT_CLASSES = {
+    "score_controller.create_score": CLASS_INGEST,
+    "session_controller.create_session": CLASS_INGEST,
+    "auth.login": CLASS_AUTH,
+    "auth.register": CLASS_AUTH,
+    "game_controller.import_games": CLASS_EXPORT,
+}
+
+# Endpoints that take no slot themselves, because each request they run takes its own
+PASS_THROUGH_ENDPOINTS = ("batch_controller.batch",)
+
+# Health probes, which are answered even while requests are shed; a shed liveness probe
+# would get a busy worker restarted
+EXEMPT_ENDPOINTS = ("health_controller.healthz", "health_controller.readyz")
+
+# Key used to remember, per request, which class slot was taken
+ENVIRON_KEY = "admission.class"
+
+
+class _Pool:
+
+    # Concurrency slots for one endpoint class
+
+    def __init__(self, limit, timeout, retry_after):
+        self.limit = limit
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.semaphore = threading.BoundedSemaphore(limit)
+
+
+class AdmissionControl:
+
+    # Per-worker admission control, initialised in create_app like the other extensions.
+    # Every request takes a slot from its endpoint class before the view runs, so a flood
+    # of one kind of request (e.g. expensive listings or a login storm) cannot use up the
+    # worker threads that score ingestion needs. Requests that cannot get a slot in time,
+    # and low-priority requests while the worker is under pressure, get 503 + Retry-After.
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.pools = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        limits = dict(DEFAULT_LIMITS)
+        limits.update(app.config.get("ADMISSION_LIMITS", {}))
+        self.pools = {name: _Pool(*limit) for name, limit in limits.items()}
+        self.capacity = sum(pool.limit for pool in self.pools.values())
+        self.shed_threshold = app.config.get("ADMISSION_SHED_THRESHOLD", DEFAULT_SHED_THRESHOLD)
+        self.endpoint_classes = dict(DEFAULT_ENDPOINT_CLASSES)
+        self.endpoint_classes.update(app.config.get("ADMISSION_ENDPOINT_CLASSES", {}))
+
+        if app.config.get("ADMISSION_CONTROL", True):
+            app.before_request(self._before_request)
+            app.teardown_request(self._teardown_request)
+
+    def classify(self, endpoint, method):
+        # Work out the class of a request from its endpoint name and HTTP method
+        endpoint_class = self.endpoint_classes.get(endpoint)
+        if endpoint_class:
+            return endpoint_class
+        if method in ("GET", "HEAD"):
+            return CLASS_CATALOGUE
+        return CLASS_DEFAULT
+
+    def under_pressure(self):
+        return self._in_flight >= self.capacity * self.shed_threshold
+
+    def _shed(self, pool):
+        return {"message": "Server is busy, please retry later"}, 503, {"Retry-After": str(pool.retry_after)}
+
+    def _before_request(self):
+        if request.endpoint is None or request.endpoint in PASS_THROUGH_ENDPOINTS or request.endpoint in EXEMPT_ENDPOINTS:
+            return None  # Unknown routes fall through to the 404 handler
+        endpoint_class = self.classify(request.endpoint, request.method)
+        pool = self.pools.get(endpoint_class) or self.pools[CLASS_DEFAULT]
+
+        # Shed low-priority work early instead of letting it queue behind ingestion
+        if endpoint_class in LOW_PRIORITY and self.under_pressure():
+            return self._shed(pool)
+
+        if not pool.semaphore.acquire(timeout=pool.timeout):
+            return self._shed(pool)
+
+        with self._lock:
+            self._in_flight += 1
+        request.environ[ENVIRON_KEY] = endpoint_class
+        return None
+
+    def _teardown_request(self, error=None):
+        # Give the slot back, if this request took one
+        endpoint_class = request.environ.pop(ENVIRON_KEY, None)
+        if endpoint_class is None:
+            return
+        with self._lock:
+            self._in_flight -= 1
+        (self.pools.get(endpoint_class) or self.pools[CLASS_DEFAULT]).semaphore.release()
+
+
+# Admission control instance, initialised with the app in create_app
+admission = AdmissionControl()
@@ -0,0 +1,543 @@
+import atexit
+import bisect
+import logging
+import math
+import os
+import struct
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select, delete, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from init import db
+from models.score import Score, STATUS_ACCEPTED, STATUS_FLAGGED, STATUS_QUARANTINED
+from models.score_baseline import ScoreBaseline, ALL_PLAYERS
+from services import outbox
+from services.sharding import shards
+
+logger = logging.getLogger(__name__)
+
+# What happens to a score that looks like an outlier (SCORE_ANOMALY_ACTION)
+ACTION_FLAG = "flag"  # Stored and counted as usual, and listed for review
+ACTION_QUARANTINE = "quarantine"  # Stored but not counted until a reviewer accepts it
+ACTION_OFF = "off"  # No checks
+ACTIONS = (ACTION_FLAG, ACTION_QUARANTINE, ACTION_OFF)
+
+# Flag reasons
+REASON_GAME_OUTLIER = "game_outlier"  # Far above the game's other scores
+REASON_PLAYER_JUMP = "player_jump"  # Far above the player's own scores, and at the top of the game
+
+# A game needs this many accepted scores before its scores are checked, and a player this
+# many in the game before jumps from their own scores are
+MIN_GAME_SCORES = 50
+MIN_PLAYER_SCORES = 10
+
+# A game outlier is at least GAME_Z standard deviations above the game's mean and beyond
+# the 99th percentile by more than GAME_SPREAD times the distance from the median to it.
+# Both must hold, so skewed games (where the standard deviation is small next to the top
+# scores) and tightly bunched games (where the percentiles are) do not flag fair scores.
+GAME_Z = 4.0
+GAME_SPREAD = 1.0
+
+# A player jump is at least PLAYER_Z standard deviations above the player's own mean
+PLAYER_Z = 6.0
+
+# Seconds between writes of each worker's statistics to the database (SCORE_BASELINE_SYNC_INTERVAL)
+DEFAULT_SYNC_INTERVAL = 30.0
+
+# (player, game) baselines kept in each worker; the least recently used are dropped
+MAX_PLAYER_BASELINES = 100000
+
+# Scores read from the database at a time during a rebuild, and rows written per statement
+DEFAULT_BATCH_SIZE = 100000
+WRITE_CHUNK_SIZE = 10000
+
+# Quantiles tracked per game
+MEDIAN = 0.5
+TOP = 0.99
+
+_MARKERS = struct.Struct("<q15d")
+
+
+def _insert_for_dialect():
+    name = db.engine.dialect.name
+    if name == "postgresql":
+        return postgresql.insert
+    if name == "sqlite":
+        return sqlite.insert
+    raise RuntimeError(f"Score baselines are not supported on {name}")
+
+
+class Moments:
+
+    # Welford's running count, mean and sum of squared differences; merges with Chan's formula
+
+    __slots__ = ("count", "mean", "m2")
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        return self
+
+    def z(self, value):
+        # Standard deviations above the mean; infinite above a mean nothing has varied from
+        variance = self.m2 / self.count if self.count else 0.0
+        if variance <= 0:
+            return math.inf if value > self.mean else 0.0
+        return (value - self.mean) / math.sqrt(variance)
+
+
+class Quantile:
+
+    # Streaming estimate of one quantile in constant memory (Jain and Chlamtac's P-squared
+    # algorithm): five markers track the minimum, maximum, the quantile and two points
+    # between, and are nudged along a parabola as values arrive.
+
+    __slots__ = ("p", "count", "heights", "positions", "desired")
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self.heights = []
+        self.positions = [1.0, 2.0, 3.0, 4.0, 5.0]
+        self.desired = [1.0, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5.0]
+
+    def add(self, value):
+        heights, positions = self.heights, self.positions
+        self.count += 1
+        if self.count <= 5:
+            bisect.insort(heights, value)
+            return
+
+        # Find the cell the value falls in, widening the ends if needed
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect.bisect_right(heights, value) - 1
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        p = self.p
+        for i, step in enumerate((0.0, p / 2, p, (1 + p) / 2, 1.0)):
+            self.desired[i] += step
+
+        # Move the middle markers that are off their desired position by a whole step
+        for i in (1, 2, 3):
+            offset = self.desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if offset > 0 else -1
+                height = heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+                    (positions[i] - positions[i - 1] + step) * (heights[i + 1] - heights[i]) / (positions[i + 1] - positions[i])
+                    + (positions[i + 1] - positions[i] - step) * (heights[i] - heights[i - 1]) / (positions[i] - positions[i - 1])
+                )
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def value(self):
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            return self.heights[min(int(self.p * self.count), self.count - 1)]
+        return self.heights[2]
+
+    @classmethod
+    def from_sorted(cls, p, values):
+        # Estimator positioned exactly on an already sorted array, for rebuilds
+        quantile = cls(p)
+        count = len(values)
+        if count <= 5:
+            for value in values:
+                quantile.add(float(value))
+            return quantile
+        fractions = np.array([0.0, p / 2, p, (1 + p) / 2, 1.0])
+        desired = 1 + (count - 1) * fractions
+        # Markers sit on distinct scores, as close to their desired positions as that allows
+        positions = np.round(desired)
+        for i in (1, 2, 3):
+            positions[i] = min(max(positions[i], positions[i - 1] + 1), count - 4 + i)
+        quantile.count = count
+        quantile.heights = [float(values[int(position) - 1]) for position in positions]
+        quantile.positions = [float(position) for position in positions]
+        quantile.desired = [float(position) for position in desired]
+        return quantile
+
+    def to_bytes(self):
+        heights = (self.heights + [0.0] * 5)[:5]
+        return _MARKERS.pack(self.count, *heights, *self.positions, *self.desired)
+
+    @classmethod
+    def from_bytes(cls, p, data):
+        quantile = cls(p)
+        values = _MARKERS.unpack(data)
+        quantile.count = values[0]
+        quantile.heights = sorted(values[1:1 + min(quantile.count, 5)]) if quantile.count <= 5 else list(values[1:6])
+        quantile.positions = list(values[6:11])
+        quantile.desired = list(values[11:16])
+        return quantile
+
+
+class _Baseline:
+
+    # One key's statistics in a worker: everything known (from the database plus this
+    # worker), what this worker has added since its last sync, and for games the quantiles
+
+    __slots__ = ("total", "unsynced", "median", "top")
+
+    def __init__(self, total=None, median=None, top=None):
+        self.total = total or Moments()
+        self.unsynced = Moments()
+        self.median = median
+        self.top = top
+
+    def add(self, value):
+        self.total.add(value)
+        self.unsynced.add(value)
+        if self.top is not None:
+            self.median.add(value)
+            self.top.add(value)
+
+
+def _row(game_id, user_id, moments, quantiles):
+    return {
+        "game_id": game_id,
+        "user_id": user_id,
+        "count": moments.count,
+        "mean": moments.mean,
+        "m2": moments.m2,
+        "quantiles": quantiles,
+        "updated_at": datetime.now(),
+    }
+
+
+def _quantiles_to_bytes(baseline):
+    return baseline.median.to_bytes() + baseline.top.to_bytes()
+
+
+def _quantiles_from_bytes(data):
+    if not data:
+        return Quantile(MEDIAN), Quantile(TOP)
+    return Quantile.from_bytes(MEDIAN, data[:_MARKERS.size]), Quantile.from_bytes(TOP, data[_MARKERS.size:])
+
+
+class ScoreAnomalyDetector:
+
+    # Inline check of every submitted score, initialised in create_app like the other extensions.
+    # Each game and each (player, game) has running statistics of its accepted scores, kept
+    # in memory in O(1) space per key, so a check is a few arithmetic operations and never
+    # scans the scores table. A background thread in each worker adds its scores to the
+    # shared baselines in the database every SCORE_BASELINE_SYNC_INTERVAL seconds (merging,
+    # so no worker's scores are lost), and keys are loaded from there the first time a
+    # worker sees them.
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._games = {}
+        self._players = OrderedDict()
+        self._evicted = {}  # Unsynced statistics of players dropped from memory
+        self._app = None
+        self._pid = None
+        self._thread = None
+        self._stopping = None
+        self.action = ACTION_FLAG
+        self.sync_interval = DEFAULT_SYNC_INTERVAL
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.action = app.config.get("SCORE_ANOMALY_ACTION", ACTION_FLAG)
+        if self.action not in ACTIONS:
+            raise ValueError(f"SCORE_ANOMALY_ACTION must be one of {', '.join(ACTIONS)}")
+        self.sync_interval = app.config.get("SCORE_BASELINE_SYNC_INTERVAL", DEFAULT_SYNC_INTERVAL)
+        if self._app is None:
+            atexit.register(self.stop)
+        self._app = app
+
+    def _load(self, game_id, user_id):
+        # Baseline of a key from the database, or an empty one
+        row = db.session.get(ScoreBaseline, (game_id, user_id))
+        baseline = _Baseline(Moments(row.count, row.mean, row.m2) if row is not None else None)
+        if user_id == ALL_PLAYERS:
+            baseline.median, baseline.top = _quantiles_from_bytes(row.quantiles if row is not None else None)
+        return baseline
+
+    def _baselines(self, game_id, user_id):
+        with self._lock:
+            game = self._games.get(game_id)
+            player = self._players.get((game_id, user_id))
+            if player is not None:
+                self._players.move_to_end((game_id, user_id))
+        if game is None:
+            game = self._load(game_id, ALL_PLAYERS)
+            with self._lock:
+                game = self._games.setdefault(game_id, game)
+        if player is None:
+            player = self._load(game_id, user_id)
+            with self._lock:
+                player = self._players.setdefault((game_id, user_id), player)
+                while len(self._players) > MAX_PLAYER_BASELINES:
+                    key, dropped = self._players.popitem(last=False)
+                    if dropped.unsynced.count:
+                        self._evicted[key] = self._evicted.get(key, Moments()).merge(dropped.unsynced)
+        return game, player
+
+    def check(self, user_id, game_id, value):
+
+        # Status and flag reason for a new score, called before it is stored.
+        # Nothing is added to the baselines here: the caller passes accepted scores to
+        # observe() once they are committed, so a request that fails or rolls back leaves
+        # them as they were. Outliers are never added, so a cheater cannot drag a game's
+        # baseline up until their scores look normal.
+
+        if self.action == ACTION_OFF:
+            return STATUS_ACCEPTED, None
+
+        game, player = self._baselines(game_id, user_id)
+        reason = None
+        with self._lock:
+            top = game.top.value()
+            if game.total.count >= MIN_GAME_SCORES and top is not None:
+                spread = max(top - game.median.value(), 0.0)
+                if value > top + GAME_SPREAD * spread and game.total.z(value) >= GAME_Z:
+                    reason = REASON_GAME_OUTLIER
+            if reason is None and player.total.count >= MIN_PLAYER_SCORES and top is not None:
+                if value > top and player.total.z(value) >= PLAYER_Z:
+                    reason = REASON_PLAYER_JUMP
+
+        if reason is None:
+            return STATUS_ACCEPTED, None
+        return (STATUS_QUARANTINED if self.action == ACTION_QUARANTINE else STATUS_FLAGGED), reason
+
+    def observe(self, user_id, game_id, value):
+        # Add an accepted score to the baselines, once the request that stored (or accepted
+        # it after review) has committed
+        if self.action == ACTION_OFF:
+            return
+        game, player = self._baselines(game_id, user_id)
+        with self._lock:
+            game.add(value)
+            player.add(value)
+        self._ensure_started()
+
+    def _ensure_started(self):
+        # Start the sync thread in each process (after any fork) on its first score
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stopping,), name="score-baseline-sync", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        # Sync what this worker still holds and stop the thread
+        if self._thread is not None and self._pid == os.getpid():
+            self._stopping.set()
+            self._thread.join(timeout)
+            self._thread = None
+            self._pid = None
+
+    def _run(self, stopping):
+        # Sync every interval, and once more on the way out. A failed sync keeps its
+        # statistics for the next one (see sync()), so it is only logged.
+        while True:
+            stopped = stopping.wait(self.sync_interval)
+            try:
+                with self._app.app_context():
+                    self.sync()
+            except Exception:
+                logger.exception("Syncing score baselines failed")
+            if stopped:
+                return
+
+    def sync(self):
+
+        # Merge this worker's new statistics into the database and take back the merged
+        # totals, which include other workers' scores. The merge is done by the database
+        # in an INSERT ... ON CONFLICT DO UPDATE, so workers syncing at once do not lose
+        # each other's counts. Quantile markers cannot be merged, so the last worker to
+        # sync a game's wins, which only matters while a game is young.
+        # Runs in its own transaction, outside any request's; called by the sync thread.
+
+        with self._lock:
+            pending = {key: baseline.unsynced for key, baseline in self._players.items() if baseline.unsynced.count}
+            for key, unsynced in self._evicted.items():
+                pending[key] = unsynced.merge(pending.get(key, Moments()))
+            self._evicted = {}
+            rows = []
+            for game_id, baseline in self._games.items():
+                if baseline.unsynced.count:
+                    rows.append(_row(game_id, ALL_PLAYERS, baseline.unsynced, _quantiles_to_bytes(baseline)))
+                    baseline.unsynced = Moments()
+            for (game_id, user_id), unsynced in pending.items():
+                rows.append(_row(game_id, user_id, unsynced, None))
+                if (game_id, user_id) in self._players:
+                    self._players[(game_id, user_id)].unsynced = Moments()
+        if not rows:
+            return 0
+
+        table = ScoreBaseline.__table__
+        stmt = _insert_for_dialect()(table)
+        count = table.c.count + stmt.excluded.count
+        delta = stmt.excluded.mean - table.c.mean
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["game_id", "user_id"],
+            set_={
+                "count": count,
+                "mean": table.c.mean + delta * stmt.excluded.count / count,
+                "m2": table.c.m2 + stmt.excluded.m2 + delta * delta * table.c.count * stmt.excluded.count / count,
+                "quantiles": db.func.coalesce(stmt.excluded.quantiles, table.c.quantiles),
+                "updated_at": stmt.excluded.updated_at,
+            },
+        ).returning(table.c.game_id, table.c.user_id, table.c.count, table.c.mean, table.c.m2)
+
+        merged = []
+        try:
+            with db.engine.begin() as connection:
+                for start in range(0, len(rows), WRITE_CHUNK_SIZE):
+                    merged += connection.execute(stmt, rows[start:start + WRITE_CHUNK_SIZE]).all()
+        except IntegrityError:
+            # A game deleted since its scores were added; its delete event drops it from
+            # memory, so the rest would fail again. Those statistics are lost.
+            raise
+        except Exception:
+            # Nothing was written (e.g. the database is restarting): keep the statistics
+            # for the next sync
+            self._restore(rows)
+            raise
+
+        # Take the merged totals, plus anything this worker added while the sync ran
+        with self._lock:
+            for row in merged:
+                key = row.game_id if row.user_id == ALL_PLAYERS else (row.game_id, row.user_id)
+                baseline = (self._games if row.user_id == ALL_PLAYERS else self._players).get(key)
+                if baseline is not None:
+                    baseline.total = Moments(row.count, row.mean, row.m2).merge(baseline.unsynced)
+        return len(rows)
+
+    def _restore(self, rows):
+        # Put the statistics of a failed sync back as unsynced
+        with self._lock:
+            for row in rows:
+                unsynced = Moments(row["count"], row["mean"], row["m2"])
+                if row["user_id"] == ALL_PLAYERS:
+                    baseline = self._games.get(row["game_id"])
+                    if baseline is not None:
+                        baseline.unsynced = unsynced.merge(baseline.unsynced)
+                else:
+                    key = (row["game_id"], row["user_id"])
+                    self._evicted[key] = unsynced.merge(self._evicted.get(key, Moments()))
+
+    def forget_player(self, user_id):
+        # Drop a deleted player's baselines and unsynced statistics, so the next sync does
+        # not write their rows back
+        with self._lock:
+            for key in [key for key in self._players if key[1] == user_id]:
+                del self._players[key]
+            for key in [key for key in self._evicted if key[1] == user_id]:
+                del self._evicted[key]
+
+    def forget_game(self, game_id):
+        # Drop a deleted game's baselines and unsynced statistics
+        with self._lock:
+            self._games.pop(game_id, None)
+            for key in [key for key in self._players if key[0] == game_id]:
+                del self._players[key]
+            for key in [key for key in self._evicted if key[0] == game_id]:
+                del self._evicted[key]
+
+    def invalidate(self):
+        # Forget every baseline and unsynced statistics, e.g. after a rebuild replaced them
+        with self._lock:
+            self._games.clear()
+            self._players.clear()
+            self._evicted = {}
+
+
+def _group_moments(keys, values):
+    # Count, mean and m2 per run of equal keys in key-sorted arrays, in two passes for precision
+    starts = np.flatnonzero(np.r_[True, np.any(keys[1:] != keys[:-1], axis=1)])
+    counts = np.diff(np.append(starts, len(values)))
+    means = np.add.reduceat(values, starts) / counts
+    deviations = values - np.repeat(means, counts)
+    m2s = np.add.reduceat(deviations * deviations, starts)
+    return starts, counts, means, m2s
+
+
+def rebuild(batch_size=DEFAULT_BATCH_SIZE):
+
+    # Recompute every baseline from the accepted scores, e.g. to start the detector on an
+    # existing database. Reads the scores table once, in batches, into numpy arrays.
+    # Returns the number of scores read.
+
+    stmt = select(Score.game_id, Score.user_id, Score.value).where(Score.status == STATUS_ACCEPTED)
+    parts = []
+    for rows in shards.stream(stmt, batch_size=batch_size):
+        parts.append(np.array(rows, dtype=np.float64).reshape(-1, 3))
+    data = np.concatenate(parts) if parts else np.empty((0, 3))
+
+    db.session.execute(delete(ScoreBaseline))
+    rows = []
+    if len(data):
+        # Whole games, with quantile markers placed on each game's sorted scores
+        data = data[np.lexsort((data[:, 2], data[:, 0]))]
+        starts, counts, means, m2s = _group_moments(data[:, :1], data[:, 2])
+        for start, count, mean, m2 in zip(starts, counts, means, m2s):
+            values = data[start:start + count, 2]
+            baseline = _Baseline(median=Quantile.from_sorted(MEDIAN, values), top=Quantile.from_sorted(TOP, values))
+            rows.append(_row(int(data[start, 0]), ALL_PLAYERS, Moments(int(count), float(mean), float(m2)), _quantiles_to_bytes(baseline)))
+
+        # Each player in each game
+        data = data[np.lexsort((data[:, 1], data[:, 0]))]
+        starts, counts, means, m2s = _group_moments(data[:, :2], data[:, 2])
+        for start, count, mean, m2 in zip(starts, counts, means, m2s):
+            rows.append(_row(int(data[start, 0]), int(data[start, 1]), Moments(int(count), float(mean), float(m2)), None))
+
+    for start in range(0, len(rows), WRITE_CHUNK_SIZE):
+        db.session.execute(insert(ScoreBaseline), rows[start:start + WRITE_CHUNK_SIZE])
+    outbox.record("score_baselines.rebuilt")
+    db.session.commit()
+    return len(data)
+
+
+def delete_player(user_id):
+    # Remove a player's baselines in the current transaction, e.g. with the player
+    # (user_id is not a foreign key, so the database cannot cascade to them)
+    db.session.execute(delete(ScoreBaseline).where(ScoreBaseline.user_id == user_id))
+
+
+# Score anomaly detector instance, initialised with the app in create_app
+detector = ScoreAnomalyDetector()
+
+# Every worker drops its baselines once they are rebuilt, and reloads them from the database
+outbox.subscribe("score_baselines.", lambda event: detector.invalidate())
+
+# Every worker drops a deleted player's or game's baselines
+outbox.subscribe("user.deleted", lambda event: detector.forget_player(event.entity_id))
+outbox.subscribe("game.deleted", lambda event: detector.forget_game(event.entity_id))
@@ -0,0 +1,162 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session as OrmSession
+
+from init import db
+from models.audit_log import AuditLog
+from models.outbox_event import OutboxEvent
+from services.logs import current_actor, current_request_id
+
+# Audit trail of every write: who changed which game, score, user... and when.
+# Entries come from the domain events a transaction records in the outbox (see
+# services/outbox.py), so everything that changes data is covered without touching the
+# handlers. They are made when the transaction commits, queued in memory, and inserted in
+# batches by a background thread, so the request path pays for a queue put and never for
+# a write. The queue is drained when the process exits normally.
+
+# Defaults, overridable through app config
+DEFAULT_BATCH_SIZE = 500  # Most entries per INSERT (AUDIT_BATCH_SIZE)
+DEFAULT_FLUSH_INTERVAL = 1.0  # Seconds entries may wait to be batched with others (AUDIT_FLUSH_INTERVAL)
+RETRY_DELAY = 5.0  # Seconds before retrying a batch the database refused
+
+# Key in session.info holding the entries flushed in the current transaction
+SESSION_KEY = "audit.entries"
+
+logger = logging.getLogger(__name__)
+
+
+@event.listens_for(OrmSession, "after_flush")
+def _collect_entries(session, flush_context):
+    # Remember the events written by this flush, with who made them, while still in the request
+    entries = [
+        {
+            "occurred_at": obj.created_at,
+            "actor_id": current_actor(),
+            "action": obj.topic,
+            "entity_id": obj.entity_id,
+            "request_id": current_request_id(),
+            "details": obj.payload,
+        }
+        for obj in session.new
+        if isinstance(obj, OutboxEvent)
+    ]
+    if entries:
+        session.info.setdefault(SESSION_KEY, []).extend(entries)
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _queue_committed(session):
+    entries = session.info.pop(SESSION_KEY, None)
+    if entries:
+        audit.add(entries)
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_rolled_back(session):
+    session.info.pop(SESSION_KEY, None)
+
+
+class AuditFlusher:
+
+    # Per-process background writer for the audit trail, initialised in create_app like the
+    # other extensions. The thread waits up to AUDIT_FLUSH_INTERVAL for entries to gather,
+    # then inserts up to AUDIT_BATCH_SIZE of them in one statement. A batch the database
+    # refuses (e.g. while it restarts) is kept and retried, not dropped.
+
+    _STOP = object()
+
+    def __init__(self, app=None):
+        self.queue = queue.SimpleQueue()
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL
+        self._app = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.batch_size = app.config.get("AUDIT_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+        self.flush_interval = app.config.get("AUDIT_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)
+        if self._app is None:
+            atexit.register(self.stop)
+        self._app = app
+
+    def add(self, entries):
+        # Queue committed entries for the writer thread
+        self._ensure_started()
+        self.queue.put(entries)
+
+    def _ensure_started(self):
+        # Start the thread in each process (after any fork) on its first entries
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="audit-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        # Write everything queued so far and stop the thread
+        if self._thread is not None and self._pid == os.getpid():
+            self.queue.put(self._STOP)
+            self._thread.join(timeout)
+            self._thread = None
+            self._pid = None
+
+    def _take(self, pending):
+        # Move queued entries into pending until a batch is full or the interval is up;
+        # returns False once stop() has been called
+        deadline = time.monotonic() + self.flush_interval
+        while len(pending) < self.batch_size:
+            timeout = deadline - time.monotonic() if pending else None
+            if timeout is not None and timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return False
+            pending.extend(item)
+        return True
+
+    def _write(self, rows):
+        with self._app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(insert(AuditLog), rows)
+
+    def _run(self):
+        pending = []
+        running = True
+        while running or pending:
+            if running:
+                running = self._take(pending)
+            while pending:
+                batch = pending[:self.batch_size]
+                try:
+                    self._write(batch)
+                except Exception:
+                    if not running:
+                        # Shutting down: report what is lost rather than hang the exit
+                        logger.exception("Writing audit entries failed at shutdown, %s lost", len(pending))
+                        return
+                    logger.exception("Writing %s audit entries failed, retrying", len(batch))
+                    time.sleep(RETRY_DELAY)
+                    break
+                del pending[:len(batch)]
+                if running and len(pending) < self.batch_size:
+                    break  # Gather more before writing a part batch
+
+
+# Shared instance, initialised in create_app
+audit = AuditFlusher()
@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from init import db
+from models.game import Game
+from models.genre import Genre
+from models.developer import Developer
+from services import outbox
+
+# Default number of games written per statement batch and transaction
+DEFAULT_CHUNK_SIZE = 5000
+
+# Columns every imported row has to provide
+REQUIRED_COLUMNS = ("title", "genre", "developer")
+
+# Maximum number of row errors reported back
+MAX_ERRORS = 50
+
+
+class CatalogueImportError(Exception):
+    # Raised when the import file cannot be read at all
+    pass
+
+
+def read_rows(text, fmt):
+
+    # Parse an import file into a list of dicts with 'title', 'genre' and 'developer'.
+    # - fmt: 'csv' (with a header row) or 'json' (a list of objects, or {"games": [...]}).
+
+    if fmt == "csv":
+        return list(csv.DictReader(io.StringIO(text)))
+    if fmt == "json":
+        try:
+            data = json.loads(text)
+        except ValueError as error:
+            raise CatalogueImportError(f"Invalid JSON: {error}")
+        return _json_rows(data)
+    raise CatalogueImportError(f"Unsupported format: {fmt}")
+
+
+def _json_rows(data):
+    # Accept either a bare list of games or an object wrapping it under "games"
+    if isinstance(data, dict):
+        data = data.get("games")
+    if not isinstance(data, list):
+        raise CatalogueImportError("Expected a list of games")
+    return data
+
+
+def _insert_for_dialect():
+    # INSERT ... ON CONFLICT is dialect specific; both supported backends share the same API
+    name = db.engine.dialect.name
+    if name == "postgresql":
+        return postgresql.insert
+    if name == "sqlite":
+        return sqlite.insert
+    raise CatalogueImportError(f"Bulk import is not supported on {name}")
+
+
+def _clean(rows):
+    # Validate rows, returning the usable ones (deduplicated by title, last one wins) and errors
+    games, errors = {}, []
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            errors.append({"row": number, "message": "Expected an object"})
+            continue
+        values = {column: str(row.get(column) or "").strip() for column in REQUIRED_COLUMNS}
+        missing = [column for column, value in values.items() if not value]
+        if missing:
+            errors.append({"row": number, "message": f"Missing {', '.join(missing)}"})
+            continue
+        if len(values["title"]) > 150 or len(values["developer"]) > 150 or len(values["genre"]) > 80:
+            errors.append({"row": number, "message": "Value too long"})
+            continue
+        games[values["title"]] = values
+    return list(games.values()), errors
+
+
+def _resolve_names(model, names, insert, chunk_size):
+
+    # Map names to IDs for a genre/developer table, creating any that are missing.
+    # The whole table is preloaded into a dict (these tables are small), missing names
+    # are inserted in batches, and only the new rows are read back.
+
+    ids = dict(db.session.execute(select(model.name, model.id)).all())
+    missing = sorted(set(names) - ids.keys())
+    for start in range(0, len(missing), chunk_size):
+        batch = missing[start:start + chunk_size]
+        db.session.execute(
+            insert(model.__table__).on_conflict_do_nothing(index_elements=["name"]),
+            [{"name": name} for name in batch],
+        )
+        ids.update(db.session.execute(select(model.name, model.id).where(model.name.in_(batch))).all())
+    return ids, len(missing)
+
+
+def import_catalogue(rows, chunk_size=DEFAULT_CHUNK_SIZE):
+
+    # Import games with genre and developer names, creating missing genres and developers.
+    # Games are upserted by title, so re-running the same file changes nothing.
+    # Returns a summary dict of what was written and any rejected rows.
+
+    insert = _insert_for_dialect()
+    games, errors = _clean(rows)
+
+    genre_ids, genres_created = _resolve_names(Genre, {g["genre"] for g in games}, insert, chunk_size)
+    developer_ids, developers_created = _resolve_names(Developer, {g["developer"] for g in games}, insert, chunk_size)
+    if genres_created or developers_created:
+        outbox.record("catalogue.imported", genres_created=genres_created, developers_created=developers_created)
+    db.session.commit()
+
+    # Upsert by title; rows whose genre and developer are unchanged are left alone.
+    # Changed rows get a new version so clients holding the old ETag see the change
+    stmt = insert(Game.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["title"],
+        set_={
+            "genre_id": stmt.excluded.genre_id,
+            "developer_id": stmt.excluded.developer_id,
+            "version": Game.__table__.c.version + 1,
+            "updated_at": stmt.excluded.updated_at,  # onupdate is not applied to upserts
+        },
+        where=(Game.genre_id != stmt.excluded.genre_id) | (Game.developer_id != stmt.excluded.developer_id),
+    )
+
+    for start in range(0, len(games), chunk_size):
+        chunk = [
+            {
+                "title": game["title"],
+                "genre_id": genre_ids[game["genre"]],
+                "developer_id": developer_ids[game["developer"]],
+            }
+            for game in games[start:start + chunk_size]
+        ]
+        db.session.execute(stmt, chunk)
+        # Each chunk is committed on its own, so each one announces its change
+        outbox.record("catalogue.imported", games=len(chunk))
+        db.session.commit()
+
+    return {
+        "rows": len(rows),
+        "games": len(games),
+        "genres_created": genres_created,
+        "developers_created": developers_created,
+        "errors": errors[:MAX_ERRORS],
+        "error_count": len(errors),
+    }
@@ -0,0 +1,35 @@
+from flask import request
+
+# Optimistic concurrency for the update handlers.
+# Versioned models carry a 'version' column used as SQLAlchemy's version_id_col, so every
+# UPDATE is issued as "... WHERE id = ? AND version = ?" and bumps the version. Clients get
+# the version as an ETag and send it back in If-Match; nothing is locked while they edit.
+# The handlers check If-Match in the UPDATE itself (see services/writes.py).
+
+
+def etag(obj):
+    # Strong ETag for a versioned row
+    return f'"{obj.version}"'
+
+
+def with_etag(response, obj, status=None):
+    # Attach the row's ETag to a response built by a schema's jsonify()
+    response.headers["ETag"] = etag(obj)
+    if status is not None:
+        response.status_code = status
+    return response
+
+
+def expected_versions():
+    # Versions listed in the request's If-Match header, or None if it is '*' (any version).
+    # If-Match may list several ETags. It uses the strong comparison (RFC 9110, 13.1.1), so
+    # weak ones (W/"...") never match, and neither do ones that are not a version of ours
+    expected = [tag.strip() for tag in request.headers["If-Match"].split(",")]
+    if "*" in expected:
+        return None
+    versions = []
+    for tag in expected:
+        if len(tag) > 2 and tag[0] == tag[-1] == '"' and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
+
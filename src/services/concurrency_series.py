@@ -0,0 +1,440 @@
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select, delete, insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+from init import db
+from models.session import Session
+from models.concurrency import (
+    ConcurrencyBlock,
+    ConcurrencyChange,
+    OpenSession,
+    RESOLUTION_MINUTE,
+    RESOLUTION_HOUR,
+    RESOLUTION_DAY,
+)
+from services.sharding import shards
+
+RESOLUTIONS = (RESOLUTION_MINUTE, RESOLUTION_HOUR, RESOLUTION_DAY)
+
+# Length of one slot, and the slots per day, at each resolution
+STEP = {
+    RESOLUTION_MINUTE: timedelta(minutes=1),
+    RESOLUTION_HOUR: timedelta(hours=1),
+    RESOLUTION_DAY: timedelta(days=1),
+}
+SLOTS_PER_DAY = {RESOLUTION_MINUTE: 1440, RESOLUTION_HOUR: 24, RESOLUTION_DAY: 1}
+
+# Days covered by one stored block at each resolution
+BLOCK_DAYS = {RESOLUTION_MINUTE: 1, RESOLUTION_HOUR: 30, RESOLUTION_DAY: 360}
+
+# Retention per tier, in days. Minute blocks older than this are rolled up into the hour and
+# day tiers by `flask db_commands rollup-concurrency`; day blocks are kept for good.
+MINUTE_RETENTION_DAYS = 14
+HOUR_RETENTION_DAYS = 400
+
+# Open sessions that started longer ago than this are taken as abandoned and not counted
+MAX_OPEN_HOURS = 24
+
+# Most points a single query can return
+MAX_POINTS = 10000
+
+# Sessions read from the database at a time during a rebuild
+DEFAULT_BATCH_SIZE = 100000
+
+# Packed formats: players online per minute, and peak and average per hour or day
+_MINUTE_DTYPE = np.dtype("<i4")
+_ROLLUP_DTYPE = np.dtype([("peak", "<i4"), ("average", "<f4")])
+
+_EPOCH = date(1970, 1, 1)
+_EPOCH_TIME = datetime(1970, 1, 1)
+
+
+def _insert_for_dialect():
+    name = db.engine.dialect.name
+    if name == "postgresql":
+        return postgresql.insert
+    if name == "sqlite":
+        return sqlite.insert
+    raise RuntimeError(f"Concurrency series are not supported on {name}")
+
+
+def _block_start(resolution, day):
+    # First day of the block holding a day, blocks being aligned on 1970-01-01
+    span = BLOCK_DAYS[resolution]
+    return _EPOCH + timedelta(days=(day - _EPOCH).days // span * span)
+
+
+def _empty(resolution):
+    slots = BLOCK_DAYS[resolution] * SLOTS_PER_DAY[resolution]
+    return np.zeros(slots, dtype=_MINUTE_DTYPE if resolution == RESOLUTION_MINUTE else _ROLLUP_DTYPE)
+
+
+def _unpack(resolution, data):
+    return np.frombuffer(data, dtype=_MINUTE_DTYPE if resolution == RESOLUTION_MINUTE else _ROLLUP_DTYPE).copy()
+
+
+def _locked_block(game_id, resolution, start):
+    # Fetch and lock a block for writing, creating it empty on first use
+    db.session.execute(
+        _insert_for_dialect()(ConcurrencyBlock.__table__)
+        .values(game_id=game_id, resolution=resolution, start=start, data=_empty(resolution).tobytes())
+        .on_conflict_do_nothing(index_elements=["game_id", "resolution", "start"])
+    )
+    return db.session.get(
+        ConcurrencyBlock, (game_id, resolution, start), with_for_update=True, populate_existing=True
+    )
+
+
+def _minute(moment):
+    # Minutes since 1970-01-01 of the minute a datetime falls in
+    return int((moment - _EPOCH_TIME).total_seconds() // 60)
+
+
+def _minute_range(start_time, end_time):
+    # Minutes a session overlaps, as the range [first, last)
+    return _minute(start_time), -int(-(end_time - _EPOCH_TIME).total_seconds() // 60)
+
+
+def _aggregate(levels, resolution):
+    # Peak and average of per-minute levels for each hour or day they cover
+    per_slot = levels.reshape(-1, 1440 // SLOTS_PER_DAY[resolution])
+    slots = np.zeros(len(per_slot), dtype=_ROLLUP_DTYPE)
+    slots["peak"] = per_slot.max(axis=1)
+    slots["average"] = per_slot.mean(axis=1)
+    return slots
+
+
+def _add_change(game_id, minute, delta):
+    # Add to a game's change in players online at one minute, in one upsert
+    insert = _insert_for_dialect()
+    table = ConcurrencyChange.__table__
+    stmt = insert(table).values(game_id=game_id, minute=minute, delta=delta)
+    db.session.execute(
+        stmt.on_conflict_do_update(index_elements=["game_id", "minute"], set_={"delta": table.c.delta + stmt.excluded.delta})
+    )
+
+
+def _add_interval(game_id, start_time, end_time, sign=1):
+
+    # Add (or with sign=-1, remove) one player over a time range: +1 at its first minute
+    # and -1 after its last, as two small upserts. Ingest never rewrites the minute blocks,
+    # so sessions of a popular game only wait on each other when they start or end in the
+    # same minute; fold_changes() moves the changes into the blocks later.
+
+    first, last = _minute_range(start_time, end_time)
+    _add_change(game_id, first, sign)
+    _add_change(game_id, last, -sign)
+
+
+def record_session(session):
+    # Count a new session: ended ones go straight into the series, open ones are tracked until they end
+    if session.end_time is None:
+        db.session.add(OpenSession(
+            session_id=session.id, user_id=session.user_id, game_id=session.game_id, start_time=session.start_time
+        ))
+    elif session.end_time > session.start_time:
+        _add_interval(session.game_id, session.start_time, session.end_time)
+
+
+def record_session_end(session):
+    # Move an ended session from the open sessions into the series
+    db.session.execute(delete(OpenSession).where(OpenSession.session_id == session.id))
+    if session.end_time > session.start_time:
+        _add_interval(session.game_id, session.start_time, session.end_time)
+
+
+def remove_session(session):
+    # Take a session back out before it is deleted
+    if session.end_time is None:
+        db.session.execute(delete(OpenSession).where(OpenSession.session_id == session.id))
+    elif session.end_time > session.start_time:
+        _add_interval(session.game_id, session.start_time, session.end_time, sign=-1)
+
+
+def _open_levels(game_id, first_day, last_day, now):
+    # Per-minute counts of still-open sessions for the days in range, {day: levels}.
+    # Sessions that started before the range count from its first minute (see np.clip below)
+    earliest = now - timedelta(hours=MAX_OPEN_HOURS)
+    starts = db.session.scalars(
+        select(OpenSession.start_time).where(
+            OpenSession.game_id == game_id, OpenSession.start_time >= earliest, OpenSession.start_time <= now
+        )
+    ).all()
+    if not starts or now.date() < first_day:
+        return {}
+
+    # +1 from each start up to now, built as a difference array over the days in range
+    base = (first_day - _EPOCH).days * 1440
+    end_day = min(last_day, now.date())
+    length = ((end_day - first_day).days + 1) * 1440
+    changes = np.zeros(length + 1, dtype=np.int64)
+    np.add.at(changes, np.clip([_minute(start) - base for start in starts], 0, length), 1)
+    changes[min(_minute(now) - base + 1, length)] -= len(starts)
+    levels = np.cumsum(changes[:length]).astype(_MINUTE_DTYPE)
+    return {
+        first_day + timedelta(days=number): levels[number * 1440:(number + 1) * 1440]
+        for number in range(length // 1440)
+        if levels[number * 1440:(number + 1) * 1440].any()
+    }
+
+
+def _pending_levels(game_id, first_day, last_day):
+    # Per-minute counts from the changes not folded into the minute blocks yet, for the
+    # days in range, {day: levels}. Changes before the range set its starting count
+    base = (first_day - _EPOCH).days * 1440
+    length = ((last_day - first_day).days + 1) * 1440
+    rows = db.session.execute(
+        select(ConcurrencyChange.minute, ConcurrencyChange.delta).where(
+            ConcurrencyChange.game_id == game_id, ConcurrencyChange.minute < base + length
+        )
+    ).all()
+    if not rows:
+        return {}
+
+    minutes, deltas = (np.array(column, dtype=np.int64) for column in zip(*rows))
+    changes = np.zeros(length, dtype=np.int64)
+    np.add.at(changes, np.clip(minutes - base, 0, None), deltas)
+    levels = np.cumsum(changes).astype(_MINUTE_DTYPE)
+    return {
+        first_day + timedelta(days=number): levels[number * 1440:(number + 1) * 1440]
+        for number in range(length // 1440)
+        if levels[number * 1440:(number + 1) * 1440].any()
+    }
+
+
+def series(game_id, start, end, resolution, now=None):
+
+    # Players online in a game per minute, hour or day, from start (rounded down) to end.
+    # Recent days are read from the minute tier (one row per day), the changes not folded
+    # into it yet and the open sessions, older ones from the hour or day rollups, so a year
+    # is a few dozen rows and never touches the sessions table.
+    # Returns a list of {"time", "peak", "average"}, oldest first.
+
+    now = now or datetime.now()
+    first_day = start.date()
+    last_day = (end - timedelta(microseconds=1)).date()
+    per_day = SLOTS_PER_DAY[resolution]
+
+    minutes = {
+        block.start: _unpack(RESOLUTION_MINUTE, block.data)
+        for block in db.session.scalars(
+            select(ConcurrencyBlock).where(
+                ConcurrencyBlock.game_id == game_id,
+                ConcurrencyBlock.resolution == RESOLUTION_MINUTE,
+                ConcurrencyBlock.start >= first_day,
+                ConcurrencyBlock.start <= last_day,
+            )
+        )
+    }
+    for pending in (_pending_levels(game_id, first_day, last_day), _open_levels(game_id, first_day, last_day, now)):
+        for day, levels in pending.items():
+            minutes[day] = minutes[day] + levels if day in minutes else levels
+
+    rollups = {}
+    if resolution != RESOLUTION_MINUTE:
+        rollups = {
+            block.start: _unpack(resolution, block.data)
+            for block in db.session.scalars(
+                select(ConcurrencyBlock).where(
+                    ConcurrencyBlock.game_id == game_id,
+                    ConcurrencyBlock.resolution == resolution,
+                    ConcurrencyBlock.start >= _block_start(resolution, first_day),
+                    ConcurrencyBlock.start <= last_day,
+                )
+            )
+        }
+
+    # One array of slots per day, from the freshest tier that has it
+    days = []
+    day = first_day
+    while day <= last_day:
+        if day in minutes:
+            if resolution == RESOLUTION_MINUTE:
+                slots = np.zeros(1440, dtype=_ROLLUP_DTYPE)
+                slots["peak"] = slots["average"] = minutes[day]
+            else:
+                slots = _aggregate(minutes[day], resolution)
+        else:
+            block_start = _block_start(resolution, day)
+            if resolution != RESOLUTION_MINUTE and block_start in rollups:
+                offset = (day - block_start).days * per_day
+                slots = rollups[block_start][offset:offset + per_day]
+            else:
+                slots = np.zeros(per_day, dtype=_ROLLUP_DTYPE)
+        days.append(slots)
+        day += timedelta(days=1)
+
+    values = np.concatenate(days)
+    step = STEP[resolution]
+    day_start = datetime.combine(first_day, datetime.min.time())
+    first = int((start - day_start) / step)
+    last = -(-(end - day_start) // step)
+    return [
+        {"time": (day_start + index * step).isoformat(), "peak": int(value["peak"]), "average": round(float(value["average"]), 2)}
+        for index, value in zip(range(first, last), values[first:last])
+    ]
+
+
+def points(start, end, resolution):
+    # Number of points a query would return, to refuse ranges too long for the step
+    step = STEP[resolution]
+    return -(-(end - start) // step) + 1
+
+
+def _write_rollups(game_id, day, levels):
+    # Store a day's per-minute levels in the hour and day tiers
+    for resolution in (RESOLUTION_HOUR, RESOLUTION_DAY):
+        block_start = _block_start(resolution, day)
+        block = _locked_block(game_id, resolution, block_start)
+        slots = _unpack(resolution, block.data)
+        offset = (day - block_start).days * SLOTS_PER_DAY[resolution]
+        slots[offset:offset + SLOTS_PER_DAY[resolution]] = _aggregate(levels, resolution)
+        block.data = slots.tobytes()
+
+
+def fold_changes(now=None):
+
+    # Add the per-minute changes recorded before now to the minute blocks and delete them,
+    # one game per transaction, so series() has few changes left to add up. Each game's
+    # changes are deleted with DELETE ... RETURNING, so changes written meanwhile stay for
+    # the next fold. Their sum (the players still online at the cutoff, and the other half
+    # of sessions whose changes were not all folded) is kept as one change at the cutoff.
+    # Days past MINUTE_RETENTION_DAYS are left alone, as they are already rolled up.
+    # Returns the number of games folded.
+
+    now = now or datetime.now()
+    cutoff = _minute(now)
+    oldest = (now.date() - timedelta(days=MINUTE_RETENTION_DAYS) - _EPOCH).days
+    game_ids = db.session.scalars(
+        select(ConcurrencyChange.game_id).where(ConcurrencyChange.minute < cutoff).distinct()
+    ).all()
+    for game_id in game_ids:
+        rows = db.session.execute(
+            delete(ConcurrencyChange)
+            .where(ConcurrencyChange.game_id == game_id, ConcurrencyChange.minute < cutoff)
+            .returning(ConcurrencyChange.minute, ConcurrencyChange.delta)
+        ).all()
+        if rows:
+            minutes, deltas = (np.array(column, dtype=np.int64) for column in zip(*rows))
+            # Changes before the oldest day kept per minute only set its starting count
+            base = max(int(minutes.min()) // 1440, oldest) * 1440
+            length = (cutoff // 1440 + 1) * 1440 - base
+            changes = np.zeros(length, dtype=np.int64)
+            np.add.at(changes, np.clip(minutes - base, 0, None), deltas)
+            carry = int(deltas.sum())
+            changes[cutoff - base] -= carry
+            levels = np.cumsum(changes).astype(_MINUTE_DTYPE)
+            for number in range(length // 1440):
+                day_levels = levels[number * 1440:(number + 1) * 1440]
+                if not day_levels.any():
+                    continue
+                block = _locked_block(game_id, RESOLUTION_MINUTE, _EPOCH + timedelta(days=base // 1440 + number))
+                block.data = (_unpack(RESOLUTION_MINUTE, block.data) + day_levels).tobytes()
+            if carry:
+                _add_change(game_id, cutoff, carry)
+        db.session.commit()
+    return len(game_ids)
+
+
+def rollup(today=None):
+
+    # Fold the pending changes into the minute blocks, downsample minute blocks past
+    # MINUTE_RETENTION_DAYS into the hour and day tiers and delete them, then delete hour
+    # blocks past HOUR_RETENTION_DAYS. Each day is moved in its own short transaction.
+    # Returns (days rolled up, hour blocks removed).
+
+    fold_changes()
+    today = today or date.today()
+    cutoff = today - timedelta(days=MINUTE_RETENTION_DAYS)
+    rolled = 0
+    while True:
+        keys = db.session.execute(
+            select(ConcurrencyBlock.game_id, ConcurrencyBlock.start)
+            .where(ConcurrencyBlock.resolution == RESOLUTION_MINUTE, ConcurrencyBlock.start < cutoff)
+            .limit(100)
+        ).all()
+        if not keys:
+            break
+        for game_id, day in keys:
+            block = db.session.get(
+                ConcurrencyBlock, (game_id, RESOLUTION_MINUTE, day), with_for_update=True, populate_existing=True
+            )
+            if block is not None:
+                _write_rollups(game_id, day, _unpack(RESOLUTION_MINUTE, block.data))
+                db.session.delete(block)
+            db.session.commit()
+            rolled += 1
+
+    # Hour blocks whose last day is past retention
+    oldest = today - timedelta(days=HOUR_RETENTION_DAYS + BLOCK_DAYS[RESOLUTION_HOUR])
+    removed = db.session.execute(
+        delete(ConcurrencyBlock).where(
+            ConcurrencyBlock.resolution == RESOLUTION_HOUR, ConcurrencyBlock.start < oldest
+        )
+    ).rowcount
+    db.session.commit()
+    return rolled, removed
+
+
+def rebuild(game_id=None, batch_size=DEFAULT_BATCH_SIZE):
+
+    # Recompute the time series and open sessions from the sessions table (all shards),
+    # for one game or all of them, e.g. to backfill history recorded before the series
+    # existed. Returns the number of sessions read.
+
+    stmt = select(Session.id, Session.user_id, Session.game_id, Session.start_time, Session.end_time)
+    if game_id is not None:
+        stmt = stmt.where(Session.game_id == game_id)
+
+    # Ended sessions as minute ranges per game; open ones are stored as they are
+    games, firsts, lasts, open_rows = [], [], [], []
+    total = 0
+    for rows in shards.stream(stmt, game_id, batch_size):
+        total += len(rows)
+        for row in rows:
+            if row.end_time is None:
+                open_rows.append({
+                    "session_id": row.id, "user_id": row.user_id, "game_id": row.game_id, "start_time": row.start_time
+                })
+            elif row.end_time > row.start_time:
+                first, last = _minute_range(row.start_time, row.end_time)
+                games.append(row.game_id)
+                firsts.append(first)
+                lasts.append(last)
+
+    for model in (ConcurrencyBlock, ConcurrencyChange, OpenSession):
+        query = delete(model)
+        if game_id is not None:
+            query = query.where(model.game_id == game_id)
+        db.session.execute(query)
+    if open_rows:
+        db.session.execute(insert(OpenSession), open_rows)
+
+    games, firsts, lasts = np.array(games, dtype=np.int64), np.array(firsts, dtype=np.int64), np.array(lasts, dtype=np.int64)
+    cutoff = date.today() - timedelta(days=MINUTE_RETENTION_DAYS)
+    for game in np.unique(games):
+        mine = games == game
+        # Levels per minute for whole days, from a difference array of starts and ends
+        base = firsts[mine].min() // 1440 * 1440
+        length = (-(-lasts[mine].max() // 1440) * 1440) - base
+        changes = np.zeros(length + 1, dtype=np.int64)
+        np.add.at(changes, firsts[mine] - base, 1)
+        np.add.at(changes, lasts[mine] - base, -1)
+        levels = np.cumsum(changes[:length]).astype(_MINUTE_DTYPE)
+
+        minute_rows = []
+        for number in range(length // 1440):
+            day_levels = levels[number * 1440:(number + 1) * 1440]
+            if not day_levels.any():
+                continue
+            day = _EPOCH + timedelta(days=int(base // 1440) + number)
+            if day >= cutoff:
+                minute_rows.append({"game_id": int(game), "resolution": RESOLUTION_MINUTE, "start": day, "data": day_levels.tobytes()})
+            else:
+                _write_rollups(int(game), day, day_levels)
+        if minute_rows:
+            db.session.execute(insert(ConcurrencyBlock), minute_rows)
+    db.session.commit()
+    return total
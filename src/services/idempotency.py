@@ -0,0 +1,289 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, request, make_response, g
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import select, insert, update, delete, func, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from init import db
+from models.idempotency_record import IdempotencyRecord
+
+# Header clients send to make a POST safe to retry
+HEADER = "Idempotency-Key"
+
+# Defaults, overridable through app config
+DEFAULT_TTL = 24 * 60 * 60  # Seconds a stored response is replayed for (IDEMPOTENCY_TTL)
+DEFAULT_MAX_KEYS = 10000  # Responses kept in memory per worker (IDEMPOTENCY_MAX_KEYS)
+DEFAULT_WAIT = 10.0  # Seconds a duplicate waits for the first request (IDEMPOTENCY_WAIT)
+
+# How often a duplicate polls the shared table while another worker runs the request
+SHARED_POLL_INTERVAL = 0.05
+
+MAX_KEY_LENGTH = 200
+
+# A response kept for replay
+StoredResponse = namedtuple("StoredResponse", "request_hash status_code body mimetype")
+
+
+class IdempotencyStore:
+
+    # Bounded in-memory store of responses by idempotency key, with TTL eviction.
+    # It also tracks requests in progress, so concurrent duplicates within a worker
+    # wait for the first one instead of running the write again.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._responses = OrderedDict()  # key -> (expires_at, StoredResponse), oldest first
+        self._in_flight = {}  # key -> threading.Event set when the first request finishes
+
+    def get(self, key):
+        with self._lock:
+            entry = self._responses.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._responses[key]
+                return None
+            return entry[1]
+
+    def put(self, key, stored, ttl, max_keys):
+        with self._lock:
+            now = time.monotonic()
+            self._responses[key] = (now + ttl, stored)
+            self._responses.move_to_end(key)
+            # Entries share one TTL, so the oldest are also the first to expire
+            while self._responses:
+                oldest_key, (expires_at, _) = next(iter(self._responses.items()))
+                if expires_at >= now and len(self._responses) <= max_keys:
+                    break
+                del self._responses[oldest_key]
+
+    def claim(self, key):
+        # Returns (event, True) if this request owns the key, or the owner's (event, False)
+        with self._lock:
+            event = self._in_flight.get(key)
+            if event is not None:
+                return event, False
+            event = self._in_flight[key] = threading.Event()
+            return event, True
+
+    def release(self, key):
+        with self._lock:
+            event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
+
+
+# Shared store for this process
+store = IdempotencyStore()
+
+
+def _shared_enabled():
+    return current_app.config.get("IDEMPOTENCY_SHARED_STORE", False)
+
+
+def _shared_get(key):
+    # Read a stored response from the shared table, ignoring expired records
+    with db.engine.connect() as connection:
+        row = connection.execute(
+            select(IdempotencyRecord.__table__).where(
+                IdempotencyRecord.key == key, IdempotencyRecord.expires_at > datetime.now()
+            )
+        ).first()
+    return row
+
+
+def _shared_claim(key, request_hash, ttl, wait):
+
+    # Insert an in-progress record in the request's own transaction, so it is committed
+    # with the view's write and its stored response (see remember()), or rolled back with
+    # them. A worker that dies mid-request therefore frees the key instead of leaving it
+    # in progress until it expires. Returns False if another worker holds the key: a
+    # duplicate's insert waits up to wait seconds on the first request's uncommitted row,
+    # and fails once that row is committed.
+
+    now = datetime.now()
+    postgres = db.engine.dialect.name == "postgresql"
+    try:
+        # Clear an expired record for the key so it can be reused
+        db.session.execute(
+            delete(IdempotencyRecord.__table__).where(
+                IdempotencyRecord.key == key, IdempotencyRecord.expires_at <= now
+            )
+        )
+        if postgres:
+            db.session.execute(select(func.set_config("lock_timeout", f"{int(wait * 1000)}ms", True)))
+        db.session.execute(
+            insert(IdempotencyRecord.__table__).values(
+                key=key, request_hash=request_hash, expires_at=now + timedelta(seconds=ttl)
+            )
+        )
+        if postgres:
+            db.session.execute(text("SET LOCAL lock_timeout TO DEFAULT"))
+        return True
+    except (IntegrityError, OperationalError):
+        # Taken, or still locked by the first request when the wait ran out
+        db.session.rollback()
+        return False
+
+
+def _shared_store(key, stored):
+    # Save the response on the key's record in db.session; the caller commits it
+    db.session.execute(
+        update(IdempotencyRecord.__table__)
+        .where(IdempotencyRecord.key == key)
+        .values(status_code=stored.status_code, response_body=stored.body.decode("utf-8"), mimetype=stored.mimetype)
+    )
+
+
+def _shared_abandon(key):
+    # Drop the record so the client can retry after a failure: the uncommitted one is
+    # rolled back, and one a view already committed is deleted if it has no response
+    db.session.rollback()
+    with db.engine.begin() as connection:
+        connection.execute(
+            delete(IdempotencyRecord.__table__).where(
+                IdempotencyRecord.key == key, IdempotencyRecord.status_code.is_(None)
+            )
+        )
+
+
+def _shared_wait(key, timeout):
+    # Poll the shared table until the response of a committed record is there, or give up
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        row = _shared_get(key)
+        if row is None:
+            return None  # Still running (so not committed yet), or abandoned
+        if row.status_code is not None:
+            return StoredResponse(row.request_hash, row.status_code, row.response_body.encode("utf-8"), row.mimetype)
+        time.sleep(SHARED_POLL_INTERVAL)
+    return None
+
+
+def _replay(stored, request_hash):
+    # Build the response for a retried request
+    if stored.request_hash != request_hash:
+        return {"message": f"{HEADER} was already used for a different request"}, 422
+    response = current_app.response_class(stored.body, status=stored.status_code, mimetype=stored.mimetype)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def remember(response):
+
+    # Store the response of an @idempotent view in the request's transaction, for views
+    # to call just before they commit their write, so the write and the response to
+    # replay are committed together. Returns the response as a response object.
+
+    response = make_response(response)
+    pending = g.get("idempotency")
+    if pending is not None and response.status_code < 500:
+        stored = StoredResponse(pending["request_hash"], response.status_code, response.get_data(), response.mimetype)
+        _shared_store(pending["key"], stored)
+        pending["stored"] = True
+    return response
+
+
+def row_key():
+    # Digest of the current request's Idempotency-Key and body, or None without the header.
+    # Views store it on the rows they create, so a retry can find a row an earlier attempt
+    # already wrote outside the request's transaction (see ShardRouter.add).
+    return g.get("idempotency_row_key")
+
+
+def _in_progress():
+    return {"message": "A request with this Idempotency-Key is still in progress"}, 409
+
+
+def idempotent(view):
+
+    # Make a POST view safe to retry with an Idempotency-Key header.
+    # The first request with a key runs the view and its response is stored; retries
+    # with the same key get the stored response without touching the write path, and
+    # concurrent duplicates wait for the first request rather than inserting again.
+    # Keys are scoped by user and endpoint. Must be applied below @jwt_required().
+    # Views that write pass their response to remember() before committing.
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(HEADER)
+        if not client_key:
+            return view(*args, **kwargs)
+        if len(client_key) > MAX_KEY_LENGTH:
+            return {"message": f"{HEADER} is too long"}, 400
+
+        config = current_app.config
+        ttl = config.get("IDEMPOTENCY_TTL", DEFAULT_TTL)
+        wait = config.get("IDEMPOTENCY_WAIT", DEFAULT_WAIT)
+        key = f"{get_jwt_identity()}:{request.endpoint}:{client_key}"
+        request_hash = hashlib.sha256(request.get_data()).hexdigest()
+
+        stored = store.get(key)
+        if stored is not None:
+            return _replay(stored, request_hash)
+
+        # Coalesce duplicates within this worker
+        event, owner = store.claim(key)
+        if not owner:
+            event.wait(wait)
+            stored = store.get(key)
+            return _replay(stored, request_hash) if stored else _in_progress()
+
+        # The previous owner may have finished between the lookup and the claim
+        stored = store.get(key)
+        if stored is not None:
+            store.release(key)
+            return _replay(stored, request_hash)
+
+        shared = False
+        g.idempotency_row_key = hashlib.sha256(f"{key}:{request_hash}".encode("utf-8")).hexdigest()
+        try:
+            # Coalesce duplicates across workers through the shared table
+            if _shared_enabled():
+                if not _shared_claim(key, request_hash, ttl, wait):
+                    stored = _shared_wait(key, wait)
+                    if stored is None:
+                        return _in_progress()
+                    store.put(key, stored, ttl, config.get("IDEMPOTENCY_MAX_KEYS", DEFAULT_MAX_KEYS))
+                    return _replay(stored, request_hash)
+                shared = True
+                g.idempotency = {"key": key, "request_hash": request_hash, "stored": False}
+
+            response = make_response(view(*args, **kwargs))
+
+            # Only successful and client-error responses are replayed; server errors can be retried
+            if response.status_code < 500:
+                stored = StoredResponse(request_hash, response.status_code, response.get_data(), response.mimetype)
+                store.put(key, stored, ttl, config.get("IDEMPOTENCY_MAX_KEYS", DEFAULT_MAX_KEYS))
+                if shared and not g.idempotency["stored"]:
+                    # The view returned without remember(), e.g. an error before any write
+                    _shared_store(key, stored)
+                    db.session.commit()
+            elif shared:
+                _shared_abandon(key)
+            return response
+        except Exception:
+            if shared:
+                _shared_abandon(key)
+            raise
+        finally:
+            g.pop("idempotency", None)
+            g.pop("idempotency_row_key", None)
+            store.release(key)
+
+    return wrapper
+
+
+def purge_expired():
+    # Delete expired records from the shared table; returns the number removed
+    with db.engine.begin() as connection:
+        result = connection.execute(
+            delete(IdempotencyRecord.__table__).where(IdempotencyRecord.expires_at <= datetime.now())
+        )
+    return result.rowcount
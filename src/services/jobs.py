@@ -0,0 +1,218 @@
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import select, update, delete
+
+from init import db
+from models.job import Job, STATUS_QUEUED, STATUS_RUNNING, STATUS_FINISHED, STATUS_FAILED
+
+# Defaults, overridable through app config
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF = 5.0  # Seconds before the first retry, doubled on each further failure (JOB_BACKOFF)
+DEFAULT_MAX_BACKOFF = 3600.0  # Longest wait between retries (JOB_MAX_BACKOFF)
+DEFAULT_LOCK_TIMEOUT = 600.0  # Seconds without a heartbeat before a running job is requeued (JOB_LOCK_TIMEOUT)
+DEFAULT_POLL_INTERVAL = 1.0  # Seconds an idle worker waits before looking for jobs again
+
+# Registered tasks: name -> (function, max_attempts)
+_tasks = {}
+
+
+def task(name, max_attempts=DEFAULT_MAX_ATTEMPTS):
+
+    # Register a function as a background task.
+    # The function is called as fn(job, **payload) inside an app context; it can report
+    # progress with update_progress(job, ...) and its return value is stored as the result.
+    # Tasks can be retried after a failure or a crashed worker, so they must be safe to rerun.
+
+    def register(fn):
+        _tasks[name] = (fn, max_attempts)
+        return fn
+    return register
+
+
+def enqueue(name, run_at=None, delay=None, requested_by=None, **payload):
+
+    # Add a job to db.session; it is committed, and so only becomes visible to workers,
+    # with the caller's transaction.
+    # - run_at / delay: Schedule the job for a time, or a number of seconds from now.
+    # - payload: JSON-serialisable keyword arguments for the task.
+
+    if name not in _tasks:
+        raise KeyError(f"Unknown task: {name}")
+    if run_at is None:
+        run_at = datetime.now() + timedelta(seconds=delay or 0)
+    job = Job(
+        name=name,
+        payload=payload,
+        status=STATUS_QUEUED,
+        attempts=0,
+        max_attempts=_tasks[name][1],
+        run_at=run_at,
+        requested_by=requested_by,
+    )
+    db.session.add(job)
+    db.session.flush()  # Assign the job ID so it can be returned to the client
+    return job
+
+
+def update_progress(job, result):
+    # Store a running task's progress and refresh its lock, so long jobs are not requeued
+    job.result = result
+    job.locked_at = datetime.now()
+    db.session.commit()
+
+
+def _backoff(attempts):
+    # Seconds to wait before the next attempt: exponential, capped, with jitter so that
+    # jobs that failed together do not all retry at the same moment
+    config = current_app.config
+    delay = min(config.get("JOB_MAX_BACKOFF", DEFAULT_MAX_BACKOFF), config.get("JOB_BACKOFF", DEFAULT_BACKOFF) * 2 ** (attempts - 1))
+    return delay * random.uniform(0.9, 1.1)
+
+
+def requeue_stale():
+
+    # Put running jobs whose worker stopped reporting back in the queue.
+    # The attempt already counted, so a job that keeps crashing its worker eventually fails.
+
+    timeout = current_app.config.get("JOB_LOCK_TIMEOUT", DEFAULT_LOCK_TIMEOUT)
+    now = datetime.now()
+    result = db.session.execute(
+        update(Job)
+        .where(Job.status == STATUS_RUNNING, Job.locked_at < now - timedelta(seconds=timeout))
+        .values(status=STATUS_QUEUED, run_at=now, locked_by=None)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def claim(worker_name):
+
+    # Claim the oldest due job, or return None when there is nothing to do.
+    # On PostgreSQL, SELECT ... FOR UPDATE SKIP LOCKED lets many workers poll the table
+    # without queueing behind each other's row locks. The status check in the UPDATE keeps
+    # the claim safe on databases without SKIP LOCKED (SQLite ignores FOR UPDATE).
+
+    while True:
+        now = datetime.now()
+        job = db.session.scalars(
+            select(Job)
+            .where(Job.status == STATUS_QUEUED, Job.run_at <= now)
+            .order_by(Job.run_at, Job.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).first()
+        if job is None:
+            db.session.rollback()
+            return None
+
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.id == job.id, Job.status == STATUS_QUEUED)
+            .values(status=STATUS_RUNNING, attempts=Job.attempts + 1, locked_at=now, locked_by=worker_name)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return job
+        # Another worker took it between the SELECT and the UPDATE; try the next one
+
+
+def run(job):
+
+    # Run a claimed job and record the outcome: finished, queued again with backoff, or failed
+
+    fn = _tasks.get(job.name, (None,))[0]
+    try:
+        if fn is None:
+            raise KeyError(f"Unknown task: {job.name}")
+        result = fn(job, **job.payload)
+    except Exception as error:
+        db.session.rollback()
+        current_app.logger.exception("Job %s (%s) failed on attempt %s", job.id, job.name, job.attempts)
+        job.last_error = f"{type(error).__name__}: {error}"
+        job.locked_at = None
+        job.locked_by = None
+        if job.attempts < job.max_attempts:
+            job.status = STATUS_QUEUED
+            job.run_at = datetime.now() + timedelta(seconds=_backoff(job.attempts))
+        else:
+            job.status = STATUS_FAILED
+            job.finished_at = datetime.now()
+        db.session.commit()
+        return False
+
+    if result is not None:
+        job.result = result
+    job.status = STATUS_FINISHED
+    job.locked_at = None
+    job.finished_at = datetime.now()
+    db.session.commit()
+    return True
+
+
+def run_worker(app, concurrency=1, poll_interval=DEFAULT_POLL_INTERVAL, burst=False, stop=None):
+
+    # Run jobs on `concurrency` threads until stopped.
+    # - burst: Return once no job is due, instead of waiting for more.
+    # - stop: threading.Event that ends the worker after the jobs in progress finish.
+    # The number of threads bounds how fast jobs drain, whatever is enqueued.
+
+    stop = stop or threading.Event()
+    base_name = f"{socket.gethostname()}:{os.getpid()}"
+    timeout = app.config.get("JOB_LOCK_TIMEOUT", DEFAULT_LOCK_TIMEOUT)
+
+    def loop(number):
+        worker_name = f"{base_name}:{number}"
+        last_requeue = 0.0
+        while not stop.is_set():
+            job = None
+            with app.app_context():
+                try:
+                    # One thread per process looks for crashed workers' jobs now and then
+                    if number == 0 and time.monotonic() - last_requeue > timeout / 2:
+                        requeue_stale()
+                        last_requeue = time.monotonic()
+                    job = claim(worker_name)
+                    if job is not None:
+                        run(job)
+                except Exception:
+                    # e.g. the database is unreachable; keep the worker alive and try again
+                    app.logger.exception("Worker %s could not process jobs", worker_name)
+                    job = None
+                    if burst:
+                        return
+                finally:
+                    db.session.remove()
+            if job is None:
+                if burst:
+                    return
+                stop.wait(poll_interval)
+
+    threads = [threading.Thread(target=loop, args=(number,), name=f"worker-{number}") for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def purge_finished(days):
+    # Delete finished and failed jobs older than the given number of days; returns the number removed
+    result = db.session.execute(
+        delete(Job).where(
+            Job.status.in_([STATUS_FINISHED, STATUS_FAILED]),
+            Job.finished_at < datetime.now() - timedelta(days=days),
+        )
+    )
+    db.session.commit()
+    return result.rowcount
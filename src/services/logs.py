@@ -0,0 +1,211 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler
+
+from flask import request, has_request_context
+from flask_jwt_extended import get_jwt_identity
+
+# Structured JSON logging that stays off the request path.
+# Every log record (the access log and the app's own loggers alike) goes through a
+# QueueHandler onto an in-memory queue; a writer thread takes records off in batches,
+# formats them as one JSON object per line and writes each batch with a single write().
+# A log call on the request path therefore costs a LogRecord and a queue put. The queue
+# is drained when the process exits normally, so a graceful shutdown loses nothing.
+
+# Defaults, overridable through app config
+DEFAULT_LEVEL = "INFO"  # LOG_LEVEL
+DEFAULT_BATCH_SIZE = 1000  # Most records per write (LOG_BATCH_SIZE)
+
+# Logger the access log is written to
+ACCESS_LOGGER = "access"
+
+# Header carrying the request ID; taken from the client (or proxy) if sent, made up otherwise
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Keys in the WSGI environ for when the request started and its ID. Kept per request rather
+# than on flask.g, which batch sub-requests share with their batch
+STARTED_KEY = "logs.started"
+REQUEST_ID_KEY = "logs.request_id"
+
+# Attributes every LogRecord has; anything else on a record is an extra field to log
+_STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+
+    # Formats a record as one line of JSON, with the extra fields passed to the log call
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _Handler(QueueHandler):
+
+    # Puts records on the writer's queue as they are. QueueHandler normally formats them
+    # first so they can cross processes; this queue stays in the process, so formatting
+    # is left to the writer thread.
+
+    def __init__(self, writer):
+        super().__init__(writer.queue)
+        self.writer = writer
+
+    def prepare(self, record):
+        return record
+
+    def emit(self, record):
+        self.writer.ensure_started()
+        super().emit(record)
+
+
+class LogWriter:
+
+    # Background thread writing queued records to a stream in batches: it waits for one
+    # record, takes whatever else has queued up behind it (up to batch_size) and writes
+    # them all at once, so a burst of requests costs one write, not one per line.
+
+    _STOP = object()
+
+    def __init__(self, stream=None, batch_size=DEFAULT_BATCH_SIZE):
+        self.queue = queue.SimpleQueue()
+        self.stream = stream or sys.stdout
+        self.batch_size = batch_size
+        self.formatter = JsonFormatter()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+    def ensure_started(self):
+        # Start the thread in each process (after any fork) on its first record
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        # Write everything queued so far and stop the thread
+        if self._thread is not None and self._pid == os.getpid():
+            self.queue.put(self._STOP)
+            self._thread.join(timeout)
+            self._thread = None
+            self._pid = None
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = records[-1] is self._STOP
+            lines = []
+            for record in records:
+                if record is self._STOP:
+                    continue
+                try:
+                    lines.append(self.formatter.format(record))
+                except Exception:
+                    lines.append(json.dumps({"level": "ERROR", "logger": __name__, "message": "Unformattable log record"}))
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except Exception:
+                    pass  # Nowhere left to report it
+            if stopping:
+                return
+
+
+class StructuredLogging:
+
+    # JSON logging and per-request access logs, initialised in create_app like the other
+    # extensions. LOG_FILE sends the logs to a file instead of stdout; ACCESS_LOG = False
+    # turns the access log off. Each request gets an ID (X-Request-ID), which is returned
+    # in the response and logged with the request and any writes it makes.
+
+    def __init__(self, app=None):
+        self.writer = None
+        self.access_logger = logging.getLogger(ACCESS_LOGGER)
+        self.access_log = True
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.writer is None:
+            stream = open(app.config["LOG_FILE"], "a", buffering=1) if app.config.get("LOG_FILE") else None
+            self.writer = LogWriter(stream, app.config.get("LOG_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+            root = logging.getLogger()
+            root.handlers = [_Handler(self.writer)]
+            root.setLevel(app.config.get("LOG_LEVEL", DEFAULT_LEVEL))
+            atexit.register(self.writer.stop)
+        self.access_log = app.config.get("ACCESS_LOG", True)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        request.environ[STARTED_KEY] = time.perf_counter()
+        request.environ[REQUEST_ID_KEY] = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+
+    def _after_request(self, response):
+        started = request.environ.get(STARTED_KEY)
+        if started is None:
+            return response
+        request_id = request.environ[REQUEST_ID_KEY]
+        response.headers[REQUEST_ID_HEADER] = request_id
+        logger = self.access_logger
+        if self.access_log and logger.isEnabledFor(logging.INFO):
+            fields = {
+                "request_id": request_id,
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+                "user_id": current_actor(),
+                "remote_addr": request.remote_addr,
+            }
+            # makeRecord() rather than info(), which would also walk the stack to find the caller
+            record = logger.makeRecord(
+                logger.name, logging.INFO, "", 0, "%s %s %s", (request.method, request.path, response.status_code), None, extra=fields
+            )
+            logger.handle(record)
+        return response
+
+
+def current_actor():
+    # ID of the user the current request is authenticated as, or None
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        return None  # Not in a request, or the route does not check a JWT
+
+
+def current_request_id():
+    # ID of the current request, or None outside a request
+    return request.environ.get(REQUEST_ID_KEY) if has_request_context() else None
+
+
+# Shared instance, initialised in create_app
+logs = StructuredLogging()
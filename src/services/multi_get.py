@@ -0,0 +1,46 @@
+from flask import request
+from marshmallow import ValidationError
+from sqlalchemy import select
+
+from init import db
+from services.sharding import shards, SHARDED_MODELS
+from services.repository import query_stats
+
+# Most IDs one ?ids= request can ask for
+MAX_IDS = 100
+
+
+def requested_ids():
+
+    # IDs asked for with ?ids=1,2,3, without duplicates and in the order given, or None
+    # when the parameter is absent. Invalid lists raise a ValidationError, which is
+    # returned as a 400.
+
+    if "ids" not in request.args:
+        return None
+    try:
+        ids = [int(part) for part in request.args["ids"].split(",") if part.strip()]
+    except ValueError:
+        raise ValidationError({"ids": ["Must be a comma separated list of integers."]})
+    ids = list(dict.fromkeys(ids))
+    if not ids or len(ids) > MAX_IDS:
+        raise ValidationError({"ids": [f"Must list between 1 and {MAX_IDS} IDs."]})
+    return ids
+
+
+def get_many(model, ids, *criteria, options=()):
+
+    # Rows with the given IDs (and matching any further criteria) from one IN query, in
+    # the order the IDs were given; IDs that do not exist are left out. Scores and
+    # sessions are read from every shard in parallel, with their users and games.
+    # - options: Loader options for the relationships the response serialises.
+
+    if model in SHARDED_MODELS:
+        rows = shards.select(model, model.id.in_(ids), *criteria)
+        if not shards.enabled:
+            shards.attach(rows)  # Already attached when sharded
+    else:
+        with query_stats.measure(f"{model.__name__}.get_many"):
+            rows = db.session.scalars(select(model).where(model.id.in_(ids), *criteria).options(*options)).all()
+    by_id = {row.id: row for row in rows}
+    return [by_id[id] for id in ids if id in by_id]
@@ -0,0 +1,250 @@
+import logging
+import os
+import select as select_module
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event, select, delete, func, or_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session as OrmSession
+
+from init import db
+from models.outbox_event import OutboxEvent
+
+# PostgreSQL channel notified when events are committed
+CHANNEL = "outbox_events"
+
+# Defaults, overridable through app config
+DEFAULT_POLL_INTERVAL = 2.0  # Longest delay before a worker sees another worker's events (OUTBOX_POLL_INTERVAL)
+DEFAULT_RETENTION_HOURS = 24  # Events kept for `flask db_commands purge-outbox`
+
+# An event ID below the newest one seen may belong to a transaction that has not committed
+# yet; it is looked for again on each poll for this long before it is taken as rolled back
+GAP_TIMEOUT = 60.0
+MAX_GAPS = 10000
+
+# Events read per query
+BATCH_SIZE = 500
+
+# Key in session.info holding the events flushed in the current transaction
+SESSION_KEY = "outbox.events"
+
+# An event as delivered to subscribers
+Event = namedtuple("Event", "id topic entity_id payload")
+
+logger = logging.getLogger(__name__)
+
+# Subscribers: (topic prefix, handler)
+_subscribers = []
+
+
+def subscribe(prefix, handler):
+
+    # Call handler(event) for every event whose topic starts with prefix, in every process.
+    # Handlers run once when the change is committed in this process, and again (or for
+    # the first time, in other processes) when the relay reads the event, so they must be
+    # idempotent, e.g. dropping a cache entry.
+
+    _subscribers.append((prefix, handler))
+
+
+def _dispatch(evt):
+    for prefix, handler in list(_subscribers):
+        if evt.topic.startswith(prefix):
+            try:
+                handler(evt)
+            except Exception:
+                logger.exception("Outbox subscriber failed for %s %s", evt.topic, evt.id)
+
+
+def record(topic, entity_id=None, **payload):
+
+    # Record an event in db.session, so it is committed (or rolled back) with the change it
+    # describes. Topics are "<entity>.<action>", e.g. "game.updated".
+
+    outbox_event = OutboxEvent(topic=topic, entity_id=entity_id, payload=payload)
+    db.session.add(outbox_event)
+    if db.engine.dialect.name == "postgresql":
+        # Notifications are delivered on commit, and identical ones are sent only once
+        db.session.execute(select(func.pg_notify(CHANNEL, "")))
+    return outbox_event
+
+
+@event.listens_for(OrmSession, "after_flush")
+def _collect_events(session, flush_context):
+    # Remember the events written by this flush, while their IDs and values are loaded
+    events = [
+        Event(obj.id, obj.topic, obj.entity_id, obj.payload)
+        for obj in session.new
+        if isinstance(obj, OutboxEvent)
+    ]
+    if events:
+        session.info.setdefault(SESSION_KEY, []).extend(events)
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _dispatch_committed(session):
+    # Tell this process's subscribers straight away; other processes hear through the relay
+    for evt in session.info.pop(SESSION_KEY, []):
+        _dispatch(evt)
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_rolled_back(session):
+    session.info.pop(SESSION_KEY, None)
+
+
+class OutboxRelay:
+
+    # Per-process relay delivering other processes' events to this process's subscribers.
+    # A background thread reads new events from the outbox table in ID order. On PostgreSQL
+    # it wakes up on LISTEN/NOTIFY as soon as an event is committed; elsewhere, or if a
+    # notification is missed, it polls every OUTBOX_POLL_INTERVAL seconds, which bounds how
+    # stale a cache can get. Events live in the table, so a worker that crashes or restarts
+    # cannot make anyone miss one.
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = threading.Event()
+        self.last_id = 0
+        self.start_id = None  # Last event already reflected in this process's caches, if known
+        self._gaps = OrderedDict()  # Missing event ID -> when it was first missed
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get("OUTBOX_RELAY", True):
+            app.before_request(self.ensure_started)
+
+    def start_from_now(self):
+
+        # Deliver every event committed from now on, even if the relay thread only starts
+        # later. Called before caches are filled at startup (or in a server process before
+        # it forks workers), so changes made between filling them and the first request are
+        # not missed. Needs an app context; does nothing until the outbox table exists.
+
+        try:
+            self.start_id = db.session.scalar(select(func.max(OutboxEvent.id))) or 0
+        except SQLAlchemyError:
+            self.start_id = None
+        finally:
+            db.session.remove()
+
+    def ensure_started(self):
+        # Start the relay thread on the first request of each process (after any fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            app = current_app._get_current_object()
+            threading.Thread(target=self._run, args=(app,), name="outbox-relay", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, app):
+        with app.app_context():
+            interval = app.config.get("OUTBOX_POLL_INTERVAL", DEFAULT_POLL_INTERVAL)
+            try:
+                # Events from before this process started are not needed: its caches are empty,
+                # or were filled after start_id
+                if self.start_id is not None:
+                    self.last_id = self.start_id
+                else:
+                    self.last_id = db.session.scalar(select(func.max(OutboxEvent.id))) or 0
+            finally:
+                db.session.remove()
+
+            listener = None
+            while not self._stop.is_set():
+                try:
+                    if listener is None and db.engine.dialect.name == "postgresql":
+                        listener = self._listen()
+                    self._wait(listener, interval)
+                    while self.poll() == BATCH_SIZE:
+                        pass
+                except Exception:
+                    logger.exception("Outbox relay failed, retrying")
+                    if listener is not None:
+                        listener.close()
+                        listener = None
+                    self._stop.wait(interval)
+                finally:
+                    db.session.remove()
+            if listener is not None:
+                listener.close()
+
+    def _listen(self):
+        # Dedicated connection for LISTEN, taken out of the pool for good
+        connection = db.engine.raw_connection()
+        connection.detach()
+        connection.dbapi_connection.autocommit = True
+        cursor = connection.dbapi_connection.cursor()
+        cursor.execute(f"LISTEN {CHANNEL}")
+        cursor.close()
+        return connection
+
+    def _wait(self, listener, timeout):
+        # Sleep until notified or until the poll interval has passed
+        if listener is None:
+            self._stop.wait(timeout)
+            return
+        dbapi_connection = listener.dbapi_connection
+        readable, _, _ = select_module.select([dbapi_connection], [], [], timeout)
+        if readable:
+            dbapi_connection.poll()
+            dbapi_connection.notifies.clear()
+
+    def poll(self):
+
+        # Deliver events committed since the last poll; returns the number read.
+        # IDs are handed out when a row is inserted, not when it is committed, so an ID
+        # skipped over may still turn up; such gaps are checked again until GAP_TIMEOUT.
+
+        criteria = OutboxEvent.id > self.last_id
+        if self._gaps:
+            criteria = or_(criteria, OutboxEvent.id.in_(list(self._gaps)))
+        rows = db.session.execute(
+            select(OutboxEvent.id, OutboxEvent.topic, OutboxEvent.entity_id, OutboxEvent.payload)
+            .where(criteria)
+            .order_by(OutboxEvent.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        db.session.rollback()  # Do not hold a transaction open between polls
+
+        now = time.monotonic()
+        for row in rows:
+            if row.id in self._gaps:
+                del self._gaps[row.id]
+            elif row.id > self.last_id:
+                for missing in range(self.last_id + 1, row.id):
+                    self._gaps[missing] = now
+                self.last_id = row.id
+            _dispatch(Event(*row))
+
+        while self._gaps:
+            missing, since = next(iter(self._gaps.items()))
+            if now - since < GAP_TIMEOUT and len(self._gaps) <= MAX_GAPS:
+                break
+            del self._gaps[missing]
+        return len(rows)
+
+
+def purge_old(hours=DEFAULT_RETENTION_HOURS):
+    # Delete events older than the given number of hours; returns the number removed
+    result = db.session.execute(
+        delete(OutboxEvent).where(OutboxEvent.created_at < datetime.now() - timedelta(hours=hours))
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+# Outbox relay instance, initialised with the app in create_app
+relay = OutboxRelay()
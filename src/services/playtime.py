@@ -0,0 +1,140 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete
+from sqlalchemy.dialects import postgresql, sqlite
+
+from init import db
+from models.session import Session
+from models.playtime_rollup import PlaytimeRollup
+from services.sharding import shards
+
+# Supported report buckets
+BUCKET_DAY = "day"
+BUCKET_WEEK = "week"
+BUCKETS = (BUCKET_DAY, BUCKET_WEEK)
+
+
+def split_by_day(start_time, end_time):
+    # Split a session into (day, seconds) parts, so time after midnight counts for the next day
+    parts = []
+    current = start_time
+    while current < end_time:
+        next_midnight = datetime.combine(current.date() + timedelta(days=1), datetime.min.time())
+        part_end = min(end_time, next_midnight)
+        parts.append((current.date(), int((part_end - current).total_seconds())))
+        current = part_end
+    return parts
+
+
+def _add(user_id, amounts):
+
+    # Add seconds and session counts to a user's daily rollups.
+    # - amounts: {day: (seconds, sessions)}, negative to take an ended session back out.
+    # Uses a single INSERT ... ON CONFLICT DO UPDATE, so concurrent session ends for the
+    # same day add up instead of overwriting each other.
+
+    if not amounts:
+        return
+    name = db.engine.dialect.name
+    if name == "postgresql":
+        insert = postgresql.insert
+    elif name == "sqlite":
+        insert = sqlite.insert
+    else:
+        raise RuntimeError(f"Playtime rollups are not supported on {name}")
+
+    table = PlaytimeRollup.__table__
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "day"],
+        set_={
+            "seconds": table.c.seconds + stmt.excluded.seconds,
+            "sessions": table.c.sessions + stmt.excluded.sessions,
+        },
+    )
+    db.session.execute(
+        stmt,
+        [
+            {"user_id": user_id, "day": day, "seconds": seconds, "sessions": sessions}
+            for day, (seconds, sessions) in amounts.items()
+        ],
+    )
+
+
+def _amounts(session, sign=1):
+    # Rollup changes for an ended session; the session counts for the day it started
+    amounts = {}
+    for day, seconds in split_by_day(session.start_time, session.end_time):
+        amounts[day] = (sign * seconds, 0)
+    day = session.start_time.date()
+    amounts[day] = (amounts.get(day, (0, 0))[0], sign)
+    return amounts
+
+
+def record_session_end(session):
+    # Add an ended session to its user's rollups. Runs in the caller's transaction.
+    if session.end_time is not None and session.end_time > session.start_time:
+        _add(session.user_id, _amounts(session))
+
+
+def remove_session(session):
+    # Take an ended session back out of its user's rollups before it is deleted
+    if session.end_time is not None and session.end_time > session.start_time:
+        _add(session.user_id, _amounts(session, sign=-1))
+
+
+def rebuild(user_id=None):
+
+    # Recompute rollups from the sessions table, for one user or for everyone.
+    # Used to backfill rollups for sessions recorded before they existed.
+    # Returns the number of ended sessions counted.
+
+    query = delete(PlaytimeRollup)
+    sessions = select(Session.user_id, Session.start_time, Session.end_time).where(
+        Session.end_time.is_not(None), Session.end_time > Session.start_time
+    )
+    if user_id is not None:
+        query = query.where(PlaytimeRollup.user_id == user_id)
+        sessions = sessions.where(Session.user_id == user_id)
+    db.session.execute(query)
+
+    totals, count = {}, 0
+    for row in shards.execute(sessions):
+        user_totals = totals.setdefault(row.user_id, {})
+        for day, (seconds, started) in _amounts(row).items():
+            previous = user_totals.get(day, (0, 0))
+            user_totals[day] = (previous[0] + seconds, previous[1] + started)
+        count += 1
+    for row_user_id, amounts in totals.items():
+        _add(row_user_id, amounts)
+    db.session.commit()
+    return count
+
+
+def report(user_id, bucket=BUCKET_DAY, start=None, end=None):
+
+    # Play time for a user per day or per week (weeks start on Monday), read from the rollups.
+    # - start, end: Optional dates; the range includes start and excludes end.
+    # Returns a list of {"start": date, "seconds": int, "sessions": int}, oldest first.
+
+    query = select(PlaytimeRollup.day, PlaytimeRollup.seconds, PlaytimeRollup.sessions).where(
+        PlaytimeRollup.user_id == user_id
+    )
+    if start is not None:
+        query = query.where(PlaytimeRollup.day >= start)
+    if end is not None:
+        query = query.where(PlaytimeRollup.day < end)
+
+    buckets = OrderedDict()
+    for day, seconds, sessions in db.session.execute(query.order_by(PlaytimeRollup.day)):
+        if bucket == BUCKET_WEEK:
+            day = day - timedelta(days=day.weekday())
+        previous = buckets.get(day, (0, 0))
+        buckets[day] = (previous[0] + seconds, previous[1] + sessions)
+
+    return [
+        {"start": day.isoformat(), "seconds": seconds, "sessions": sessions}
+        for day, (seconds, sessions) in buckets.items()
+        if seconds or sessions
+    ]
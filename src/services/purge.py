@@ -0,0 +1,134 @@
+from flask import current_app
+from sqlalchemy import select, delete, tuple_
+
+from init import db
+from models.user import User
+from models.game import Game
+from models.score import Score
+from models.session import Session
+from models.achievement import Achievement
+from models.achievement_definition import AchievementDefinition, AchievementProgress
+from models.rating import Rating, ScoreStats
+from models.active_player_sketch import ActivePlayerSketch
+from models.concurrency import ConcurrencyBlock, ConcurrencyChange, OpenSession
+from models.similar_game import SimilarGame
+from models.score_baseline import ScoreBaseline
+from services import outbox
+from services.sharding import shards, SHARDED_MODELS
+from services.jobs import task, enqueue, update_progress
+
+# Default number of rows removed per transaction
+DEFAULT_CHUNK_SIZE = 10000
+
+# Parent model and the child tables (with their foreign key column) emptied before it, in order
+PURGE_TARGETS = {
+    "game": (Game, [
+        (Score, Score.game_id),
+        (Session, Session.game_id),
+        (Achievement, Achievement.game_id),
+        (AchievementProgress, AchievementProgress.game_id),
+        (AchievementDefinition, AchievementDefinition.game_id),
+        (Rating, Rating.game_id),
+        (ScoreStats, ScoreStats.game_id),
+        (ActivePlayerSketch, ActivePlayerSketch.game_id),
+        (ConcurrencyBlock, ConcurrencyBlock.game_id),
+        (ConcurrencyChange, ConcurrencyChange.game_id),
+        (OpenSession, OpenSession.game_id),
+        (SimilarGame, SimilarGame.game_id),
+        (SimilarGame, SimilarGame.similar_game_id),
+        (ScoreBaseline, ScoreBaseline.game_id),
+    ]),
+    "user": (User, [
+        (Score, Score.user_id),
+        (Session, Session.user_id),
+        (Achievement, Achievement.user_id),
+        (AchievementProgress, AchievementProgress.user_id),
+        (Rating, Rating.user_id),
+        (OpenSession, OpenSession.user_id),
+        (ScoreBaseline, ScoreBaseline.user_id),
+    ]),
+}
+
+
+def _delete_chunk(model, column, parent_id, chunk_size, session=None):
+
+    # Delete up to chunk_size child rows in their own short transaction.
+    # Rows are picked by primary key through the foreign key index, so each chunk only
+    # locks the rows it removes and nothing is loaded into Python.
+    # - session: The shard session for sharded tables, db.session by default.
+
+    session = session or db.session
+    key = list(model.__table__.primary_key.columns)
+    batch = select(*key).where(column == parent_id).limit(chunk_size)
+    if len(key) == 1:
+        condition = key[0].in_(batch)
+    else:
+        condition = tuple_(*key).in_(batch)
+
+    result = session.execute(delete(model.__table__).where(condition))
+    session.commit()
+    return result.rowcount
+
+
+def _delete_children(model, column, parent_id, chunk_size, deleted, on_progress, session=None):
+    # Delete all child rows chunk by chunk, counting them in deleted as they go
+    while True:
+        count = _delete_chunk(model, column, parent_id, chunk_size, session)
+        deleted[model.__tablename__] += count
+        if on_progress:
+            on_progress(deleted)
+        if count < chunk_size:
+            return
+
+
+def purge(entity, entity_id, chunk_size=DEFAULT_CHUNK_SIZE, on_progress=None):
+
+    # Delete a game or user and everything that belongs to it, chunk by chunk.
+    # Returns the number of rows deleted per table.
+    # - on_progress: Optional callback given those counts after each chunk.
+
+    parent, children = PURGE_TARGETS[entity]
+    deleted = {}
+
+    for model, column in children:
+        table = model.__tablename__
+        deleted.setdefault(table, 0)
+        if shards.enabled and model in SHARDED_MODELS:
+            # A game's rows are all on its shard; a user's can be on any of them
+            for name in shards.names_for(entity_id if entity == "game" else None):
+                with shards.session(name) as session:
+                    _delete_children(model, column, entity_id, chunk_size, deleted, on_progress, session)
+        else:
+            _delete_children(model, column, entity_id, chunk_size, deleted, on_progress)
+
+    # Anything written since the last chunk is removed by the database cascade
+    result = db.session.execute(delete(parent.__table__).where(parent.id == entity_id))
+    if result.rowcount:
+        outbox.record(f"{entity}.deleted", entity_id)
+    db.session.commit()
+    deleted[parent.__tablename__] = result.rowcount
+    return deleted
+
+
+@task("purge", max_attempts=10)
+def purge_task(job, entity, entity_id):
+    # Background delete queued by start_purge; progress is saved on the job after each chunk.
+    # Safe to retry, since every chunk only deletes rows that are still there.
+    chunk_size = current_app.config.get("PURGE_CHUNK_SIZE", DEFAULT_CHUNK_SIZE)
+    deleted = purge(
+        entity,
+        entity_id,
+        chunk_size,
+        on_progress=lambda deleted: update_progress(job, {"deleted": dict(deleted)}),
+    )
+    return {"deleted": deleted}
+
+
+def start_purge(entity, entity_id, requested_by):
+
+    # Queue a game or user for deletion by a worker and return the job,
+    # so the request can respond straight away with 202 Accepted.
+
+    job = enqueue("purge", requested_by=requested_by, entity=entity, entity_id=entity_id)
+    db.session.commit()
+    return job
@@ -0,0 +1,369 @@
+import gc
+import json
+import math
+import os
+import random
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event, insert, select, func
+
+from init import db, bcrypt
+from models.user import User
+from models.genre import Genre
+from models.developer import Developer
+from models.game import Game
+from models.score import Score
+from models.session import Session
+from models.achievement import Achievement
+from models.achievement_definition import AchievementDefinition
+from models.job import Job, STATUS_FINISHED
+from services.sharding import shards, SHARDED_MODELS
+from services import snapshot
+from services.repository import query_stats
+
+# Budgets checked in next to the app
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "query_budgets.json")
+
+# Tables too big to ever read with a sequential scan
+PROTECTED_TABLES = ("scores", "sessions")
+
+# Rows seeded at scale 1, chosen so that scans of the big tables are slower than index
+# lookups for the planner and N+1 queries show up as hundreds of statements
+SEED_SIZES = {"genres": 12, "developers": 60, "games": 500, "users": 2000, "scores": 100000, "sessions": 100000, "achievements": 5000}
+
+# Seed of the random data, so every run sees the same database
+RANDOM_SEED = 43
+
+# --update sets cost ceilings this far above the measured cost
+COST_HEADROOM = 1.5
+
+# Path segment of each route's first ID argument, and the model it is looked up in
+ROUTE_MODELS = {
+    "games": Game,
+    "genres": Genre,
+    "developers": Developer,
+    "users": User,
+    "achievements": Achievement,
+    "scores": Score,
+    "sessions": Session,
+    "purge-jobs": Job,
+    "achievement-definitions": AchievementDefinition,
+}
+
+# Query strings for endpoints that need them
+QUERY_STRINGS = {
+    "search_controller.search_catalogue": "q=game",
+    "search_controller.autocomplete_catalogue": "q=ga",
+}
+
+
+def _insert(model, rows, chunk_size=10000):
+    # Bulk insert, onto each row's shard for scores and sessions
+    if model in SHARDED_MODELS and shards.enabled:
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(shards.shard_for(row["game_id"]), []).append(row)
+        for name, shard_rows in by_shard.items():
+            with shards.session(name) as session:
+                for start in range(0, len(shard_rows), chunk_size):
+                    session.execute(insert(model), shard_rows[start:start + chunk_size])
+                session.commit()
+        return
+    for start in range(0, len(rows), chunk_size):
+        db.session.execute(insert(model), rows[start:start + chunk_size])
+
+
+def seed(scale=1.0):
+
+    # Fill an empty database with the same realistic data every time: popular games and
+    # active players get most of the scores and sessions, as in production. Derived tables
+    # (ratings, rollups, sketches, similar games, score baselines) are rebuilt from it.
+    # Returns the number of rows seeded per table.
+
+    if db.session.scalar(select(func.count()).select_from(Game)):
+        raise RuntimeError("The database already has games; seed an empty database")
+
+    rng = random.Random(RANDOM_SEED)
+    sizes = {name: max(int(size * scale), 1) for name, size in SEED_SIZES.items()}
+    sizes["genres"], sizes["developers"] = SEED_SIZES["genres"], SEED_SIZES["developers"]
+    now = datetime.now().replace(microsecond=0)
+
+    _insert(Genre, [{"id": i, "name": f"Genre {i}"} for i in range(1, sizes["genres"] + 1)])
+    _insert(Developer, [{"id": i, "name": f"Developer {i}"} for i in range(1, sizes["developers"] + 1)])
+    _insert(Game, [
+        {"id": i, "title": f"Game {i}", "genre_id": i % sizes["genres"] + 1, "developer_id": i % sizes["developers"] + 1}
+        for i in range(1, sizes["games"] + 1)
+    ])
+    password = bcrypt.generate_password_hash("player123").decode("utf-8")  # One hash, bcrypt is slow
+    _insert(User, [
+        {"id": i, "name": f"Player {i}", "email": f"player{i}@example.com", "password": password, "is_admin": i == 1}
+        for i in range(1, sizes["users"] + 1)
+    ])
+
+    # Lower IDs are more popular games and more active players, so ID 1 is the worst case
+    game_weights = [1 / rank for rank in range(1, sizes["games"] + 1)]
+    user_weights = [1 / rank ** 0.5 for rank in range(1, sizes["users"] + 1)]
+    games = range(1, sizes["games"] + 1)
+    users = range(1, sizes["users"] + 1)
+
+    def pairs(count):
+        return zip(rng.choices(users, user_weights, k=count), rng.choices(games, game_weights, k=count))
+
+    _insert(Score, [
+        {
+            "id": i, "user_id": user_id, "game_id": game_id, "value": max(int(rng.gauss(1000, 200)), 0),
+            "date_achieved": now - timedelta(seconds=rng.randrange(60 * 86400)),
+        }
+        for i, (user_id, game_id) in enumerate(pairs(sizes["scores"]), 1)
+    ])
+    sessions = []
+    for i, (user_id, game_id) in enumerate(pairs(sizes["sessions"]), 1):
+        start = now - timedelta(seconds=rng.randrange(30 * 86400))
+        end = start + timedelta(minutes=rng.randrange(5, 120))
+        sessions.append({"id": i, "user_id": user_id, "game_id": game_id, "start_time": start, "end_time": end if end < now else None})
+    _insert(Session, sessions)
+    _insert(Achievement, [
+        {"id": i, "user_id": user_id, "game_id": game_id, "name": f"Achievement {i}", "description": "Seeded", "unlocked_at": now}
+        for i, (user_id, game_id) in enumerate(pairs(sizes["achievements"]), 1)
+    ])
+    # A finished background delete of the admin's, so its progress route has a job to show
+    _insert(Job, [{
+        "id": 1, "name": "purge", "payload": {"entity": "game", "entity_id": sizes["games"] + 1},
+        "status": STATUS_FINISHED, "requested_by": 1, "result": {"deleted": {"games": 1}},
+        "created_at": now, "finished_at": now,
+    }])
+    db.session.commit()
+
+    # Derived tables and fresh planner statistics, so plans are the ones production would get
+    snapshot.rebuild_derived()
+    return sizes
+
+
+@contextmanager
+def capture():
+
+    # Record every statement this thread sends to the main database and the shards, as
+    # (engine, SQL, parameters). Other threads, such as the outbox relay, are ignored.
+
+    statements = []
+    thread = threading.get_ident()
+
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread and not executemany:
+            statements.append((connection.engine, statement, parameters))
+
+    engines = [db.engine] + list(shards.engines.values())
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def _walk(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _walk(child)
+
+
+def explain(engine, statement, parameters):
+
+    # Tables read with a sequential scan and the planner's total cost of a statement.
+    # Only PostgreSQL reports costs; SQLite's plan only shows the scans. Statements other
+    # than reads are not explained, since EXPLAIN on them is not always side effect free.
+
+    if not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+        return set(), None
+    with engine.connect() as connection:
+        if engine.dialect.name == "postgresql":
+            plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            root = plan[0]["Plan"]
+            scans = {node["Relation Name"] for node in _walk(root) if node["Node Type"] == "Seq Scan"}
+            return scans, root["Total Cost"]
+        rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+        scans = set()
+        for row in rows:
+            match = re.match(r"SCAN (?:TABLE )?(\w+)", row[-1])
+            if match and "USING" not in row[-1]:
+                scans.add(match.group(1))
+        return scans, None
+
+
+def _sample_ids(user_id):
+    # One ID per route segment: the sample user's own rows where rows belong to a player
+    samples = {"users": user_id}
+    for segment, model in ROUTE_MODELS.items():
+        if model is User:
+            continue
+        criteria = []
+        if model is Job:
+            criteria = [Job.requested_by == user_id]
+        elif hasattr(model, "user_id"):
+            criteria = [model.user_id == user_id]
+        if model in SHARDED_MODELS:
+            rows = shards.select(model, *criteria, order_by=model.id, limit=1)
+        else:
+            rows = db.session.scalars(select(model).where(*criteria).order_by(model.id).limit(1)).all()
+        if rows:
+            samples[segment] = rows[0].id
+    return samples
+
+
+def _paths(app, user_id):
+    # (endpoint, path) for every GET route, with sample IDs filled in
+    samples = _sample_ids(user_id)
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        if "GET" not in rule.methods or rule.endpoint == "static":
+            continue
+        path = rule.rule
+        segments = path.strip("/").split("/")
+        missing = False
+        for argument in rule.arguments:
+            # An argument takes its ID from the segment just before it
+            position = segments.index(f"<int:{argument}>")
+            segment = segments[position - 1]
+            if segment not in samples:
+                missing = True
+                break
+            segments[position] = str(samples[segment])
+        if missing:
+            yield rule.endpoint, None
+            continue
+        path = "/" + "/".join(segments)
+        if rule.endpoint in QUERY_STRINGS:
+            path += "?" + QUERY_STRINGS[rule.endpoint]
+        yield rule.endpoint, path
+
+
+def measure(app):
+
+    # Call every GET route once to warm the caches, then again with statement capture.
+    # Returns {endpoint: measurement}; measurements have the path, status, statement
+    # count, most repeats of one statement (an N+1 query repeats), sequentially scanned
+    # tables, the highest statement cost, and how many statements of the second call
+    # found their compiled form in the engine's cache (a warm route should miss none).
+
+    user_id = db.session.scalar(select(func.min(User.id)).where(User.is_admin.is_(True))) or db.session.scalar(select(func.min(User.id)))
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user_id)}"}
+    client = app.test_client()
+    results = {}
+    for endpoint, path in list(_paths(app, user_id)):
+        if path is None:
+            results[endpoint] = {"path": None, "skipped": "no sample row"}
+            continue
+        db.session.expunge_all()
+        client.get(path, headers=headers)
+        db.session.expunge_all()
+        # The identity map holds objects weakly, and objects in reference cycles are only
+        # freed by the garbage collector, so it is paused to make lazy loads repeatable
+        gc.collect()
+        gc.disable()
+        before = query_stats.snapshot()
+        try:
+            with capture() as statements:
+                response = client.get(path, headers=headers)
+        finally:
+            gc.enable()
+        hits, misses = _cache_counts(before, query_stats.snapshot())
+        scans, cost = set(), None
+        for engine, statement, parameters in statements:
+            statement_scans, statement_cost = explain(engine, statement, parameters)
+            scans |= statement_scans
+            if statement_cost is not None:
+                cost = max(cost or 0.0, statement_cost)
+        repeats = Counter(statement for _, statement, _ in statements)
+        results[endpoint] = {
+            "path": path,
+            "status": response.status_code,
+            "statements": len(statements),
+            "max_repeats": max(repeats.values(), default=0),
+            "seq_scans": sorted(scans),
+            "cost": cost,
+            "cache_hits": hits,
+            "cache_misses": misses,
+        }
+    return results
+
+
+def _cache_counts(before, after):
+    # Compiled-cache hits and misses between two query_stats snapshots
+    def total(figures, key):
+        return sum(entry[key] for entry in figures.values())
+    return (
+        total(after, "cache_hits") - total(before, "cache_hits"),
+        total(after, "cache_misses") - total(before, "cache_misses"),
+    )
+
+
+def load_baseline(path=DEFAULT_BASELINE_PATH):
+    if not os.path.exists(path):
+        return {"scale": 1.0, "protected_tables": list(PROTECTED_TABLES), "endpoints": {}}
+    with open(path) as file:
+        return json.load(file)
+
+
+def check(results, baseline):
+
+    # Compare measurements with the budgets; returns a list of (endpoint, problem)
+
+    protected = set(baseline.get("protected_tables", PROTECTED_TABLES))
+    problems = []
+    for endpoint, result in sorted(results.items()):
+        if result["path"] is None:
+            continue
+        budget = baseline["endpoints"].get(endpoint)
+        if budget is None:
+            problems.append((endpoint, "has no budget; run with --update to add one"))
+            continue
+        if result["status"] >= 500:
+            problems.append((endpoint, f"returned {result['status']}"))
+        if result["statements"] > budget["statements"]:
+            problems.append((endpoint, f"ran {result['statements']} statements, budget {budget['statements']}"))
+        if result["max_repeats"] > budget["max_repeats"]:
+            problems.append((endpoint, f"repeated one statement {result['max_repeats']} times (N+1), budget {budget['max_repeats']}"))
+        # Routes that return every score or session, such as GET /games, have their scans
+        # recorded in the budget; any other scan of a protected table is a lost index
+        for table in sorted(set(result["seq_scans"]) & protected - set(budget.get("seq_scans", []))):
+            problems.append((endpoint, f"scans {table} sequentially"))
+        if result["cost"] is not None:
+            # Costs are only measured on PostgreSQL, where every measured route needs a ceiling
+            if budget.get("max_cost") is None:
+                problems.append((endpoint, "has no cost budget; run with --update on PostgreSQL to add one"))
+            elif result["cost"] > budget["max_cost"]:
+                problems.append((endpoint, f"costs {result['cost']:.0f}, budget {budget['max_cost']:.0f}"))
+    return problems
+
+
+def update_baseline(results, baseline, scale, path=DEFAULT_BASELINE_PATH):
+
+    # Write the measurements as the new budgets. Cost ceilings are only measured on
+    # PostgreSQL; elsewhere the existing ceilings are kept.
+
+    protected = set(baseline.get("protected_tables", PROTECTED_TABLES))
+    endpoints = {}
+    for endpoint, result in sorted(results.items()):
+        if result["path"] is None:
+            continue
+        previous = baseline["endpoints"].get(endpoint, {})
+        cost = result["cost"]
+        endpoints[endpoint] = {
+            "statements": result["statements"],
+            "max_repeats": result["max_repeats"],
+            "seq_scans": sorted(set(result["seq_scans"]) & protected),
+            # Rounded up, so a near-zero cost such as SELECT 1 still fits its own ceiling
+            "max_cost": math.ceil(cost * COST_HEADROOM * 10) / 10 if cost is not None else previous.get("max_cost"),
+        }
+    baseline = {"scale": scale, "protected_tables": list(baseline.get("protected_tables", PROTECTED_TABLES)), "endpoints": endpoints}
+    with open(path, "w") as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+        file.write("\n")
+    return baseline
@@ -0,0 +1,250 @@
+import math
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select, delete, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+
+from init import db
+from models.score import Score, COUNTED_STATUSES
+from models.rating import Rating, ScoreStats, INITIAL_RATING
+from services.sharding import shards
+
+# How far one score can move a rating: MAX_K for a new player, easing towards MIN_K as the
+# rating settles (K halves after K_HALF_LIFE scores), as Glicko does with its deviation
+MAX_K = 40.0
+MIN_K = 10.0
+K_HALF_LIFE = 10
+
+# Scores read from the database at a time during a backfill
+DEFAULT_BATCH_SIZE = 100000
+
+# Ratings written per INSERT during a backfill
+WRITE_CHUNK_SIZE = 10000
+
+# Scale of the logistic curve used as the normal CDF (accurate to about 0.01)
+_LOGISTIC_SCALE = 1.702
+
+
+# How ratings work:
+# Scores have no opponent, so each score is treated as a match against the rest of the
+# game's field. The result is where the score falls among the game's scores so far (0 to 1,
+# from its z-score), and the expected result comes from the Elo formula against a field
+# rated INITIAL_RATING. Consistently beating 84% of the field settles at about 1780.
+# Sessions carry no result and do not affect ratings.
+
+
+def k_factor(games):
+    # Weight of the next score for a player who already has this many rated scores
+    return MIN_K + (MAX_K - MIN_K) * 0.5 ** (games / K_HALF_LIFE)
+
+
+def expected(rating):
+    # Elo expected result against the field
+    return 1.0 / (1.0 + 10.0 ** ((INITIAL_RATING - rating) / 400.0))
+
+
+def _insert_for_dialect():
+    name = db.engine.dialect.name
+    if name == "postgresql":
+        return postgresql.insert
+    if name == "sqlite":
+        return sqlite.insert
+    raise RuntimeError(f"Ratings are not supported on {name}")
+
+
+def _add_to_stats(game_id, value):
+
+    # Add a score to its game's running statistics and return them (count, mean, m2).
+    # Welford's update is done by the database in a single INSERT ... ON CONFLICT DO UPDATE
+    # ... RETURNING, so concurrent scores for a popular game never wait on a row lock
+    # held until the end of another request.
+
+    insert = _insert_for_dialect()
+    table = ScoreStats.__table__
+    stmt = insert(table).values(game_id=game_id, count=1, mean=float(value), m2=0.0)
+    x = stmt.excluded.mean
+    new_mean = table.c.mean + (x - table.c.mean) / (table.c.count + 1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["game_id"],
+        set_={
+            "count": table.c.count + 1,
+            "mean": new_mean,
+            "m2": table.c.m2 + (x - table.c.mean) * (x - new_mean),
+        },
+    ).returning(table.c.count, table.c.mean, table.c.m2)
+    return db.session.execute(stmt).one()
+
+
+def result(value, count, mean, m2):
+    # Share of the field a score beats (0 to 1), from the game's statistics including it
+    variance = m2 / count if count else 0.0
+    if variance <= 0:
+        return 0.5
+    z = (value - mean) / math.sqrt(variance)
+    return 1.0 / (1.0 + math.exp(-_LOGISTIC_SCALE * z))
+
+
+def record_score(score):
+
+    # Update the player's rating in the score's game; called before the score is committed.
+    # The rating row is created with INSERT ... ON CONFLICT DO NOTHING and then locked, like
+    # achievement progress, so two first scores from the same player cannot both insert it
+    # and concurrent scores are applied one after the other.
+
+    count, mean, m2 = _add_to_stats(score.game_id, score.value)
+    outcome = result(score.value, count, mean, m2)
+
+    db.session.execute(
+        _insert_for_dialect()(Rating.__table__)
+        .values(user_id=score.user_id, game_id=score.game_id, rating=INITIAL_RATING, games=0)
+        .on_conflict_do_nothing(index_elements=["user_id", "game_id"])
+    )
+    rating = db.session.get(
+        Rating, (score.user_id, score.game_id), with_for_update=True, populate_existing=True
+    )
+    rating.rating += k_factor(rating.games) * (outcome - expected(rating.rating))
+    rating.games += 1
+    rating.updated_at = score.date_achieved
+    return rating
+
+
+def _load_scores(game_id=None, batch_size=DEFAULT_BATCH_SIZE):
+
+    # Read every score (or one game's) into numpy arrays, a batch at a time, so 50M scores
+    # take a few hundred MB rather than 50M Python objects.
+    # Returns (game_ids, user_ids, values, times, ids), with times in microseconds.
+
+    stmt = (
+        select(Score.game_id, Score.user_id, Score.value, Score.date_achieved, Score.id)
+        .where(Score.status.in_(COUNTED_STATUSES))  # Quarantined and rejected scores never count
+    )
+    if game_id is not None:
+        stmt = stmt.where(Score.game_id == game_id)
+
+    parts = [[], [], [], [], []]
+    for rows in shards.stream(stmt, game_id, batch_size):
+        game_ids, user_ids, values, times, ids = zip(*rows)
+        parts[0].append(np.array(game_ids, dtype=np.int64))
+        parts[1].append(np.array(user_ids, dtype=np.int64))
+        parts[2].append(np.array(values, dtype=np.float64))
+        parts[3].append(np.array(times, dtype="datetime64[us]").astype(np.int64))
+        parts[4].append(np.array(ids, dtype=np.int64))
+    if not parts[0]:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty.astype(np.float64), empty, empty
+    return tuple(np.concatenate(part) for part in parts)
+
+
+def _group_starts(*keys):
+    # Indexes where a run of equal keys begins, in arrays sorted by those keys
+    change = np.zeros(len(keys[0]), dtype=bool)
+    change[0] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(change)
+
+
+def compute(game_ids, user_ids, values, times, ids):
+
+    # Replay score history in bulk, giving the same ratings as record_score would have.
+    # - Game statistics are running sums per game, so every score's result is computed
+    #   at once from cumulative sums.
+    # - Ratings depend on the previous rating, so they are computed one step at a time,
+    #   but each step updates every player's n-th score in one numpy operation: the
+    #   number of steps is the most scores any one player has in one game.
+    # Returns (stats, ratings): {game_id: (count, mean, m2)} and a list of rating dicts.
+
+    if len(values) == 0:
+        return {}, []
+
+    # Results: order by game, then time, and keep running statistics within each game
+    order = np.lexsort((ids, times, game_ids))
+    x = values[order]
+    starts = _group_starts(game_ids[order])
+    ends = np.append(starts[1:], len(x))
+    outcome = np.empty(len(x))
+    stats = {}
+    for start, end in zip(starts, ends):
+        # Shifted by the first score, so the sums stay small and precise
+        shifted = x[start:end] - x[start]
+        count = np.arange(1, end - start + 1)
+        mean = np.cumsum(shifted) / count
+        variance = np.maximum(np.cumsum(shifted * shifted) / count - mean * mean, 0.0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = np.where(variance > 0, (shifted - mean) / np.sqrt(variance), 0.0)
+        outcome[start:end] = 1.0 / (1.0 + np.exp(-_LOGISTIC_SCALE * z))
+        stats[int(game_ids[order[start]])] = (
+            int(count[-1]), float(x[start] + mean[-1]), float(variance[-1] * count[-1])
+        )
+    by_row = np.empty(len(x))
+    by_row[order] = outcome
+
+    # Ratings: order by player within each game, then time, and number each player's scores
+    order = np.lexsort((ids, times, user_ids, game_ids))
+    starts = _group_starts(game_ids[order], user_ids[order])
+    lengths = np.diff(np.append(starts, len(order)))
+    pair = np.repeat(np.arange(len(starts)), lengths)
+    step = np.arange(len(order)) - np.repeat(starts, lengths)
+    outcome = by_row[order]
+
+    rating = np.full(len(starts), INITIAL_RATING)
+    by_step = np.argsort(step, kind="stable")
+    position = 0
+    for number, size in enumerate(np.bincount(step)):
+        rows = by_step[position:position + size]
+        position += size
+        players = pair[rows]
+        current = rating[players]
+        rating[players] = current + k_factor(number) * (outcome[rows] - expected(current))
+
+    last = order[starts + lengths - 1]
+    updated = times[last].astype("datetime64[us]").astype(datetime)
+    ratings = [
+        {"user_id": int(user), "game_id": int(game), "rating": float(value), "games": int(games), "updated_at": when}
+        for user, game, value, games, when in zip(
+            user_ids[last], game_ids[last], rating, lengths, updated
+        )
+    ]
+    return stats, ratings
+
+
+def rebuild(game_id=None, batch_size=DEFAULT_BATCH_SIZE):
+
+    # Recompute ratings and score statistics from the full score history, for one game or
+    # all of them, and replace the stored ones in one transaction. Scores added while this
+    # runs may be missed, so run it when ingest is quiet. Returns the number of scores read.
+
+    columns = _load_scores(game_id, batch_size)
+    stats, ratings = compute(*columns)
+
+    rating_rows = delete(Rating)
+    stats_rows = delete(ScoreStats)
+    if game_id is not None:
+        rating_rows = rating_rows.where(Rating.game_id == game_id)
+        stats_rows = stats_rows.where(ScoreStats.game_id == game_id)
+    db.session.execute(rating_rows)
+    db.session.execute(stats_rows)
+
+    if stats:
+        db.session.execute(
+            insert(ScoreStats),
+            [{"game_id": game, "count": count, "mean": mean, "m2": m2} for game, (count, mean, m2) in stats.items()],
+        )
+    for start in range(0, len(ratings), WRITE_CHUNK_SIZE):
+        db.session.execute(insert(Rating), ratings[start:start + WRITE_CHUNK_SIZE])
+    db.session.commit()
+    return len(columns[0])
+
+
+def leaderboard(game_id, offset=0, limit=50):
+    # A game's ratings, highest first, with their players
+    return db.session.scalars(
+        select(Rating)
+        .where(Rating.game_id == game_id)
+        .order_by(Rating.rating.desc(), Rating.user_id)
+        .offset(offset)
+        .limit(limit)
+        .options(selectinload(Rating.user))
+    ).all()
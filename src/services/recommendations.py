@@ -0,0 +1,243 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select, delete, insert, func
+
+from init import db
+from models.game import Game
+from models.session import Session
+from models.similar_game import SimilarGame, SimilarityRun
+from services import outbox
+from services.jobs import task
+from services.sharding import shards
+
+# Similar games stored per game
+TOP_K = 20
+
+# Pairs of games need at least this many players in common to count as similar, so two
+# players who happen to share obscure games do not produce a recommendation
+MIN_PLAYERS_IN_COMMON = 2
+
+# Games whose similarities are computed in one sparse product; bounds the memory used
+DEFAULT_CHUNK_SIZE = 500
+
+# Sessions read from the database at a time
+DEFAULT_BATCH_SIZE = 100000
+
+# Games whose lists are kept in each process
+CACHE_SIZE = 1024
+
+
+def _load_pairs(batch_size=DEFAULT_BATCH_SIZE):
+    # Every (user, game) pair that has a session, as two numpy arrays. A game's sessions
+    # are all on one shard, so the pairs are already distinct across shards.
+    stmt = select(Session.user_id, Session.game_id).distinct()
+    users, games = [], []
+    for rows in shards.stream(stmt, batch_size=batch_size):
+        user_ids, game_ids = zip(*rows)
+        users.append(np.array(user_ids, dtype=np.int64))
+        games.append(np.array(game_ids, dtype=np.int64))
+    if not users:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(users), np.concatenate(games)
+
+
+def _games_played_since(since):
+    # Games with sessions started at or after a time, found through the start_time index
+    rows = shards.execute(select(Session.game_id).where(Session.start_time >= since).distinct())
+    return sorted({row.game_id for row in rows})
+
+
+def compute(user_ids, game_ids, targets=None, chunk_size=DEFAULT_CHUNK_SIZE):
+
+    # Item-item cosine similarity from a sparse players x games matrix.
+    # Only the columns for the target games (every game by default) are multiplied, a
+    # chunk at a time, so the games x games matrix is never built, dense or sparse.
+    # Returns {game_id: (other game IDs, scores, players in common)} with every similar
+    # game, best first; callers keep the top k.
+
+    if len(user_ids) == 0:
+        return {}
+    games, game_index = np.unique(game_ids, return_inverse=True)
+    _, user_index = np.unique(user_ids, return_inverse=True)
+    played = sparse.csc_matrix(
+        (np.ones(len(user_index), dtype=np.float32), (user_index, game_index)),
+        shape=(user_index.max() + 1, len(games)),
+    )
+    played.data[:] = 1  # Count a player once however often they appear
+    norms = np.sqrt(np.asarray(played.sum(axis=0)).ravel())
+    played_by_game = played.T.tocsr()
+
+    if targets is None:
+        columns = np.arange(len(games))
+    else:
+        targets = np.asarray(targets, dtype=np.int64)
+        columns = np.searchsorted(games, targets)
+        columns = columns[(columns < len(games)) & (games[np.minimum(columns, len(games) - 1)] == targets)]
+
+    results = {}
+    for start in range(0, len(columns), chunk_size):
+        chunk = columns[start:start + chunk_size]
+        # Players in common between every game and each game of the chunk (games x chunk)
+        common = (played_by_game @ played[:, chunk]).tocsc()
+        for position, column in enumerate(chunk):
+            span = slice(common.indptr[position], common.indptr[position + 1])
+            others, counts = common.indices[span], common.data[span]
+            keep = (others != column) & (counts >= MIN_PLAYERS_IN_COMMON)
+            others, counts = others[keep], counts[keep]
+            scores = counts / (norms[others] * norms[column])
+            order = np.lexsort((games[others], -scores))
+            results[int(games[column])] = (games[others][order], scores[order], counts[order].astype(np.int64))
+    return results
+
+
+def _rows(game_id, others, scores, counts, k=TOP_K):
+    return [
+        {"game_id": game_id, "similar_game_id": int(other), "score": float(score), "players_in_common": int(count)}
+        for other, score, count in zip(others[:k], scores[:k], counts[:k])
+    ]
+
+
+def _merge_into_neighbours(results, k=TOP_K):
+
+    # After an incremental refresh, a recomputed game's similarity to each neighbour has
+    # changed too, so update it in the neighbours' stored lists (adding it when it now
+    # makes their top k). A neighbour whose list loses an entry cannot refill it from
+    # here; the next full refresh does.
+
+    changed = set(results)
+    updates = {}
+    for game_id, (others, scores, counts) in results.items():
+        for other, score, count in zip(others, scores, counts):
+            if int(other) not in changed:
+                updates.setdefault(int(other), {})[game_id] = (float(score), int(count))
+    if not updates:
+        return [], []
+
+    stored = {}
+    for row in db.session.execute(
+        select(SimilarGame.game_id, SimilarGame.similar_game_id, SimilarGame.score, SimilarGame.players_in_common)
+        .where(SimilarGame.game_id.in_(list(updates)))
+    ):
+        stored.setdefault(row.game_id, {})[row.similar_game_id] = (row.score, row.players_in_common)
+
+    # Recomputed games that lost all similarity must leave their neighbours' lists too
+    for game_id, entries in stored.items():
+        for similar_game_id in changed & set(entries):
+            if similar_game_id not in updates.get(game_id, {}):
+                del entries[similar_game_id]
+
+    rows = []
+    for game_id in set(updates) | set(stored):
+        entries = stored.get(game_id, {})
+        entries.update(updates.get(game_id, {}))
+        best = sorted(entries.items(), key=lambda item: (-item[1][0], item[0]))[:k]
+        rows += [
+            {"game_id": game_id, "similar_game_id": other, "score": score, "players_in_common": count}
+            for other, (score, count) in best
+        ]
+    affected = list(set(updates) | set(stored))
+    db.session.execute(delete(SimilarGame).where(SimilarGame.game_id.in_(affected)))
+    return rows, affected
+
+
+def refresh(full=False, chunk_size=DEFAULT_CHUNK_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+
+    # Recompute "players also played" lists from the sessions table.
+    # - full: Recompute every game. Otherwise only games with sessions started since the
+    #   last refresh are recomputed (and their entries in other games' lists updated);
+    #   with no previous refresh, every game is.
+    # Returns the number of games recomputed.
+
+    until = datetime.now()
+    since = None if full else db.session.scalar(select(func.max(SimilarityRun.until)))
+    targets = None if since is None else _games_played_since(since)
+    if targets == []:
+        db.session.add(SimilarityRun(full=False, until=until, games=0))
+        db.session.commit()
+        return 0
+
+    user_ids, game_ids = _load_pairs(batch_size)
+    results = compute(user_ids, game_ids, targets, chunk_size=chunk_size)
+
+    if targets is None:
+        db.session.execute(delete(SimilarGame))
+        rows, affected = [], None
+    else:
+        db.session.execute(delete(SimilarGame).where(SimilarGame.game_id.in_(targets)))
+        rows, affected = _merge_into_neighbours(results)
+    for game_id, (others, scores, counts) in results.items():
+        rows += _rows(game_id, others, scores, counts)
+
+    # Rows of games deleted since the sessions were read would break the foreign keys
+    existing = set(db.session.scalars(select(Game.id)))
+    rows = [row for row in rows if row["game_id"] in existing and row["similar_game_id"] in existing]
+    for start in range(0, len(rows), 10000):
+        db.session.execute(insert(SimilarGame), rows[start:start + 10000])
+
+    recomputed = len(results) if targets is None else len(targets)
+    db.session.add(SimilarityRun(full=targets is None, until=until, games=recomputed))
+    if targets is None:
+        outbox.record("similar_games.refreshed")
+    else:
+        outbox.record("similar_games.refreshed", game_ids=sorted(set(targets) | set(affected or [])))
+    db.session.commit()
+    return recomputed
+
+
+@task("similar_games", max_attempts=3)
+def similar_games_task(job, full=False):
+    # Background refresh queued by `flask db_commands refresh-similar-games --background`
+    return {"games": refresh(full)}
+
+
+class SimilarGamesCache:
+
+    # Per-process LRU cache of similar games lists, dropped whenever any worker refreshes
+    # them (through the outbox), so requests normally never query the table.
+
+    def __init__(self, size=CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._lists = OrderedDict()
+        self.size = size
+
+    def get(self, game_id):
+        with self._lock:
+            if game_id in self._lists:
+                self._lists.move_to_end(game_id)
+                return self._lists[game_id]
+        rows = db.session.execute(
+            select(SimilarGame.similar_game_id, Game.title, SimilarGame.score, SimilarGame.players_in_common)
+            .join(Game, Game.id == SimilarGame.similar_game_id)
+            .where(SimilarGame.game_id == game_id)
+            .order_by(SimilarGame.score.desc(), SimilarGame.similar_game_id)
+        ).all()
+        similar = tuple(
+            {"game": {"id": id, "title": title}, "score": round(score, 4), "players_in_common": count}
+            for id, title, score, count in rows
+        )
+        with self._lock:
+            self._lists[game_id] = similar
+            while len(self._lists) > self.size:
+                self._lists.popitem(last=False)
+        return similar
+
+    def invalidate(self, game_ids=None):
+        # Forget some games' lists, or every list when no IDs are given
+        with self._lock:
+            if game_ids is None:
+                self._lists.clear()
+            else:
+                for game_id in game_ids:
+                    self._lists.pop(game_id, None)
+
+
+# Shared similar games cache for this process
+similar_cache = SimilarGamesCache()
+
+# Drop lists when they are refreshed, and every list mentioning a game that changed or was deleted
+outbox.subscribe("similar_games.", lambda event: similar_cache.invalidate(event.payload.get("game_ids")))
+outbox.subscribe("game.", lambda event: similar_cache.invalidate())
@@ -0,0 +1,116 @@
+import logging
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from marshmallow import fields
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from init import db
+from models.genre import Genre
+from models.developer import Developer
+from services import outbox, repository
+
+# In-process copy of the genres and developers, which every game refers to. Both tables
+# are tiny and rarely change, so each worker keeps them in memory: game responses take a
+# game's genre and developer from here instead of loading them per game, and game writes
+# check the IDs they are given without a query. The copy is dropped whenever any worker
+# changes either table (see services/outbox.py) and read again on next use.
+
+# Tables held, by the name games use for them (game.genre_id, game.developer_id)
+MODELS = {"genre": Genre, "developer": Developer}
+
+# One genre or developer, as games show it
+Reference = namedtuple("Reference", "id name")
+
+logger = logging.getLogger(__name__)
+
+
+class ReferenceData:
+
+    # Genres and developers by ID, as immutable maps ({kind: {id: Reference}}). A new
+    # set of maps replaces the old one on reload, so readers never need a lock.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._maps = None
+
+    def invalidate(self):
+        # Drop the maps so the next lookup reads the tables again
+        self._maps = None
+
+    def preload(self):
+        # Read the tables now (e.g. at startup) rather than on the first request. Needs an
+        # app context; before the tables exist they are left to be read on first use.
+        try:
+            self._load()
+        except SQLAlchemyError as error:
+            logger.info("Reference data not preloaded: %s", error.__class__.__name__)
+
+    def _load(self, stale=None):
+        # Current maps, read from the database if there are none (or they are the stale ones)
+        maps = self._maps
+        if maps is not None and maps is not stale:
+            return maps
+        with self._lock:
+            if self._maps is None or self._maps is stale:
+                # Read on a connection of its own, so rows the current transaction has
+                # written but not committed are never cached
+                loaded = {}
+                with db.engine.connect() as connection:
+                    for kind, model in MODELS.items():
+                        rows = connection.execute(select(model.id, model.name))
+                        loaded[kind] = MappingProxyType({id: Reference(id, name) for id, name in rows})
+                self._maps = MappingProxyType(loaded)
+            return self._maps
+
+    def get(self, kind, id):
+        # Genre or developer with this ID from a row in the database (e.g. a game's
+        # genre_id), or None for a null ID. A missing ID means the maps are out of date,
+        # since the database only holds IDs that exist, so they are read again.
+        if id is None:
+            return None
+        maps = self._load()
+        found = maps[kind].get(id)
+        if found is None:
+            found = self._load(stale=maps)[kind].get(id)
+        return found
+
+    def exists(self, kind, id):
+        # Whether a genre or developer ID sent by a client exists. An ID that is not in the
+        # maps may have been created since they were read, so the database is asked; made-up
+        # IDs then cost one primary key lookup, not a reload.
+        if id is None:
+            return False
+        if id in self._load()[kind]:
+            return True
+        if repository.exists(MODELS[kind], id):
+            self.invalidate()
+            return True
+        return False
+
+
+# Shared copy for this process
+reference_data = ReferenceData()
+
+# Read it again whenever any worker changes a genre or developer
+for _topic in ("genre.", "developer.", "catalogue."):
+    outbox.subscribe(_topic, lambda event: reference_data.invalidate())
+
+
+class ReferenceField(fields.Field):
+
+    # A game's genre or developer for responses, {"id", "name"}, taken from the reference
+    # data by the game's genre_id or developer_id instead of loading the relationship
+
+    def __init__(self, kind, **kwargs):
+        super().__init__(dump_only=True, **kwargs)
+        self.kind = kind
+
+    def get_value(self, obj, attr, accessor=None, default=None):
+        return getattr(obj, f"{self.kind}_id", None)
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        reference = reference_data.get(self.kind, value)
+        return {"id": reference.id, "name": reference.name} if reference else None
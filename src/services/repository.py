@@ -0,0 +1,162 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event, lambda_stmt, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+
+from init import db
+from services.logs import current_request_id
+
+# Data access for the tables on the main database (the catalogue, users, achievements
+# and jobs), in SQLAlchemy 2.0 style. Scores and sessions go through the shard router
+# (services/sharding.py) instead.
+# - Lookups by primary key use Session.get, which returns an object already in the
+#   session without a query.
+# - The hottest statements are lambda statements. SQLAlchemy caches a lambda statement by
+#   the lambda's code and the models it uses, so it is only built and compiled once per
+#   process, and later calls only supply the new parameter values.
+# - Every call is timed, and the statements it runs are counted as compiled-cache hits or
+#   misses, per query. check-query-plans reports these figures, and calls slower than
+#   SLOW_QUERY_MS are logged.
+
+# Defaults, overridable through app config
+DEFAULT_SLOW_QUERY_MS = 200  # Calls at least this slow are logged as warnings (SLOW_QUERY_MS)
+
+# Name of the repository call running in this thread, which its statements are counted
+# under; statements run elsewhere (services, relationship loads) are counted under OTHER
+OTHER = "other"
+_current_query = contextvars.ContextVar("repository.query", default=OTHER)
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+
+    # Per-process timing and compiled-cache figures for each repository query, initialised
+    # in create_app like the other extensions. Figures are kept per query name, e.g.
+    # "Game.get" or "User.first_by":
+    # - calls, total_ms and max_ms: How often the call ran and how long it took, including
+    #   the ORM's work on the rows, not only the database's.
+    # - cache_hits and cache_misses: Statements whose compiled form came from the engine's
+    #   cache or had to be compiled. Statements that cannot be cached (e.g. plain SQL text)
+    #   count as uncached.
+
+    def __init__(self, app=None):
+        self.slow_query_ms = DEFAULT_SLOW_QUERY_MS
+        self._lock = threading.Lock()
+        self._queries = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.slow_query_ms = app.config.get("SLOW_QUERY_MS", DEFAULT_SLOW_QUERY_MS)
+
+    def _entry(self, name):
+        entry = self._queries.get(name)
+        if entry is None:
+            entry = self._queries.setdefault(
+                name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "cache_hits": 0, "cache_misses": 0, "uncached": 0}
+            )
+        return entry
+
+    @contextmanager
+    def measure(self, name):
+        # Time one repository call and count its statements under its name
+        token = _current_query.set(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            _current_query.reset(token)
+            with self._lock:
+                entry = self._entry(name)
+                entry["calls"] += 1
+                entry["total_ms"] += elapsed
+                entry["max_ms"] = max(entry["max_ms"], elapsed)
+            if self.slow_query_ms is not None and elapsed >= self.slow_query_ms:
+                logger.warning(
+                    "Slow query %s took %.1f ms", name, elapsed,
+                    extra={"query": name, "duration_ms": round(elapsed, 3), "request_id": current_request_id()},
+                )
+
+    def count_statement(self, context):
+        # Count whether a statement's compiled form came from the cache
+        outcome = getattr(context, "cache_hit", None)
+        key = "cache_hits" if outcome is CACHE_HIT else "cache_misses" if outcome is CACHE_MISS else "uncached"
+        with self._lock:
+            self._entry(_current_query.get())[key] += 1
+
+    def snapshot(self):
+        # Copy of the figures so far, {name: figures}
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._queries.items()}
+
+    def reset(self):
+        with self._lock:
+            self._queries = {}
+
+
+# Shared instance, initialised in create_app
+query_stats = QueryStats()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _count_statement(connection, cursor, statement, parameters, context, executemany):
+    # Every engine, so statements on the shards are counted too
+    if context is not None:
+        query_stats.count_statement(context)
+
+
+def cache_hit_rate(figures):
+    # Share of cacheable statements whose compiled form came from the cache, or None
+    hits = sum(entry["cache_hits"] for entry in figures.values())
+    misses = sum(entry["cache_misses"] for entry in figures.values())
+    return hits / (hits + misses) if hits + misses else None
+
+
+def get(model, id, *options):
+    # The row with this primary key, or None. Rows already in the session are returned
+    # without a query.
+    # - options: Loader options for the relationships the response serialises, e.g.
+    #   selectinload(Game.score_list), so they are read in one query each.
+    with query_stats.measure(f"{model.__name__}.get"):
+        return db.session.get(model, id, options=options)
+
+
+def exists(model, id):
+    # Whether a row with this primary key exists, reading only its ID rather than loading
+    # the whole row, for routes that only check a game or user is there
+    with query_stats.measure(f"{model.__name__}.exists"):
+        if id is None:
+            return False
+        stmt = lambda_stmt(lambda: select(model.id).where(model.id == id))
+        return db.session.scalar(stmt) is not None
+
+
+def list_all(model, *options):
+    # Every row of a table, with optional loader options as for get()
+    with query_stats.measure(f"{model.__name__}.list_all"):
+        if options:
+            return db.session.scalars(select(model).options(*options)).all()
+        return db.session.scalars(lambda_stmt(lambda: select(model))).all()
+
+
+def first_by(column, value):
+    # The first row whose column equals value, or None, e.g. first_by(User.email, email)
+    model = column.class_
+    with query_stats.measure(f"{model.__name__}.first_by"):
+        stmt = lambda_stmt(lambda: select(model).where(column == value).limit(1))
+        return db.session.scalars(stmt).first()
+
+
+def list_by(column, value):
+    # Every row whose column equals value, e.g. list_by(AchievementDefinition.game_id, id)
+    model = column.class_
+    with query_stats.measure(f"{model.__name__}.list_by"):
+        stmt = lambda_stmt(lambda: select(model).where(column == value))
+        return db.session.scalars(stmt).all()
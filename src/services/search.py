@@ -0,0 +1,262 @@
+import re
+import threading
+
+from flask import current_app
+from sqlalchemy import select, union_all, literal, literal_column, func, case, or_
+
+from init import db
+from services import outbox
+from models.game import Game
+from models.genre import Genre
+from models.developer import Developer
+
+# Searchable entity types, mapped to their model and the column that is searched
+SEARCH_TARGETS = {
+    "game": (Game, Game.title),
+    "developer": (Developer, Developer.name),
+    "genre": (Genre, Genre.name),
+}
+
+# Characters that have a special meaning inside a LIKE pattern
+_LIKE_ESCAPE = re.compile(r"([\\%_])")
+
+# Splits a name into lowercase words for word-prefix matching
+_WORDS = re.compile(r"\w+")
+
+
+def _normalise(text):
+    # Lowercase and collapse whitespace so that matching is case-insensitive
+    return " ".join(text.lower().split())
+
+
+def _like_prefix(q):
+    # Escape the query so it can be used safely as a LIKE prefix pattern
+    return _LIKE_ESCAPE.sub(r"\\\1", q) + "%"
+
+
+class PrefixTrie:
+
+    # In-process prefix trie used when the database has no trigram/full-text support
+    # (SQLite in tests and small deployments).
+    # - Every name is inserted once for the full name and once for each word start,
+    #   so "creed" finds "Assassin's Creed".
+    # - Each node keeps a short list of the lexicographically first entries below it,
+    #   which makes autocomplete O(len(prefix)) regardless of catalogue size.
+
+    __slots__ = ("root", "top_k")
+
+    def __init__(self, top_k=25):
+        self.root = {}
+        self.top_k = top_k
+
+    def insert(self, key, entry):
+        # Insert every word-start suffix of the key, pointing at the same entry
+        for match in _WORDS.finditer(key):
+            self._insert_suffix(key[match.start():], entry)
+
+    def _insert_suffix(self, suffix, entry):
+        node = self.root
+        for char in suffix:
+            node = node.setdefault(char, {})
+            top = node.setdefault("\0top", [])
+            if len(top) < self.top_k and entry not in top:
+                top.append(entry)
+        node.setdefault("\0entries", []).append(entry)
+
+    def _find(self, prefix):
+        # Walk down to the node for the prefix, or None if nothing starts with it
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    def complete(self, prefix):
+        # Return the precomputed top entries for the prefix
+        node = self._find(prefix)
+        return list(node.get("\0top", ())) if node else []
+
+    def matches(self, prefix):
+        # Return every entry with a word starting with the prefix
+        node = self._find(prefix)
+        if node is None:
+            return set()
+        found, stack = set(), [node]
+        while stack:
+            current = stack.pop()
+            for char, child in current.items():
+                if char == "\0entries":
+                    found.update(child)
+                elif char != "\0top":
+                    stack.append(child)
+        return found
+
+
+class TrieSearchIndex:
+
+    # Lazily built tries over game titles, developer names and genre names, one per type.
+    # The index is rebuilt on the next query after invalidate() is called.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tries = None
+
+    def invalidate(self):
+        # Drop the current index so the next query rebuilds it from the database
+        self._tries = None
+
+    def load(self):
+        # Return the tries, building them from the database first if needed
+        tries = self._tries
+        if tries is not None:
+            return tries
+        with self._lock:
+            if self._tries is None:
+                tries = {}
+                for entity_type, (model, column) in SEARCH_TARGETS.items():
+                    rows = sorted(
+                        (_normalise(name), id, name)
+                        for id, name in db.session.execute(select(model.id, column))
+                    )
+                    # Sorted insertion keeps each node's top list in alphabetical order
+                    trie = PrefixTrie()
+                    for key, id, name in rows:
+                        trie.insert(key, (key, entity_type, id, name))
+                    tries[entity_type] = trie
+                self._tries = tries
+        return self._tries
+
+    def autocomplete(self, q, types, limit):
+        tries = self.load()
+        prefix = _normalise(q)
+        entries = [entry for t in types for entry in tries[t].complete(prefix)]
+        entries.sort()
+        return [_result(entry) for entry in entries[:limit]]
+
+    def search(self, q, types, offset, limit):
+        tries = self.load()
+        normalised = _normalise(q)
+        tokens = _WORDS.findall(normalised)
+        if not tokens:
+            return []
+
+        ranked = []
+        for entity_type in types:
+            # Every query word must prefix some word of the name
+            trie = tries[entity_type]
+            candidates = trie.matches(tokens[0])
+            for token in tokens[1:]:
+                candidates &= trie.matches(token)
+
+            for entry in candidates:
+                key = entry[0]
+                # Exact match ranks above a full-name prefix, which ranks above a word prefix
+                if key == normalised:
+                    rank = 1.0
+                elif key.startswith(normalised):
+                    rank = 0.75
+                else:
+                    rank = 0.5
+                ranked.append((-rank, key, entry))
+        ranked.sort()
+        return [_result(entry, -rank) for rank, key, entry in ranked[offset:offset + limit]]
+
+
+def _result(entry, rank=None):
+    # Shape a search hit for the JSON response
+    result = {"type": entry[1], "id": entry[2], "name": entry[3]}
+    if rank is not None:
+        result["rank"] = round(rank, 4)
+    return result
+
+
+# Shared trie index for this process
+trie_index = TrieSearchIndex()
+
+# Rebuild it whenever any worker changes the catalogue
+for _topic in ("game.", "genre.", "developer.", "catalogue."):
+    outbox.subscribe(_topic, lambda event: trie_index.invalidate())
+
+
+def _use_postgres():
+    # The configured backend wins; otherwise pick based on the database dialect
+    backend = current_app.config.get("SEARCH_BACKEND")
+    if backend:
+        return backend == "postgresql"
+    return db.engine.dialect.name == "postgresql"
+
+
+def _pg_search_select(entity_type, model, column, q):
+    # Ranked select for one entity type, combining trigram similarity, full-text rank
+    # and a bonus for prefix matches
+    # The text search config is inlined so the expression matches the index definition
+    config = literal_column("'simple'")
+    document = func.to_tsvector(config, column)
+    query = func.plainto_tsquery(config, q)
+    rank = (
+        func.greatest(func.similarity(column, q), func.ts_rank(document, query))
+        + case((func.lower(column).like(_like_prefix(q.lower()), escape="\\"), 0.5), else_=0.0)
+    )
+    return select(
+        literal(entity_type).label("type"),
+        model.id.label("id"),
+        column.label("name"),
+        rank.label("rank"),
+    ).where(or_(column.op("%")(q), document.op("@@")(query), column.ilike("%" + _like_prefix(q), escape="\\")))
+
+
+def _pg_autocomplete_select(entity_type, model, column, q, limit):
+    # Prefix lookup served by the lower(name) text_pattern_ops index
+    return (
+        select(literal(entity_type).label("type"), model.id.label("id"), column.label("name"))
+        .where(func.lower(column).like(_like_prefix(q.lower()), escape="\\"))
+        .order_by(func.lower(column))
+        .limit(limit)
+    )
+
+
+def preload():
+    # Build (or rebuild) the in-process index now, e.g. at startup rather than on the first
+    # query, when it is the one searches use
+    if not _use_postgres():
+        trie_index.invalidate()
+        trie_index.load()
+
+
+def search(q, types, offset, limit):
+
+    # Ranked search over the requested entity types.
+    # Returns a list of result dicts ordered by rank, then name.
+
+    if not _use_postgres():
+        return trie_index.search(q, types, offset, limit)
+
+    selects = [_pg_search_select(t, *SEARCH_TARGETS[t], q) for t in SEARCH_TARGETS if t in types]
+    combined = union_all(*selects).subquery()
+    stmt = (
+        select(combined)
+        .order_by(combined.c.rank.desc(), combined.c.name)
+        .offset(offset)
+        .limit(limit)
+    )
+    return [
+        {"type": row.type, "id": row.id, "name": row.name, "rank": round(float(row.rank), 4)}
+        for row in db.session.execute(stmt)
+    ]
+
+
+def autocomplete(q, types, limit):
+
+    # Prefix suggestions over the requested entity types, ordered by name.
+
+    if not _use_postgres():
+        return trie_index.autocomplete(q, types, limit)
+
+    selects = [
+        _pg_autocomplete_select(t, *SEARCH_TARGETS[t], q, limit).subquery().select()
+        for t in SEARCH_TARGETS if t in types
+    ]
+    combined = union_all(*selects).subquery()
+    stmt = select(combined).order_by(func.lower(combined.c.name)).limit(limit)
+    return [{"type": row.type, "id": row.id, "name": row.name} for row in db.session.execute(stmt)]
@@ -0,0 +1,197 @@
+import gc
+import logging
+import os
+import sys
+import time
+
+from sqlalchemy import text
+from sqlalchemy.orm import configure_mappers
+from marshmallow import Schema, fields
+
+from init import db
+from services.sharding import shards
+from services.outbox import relay
+from services.logs import logs
+from services.audit import audit
+from services.anomalies import detector
+from services.reference_data import reference_data
+from services import search
+
+# Production server: gunicorn with the app loaded once in the master process and shared
+# with the forked workers.
+# - Before forking, the master builds everything the workers would otherwise each build on
+#   their first requests (mappers, nested schemas, in-memory caches), closes its database
+#   connections, and freezes the garbage collector's view of its objects. Workers then
+#   share those memory pages with the master instead of each holding a copy; a collection
+#   in a worker would otherwise write to every object and copy every page.
+# - Each worker opens its database connections and starts its background threads before
+#   it reports ready on /readyz, so the first requests it gets do not pay for them.
+
+# Seconds after which the master refreshes its caches before forking another worker
+WARM_UP_MAX_AGE = 60.0
+
+# Threads per worker. Workers use every CPU for the CPU-bound parts of a request (JSON,
+# bcrypt); a few threads each keep those CPUs busy while other requests wait on the database
+DEFAULT_THREADS = 4
+
+logger = logging.getLogger(__name__)
+
+
+def default_workers():
+    # One worker per CPU this process may run on (which may be fewer than the machine has)
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(cpus, 2)
+
+
+class Readiness:
+
+    # Whether this process is ready for traffic. A process started by `flask serve` is not
+    # ready until its worker has warmed up; other processes (e.g. `flask run`) always are.
+
+    def __init__(self):
+        self.warming_up = False
+
+
+readiness = Readiness()
+
+
+def _engines():
+    return [db.engine] + list(shards.engines.values())
+
+
+def _build_schemas(schema, depth=0):
+    # Create the nested schemas a response would build on first use, as dump() would
+    if depth > 10:
+        return
+    for field in schema.dump_fields.values():
+        if isinstance(field, fields.List):
+            field = field.inner
+        if isinstance(field, fields.Nested):
+            _build_schemas(field.schema, depth + 1)
+
+
+def _module_schemas():
+    # The schema instances the models modules define for their responses
+    for name, module in list(sys.modules.items()):
+        if name.startswith("models.") and module is not None:
+            for value in vars(module).values():
+                if isinstance(value, Schema):
+                    yield value
+
+
+def warm_up_master(app):
+
+    # Run in the master before forking: build and load everything workers share, then drop
+    # the master's database connections (forked workers must open their own) and freeze
+    # the objects made so far, so that collections in the workers leave their pages alone.
+
+    started = time.perf_counter()
+    with app.app_context():
+        relay.start_from_now()  # Before the caches are filled, so later changes reach the workers
+        configure_mappers()
+        for schema in _module_schemas():
+            _build_schemas(schema)
+        reference_data.invalidate()
+        reference_data.preload()
+        search.preload()
+    for engine in _engines():
+        engine.dispose()
+    logger.info("Master warmed up in %.0f ms", (time.perf_counter() - started) * 1000)
+
+    # Threads do not survive a fork, so background writers are stopped (and their queues
+    # written out) here, after the last log line; each worker starts its own on first use
+    logs.writer.stop()
+    audit.stop()
+
+    gc.collect()
+    gc.freeze()
+    return time.monotonic()
+
+
+def warm_up_worker(app, threads):
+
+    # Run in each worker after the fork: open a database connection per thread (as many as
+    # the pool keeps) and one per shard, and start the outbox relay, then report ready
+
+    started = time.perf_counter()
+    with app.app_context():
+        pool_size = db.engine.pool.size() if hasattr(db.engine.pool, "size") else 1
+        connections = [db.engine.connect() for _ in range(min(threads, pool_size))]
+        connections += [engine.connect() for engine in shards.engines.values()]
+        try:
+            for connection in connections:
+                connection.execute(text("SELECT 1"))
+        finally:
+            for connection in connections:
+                connection.close()  # Back to the pool, still open
+        relay.ensure_started()
+    readiness.warming_up = False
+    logger.info("Worker %s ready in %.0f ms", os.getpid(), (time.perf_counter() - started) * 1000)
+
+
+def check_ready():
+    # None when this process can serve traffic, otherwise the reason it cannot
+    if readiness.warming_up:
+        return "warming up"
+    try:
+        for engine in _engines():
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+    except Exception:
+        return "database unavailable"
+    return None
+
+
+def serve(app, bind, workers, threads, timeout):
+
+    # Run the app under gunicorn until it is stopped (SIGTERM or SIGINT shut it down
+    # gracefully: workers finish their requests and write out their logs, audit trail and score baselines)
+
+    # Imported here because gunicorn only runs on Unix, and the rest of the app does not
+    # need it
+    from gunicorn.app.base import BaseApplication
+
+    app.debug = False  # Never in debug mode in production, whatever FLASK_DEBUG says
+    readiness.warming_up = True  # Inherited by every worker until it has warmed up
+    state = {"warmed_at": None}
+
+    def pre_fork(server, worker):
+        # Warm up before the first worker, and again for a worker forked long after (e.g. to
+        # replace one that died), so it does not start from old copies
+        if state["warmed_at"] is None or time.monotonic() - state["warmed_at"] > WARM_UP_MAX_AGE:
+            state["warmed_at"] = warm_up_master(app)
+
+    def post_worker_init(worker):
+        warm_up_worker(app, threads)
+
+    def worker_exit(server, worker):
+        # Write out what the worker's background threads still hold before it goes
+        audit.stop()
+        logs.writer.stop()
+        detector.stop()
+
+    options = {
+        "bind": bind,
+        "workers": workers,
+        "worker_class": "gthread",
+        "threads": threads,
+        "timeout": timeout,
+        "preload_app": True,
+        "pre_fork": pre_fork,
+        "post_worker_init": post_worker_init,
+        "worker_exit": worker_exit,
+    }
+
+    class Server(BaseApplication):
+
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
@@ -0,0 +1,325 @@
+import contextvars
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, select, insert, update, delete, func, event, MetaData, Table, Column, Index
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from init import db
+from models.user import User
+from models.game import Game
+from models.score import Score
+from models.session import Session, start_time_brin_index
+from models.id_block import IdBlock
+from services.repository import query_stats
+
+# Tables whose rows are spread over the shards by game_id; every other table stays on
+# the main database
+SHARDED_MODELS = (Score, Session)
+
+# IDs taken from the main database at a time, per table and per process (SHARD_ID_BLOCK_SIZE)
+DEFAULT_ID_BLOCK_SIZE = 1000
+
+
+def _copy_without_foreign_keys(table, metadata):
+    # Copy a table definition for the shards. Users and games live on the main database,
+    # so the copy has no foreign keys; the router does the deletes they would cascade.
+    copy = Table(
+        table.name,
+        metadata,
+        *[
+            Column(
+                column.name,
+                column.type,
+                primary_key=column.primary_key,
+                nullable=column.nullable,
+                autoincrement=column.autoincrement,
+                server_default=column.server_default.arg if column.server_default is not None else None,
+            )
+            for column in table.columns
+        ],
+    )
+    for index in table.indexes:
+        Index(
+            index.name,
+            *[copy.c[column.name] for column in index.columns],
+            unique=index.unique,
+            **index.dialect_kwargs,  # e.g. the WHERE clause of a partial index
+        )
+    return copy
+
+
+# Schema created on every shard
+shard_metadata = MetaData()
+for model in SHARDED_MODELS:
+    _copy_without_foreign_keys(model.__table__, shard_metadata)
+event.listen(shard_metadata.tables["sessions"], "after_create", start_time_brin_index)
+
+
+class ShardRouter:
+
+    # Optional sharding of scores and sessions, initialised in create_app like the other extensions.
+    # With SHARD_DATABASE_URIS set ({name: uri}), each game's scores and sessions are stored
+    # on one shard database, picked from SHARD_MAP ({game_id: name}) or by game_id modulo the
+    # number of shards, so ingest writes are spread over all of them. Users, games and the
+    # rest of the catalogue stay on the main database. Per-user reads query every shard in
+    # parallel and merge the results. Without shards every method works on db.session, so
+    # controllers use the same calls either way.
+
+    def __init__(self, app=None):
+        self.names = []
+        self.engines = {}
+        self.shard_map = {}
+        self.id_block_size = DEFAULT_ID_BLOCK_SIZE
+        self._executor = None
+        self._lock = threading.Lock()
+        self._blocks = {}  # table name -> [next ID, end of block]
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        uris = app.config.get("SHARD_DATABASE_URIS") or {}
+        self.names = sorted(uris)
+        self.engines = {name: create_engine(uris[name], pool_pre_ping=True) for name in self.names}
+        self.shard_map = {int(game_id): name for game_id, name in app.config.get("SHARD_MAP", {}).items()}
+        unknown = set(self.shard_map.values()) - set(self.names)
+        if unknown:
+            raise ValueError(f"SHARD_MAP refers to unknown shards: {', '.join(sorted(unknown))}")
+        self.id_block_size = app.config.get("SHARD_ID_BLOCK_SIZE", DEFAULT_ID_BLOCK_SIZE)
+        self._executor = ThreadPoolExecutor(max_workers=len(self.names), thread_name_prefix="shard") if self.names else None
+        self._blocks = {}
+
+    @property
+    def enabled(self):
+        return bool(self.names)
+
+    def shard_for(self, game_id):
+        # Name of the shard holding a game's scores and sessions
+        return self.shard_map.get(game_id) or self.names[game_id % len(self.names)]
+
+    def names_for(self, game_id=None):
+        # Shards to query: only the game's shard when the query is for one game, otherwise all
+        return [self.shard_for(game_id)] if game_id is not None else list(self.names)
+
+    @contextmanager
+    def session(self, name):
+        # ORM session on one shard. Objects keep their loaded values after commit and close,
+        # so they can be serialised once the session is gone.
+        session = OrmSession(self.engines[name], expire_on_commit=False)
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def _fan_out(self, names, work):
+        # Run work(session) on each named shard in parallel; results are in the order of names.
+        # Each task runs in a copy of the caller's context, so its statements are counted
+        # under the caller's query (see services/repository.py)
+        def run(name):
+            with self.session(name) as session:
+                return work(session)
+        if len(names) == 1:
+            return [run(names[0])]
+        contexts = [contextvars.copy_context() for _ in names]
+        return list(self._executor.map(lambda name, context: context.run(run, name), names, contexts))
+
+    def create_all(self):
+        for engine in self.engines.values():
+            shard_metadata.create_all(engine)
+
+    def drop_all(self):
+        for engine in self.engines.values():
+            shard_metadata.drop_all(engine)
+
+    def attach(self, rows):
+        # Give scores or sessions their user and game from the main database, in one query
+        # each, so the schemas can serialise them without a lazy load per row (against the
+        # shard, for rows loaded from one)
+        user_ids = {row.user_id for row in rows}
+        game_ids = {row.game_id for row in rows}
+        users = {user.id: user for user in db.session.scalars(select(User).where(User.id.in_(user_ids)))} if user_ids else {}
+        games = {game.id: game for game in db.session.scalars(select(Game).where(Game.id.in_(game_ids)))} if game_ids else {}
+        for row in rows:
+            set_committed_value(row, "user", users.get(row.user_id))
+            set_committed_value(row, "game", games.get(row.game_id))
+        return rows
+
+    def add(self, obj):
+
+        # Insert a new score or session and return the stored row.
+        # Without shards the row is flushed in db.session and committed by the caller.
+        # With shards it gets an ID from the main database and is committed on its game's
+        # shard straight away, before the caller commits db.session with the derived data
+        # (achievements, ratings, outbox event and the idempotent response). If that second
+        # commit fails, the row is left on the shard without them. A retry with the same
+        # Idempotency-Key then finds the row by its idempotency_key and gets it back instead
+        # of a second copy, and the caller records the derived data again.
+
+        if not self.enabled:
+            db.session.add(obj)
+            db.session.flush()
+            return obj
+
+        model = type(obj)
+        name = self.shard_for(obj.game_id)
+        if obj.idempotency_key is not None:
+            with self.session(name) as session:
+                existing = session.scalars(select(model).where(model.idempotency_key == obj.idempotency_key)).first()
+            if existing is not None:
+                return self.attach([existing])[0]
+
+        obj.id = self._next_id(model)
+        with self.session(name) as session:
+            session.add(obj)
+            session.commit()
+        self.attach([obj])
+        return obj
+
+    def get(self, model, id):
+        # Look up a score or session by ID, on every shard in parallel (IDs are unique across shards)
+        with query_stats.measure(f"{model.__name__}.get"):
+            if not self.enabled:
+                return db.session.get(model, id)
+            found = [row for row in self._fan_out(self.names, lambda session: session.get(model, id)) if row is not None]
+            return self.attach(found)[0] if found else None
+
+    def select(self, model, *criteria, order_by=None, game_id=None, limit=None):
+
+        # Rows of a sharded model matching the criteria.
+        # - order_by: Optional column, or tuple of columns; each shard sorts its own rows and
+        #   they are merged.
+        # - game_id: Only query that game's shard, for queries limited to one game.
+        # - limit: Optional maximum number of rows; each shard returns at most this many
+        #   and the first of the merged rows are kept.
+
+        stmt = select(model).where(*criteria)
+        columns = order_by if isinstance(order_by, tuple) else (order_by,)
+        if order_by is not None:
+            stmt = stmt.order_by(*columns)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        with query_stats.measure(f"{model.__name__}.select"):
+            if not self.enabled:
+                return db.session.scalars(stmt).all()
+
+            results = self._fan_out(self.names_for(game_id), lambda session: session.scalars(stmt).all())
+            if order_by is not None:
+                rows = list(heapq.merge(*results, key=lambda row: tuple(getattr(row, column.key) for column in columns)))
+            else:
+                rows = [row for result in results for row in result]
+            return self.attach(rows[:limit])
+
+    def execute(self, stmt, game_id=None):
+        # Run a read-only statement on every shard (or only the game's shard) and return all rows
+        if not self.enabled:
+            return db.session.execute(stmt).all()
+        results = self._fan_out(self.names_for(game_id), lambda session: session.execute(stmt).all())
+        return [row for result in results for row in result]
+
+    def stream(self, stmt, game_id=None, batch_size=100000):
+
+        # Run a read-only statement on each shard in turn (or only the game's shard) and
+        # yield the rows in lists of up to batch_size, for reads too big to hold as rows.
+        # Rows come back per shard, not in any overall order.
+
+        options = {"stream_results": True, "yield_per": batch_size}
+        if not self.enabled:
+            yield from db.session.execute(stmt, execution_options=options).partitions()
+            return
+        for name in self.names_for(game_id):
+            with self.session(name) as session:
+                yield from session.execute(stmt, execution_options=options).partitions()
+
+    def update(self, obj, **values):
+        # Change columns of a row returned by get() or select()
+        for key, value in values.items():
+            setattr(obj, key, value)
+        if not self.enabled:
+            return obj
+        table = type(obj).__table__
+        with self.session(self.shard_for(obj.game_id)) as session:
+            session.execute(update(table).where(table.c.id == obj.id).values(**values))
+            session.commit()
+        return obj
+
+    def delete(self, obj):
+        # Delete a row returned by get() or select()
+        if not self.enabled:
+            db.session.delete(obj)
+            return
+        table = type(obj).__table__
+        with self.session(self.shard_for(obj.game_id)) as session:
+            session.execute(delete(table).where(table.c.id == obj.id))
+            session.commit()
+
+    def delete_all(self, column, value):
+
+        # Delete the scores and sessions of a user or game that is being deleted.
+        # - column: 'user_id' or 'game_id'.
+        # On the main database this is done by ON DELETE CASCADE, which cannot reach the shards.
+
+        if not self.enabled:
+            return
+
+        def work(session):
+            for model in SHARDED_MODELS:
+                table = model.__table__
+                session.execute(delete(table).where(table.c[column] == value))
+            session.commit()
+
+        self._fan_out(self.names_for(value if column == "game_id" else None), work)
+
+    def _next_id(self, model):
+        # Next ID for a new row, unique across all shards
+        name = model.__tablename__
+        with self._lock:
+            block = self._blocks.get(name)
+            if block is None or block[0] >= block[1]:
+                start = self._allocate_block(model)
+                block = self._blocks[name] = [start, start + self.id_block_size]
+            block[0] += 1
+            return block[0] - 1
+
+    def _allocate_block(self, model):
+
+        # Reserve the next block of IDs for a table in the main database and return its first ID.
+        # A single UPDATE ... RETURNING per block keeps the main database out of the way of
+        # ingest, however many shards there are.
+
+        table = IdBlock.__table__
+        name = model.__tablename__
+        size = self.id_block_size
+        while True:
+            with db.engine.begin() as connection:
+                end = connection.execute(
+                    update(table)
+                    .where(table.c.name == name)
+                    .values(next_id=table.c.next_id + size)
+                    .returning(table.c.next_id)
+                ).scalar()
+            if end is not None:
+                return end - size
+
+            # First block for this table: start above any ID already in use
+            first = self._max_id(model) + 1
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(insert(table).values(name=name, next_id=first + size))
+                return first
+            except IntegrityError:
+                continue  # Another worker created the counter first, take a block from it
+
+    def _max_id(self, model):
+        # Highest ID of a table on the main database and all shards
+        stmt = select(func.max(model.id))
+        highest = [db.session.scalar(stmt)]
+        highest += self._fan_out(self.names, lambda session: session.scalar(stmt))
+        return max([value for value in highest if value is not None], default=0)
+
+
+# Shard router instance, initialised with the app in create_app
+shards = ShardRouter()
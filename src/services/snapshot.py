@@ -0,0 +1,375 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from sqlalchemy import select, func, text
+
+from init import db
+from models.user import User
+from models.genre import Genre
+from models.developer import Developer
+from models.game import Game
+from models.score import Score
+from models.session import Session
+from models.achievement import Achievement
+from models.achievement_definition import AchievementDefinition, AchievementProgress
+from models.tombstone import Tombstone
+from services.sharding import shards, shard_metadata, SHARDED_MODELS
+from services import ratings, active_players, concurrency_series, playtime, recommendations, anomalies, outbox
+
+# Columnar snapshots of the dataset, for backups and analytics extracts.
+# Every table is written as Parquet files under <directory>/<table>/, one per range of
+# primary keys, by several threads at once. On PostgreSQL each range is read with
+# COPY ... TO STDOUT and parsed straight into Arrow, and imported with COPY ... FROM STDIN,
+# so rows never become Python objects and a snapshot runs at the speed of the disks and
+# the database. Other databases (SQLite in development) stream rows through a server-side
+# cursor instead. Derived tables (ratings, rollups, sketches, similar games, score
+# baselines) are not exported; an import rebuilds them from the imported rows.
+
+# Tables in the snapshot, parents before children so an import satisfies foreign keys
+MODELS = (Genre, Developer, User, Game, AchievementDefinition, Score, Session, Achievement, AchievementProgress, Tombstone)
+
+# Manifest written last, so a directory without one is an unfinished export
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 2  # 2: updated_at columns and tombstones, for /sync
+
+# Primary key values per file, threads working at once, and rows per Arrow batch
+DEFAULT_CHUNK_ROWS = 1000000
+DEFAULT_WORKERS = min(os.cpu_count() or 1, 8)
+BATCH_ROWS = 65536
+
+COMPRESSIONS = ("zstd", "snappy", "gzip", "none")
+
+# Arrow type for each Python type the models' columns map to
+ARROW_TYPES = {
+    int: pa.int64(),
+    str: pa.string(),
+    bool: pa.bool_(),
+    float: pa.float64(),
+    datetime: pa.timestamp("us"),
+    date: pa.date32(),
+}
+
+
+class SnapshotError(Exception):
+    # Raised for a snapshot that cannot be imported, or a database it cannot go into
+    pass
+
+
+def arrow_schema(table):
+    return pa.schema([
+        pa.field(column.name, ARROW_TYPES[column.type.python_type], nullable=column.nullable)
+        for column in table.columns
+    ])
+
+
+def _sources(model):
+    # (name, engine, table) for every database holding rows of a model
+    if model in SHARDED_MODELS and shards.enabled:
+        return [(name, shards.engines[name], shard_metadata.tables[model.__tablename__]) for name in shards.names]
+    return [("main", db.engine, model.__table__)]
+
+
+def _ranges(engine, table, chunk_rows):
+    # Half-open ranges of the first primary key column covering every row of a table
+    key = table.primary_key.columns.values()[0]
+    with engine.connect() as connection:
+        low, high = connection.execute(select(func.min(key), func.max(key))).one()
+    if low is None:
+        return []
+    return [(start, start + chunk_rows) for start in range(low, high + 1, chunk_rows)]
+
+
+def _range_query(table, start, end):
+    key = table.primary_key.columns.values()[0]
+    return select(*table.columns).where(key >= start, key < end).order_by(*table.primary_key.columns)
+
+
+def _copy_out(engine, table, start, end, schema):
+
+    # Arrow batches of one key range, read with COPY ... TO STDOUT. psycopg2 writes the
+    # CSV into a pipe on one thread while Arrow parses it on this one; both release the
+    # GIL, so several ranges really do run at once.
+
+    query = _range_query(table, start, end).compile(engine, compile_kwargs={"literal_binds": True})
+    read_fd, write_fd = os.pipe()
+    raw = engine.raw_connection()
+    failure = []
+
+    def copy():
+        try:
+            with os.fdopen(write_fd, "wb") as sink, raw.cursor() as cursor:
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv)", sink)
+        except Exception as error:
+            failure.append(error)
+
+    writer = threading.Thread(target=copy, daemon=True)
+    writer.start()
+    try:
+        with os.fdopen(read_fd, "rb") as source:
+            yield from _read_csv(source, schema)
+    finally:
+        writer.join()
+        raw.close()
+    if failure:
+        raise failure[0]
+
+
+def _read_csv(source, schema):
+    # Arrow batches of the CSV that COPY ... TO STDOUT writes
+    try:
+        reader = pa_csv.open_csv(
+            source,
+            read_options=pa_csv.ReadOptions(column_names=schema.names),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={field.name: field.type for field in schema},
+                true_values=["t"],
+                false_values=["f"],
+                null_values=[""],  # PostgreSQL writes NULL unquoted and '' quoted
+                strings_can_be_null=True,
+                quoted_strings_can_be_null=False,
+            ),
+        )
+    except pa.ArrowInvalid as error:
+        if "Empty CSV file" in str(error):
+            return  # A range with no rows (a gap in the keys)
+        raise
+    yield from reader
+
+
+def _stream_out(engine, table, start, end, schema):
+    # Arrow batches of one key range, read through a server-side cursor
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=BATCH_ROWS).execute(
+            _range_query(table, start, end)
+        )
+        for rows in result.partitions():
+            columns = list(zip(*rows))
+            yield pa.record_batch(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema
+            )
+
+
+def _export_range(engine, table, start, end, path, compression):
+    # Write one key range of a table to a Parquet file; returns the number of rows
+    schema = arrow_schema(table)
+    batches = _copy_out if engine.dialect.name == "postgresql" else _stream_out
+    rows = 0
+    with pq.ParquetWriter(path, schema, compression=compression) as writer:
+        for batch in batches(engine, table, start, end, schema):
+            writer.write_batch(batch.cast(schema))
+            rows += batch.num_rows
+    if not rows:
+        os.remove(path)
+    return rows
+
+
+def export(directory, workers=DEFAULT_WORKERS, chunk_rows=DEFAULT_CHUNK_ROWS, compression="zstd"):
+
+    # Write every table in MODELS to Parquet files under directory, which must be empty
+    # or not exist yet. Returns the number of rows exported per table.
+
+    os.makedirs(directory, exist_ok=True)
+    if os.listdir(directory):
+        raise SnapshotError(f"{directory} is not empty")
+
+    # Every key range of every table (and shard) is one task, so big tables are split
+    # over all the workers instead of keeping one busy while the rest sit idle
+    tasks = []
+    for model in MODELS:
+        os.makedirs(os.path.join(directory, model.__tablename__))
+        for name, engine, table in _sources(model):
+            for start, end in _ranges(engine, table, chunk_rows):
+                filename = os.path.join(model.__tablename__, f"{name}-{start:012d}.parquet")
+                tasks.append((model.__tablename__, filename, engine, table, start, end))
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="snapshot") as executor:
+        futures = [
+            executor.submit(_export_range, engine, table, start, end, os.path.join(directory, filename), compression)
+            for _, filename, engine, table, start, end in tasks
+        ]
+        counts = [future.result() for future in futures]
+
+    manifest = {
+        "format": FORMAT_VERSION,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "tables": {
+            model.__tablename__: {"columns": arrow_schema(model.__table__).names, "files": [], "rows": 0}
+            for model in MODELS
+        },
+    }
+    for (table_name, filename, *_), rows in zip(tasks, counts):
+        if rows:
+            manifest["tables"][table_name]["files"].append({"path": filename, "rows": rows})
+            manifest["tables"][table_name]["rows"] += rows
+    with open(os.path.join(directory, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return {name: entry["rows"] for name, entry in manifest["tables"].items()}
+
+
+class _CsvStream:
+
+    # File-like object that psycopg2's copy_expert() reads COPY ... FROM STDIN data from,
+    # made by Arrow's CSV writer one batch at a time. read() returns at most size bytes,
+    # and b"" once every batch has been read.
+
+    def __init__(self, batches):
+        self._batches = iter(batches)
+        self._buffer = b""
+        self._position = 0
+
+    def read(self, size=-1):
+        while self._position >= len(self._buffer):
+            batch = next(self._batches, None)
+            if batch is None:
+                return b""
+            sink = pa.BufferOutputStream()
+            pa_csv.write_csv(batch, sink, write_options=pa_csv.WriteOptions(include_header=False))
+            self._buffer, self._position = sink.getvalue().to_pybytes(), 0
+        end = len(self._buffer) if size < 0 else self._position + size
+        data = self._buffer[self._position:end]
+        self._position += len(data)
+        return data
+
+
+def _copy_in(engine, table, batches):
+    # Load batches into a table with COPY ... FROM STDIN, in one transaction
+    columns = ", ".join(f'"{name}"' for name in table.columns.keys())
+    raw = engine.raw_connection()
+    try:
+        with raw.cursor() as cursor:
+            cursor.copy_expert(f'COPY "{table.name}" ({columns}) FROM STDIN WITH (FORMAT csv)', _CsvStream(batches))
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def _insert_many(engine, table, batches):
+    # Load batches into a table with multi-row INSERTs, in one transaction
+    with engine.begin() as connection:
+        for batch in batches:
+            connection.execute(table.insert(), batch.to_pylist())
+
+
+def _shard_batches(path):
+    # Batches of a file of scores or sessions, split by the shard each row belongs on
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=BATCH_ROWS):
+        game_ids, rows = np.unique(batch.column("game_id").to_numpy(), return_inverse=True)
+        owners = np.array([shards.shard_for(int(game_id)) for game_id in game_ids])[rows]
+        for name in np.unique(owners):
+            yield str(name), batch.filter(pa.array(owners == name))
+
+
+def _import_file(engine, model, path):
+    # Load one Parquet file into its table on engine (or onto the shards); returns the
+    # number of rows
+    load = _copy_in if engine.dialect.name == "postgresql" else _insert_many
+    if model in SHARDED_MODELS and shards.enabled:
+        by_shard = {}
+        for name, batch in _shard_batches(path):
+            by_shard.setdefault(name, []).append(batch)
+        for name, batches in by_shard.items():
+            load(shards.engines[name], shard_metadata.tables[model.__tablename__], batches)
+        return sum(batch.num_rows for batches in by_shard.values() for batch in batches)
+    load(engine, model.__table__, pq.ParquetFile(path).iter_batches(batch_size=BATCH_ROWS))
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def _read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        raise SnapshotError(f"{directory} has no {MANIFEST}; it is not a finished snapshot")
+    with open(path) as file:
+        manifest = json.load(file)
+    if manifest.get("format") != FORMAT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot format {manifest.get('format')}")
+    for model in MODELS:
+        entry = manifest["tables"].get(model.__tablename__)
+        if entry is None:
+            raise SnapshotError(f"The snapshot has no {model.__tablename__} table")
+        unknown = set(entry["columns"]) - set(model.__table__.columns.keys())
+        if unknown:
+            raise SnapshotError(f"The snapshot's {model.__tablename__} has unknown columns: {', '.join(sorted(unknown))}")
+    return manifest
+
+
+def _index_targets(model):
+    # (engine, index) for every secondary index of a model's table, on every database
+    return [(engine, index) for _, engine, table in _sources(model) for index in table.indexes]
+
+
+def import_(directory, workers=DEFAULT_WORKERS):
+
+    # Load a snapshot written by export() into an empty database whose tables have been
+    # created (flask db_commands create). Returns the number of rows imported per table.
+
+    manifest = _read_manifest(directory)
+    for model in MODELS:
+        for _, engine, table in _sources(model):
+            with engine.connect() as connection:
+                if connection.execute(select(table).limit(1)).first() is not None:
+                    raise SnapshotError(f"{table.name} is not empty; import into an empty database")
+
+    # Secondary indexes are dropped for the load and built again once every row is in,
+    # which is much faster than updating them row by row. Primary keys, unique constraints
+    # and foreign keys stay, so the data is still checked as it goes in.
+    indexes = [target for model in MODELS for target in _index_targets(model)]
+    for engine, index in indexes:
+        index.drop(bind=engine)
+
+    # SQLite has one writer at a time, so loading files in parallel would only wait on locks
+    engine = db.engine
+    if engine.dialect.name == "sqlite":
+        workers = 1
+
+    counts = {}
+    try:
+        # Tables go in one after the other, parents first; the files of a table in parallel
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="snapshot") as executor:
+            for model in MODELS:
+                files = manifest["tables"][model.__tablename__]["files"]
+                paths = [os.path.join(directory, entry["path"]) for entry in files]
+                counts[model.__tablename__] = sum(executor.map(lambda path: _import_file(engine, model, path), paths))
+    finally:
+        for engine, index in indexes:
+            index.create(bind=engine)
+
+    # New rows must get IDs above the imported ones
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as connection:
+            for model in MODELS:
+                if "id" in model.__table__.columns:
+                    connection.execute(text(
+                        f"SELECT setval(pg_get_serial_sequence('{model.__tablename__}', 'id'), "
+                        f"COALESCE((SELECT MAX(id) FROM {model.__tablename__}), 0) + 1, false)"
+                    ))
+
+    rebuild_derived()
+
+    # Running workers keep the catalogue in memory (the search index, genres and
+    # developers), so they are told it has changed
+    outbox.record("catalogue.imported", games=counts[Game.__tablename__])
+    db.session.commit()
+    return counts
+
+
+def rebuild_derived():
+    # Rebuild every table derived from scores and sessions, then refresh the planner's
+    # statistics so queries get the plans production would
+    ratings.rebuild()
+    active_players.rebuild()
+    concurrency_series.rebuild()
+    playtime.rebuild()
+    recommendations.refresh(full=True)
+    anomalies.rebuild()
+
+    if db.engine.dialect.name == "postgresql":
+        for engine in [db.engine] + list(shards.engines.values()):
+            with engine.begin() as connection:
+                connection.execute(text("ANALYZE"))
@@ -0,0 +1,235 @@
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event, select, delete, tuple_
+from sqlalchemy.orm import Session as OrmSession, selectinload
+
+from init import db
+from models.genre import Genre, GenreSchema
+from models.developer import Developer, DeveloperSchema
+from models.game import Game, GameSchema
+from models.achievement import Achievement, achievements_schema
+from models.score import Score, scores_schema
+from models.session import Session, sessions_schema
+from models.outbox_event import OutboxEvent
+from models.tombstone import Tombstone
+from services.sharding import shards, SHARDED_MODELS
+
+# Delta sync for clients that keep a copy of the catalogue and of their own history.
+# Every synced row has an indexed updated_at, set when it is created and on every change,
+# and every delete leaves a tombstone. A client sends back the token it was last given and
+# gets the rows created, changed or deleted since, a page at a time, instead of listing
+# everything again.
+# - A sync runs up to a fixed point in time, chosen on its first page and carried in the
+#   token, so rows changed while a client pages through land in the next sync, not twice.
+# - That point is SYNC_SETTLE_SECONDS in the past. updated_at is set when a change is
+#   written, not when it commits, so a transaction may commit a timestamp slightly older
+#   than rows already returned; the delay lets it commit first (and absorbs clock skew
+#   between servers).
+# - Tombstones are kept SYNC_TOMBSTONE_DAYS days. A token older than that could miss a
+#   delete, so it is refused and the client starts over with a full sync.
+
+# Defaults, overridable through app config
+DEFAULT_PAGE_SIZE = 500  # Rows per page, when the client does not ask for fewer or more
+MAX_PAGE_SIZE = 2000
+DEFAULT_SETTLE_SECONDS = 10.0  # SYNC_SETTLE_SECONDS
+DEFAULT_TOMBSTONE_DAYS = 90  # SYNC_TOMBSTONE_DAYS
+
+# Version of the token's contents, so tokens from an older format can be refused
+TOKEN_VERSION = 1
+
+# A synced resource: its name in responses, model, schema, and whether players only sync
+# their own rows of it (otherwise every row is synced)
+Resource = namedtuple("Resource", "name model schema owned")
+
+# Synced resources, parents first. Games leave out their scores, sessions and achievements,
+# which are synced as resources of their own
+RESOURCES = (
+    Resource("genres", Genre, GenreSchema(many=True, only=["id", "name"]), False),
+    Resource("developers", Developer, DeveloperSchema(many=True, only=["id", "name"]), False),
+    Resource("games", Game, GameSchema(many=True, only=["id", "title", "genre", "developer"]), False),
+    Resource("achievements", Achievement, achievements_schema, True),
+    Resource("scores", Score, scores_schema, True),
+    Resource("sessions", Session, sessions_schema, True),
+)
+
+# Resource whose tombstone each domain event leaves
+DELETED_TOPICS = {
+    "genre.deleted": "genres",
+    "developer.deleted": "developers",
+    "game.deleted": "games",
+    "achievement.deleted": "achievements",
+    "score.deleted": "scores",
+    "session.deleted": "sessions",
+}
+
+
+class SyncTokenError(Exception):
+    # Raised for a token that was not issued by /sync
+    pass
+
+
+class SyncTokenExpired(SyncTokenError):
+    # Raised for a token older than the tombstones, which could miss deletes
+    pass
+
+
+@event.listens_for(OrmSession, "before_flush")
+def _record_tombstones(session, flush_context, instances):
+    # Leave a tombstone for every delete recorded in the outbox (see services/outbox.py),
+    # so it is committed, or rolled back, with the delete itself. A deleted game's
+    # scores, sessions and achievements go with it, and clients drop them on its tombstone.
+    for obj in list(session.new):
+        if isinstance(obj, OutboxEvent) and obj.topic in DELETED_TOPICS:
+            session.add(Tombstone(
+                resource=DELETED_TOPICS[obj.topic],
+                entity_id=obj.entity_id,
+                user_id=(obj.payload or {}).get("user_id"),
+                deleted_at=datetime.now(),
+            ))
+
+
+def encode_token(since, until=None, step=0, after=None):
+    # Opaque token for the client: where the next page starts
+    state = {
+        "v": TOKEN_VERSION,
+        "since": since.isoformat() if since else None,
+        "until": until.isoformat() if until else None,
+        "step": step,
+        "after": [after[0].isoformat(), after[1]] if after else None,
+    }
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_token(token):
+    # (since, until, step, after) from a token given by encode_token
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if state["v"] != TOKEN_VERSION:
+            raise SyncTokenError("Unsupported sync token")
+        since = datetime.fromisoformat(state["since"]) if state["since"] else None
+        until = datetime.fromisoformat(state["until"]) if state["until"] else None
+        step = int(state["step"])
+        after = (datetime.fromisoformat(state["after"][0]), int(state["after"][1])) if state["after"] else None
+    except (ValueError, TypeError, KeyError, IndexError, binascii.Error) as error:
+        raise SyncTokenError("Invalid sync token") from error
+    return since, until, step, after
+
+
+def retention_days():
+    return current_app.config.get("SYNC_TOMBSTONE_DAYS", DEFAULT_TOMBSTONE_DAYS)
+
+
+def _steps(since):
+    # (resource, deleted) pairs read in turn: every resource's rows, then every resource's
+    # tombstones. A first sync has nothing to delete, so it skips the tombstones
+    steps = [(resource, False) for resource in RESOURCES]
+    if since is not None:
+        steps += [(resource, True) for resource in RESOURCES]
+    return steps
+
+
+def _changed_rows(resource, user_id, since, until, after, limit):
+    # Rows of a resource changed in [since, until) after the (updated_at, id) key, in key
+    # order, found through the updated_at index
+    model = resource.model
+    criteria = [model.updated_at < until]
+    if since is not None:
+        criteria.append(model.updated_at >= since)
+    if after is not None:
+        criteria.append(tuple_(model.updated_at, model.id) > tuple_(*after))
+    if resource.owned:
+        criteria.append(model.user_id == user_id)
+
+    if model in SHARDED_MODELS:
+        rows = shards.select(model, *criteria, order_by=(model.updated_at, model.id), limit=limit)
+        return rows if shards.enabled else shards.attach(rows)  # Already attached when sharded
+    stmt = select(model).where(*criteria).order_by(model.updated_at, model.id).limit(limit)
+    if resource.owned:
+        stmt = stmt.options(selectinload(model.user), selectinload(model.game))
+    return db.session.scalars(stmt).all()
+
+
+def _tombstones(resource, user_id, since, until, after, limit):
+    # Tombstones of a resource left in [since, until) after the (deleted_at, id) key
+    criteria = [
+        Tombstone.resource == resource.name,
+        Tombstone.user_id == user_id if resource.owned else Tombstone.user_id.is_(None),
+        Tombstone.deleted_at >= since,
+        Tombstone.deleted_at < until,
+    ]
+    if after is not None:
+        criteria.append(tuple_(Tombstone.deleted_at, Tombstone.id) > tuple_(*after))
+    return db.session.scalars(
+        select(Tombstone).where(*criteria).order_by(Tombstone.deleted_at, Tombstone.id).limit(limit)
+    ).all()
+
+
+def changes(user_id, token=None, limit=DEFAULT_PAGE_SIZE):
+
+    # One page of the changes a player's client has not seen: the catalogue rows and the
+    # player's own scores, sessions and achievements created or changed since the token
+    # (everything, without one), then the IDs of rows deleted since.
+    # Returns {"changes": {resource: [rows]}, "deleted": {resource: [IDs]}, "next": token,
+    # "has_more": bool}. The client applies the page, then asks again with "next": straight
+    # away while has_more is true, or on its next refresh once it is false.
+    # Raises SyncTokenError for a token /sync did not issue, and SyncTokenExpired for one
+    # too old to be trusted.
+
+    if token:
+        since, until, step, after = decode_token(token)
+    else:
+        since, until, step, after = None, None, 0, None
+
+    now = datetime.now()
+    if since is not None and since < now - timedelta(days=retention_days()):
+        raise SyncTokenExpired("Sync token has expired")
+    if until is None:
+        # A new sync: it runs up to a point far enough back for changes to have committed
+        settle = current_app.config.get("SYNC_SETTLE_SECONDS", DEFAULT_SETTLE_SECONDS)
+        until = now - timedelta(seconds=settle)
+        if since is not None and until < since:
+            until = since  # Synced moments ago: nothing new yet
+
+    steps = _steps(since)
+    body = {
+        "changes": {resource.name: [] for resource in RESOURCES},
+        "deleted": {resource.name: [] for resource in RESOURCES},
+    }
+    remaining = limit
+    while step < len(steps) and remaining > 0:
+        resource, deleted = steps[step]
+        if deleted:
+            rows = _tombstones(resource, user_id, since, until, after, remaining)
+            body["deleted"][resource.name] += [row.entity_id for row in rows]
+            last = (rows[-1].deleted_at, rows[-1].id) if rows else None
+        else:
+            rows = _changed_rows(resource, user_id, since, until, after, remaining)
+            body["changes"][resource.name] += resource.schema.dump(rows)
+            last = (rows[-1].updated_at, rows[-1].id) if rows else None
+        remaining -= len(rows)
+        if remaining > 0:
+            step, after = step + 1, None  # Fewer rows than asked for: this step is done
+        else:
+            after = last
+
+    if step < len(steps):
+        body["next"] = encode_token(since, until, step, after)
+        body["has_more"] = True
+    else:
+        # Done: the next sync starts where this one stopped
+        body["next"] = encode_token(until)
+        body["has_more"] = False
+    return body
+
+
+def purge_old(days=None):
+    # Delete tombstones older than the retention period; returns the number removed
+    days = retention_days() if days is None else days
+    result = db.session.execute(delete(Tombstone).where(Tombstone.deleted_at < datetime.now() - timedelta(days=days)))
+    db.session.commit()
+    return result.rowcount
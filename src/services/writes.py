@@ -0,0 +1,93 @@
+from flask import request
+from sqlalchemy import insert, update, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+
+from init import db
+from services.concurrency import etag, expected_versions
+
+# Single-statement writes for the create and update handlers.
+# Each write is one INSERT ... RETURNING or UPDATE ... RETURNING, so a handler does not
+# look rows up before writing them or re-read them afterwards: foreign keys and unique
+# constraints are checked by the database, and the returned row is what gets serialised.
+# Handlers catch IntegrityError and use violation() to turn it into the usual 400/404.
+
+UNIQUE = "unique"
+FOREIGN_KEY = "foreign_key"
+NOT_NULL = "not_null"
+
+# SQLSTATE codes reported by PostgreSQL, and the messages SQLite uses instead
+PG_CODES = {"23505": UNIQUE, "23503": FOREIGN_KEY, "23502": NOT_NULL}
+SQLITE_MESSAGES = {
+    "UNIQUE constraint failed": UNIQUE,
+    "FOREIGN KEY constraint failed": FOREIGN_KEY,
+    "NOT NULL constraint failed": NOT_NULL,
+}
+
+
+def violation(error):
+    # Kind of constraint an IntegrityError broke (UNIQUE, FOREIGN_KEY or NOT_NULL), or
+    # None for anything else, such as a check constraint
+    code = getattr(error.orig, "pgcode", None)
+    if code is not None:
+        return PG_CODES.get(code)
+    message = str(error.orig)
+    for prefix, kind in SQLITE_MESSAGES.items():
+        if message.startswith(prefix):
+            return kind
+    return None
+
+
+def missing(*references):
+    # The first (model, id) pair whose row does not exist, e.g. to find which foreign key
+    # an insert broke. Only called once the write has already failed
+    for model, id in references:
+        if id is None or db.session.get(model, id) is None:
+            return model
+    return None
+
+
+def insert_returning(model, **values):
+    # Insert one row and return it as a loaded object.
+    # Raises IntegrityError (after rolling back) if a constraint is broken
+    try:
+        obj = db.session.scalars(insert(model).values(**values).returning(model)).one()
+    except IntegrityError:
+        db.session.rollback()
+        raise
+
+    # A row that was just inserted has no children yet, so its collections are known to
+    # be empty and serialising it does not need to query them
+    for relationship in inspect(model).relationships:
+        if relationship.uselist and relationship.lazy != "dynamic":
+            set_committed_value(obj, relationship.key, [])
+    return obj
+
+
+def update_returning(model, id, **values):
+    # Update one versioned row if it still matches the request's If-Match header, bumping
+    # its version, and return (obj, None). obj is None if the row does not exist; if it
+    # exists but has changed since the client read it, or If-Match is missing, the error
+    # response is returned instead. Raises IntegrityError (after rolling back) if a
+    # constraint is broken
+    if "If-Match" not in request.headers:
+        return None, ({"message": "If-Match header is required"}, 428)
+    versions = expected_versions()
+
+    statement = update(model).where(model.id == id)
+    if versions is not None:
+        statement = statement.where(model.version.in_(versions))
+    statement = statement.values(**values, version=model.version + 1).returning(model)
+    try:
+        obj = db.session.scalars(statement, execution_options={"populate_existing": True}).one_or_none()
+    except IntegrityError:
+        db.session.rollback()
+        raise
+    if obj is not None:
+        return obj, None
+
+    # Nothing matched: either the row is gone, or its version moved on
+    current = db.session.get(model, id)
+    if current is None:
+        return None, None
+    return None, ({"message": "Resource has been modified", "etag": etag(current)}, 412)
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules import each other from src/, the directory it runs from
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# Secret used to sign the tests' access tokens
+JWT_SECRET_KEY = "test-secret-key-for-signing-access-tokens"
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # The app against a SQLite database of its own, created empty for each test
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setenv("JWT_SECRET_KEY", JWT_SECRET_KEY)
+    monkeypatch.setenv("ACCESS_LOG", "false")
+
+    from init import db
+    from main import create_app
+    from services import idempotency, search
+
+    # Stored responses and the search index are kept per process, so each test starts
+    # without those of the previous test's database
+    monkeypatch.setattr(idempotency, "store", idempotency.IdempotencyStore())
+    search.trie_index.invalidate()
+
+    app = create_app()
+    app.config["TESTING"] = True
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def register(client):
+    # Register and log in a player; returns the Authorization header for their requests
+    def register(email="player@example.com", name="Player", password="secret1"):
+        client.post("/auth/register", json={"name": name, "email": email, "password": password})
+        response = client.post("/auth/login", json={"email": email, "password": password})
+        return {"Authorization": f"Bearer {response.json['access_token']}"}
+    return register
+
+
+@pytest.fixture
+def headers(register):
+    return register()
+
+
+@pytest.fixture
+def game(client, headers):
+    # A game with its genre and developer; returns its JSON
+    client.post("/genres", json={"name": "Action"}, headers=headers)
+    client.post("/developers", json={"name": "Epic Games"}, headers=headers)
+    response = client.post("/games", json={"title": "Fortnite", "genre_id": 1, "developer_id": 1}, headers=headers)
+    return response.json
@@ -0,0 +1,79 @@
+import math
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+from init import db
+from models.active_player_sketch import ActivePlayerSketch
+from services import active_players
+from services.hll import HyperLogLog, REGISTERS, position, positions
+
+
+def sketch_of(ids):
+    sketch = HyperLogLog()
+    for value in ids:
+        sketch.add(value)
+    return sketch
+
+
+@pytest.mark.parametrize("distinct", [0, 1, 10, 1000, 20000, 200000])
+def test_estimate_is_within_a_few_percent(distinct):
+    # Hashed IDs are the same in every run, and so is the estimate. The standard error is
+    # about 1.15%; four of them allow for the bump where linear counting hands over
+    estimate = sketch_of(range(1, distinct + 1)).count()
+    assert abs(estimate - distinct) <= max(1, 4 * 1.04 / math.sqrt(REGISTERS) * distinct)
+
+
+def test_repeated_ids_are_counted_once():
+    sketch = sketch_of(range(1, 1001))
+    assert not any(sketch.add(value) for value in range(1, 1001))
+    assert sketch.count() == sketch_of(range(1, 1001)).count()
+
+
+def test_merged_sketches_count_the_union():
+    monday, tuesday = sketch_of(range(1, 6001)), sketch_of(range(4001, 10001))
+    merged = HyperLogLog().update(monday).update(tuesday)
+    assert np.array_equal(merged.registers, sketch_of(range(1, 10001)).registers)
+    assert abs(merged.count() - 10000) <= 300
+
+
+def test_positions_match_position():
+    ids = np.array([1, 2, 3, 1000, 123456789, 2**62], dtype=np.int64)
+    indexes, ranks = positions(ids)
+    assert [(int(index), int(rank)) for index, rank in zip(indexes, ranks)] == [position(int(value)) for value in ids]
+
+
+@pytest.mark.parametrize("distinct", [0, 50, 100000])
+def test_bytes_round_trip(distinct):
+    sketch = sketch_of(range(1, distinct + 1))
+    data = sketch.to_bytes()
+    assert np.array_equal(HyperLogLog.from_bytes(data).registers, sketch.registers)
+    if distinct <= 50:
+        assert len(data) < REGISTERS  # Sparse while few registers are set
+
+
+def test_active_players_endpoint(client, register, headers, game):
+    players = [headers] + [register(f"player{number}@example.com", f"Player {number}") for number in range(4)]
+    today = date.today()
+    for day in range(3):
+        start = (today - timedelta(days=day)).isoformat() + "T12:00:00"
+        for player in players[:day + 2]:
+            client.post("/sessions", json={"game_id": 1, "start_time": start}, headers=player)
+
+    response = client.get("/games/1/active-players?window=1d", headers=headers)
+    assert response.json["active_players"] == 2
+    assert response.json["days_with_sessions"] == 1
+    response = client.get("/games/1/active-players?window=30d", headers=headers)
+    assert response.json["active_players"] == 4
+    assert response.json["days_with_sessions"] == 3
+
+    # A rebuild from the sessions gives the same sketches
+    before = {(row.day, row.registers) for row in db.session.scalars(db.select(ActivePlayerSketch))}
+    assert active_players.rebuild() == 9
+    assert {(row.day, row.registers) for row in db.session.scalars(db.select(ActivePlayerSketch))} == before
+
+
+@pytest.mark.parametrize("query", ["window=0d", "window=367d", "window=week", "to=yesterday"])
+def test_active_players_invalid_parameters(client, headers, game, query):
+    assert client.get(f"/games/1/active-players?{query}", headers=headers).status_code == 400
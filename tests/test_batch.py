@@ -0,0 +1,82 @@
+import pytest
+
+from init import db
+from models.score import Score
+
+
+def batch(client, headers, *requests):
+    response = client.post("/batch", json={"requests": list(requests)}, headers=headers)
+    assert response.status_code == 200
+    return response.json["responses"]
+
+
+def test_sub_requests_run_in_order(client, headers, game):
+    responses = batch(
+        client, headers,
+        {"path": "/scores", "method": "POST", "body": {"value": 100, "game_id": 1}},
+        {"path": "/scores"},
+        {"path": "/games/1"},
+        {"path": "/games/99"},
+    )
+    assert [response["status"] for response in responses] == [201, 200, 200, 404]
+    # Later sub-requests see earlier writes, and headers such as the ETag are passed back
+    assert [score["value"] for score in responses[1]["body"]] == [100]
+    assert responses[2]["headers"]["ETag"] == '"1"'
+
+
+def test_sub_requests_use_the_batch_authorization(client, headers, game):
+    response = client.post("/batch", json={"requests": [{"path": "/scores"}]})
+    assert response.json["responses"][0]["status"] == 401
+
+
+def test_sub_requests_with_an_idempotency_key_are_replayed(client, headers, game):
+    sub_request = {
+        "path": "/scores",
+        "method": "POST",
+        "body": {"value": 100, "game_id": 1},
+        "headers": {"Idempotency-Key": "batch-1"},
+    }
+    first, = batch(client, headers, sub_request)
+    retry, = batch(client, headers, sub_request)
+    assert retry["status"] == 201
+    assert retry["headers"]["Idempotent-Replayed"] == "true"
+    assert retry["body"] == first["body"]
+    assert db.session.scalar(db.select(db.func.count()).select_from(Score)) == 1
+
+
+def test_failed_sub_request_does_not_stop_the_rest(client, headers, game):
+    responses = batch(
+        client, headers,
+        {"path": "/scores", "method": "POST", "body": {"value": "high", "game_id": 1}},
+        {"path": "/scores", "method": "POST", "body": {"value": 100, "game_id": 1}},
+    )
+    assert [response["status"] for response in responses] == [400, 201]
+
+
+@pytest.mark.parametrize("body", [
+    {},
+    {"requests": []},
+    {"requests": [{"path": "/games"}] * 21},
+    {"requests": [{"path": "games"}]},
+    {"requests": [{"path": "/batch"}]},
+])
+def test_invalid_batches(client, headers, body):
+    assert client.post("/batch", json=body, headers=headers).status_code == 400
+
+
+def test_multi_get_keeps_the_requested_order(client, register, headers, game):
+    client.post("/games", json={"title": "Rocket League", "genre_id": 1, "developer_id": 1}, headers=headers)
+    response = client.get("/games?ids=2,99,1,2", headers=headers)
+    assert [game["id"] for game in response.json] == [2, 1]
+
+    # Scores and sessions of other players are left out
+    other = register("other@example.com", "Other")
+    mine = client.post("/scores", json={"value": 100, "game_id": 1}, headers=headers).json
+    theirs = client.post("/scores", json={"value": 200, "game_id": 1}, headers=other).json
+    response = client.get(f"/scores?ids={theirs['id']},{mine['id']}", headers=headers)
+    assert [score["id"] for score in response.json] == [mine["id"]]
+
+
+@pytest.mark.parametrize("ids", ["", "1,a", ",".join(str(id) for id in range(1, 102))])
+def test_multi_get_invalid_ids(client, headers, game, ids):
+    assert client.get(f"/games?ids={ids}", headers=headers).status_code == 400
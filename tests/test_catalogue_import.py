@@ -0,0 +1,86 @@
+from init import db
+from models.game import Game
+
+CSV = """title,genre,developer
+Fortnite,Action,Epic Games
+Halo,Shooter,Bungie
+Destiny,Shooter,Bungie
+"""
+
+
+def catalogue():
+    # (title, genre, developer, version) of every game
+    return {
+        (game.title, game.genre.name, game.developer.name, game.version)
+        for game in db.session.scalars(db.select(Game))
+    }
+
+
+def import_csv(client, headers, text):
+    response = client.post("/games/import", data=text, content_type="text/csv", headers=headers)
+    assert response.status_code == 200
+    return response.json
+
+
+def test_import_creates_games_genres_and_developers(client, headers, game):
+    summary = import_csv(client, headers, CSV)
+    assert summary == {
+        "rows": 3, "games": 3, "genres_created": 1, "developers_created": 1, "errors": [], "error_count": 0,
+    }
+    assert catalogue() == {
+        ("Fortnite", "Action", "Epic Games", 1),
+        ("Halo", "Shooter", "Bungie", 1),
+        ("Destiny", "Shooter", "Bungie", 1),
+    }
+
+
+def test_importing_again_changes_nothing(client, headers):
+    import_csv(client, headers, CSV)
+    before = catalogue()
+    summary = import_csv(client, headers, CSV)
+    assert summary["genres_created"] == summary["developers_created"] == 0
+    assert catalogue() == before
+
+
+def test_changed_rows_are_updated_by_title(client, headers):
+    import_csv(client, headers, CSV)
+    etag = client.get("/games/2", headers=headers).headers["ETag"]
+    rows = [{"title": "Halo", "genre": "Shooter", "developer": "343 Industries"}]
+    response = client.post("/games/import", json=rows, headers=headers)
+    assert response.json["developers_created"] == 1
+    assert ("Halo", "Shooter", "343 Industries", 2) in catalogue()
+    # Clients holding the old ETag see the change
+    response = client.patch("/games/2", json={"title": "Halo 2"}, headers={**headers, "If-Match": etag})
+    assert response.status_code == 412
+
+
+def test_invalid_rows_are_reported(client, headers):
+    rows = [
+        {"title": "Halo", "genre": "Shooter", "developer": "Bungie"},
+        {"title": "Untitled", "genre": "Shooter"},
+        "Destiny",
+        {"title": "Halo", "genre": "Shooter", "developer": "343 Industries"},  # Last one wins
+    ]
+    summary = client.post("/games/import", json={"games": rows}, headers=headers).json
+    assert summary["games"] == 1
+    assert summary["errors"] == [
+        {"row": 2, "message": "Missing developer"},
+        {"row": 3, "message": "Expected an object"},
+    ]
+    assert catalogue() == {("Halo", "Shooter", "343 Industries", 1)}
+
+
+def test_unreadable_body(client, headers):
+    response = client.post("/games/import", data="not json", content_type="application/json", headers=headers)
+    assert response.status_code == 400
+
+
+def test_cli_import(app, tmp_path):
+    path = tmp_path / "games.csv"
+    path.write_text(CSV, encoding="utf-8")
+    runner = app.test_cli_runner()
+    for _ in range(2):
+        result = runner.invoke(args=["db_commands", "import-games", str(path)])
+        assert result.exit_code == 0, result.output
+        assert "Imported 3 games from 3 rows" in result.output
+    assert len(catalogue()) == 3
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+from init import db
+from models.concurrency import ConcurrencyChange
+from services import concurrency_series
+
+
+def post_session(client, headers, start, end):
+    body = {"game_id": 1, "start_time": start.isoformat(), "end_time": end.isoformat()}
+    response = client.post("/sessions", json=body, headers=headers)
+    assert response.status_code == 201, response.json
+    return response.json["id"]
+
+
+def peaks(start, end, now):
+    return [point["peak"] for point in concurrency_series.series(1, start, end, "minute", now=now)]
+
+
+def test_sessions_are_counted_before_and_after_folding(client, headers, game):
+    now = datetime.now().replace(second=0, microsecond=0)
+    start = now - timedelta(hours=2)
+    post_session(client, headers, start, start + timedelta(minutes=30))
+    post_session(client, headers, start + timedelta(minutes=10), start + timedelta(minutes=20))
+    # Still online after the cutoff, so part of it is carried over to the next fold
+    post_session(client, headers, now - timedelta(minutes=5), now + timedelta(minutes=5))
+
+    expected = [1] * 10 + [2] * 10 + [1] * 10 + [0] * 10
+    assert peaks(start, start + timedelta(minutes=40), now) == expected
+    recent = peaks(now - timedelta(minutes=10), now + timedelta(minutes=10), now)
+    assert recent == [0] * 5 + [1] * 10 + [0] * 5
+
+    assert concurrency_series.fold_changes(now) == 1
+    db.session.expire_all()
+    assert peaks(start, start + timedelta(minutes=40), now) == expected
+    assert peaks(now - timedelta(minutes=10), now + timedelta(minutes=10), now) == recent
+    # Only the carried count and the later session end are left to fold
+    assert sorted((change.minute, change.delta) for change in ConcurrencyChange.query) == [
+        (concurrency_series._minute(now), 1),
+        (concurrency_series._minute(now + timedelta(minutes=5)), -1),
+    ]
+
+
+def test_deleted_session_is_taken_out(client, headers, game):
+    now = datetime.now().replace(second=0, microsecond=0)
+    start = now - timedelta(hours=1)
+    post_session(client, headers, start, start + timedelta(minutes=20))
+    session_id = post_session(client, headers, start + timedelta(minutes=10), start + timedelta(minutes=20))
+    concurrency_series.fold_changes(now)
+
+    assert client.delete(f"/sessions/{session_id}", headers=headers).status_code == 200
+    assert peaks(start, start + timedelta(minutes=30), now) == [1] * 20 + [0] * 10
+
+
+def test_rebuild_gives_the_same_series(client, headers, game):
+    now = datetime.now().replace(second=0, microsecond=0)
+    start = now - timedelta(hours=3)
+    for offset in range(0, 60, 7):
+        post_session(client, headers, start + timedelta(minutes=offset), start + timedelta(minutes=offset + 25))
+    before = peaks(start, start + timedelta(hours=2), now)
+
+    concurrency_series.rebuild()
+    db.session.expire_all()
+    assert ConcurrencyChange.query.count() == 0
+    assert peaks(start, start + timedelta(hours=2), now) == before
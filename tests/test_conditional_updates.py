@@ -0,0 +1,61 @@
+import pytest
+
+
+@pytest.fixture
+def genre(client, headers):
+    response = client.post("/genres", json={"name": "Action"}, headers=headers)
+    assert response.headers["ETag"] == '"1"'
+    return response
+
+
+def put(client, headers, if_match, name="Adventure"):
+    if if_match is not None:
+        headers = {**headers, "If-Match": if_match}
+    return client.put("/genres/1", json={"name": name}, headers=headers)
+
+
+def test_update_with_the_current_etag(client, headers, genre):
+    response = put(client, headers, genre.headers["ETag"])
+    assert response.status_code == 200
+    assert response.json["name"] == "Adventure"
+    assert response.headers["ETag"] == '"2"'
+    assert client.get("/genres/1", headers=headers).headers["ETag"] == '"2"'
+
+
+def test_missing_if_match(client, headers, genre):
+    assert put(client, headers, None).status_code == 428
+    assert client.get("/genres/1", headers=headers).json["name"] == "Action"
+
+
+@pytest.mark.parametrize("if_match", ['"2"', 'W/"1"', "1", '"one"'])
+def test_stale_or_weak_etag(client, headers, genre, if_match):
+    assert put(client, headers, if_match).status_code == 412
+    assert client.get("/genres/1", headers=headers).json["name"] == "Action"
+
+
+def test_lost_update_is_refused(client, headers, genre):
+    # Two clients read version 1; the second to save is told to read again
+    read = genre.headers["ETag"]
+    assert put(client, headers, read, "Adventure").status_code == 200
+    assert put(client, headers, read, "Arcade").status_code == 412
+    assert client.get("/genres/1", headers=headers).json["name"] == "Adventure"
+
+
+def test_any_of_several_etags_or_a_wildcard(client, headers, genre):
+    assert put(client, headers, '"7", "1"', "Adventure").status_code == 200
+    assert put(client, headers, "*", "Arcade").status_code == 200
+    assert client.get("/genres/1", headers=headers).headers["ETag"] == '"3"'
+
+
+def test_missing_record(client, headers):
+    assert put(client, headers, '"1"').status_code == 404
+
+
+def test_game_update(client, headers, game):
+    etag = client.get("/games/1", headers=headers).headers["ETag"]
+    response = client.patch("/games/1", json={"title": "Fortnite 2"}, headers=headers)
+    assert response.status_code == 428
+    response = client.patch("/games/1", json={"title": "Fortnite 2"}, headers={**headers, "If-Match": etag})
+    assert response.status_code == 200
+    response = client.patch("/games/1", json={"title": "Fortnite 3"}, headers={**headers, "If-Match": etag})
+    assert response.status_code == 412
@@ -0,0 +1,75 @@
+import pytest
+
+from init import db
+from models.idempotency_record import IdempotencyRecord
+from models.score import Score
+from services import idempotency
+
+
+@pytest.fixture(params=[False, True], ids=["memory", "shared"])
+def shared(request, app):
+    # Run each test with responses kept in memory only, and also in the shared table
+    app.config["IDEMPOTENCY_SHARED_STORE"] = request.param
+    return request.param
+
+
+def count(model):
+    return db.session.scalar(db.select(db.func.count()).select_from(model))
+
+
+def test_retry_replays_the_first_response(client, headers, game, shared, monkeypatch):
+    request = {"json": {"value": 100, "game_id": 1}, "headers": {**headers, "Idempotency-Key": "key-1"}}
+    first = client.post("/scores", **request)
+    assert first.status_code == 201
+    assert "Idempotent-Replayed" not in first.headers
+
+    if shared:
+        # Another worker, which has nothing in memory, finds the response in the table
+        assert count(IdempotencyRecord) == 1
+        monkeypatch.setattr(idempotency, "store", idempotency.IdempotencyStore())
+    retry = client.post("/scores", **request)
+    assert retry.status_code == 201
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json == first.json
+    assert count(Score) == 1
+
+
+def test_client_errors_are_replayed(client, headers, game, shared):
+    request = {"json": {"value": "high", "game_id": 1}, "headers": {**headers, "Idempotency-Key": "key-1"}}
+    assert client.post("/scores", **request).status_code == 400
+    retry = client.post("/scores", **request)
+    assert retry.status_code == 400
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+
+def test_key_reused_for_a_different_request(client, headers, game, shared):
+    key = {**headers, "Idempotency-Key": "key-1"}
+    assert client.post("/scores", json={"value": 100, "game_id": 1}, headers=key).status_code == 201
+    response = client.post("/scores", json={"value": 200, "game_id": 1}, headers=key)
+    assert response.status_code == 422
+    assert count(Score) == 1
+
+
+def test_keys_are_scoped_by_user_and_endpoint(client, register, headers, game, shared):
+    other = register("other@example.com", "Other")
+    body = {"value": 100, "game_id": 1}
+    assert client.post("/scores", json=body, headers={**headers, "Idempotency-Key": "key-1"}).status_code == 201
+    response = client.post("/scores", json=body, headers={**other, "Idempotency-Key": "key-1"})
+    assert response.status_code == 201
+    assert "Idempotent-Replayed" not in response.headers
+    response = client.post("/sessions", json={"game_id": 1}, headers={**headers, "Idempotency-Key": "key-1"})
+    assert response.status_code == 201
+    assert count(Score) == 2
+
+
+def test_requests_without_a_key_are_not_deduplicated(client, headers, game, shared):
+    for _ in range(2):
+        assert client.post("/scores", json={"value": 100, "game_id": 1}, headers=headers).status_code == 201
+    assert count(Score) == 2
+
+
+def test_key_too_long(client, headers, game):
+    key = "k" * (idempotency.MAX_KEY_LENGTH + 1)
+    response = client.post("/scores", json={"value": 100, "game_id": 1}, headers={**headers, "Idempotency-Key": key})
+    assert response.status_code == 400
+    assert count(Score) == 0
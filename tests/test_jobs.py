@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from init import db
+from models.job import Job, STATUS_QUEUED, STATUS_FINISHED, STATUS_FAILED
+from services import jobs
+
+# Attempts made by the test task, which fails until it has been called `failures` times
+calls = []
+
+
+@jobs.task("test.flaky", max_attempts=3)
+def flaky(job, failures):
+    calls.append(job.id)
+    if len(calls) <= failures:
+        raise RuntimeError("not yet")
+    return {"calls": len(calls)}
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    calls.clear()
+
+
+def run_due():
+    # Claim and run every job that is due, as a worker would; returns how many ran
+    count = 0
+    while (job := jobs.claim("test-worker")) is not None:
+        jobs.run(job)
+        count += 1
+    return count
+
+
+def make_due(job):
+    job.run_at = datetime.now()
+    db.session.commit()
+
+
+def test_job_is_retried_with_backoff(app):
+    job = jobs.enqueue("test.flaky", failures=1)
+    db.session.commit()
+    assert run_due() == 1
+    assert job.status == STATUS_QUEUED
+    assert job.attempts == 1
+    assert job.last_error == "RuntimeError: not yet"
+    assert job.run_at > datetime.now() + timedelta(seconds=jobs.DEFAULT_BACKOFF * 0.8)
+    assert run_due() == 0  # Not due again yet
+
+    make_due(job)
+    assert run_due() == 1
+    assert (job.status, job.attempts, job.result) == (STATUS_FINISHED, 2, {"calls": 2})
+    assert job.finished_at is not None
+
+
+def test_job_fails_after_max_attempts(app):
+    job = jobs.enqueue("test.flaky", failures=10)
+    db.session.commit()
+    for _ in range(3):
+        make_due(job)
+        assert run_due() == 1
+    assert (job.status, job.attempts) == (STATUS_FAILED, 3)
+    assert job.finished_at is not None
+
+
+def test_scheduled_job_waits(app):
+    jobs.enqueue("test.flaky", delay=60, failures=0)
+    db.session.commit()
+    assert run_due() == 0
+    assert calls == []
+
+
+def test_stale_job_is_requeued(app):
+    job = jobs.enqueue("test.flaky", failures=0)
+    db.session.commit()
+    assert jobs.claim("crashed-worker").id == job.id
+    assert jobs.requeue_stale() == 0
+    job.locked_at = datetime.now() - timedelta(seconds=jobs.DEFAULT_LOCK_TIMEOUT + 1)
+    db.session.commit()
+    assert jobs.requeue_stale() == 1
+    db.session.refresh(job)
+    assert (job.status, job.locked_by) == (STATUS_QUEUED, None)
+
+
+def test_unknown_task(app):
+    with pytest.raises(KeyError):
+        jobs.enqueue("test.missing")
+
+
+def test_purge_finished(app):
+    old = jobs.enqueue("test.flaky", failures=0)
+    queued = jobs.enqueue("test.flaky", delay=60, failures=0)
+    db.session.commit()
+    run_due()
+    old.finished_at = datetime.now() - timedelta(days=8)
+    db.session.commit()
+    assert jobs.purge_finished(7) == 1
+    assert db.session.scalars(db.select(Job.id)).all() == [queued.id]
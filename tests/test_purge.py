@@ -0,0 +1,51 @@
+from init import db
+from models.job import STATUS_QUEUED, STATUS_FINISHED
+from services import jobs
+
+
+def run_due():
+    # Claim and run every job that is due, as a worker would
+    while (job := jobs.claim("test-worker")) is not None:
+        jobs.run(job)
+
+
+def test_background_game_delete(app, client, headers, game):
+    app.config["PURGE_CHUNK_SIZE"] = 2
+    for value in range(5):
+        client.post("/scores", json={"value": value, "game_id": 1}, headers=headers)
+        client.post("/sessions", json={"game_id": 1}, headers=headers)
+
+    response = client.delete("/games/1?async=true", headers=headers)
+    assert response.status_code == 202
+    assert response.headers["Location"] == f"/purge-jobs/{response.json['job']['id']}"
+    assert response.json["job"]["status"] == STATUS_QUEUED
+    assert client.get(response.headers["Location"], headers=headers).json["status"] == STATUS_QUEUED
+
+    # Run it with the same worker loop as `flask worker --burst`
+    db.session.remove()
+    jobs.run_worker(app, burst=True)
+
+    job = client.get(response.headers["Location"], headers=headers).json
+    assert job["status"] == STATUS_FINISHED
+    assert job["result"]["deleted"]["scores"] == 5
+    assert job["result"]["deleted"]["sessions"] == 5
+    assert job["result"]["deleted"]["games"] == 1
+    assert client.get("/games/1", headers=headers).status_code == 404
+
+
+def test_background_user_delete_can_be_followed(client, register, headers, game):
+    other = register("other@example.com", "Other")
+    client.post("/scores", json={"value": 100, "game_id": 1}, headers=headers)
+    response = client.delete("/users/1?async=true", headers=headers)
+    assert response.status_code == 202
+    location = response.headers["Location"]
+
+    assert client.get(location, headers=other).status_code == 401
+    assert client.get("/purge-jobs/99", headers=headers).status_code == 404
+
+    run_due()
+    # The user is gone, but can still read the job they started
+    assert client.get("/users/1", headers=other).status_code == 404
+    job = client.get(location, headers=headers).json
+    assert job["status"] == STATUS_FINISHED
+    assert job["result"]["deleted"]["users"] == 1
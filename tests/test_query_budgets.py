@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from services import query_budget
+
+# Query budgets of every GET route, checked the way `flask db_commands check-query-plans`
+# checks them: the database is seeded at the baseline's scale, each route is called, and
+# its statements, most repeats of one statement (N+1 queries), sequential scans of scores
+# and sessions, and planner cost are compared with query_budgets.json.
+# Costs are only measured on PostgreSQL, so the tests are skipped unless
+# QUERY_BUDGET_DATABASE_URL points at a PostgreSQL database. It is emptied first, so use
+# a scratch one:
+#     QUERY_BUDGET_DATABASE_URL=postgresql://localhost/budgets python -m pytest tests
+# After a change that is meant to move a budget, write the new ones with
+# `flask db_commands check-query-plans --update` against the same kind of database.
+
+DATABASE_URL = os.environ.get("QUERY_BUDGET_DATABASE_URL", "")
+
+pytestmark = pytest.mark.skipif(
+    not DATABASE_URL.startswith("postgresql"),
+    reason="QUERY_BUDGET_DATABASE_URL is not set to a PostgreSQL database",
+)
+
+BASELINE = query_budget.load_baseline()
+
+
+@pytest.fixture(scope="module")
+def results():
+    # Every GET route measured once against a freshly seeded database
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("DATABASE_URL", DATABASE_URL)
+        if not os.environ.get("JWT_SECRET_KEY"):
+            patch.setenv("JWT_SECRET_KEY", "query-budget-tests-secret-key-for-tokens")
+
+        from init import db
+        from main import create_app
+        from services.repository import query_stats
+
+        app = create_app()
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            query_budget.seed(BASELINE["scale"])
+            query_stats.reset()
+            yield query_budget.measure(app)
+            db.session.remove()
+
+
+@pytest.mark.parametrize("endpoint", sorted(BASELINE["endpoints"]))
+def test_route_within_budget(results, endpoint):
+    assert endpoint in results, f"{endpoint} has a budget but is no longer a GET route"
+    result = results[endpoint]
+    assert result["path"] is not None, f"{endpoint} was not called: {result['skipped']}"
+    problems = query_budget.check({endpoint: result}, BASELINE)
+    assert not problems, "; ".join(problem for _, problem in problems)
+
+
+def test_every_route_has_a_budget(results):
+    missing = sorted(set(results) - set(BASELINE["endpoints"]))
+    assert not missing, f"No budget for {', '.join(missing)}; run check-query-plans with --update"
@@ -0,0 +1,57 @@
+import pytest
+
+from init import db
+from services.query_budget import capture
+
+# Statement counts of the routes that nest related rows, on SQLite. Each route is called
+# with one player's history and again after more players have added theirs: a route that
+# loads a relationship row by row (an N+1 query) runs more statements the second time.
+# The PostgreSQL budgets of every route are checked by test_query_budgets.py.
+
+ROUTES = [
+    "/games",
+    "/games/1",
+    "/genres",
+    "/genres/1",
+    "/developers",
+    "/developers/1",
+    "/users",
+    "/users/1",
+    "/auth/users",
+    "/achievements",
+    "/scores",
+    "/sessions",
+    "/games/1/ratings",
+]
+
+
+def add_history(client, headers, user_id, count=1, achievement="First win"):
+    # Scores, sessions and an achievement for one player in game 1
+    for value in range(count):
+        assert client.post("/scores", json={"value": 100 + value, "game_id": 1}, headers=headers).status_code == 201
+        assert client.post("/sessions", json={"game_id": 1}, headers=headers).status_code == 201
+    body = {"name": achievement, "description": "Win a match", "user_id": user_id, "game_id": 1}
+    assert client.post("/achievements", json=body, headers=headers).status_code == 201
+
+
+def count_statements(client, headers, path):
+    # Statements run by a warm call of the route, with nothing left in the session
+    client.get(path, headers=headers)
+    db.session.expunge_all()
+    with capture() as statements:
+        response = client.get(path, headers=headers)
+    assert response.status_code == 200, (path, response.json)
+    return len(statements)
+
+
+@pytest.mark.parametrize("path", ROUTES)
+def test_statements_do_not_grow_with_rows(client, headers, register, game, path):
+    add_history(client, headers, 1)
+    before = count_statements(client, headers, path)
+
+    for number in range(2, 5):
+        add_history(client, register(f"player{number}@example.com", f"Player {number}"), number)
+    add_history(client, headers, 1, count=3, achievement="Hat trick")
+    after = count_statements(client, headers, path)
+
+    assert after == before, f"{path} ran {before} statements with one player and {after} with four"
@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from init import db
+from models.rating import Rating, ScoreStats, INITIAL_RATING
+from services import ratings
+
+
+def stored():
+    # Ratings and game statistics as they are in the database
+    rows = {
+        (row.user_id, row.game_id): (row.rating, row.games, row.updated_at)
+        for row in db.session.scalars(db.select(Rating))
+    }
+    stats = {row.game_id: (row.count, row.mean, row.m2) for row in db.session.scalars(db.select(ScoreStats))}
+    return rows, stats
+
+
+def test_rebuild_matches_incremental_ratings(client, register, headers, game):
+    client.post("/games", json={"title": "Rocket League", "genre_id": 1, "developer_id": 1}, headers=headers)
+    players = [headers] + [register(f"player{number}@example.com", f"Player {number}") for number in range(4)]
+    generator = random.Random(7)
+    for _ in range(60):
+        player = generator.randrange(len(players))
+        body = {"value": int(generator.gauss(1000 + 100 * player, 150)), "game_id": generator.choice([1, 2])}
+        assert client.post("/scores", json=body, headers=players[player]).status_code == 201
+
+    incremental_ratings, incremental_stats = stored()
+    assert len(incremental_stats) == 2
+    assert ratings.rebuild() == 60
+    rebuilt_ratings, rebuilt_stats = stored()
+
+    assert rebuilt_ratings.keys() == incremental_ratings.keys()
+    for key, (rating, games, updated_at) in incremental_ratings.items():
+        assert rebuilt_ratings[key][0] == pytest.approx(rating, abs=1e-6)
+        assert rebuilt_ratings[key][1:] == (games, updated_at)
+    for game_id, stats in incremental_stats.items():
+        assert rebuilt_stats[game_id] == pytest.approx(stats, rel=1e-9)
+
+
+def test_better_players_rate_higher(client, register, headers, game):
+    weak, strong = headers, register("strong@example.com", "Strong")
+    for value in range(20):
+        client.post("/scores", json={"value": 100 + value, "game_id": 1}, headers=weak)
+        client.post("/scores", json={"value": 500 + value, "game_id": 1}, headers=strong)
+
+    body = client.get("/games/1/ratings").json
+    assert [row["user"]["name"] for row in body["ratings"]] == ["Strong", "Player"]
+    assert body["ratings"][0]["rating"] > INITIAL_RATING > body["ratings"][1]["rating"]
+
+
+def test_rebuild_without_scores(app):
+    assert ratings.rebuild() == 0
+    assert stored() == ({}, {})
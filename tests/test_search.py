@@ -0,0 +1,85 @@
+import pytest
+
+from services.search import PrefixTrie
+
+
+@pytest.fixture
+def catalogue(client, headers, game):
+    # Fortnite by Epic Games (Action) from the game fixture, and a few more
+    client.post("/genres", json={"name": "Adventure"}, headers=headers)
+    client.post("/developers", json={"name": "Ubisoft"}, headers=headers)
+    for title in ("Assassin's Creed", "Assassin's Creed II", "Creed Champions", "Call of Duty"):
+        response = client.post("/games", json={"title": title, "genre_id": 2, "developer_id": 2}, headers=headers)
+        assert response.status_code == 201
+
+
+def search(client, **params):
+    response = client.get("/search", query_string=params)
+    assert response.status_code == 200
+    return response.json
+
+
+def names(results):
+    return [result["name"] for result in results]
+
+
+def test_word_prefixes_are_ranked(client, catalogue):
+    results = search(client, q="creed")["results"]
+    # A full-name prefix ranks above a later word, then names are alphabetical
+    assert names(results) == ["Creed Champions", "Assassin's Creed", "Assassin's Creed II"]
+    assert [result["rank"] for result in results] == [0.75, 0.5, 0.5]
+
+
+def test_exact_match_ranks_first(client, catalogue):
+    results = search(client, q="Call  of DUTY")["results"]
+    assert results == [{"type": "game", "id": 5, "name": "Call of Duty", "rank": 1.0}]
+
+
+def test_every_word_must_match(client, catalogue):
+    assert names(search(client, q="ass ii")["results"]) == ["Assassin's Creed II"]
+    assert search(client, q="creed duty")["results"] == []
+
+
+def test_type_filter_and_pages(client, catalogue):
+    assert search(client, q="a", type="genre")["results"] == [
+        {"type": "genre", "id": 1, "name": "Action", "rank": 0.75},
+        {"type": "genre", "id": 2, "name": "Adventure", "rank": 0.75},
+    ]
+    first = search(client, q="a", type="game,genre", per_page=2)
+    second = search(client, q="a", type="game,genre", per_page=2, page=2)
+    assert first["has_more"] is True
+    assert not set(names(first["results"])) & set(names(second["results"]))
+
+
+def test_autocomplete_is_alphabetical(client, catalogue):
+    response = client.get("/search/autocomplete", query_string={"q": "AS"})
+    assert response.json["suggestions"] == [
+        {"type": "game", "id": 2, "name": "Assassin's Creed"},
+        {"type": "game", "id": 3, "name": "Assassin's Creed II"},
+    ]
+    response = client.get("/search/autocomplete", query_string={"q": "e", "type": "developer", "limit": 1})
+    assert response.json["suggestions"] == [{"type": "developer", "id": 1, "name": "Epic Games"}]
+
+
+def test_new_names_are_found_straight_away(client, headers, catalogue):
+    assert search(client, q="assault")["results"] == []
+    client.post("/games", json={"title": "Assault Horizon", "genre_id": 1, "developer_id": 1}, headers=headers)
+    assert names(search(client, q="assault")["results"]) == ["Assault Horizon"]
+    client.patch("/genres/2", json={"name": "Arcade"}, headers={**headers, "If-Match": "*"})
+    assert names(search(client, q="arcade", type="genre")["results"]) == ["Arcade"]
+
+
+@pytest.mark.parametrize("path", ["/search", "/search/autocomplete"])
+@pytest.mark.parametrize("params", [{}, {"q": "  "}, {"q": "creed", "type": "player"}])
+def test_invalid_queries(client, path, params):
+    assert client.get(path, query_string=params).status_code == 400
+
+
+def test_trie_keeps_the_first_names_per_prefix():
+    trie = PrefixTrie(top_k=2)
+    for key in ("alpha", "alpine", "alps", "beta alpha"):
+        trie.insert(key, key)
+    assert trie.complete("alp") == ["alpha", "alpine"]
+    assert trie.matches("alp") == {"alpha", "alpine", "alps", "beta alpha"}
+    assert trie.complete("gamma") == []
+    assert trie.matches("gamma") == set()
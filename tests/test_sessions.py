@@ -0,0 +1,27 @@
+import pytest
+
+
+@pytest.mark.parametrize("start_time, end_time", [
+    ("2024-05-01T12:00:00", "2024-05-01T11:00:00"),
+    ("2024-05-01T12:00:00", "2024-05-01T12:00:00"),
+    (None, "2024-05-01T12:00:00"),  # start_time defaults to now
+])
+def test_create_rejects_end_time_not_after_start_time(client, headers, game, start_time, end_time):
+    body = {"game_id": 1, "start_time": start_time, "end_time": end_time}
+    response = client.post("/sessions", json={key: value for key, value in body.items() if value}, headers=headers)
+    assert response.status_code == 400
+    assert response.json == {"message": "end_time must be after start_time"}
+    assert client.get("/sessions", headers=headers).json == []
+
+
+def test_create_with_end_time(client, headers, game):
+    body = {"game_id": 1, "start_time": "2024-05-01T12:00:00", "end_time": "2024-05-01T13:30:00"}
+    response = client.post("/sessions", json=body, headers=headers)
+    assert response.status_code == 201
+    assert response.json["end_time"].startswith("2024-05-01T13:30:00")
+
+
+def test_end_rejects_end_time_not_after_start_time(client, headers, game):
+    session = client.post("/sessions", json={"game_id": 1, "start_time": "2024-05-01T12:00:00"}, headers=headers).json
+    response = client.patch(f"/sessions/{session['id']}", json={"end_time": "2024-05-01T11:00:00"}, headers=headers)
+    assert response.status_code == 400
@@ -0,0 +1,59 @@
+import pytest
+
+from init import db
+from models.score import Score
+from models.session import Session
+from services import outbox
+from services.sharding import shards
+
+
+@pytest.fixture(autouse=True)
+def shard_urls(tmp_path, monkeypatch):
+    # Two SQLite shards, set before the app is created
+    urls = ",".join(f"shard{number}=sqlite:///{tmp_path / f'shard{number}.db'}" for number in range(2))
+    monkeypatch.setenv("SHARD_DATABASE_URLS", urls)
+
+
+@pytest.fixture
+def app(app):
+    shards.create_all()
+    yield app
+    for engine in shards.engines.values():
+        engine.dispose()
+
+
+@pytest.mark.parametrize("path", ["/scores", "/sessions"])
+@pytest.mark.parametrize("game_id", ["1", True, None])
+def test_game_id_must_be_an_integer(client, headers, game, path, game_id):
+    response = client.post(path, json={"value": 100, "game_id": game_id}, headers=headers)
+    assert response.status_code == 400
+    assert response.json == {"message": "game_id must be an integer"}
+
+
+@pytest.mark.parametrize("path, model, body", [
+    ("/scores", Score, {"value": 100, "game_id": 1}),
+    ("/sessions", Session, {"game_id": 1}),
+])
+def test_retry_reuses_the_row_left_on_its_shard(client, headers, game, monkeypatch, path, model, body):
+    # The first attempt commits the row on its shard, then fails before the main database commits
+    record = outbox.record
+
+    def fail_once(*args, **kwargs):
+        monkeypatch.setattr(outbox, "record", record)
+        raise RuntimeError("main database unavailable")
+
+    monkeypatch.setattr(outbox, "record", fail_once)
+    request = {"json": body, "headers": {**headers, "Idempotency-Key": "retry-1"}}
+    with pytest.raises(RuntimeError):
+        client.post(path, **request)
+    db.session.rollback()
+    assert len(shards.select(model)) == 1
+
+    response = client.post(path, **request)
+    assert response.status_code == 201
+    assert [row.id for row in shards.select(model)] == [response.json["id"]]
+
+    # Another key is another request
+    response = client.post(path, json=body, headers={**headers, "Idempotency-Key": "retry-2"})
+    assert response.status_code == 201
+    assert len(shards.select(model)) == 2
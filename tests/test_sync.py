@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from services import sync
+
+
+@pytest.fixture(autouse=True)
+def no_settle(app):
+    # Sync up to now, so rows written by the test are in the next sync straight away
+    app.config["SYNC_SETTLE_SECONDS"] = 0
+
+
+def get_sync(client, headers, since=None, limit=None):
+    params = {key: value for key, value in (("since", since), ("limit", limit)) if value is not None}
+    response = client.get("/sync", query_string=params, headers=headers)
+    assert response.status_code == 200
+    return response.json
+
+
+def ids(rows):
+    return [row["id"] for row in rows]
+
+
+def test_first_sync_returns_everything_of_the_player(client, register, headers, game):
+    other = register("other@example.com", "Other")
+    client.post("/scores", json={"value": 100, "game_id": 1}, headers=headers)
+    client.post("/scores", json={"value": 200, "game_id": 1}, headers=other)
+
+    body = get_sync(client, headers)
+    assert body["has_more"] is False
+    assert ids(body["changes"]["genres"]) == [1]
+    assert ids(body["changes"]["developers"]) == [1]
+    assert body["changes"]["games"] == [{"id": 1, "title": "Fortnite", "genre": {"id": 1, "name": "Action"}, "developer": {"id": 1, "name": "Epic Games"}}]
+    assert [score["value"] for score in body["changes"]["scores"]] == [100]
+    assert all(not deleted for deleted in body["deleted"].values())
+
+
+def test_next_sync_returns_only_changes_and_deletes(client, register, headers, game):
+    other = register("other@example.com", "Other")
+    session = client.post("/sessions", json={"game_id": 1}, headers=headers).json
+    since = get_sync(client, headers)["next"]
+
+    score = client.post("/scores", json={"value": 300, "game_id": 1}, headers=headers).json
+    client.post("/scores", json={"value": 400, "game_id": 1}, headers=other)
+    assert client.delete(f"/sessions/{session['id']}", headers=headers).status_code == 200
+
+    body = get_sync(client, headers, since)
+    assert body["has_more"] is False
+    assert ids(body["changes"]["scores"]) == [score["id"]]
+    assert body["changes"]["games"] == []
+    assert body["changes"]["sessions"] == []
+    assert body["deleted"]["sessions"] == [session["id"]]
+
+    # Nothing has changed since
+    body = get_sync(client, headers, body["next"])
+    assert all(not rows for rows in body["changes"].values())
+    assert all(not deleted for deleted in body["deleted"].values())
+
+
+def test_deleted_game_leaves_a_tombstone(client, headers, game):
+    since = get_sync(client, headers)["next"]
+    assert client.delete("/games/1", headers=headers).status_code == 200
+    assert get_sync(client, headers, since)["deleted"]["games"] == [1]
+
+
+def test_pages_cover_every_row_once(client, headers, game):
+    for value in range(5):
+        client.post("/scores", json={"value": value, "game_id": 1}, headers=headers)
+    expected = get_sync(client, headers)
+
+    changes = {name: [] for name in expected["changes"]}
+    since = None
+    for _ in range(20):
+        body = get_sync(client, headers, since, limit=2)
+        assert sum(len(rows) for rows in body["changes"].values()) <= 2
+        for name, rows in body["changes"].items():
+            changes[name] += rows
+        since = body["next"]
+        if not body["has_more"]:
+            break
+    assert changes == expected["changes"]
+
+
+@pytest.mark.parametrize("since, limit, status", [
+    ("not-a-token", None, 400),
+    (sync.encode_token(datetime.now() - timedelta(days=sync.DEFAULT_TOMBSTONE_DAYS + 1)), None, 410),
+    (None, 0, 400),
+    (None, sync.MAX_PAGE_SIZE + 1, 400),
+    (None, "ten", 400),
+])
+def test_invalid_requests(client, headers, since, limit, status):
+    params = {key: value for key, value in (("since", since), ("limit", limit)) if value is not None}
+    assert client.get("/sync", query_string=params, headers=headers).status_code == status